@@ -0,0 +1,669 @@
+"""
+Load test of the driver entry points: calls CustomScriptShellDriver.execute_script / execute_scripts concurrently,
+against local stand-ins of the script repository (http), of linux hosts (ssh, with scp / sftp uploads) and of
+windows hosts (WinRM over http), with injectable latency and failure rates.
+
+    python benchmarks/load_test.py --concurrency 50 200 1000 --hosts 10 --protocols ssh winrm \
+        --latency-ms 5 --failure-rate 0.01 --repository-failure-rate 0.01 --cancel-rate 0.01 \
+        --output load_test.json
+
+For every concurrency level it reports the p50 / p95 / p99 latency of the calls, their throughput and outcomes,
+and samples the thread count, open file descriptors and RSS of the process over time. The summary is written as
+json (--output) with stable keys, so two runs can be compared for regressions.
+
+The CloudShell API and the command logger are replaced by in-process fakes (the API answers DecryptPassword /
+WriteMessageToReservationOutput / GetReservationStatus, the logger writes to stderr at --log-level), everything
+else - governor, downloader, executors - runs as in the driver. Each host is a different loopback address
+(127.0.0.x, linux), the ssh stand-ins listen on ephemeral ports, so paramiko's connect is redirected to them.
+Run it from the repository root (or with the package installed); the high levels need a raised 'ulimit -n'.
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+
+import paramiko
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'package'))
+sys.path.insert(0, os.path.join(_ROOT, 'drivers', 'customscript_shell'))
+
+from cloudshell.shell.core.driver_context import ResourceCommandContext, ReservationContextDetails, \
+    CancellationContext
+
+from cloudshell.cm.customscript import customscript_shell
+from driver import CustomScriptShellDriver
+
+LINUX_SCRIPT = b'#!/bin/sh\necho "load test"\n'
+WINDOWS_SCRIPT = b'Write-Output "load test"\r\n'
+
+
+class _Faults(object):
+    """
+    Latency and failure injection shared by the stand-ins.
+    """
+    def __init__(self, latency_ms, failure_rate, seed):
+        self.latency = latency_ms / 1000.0
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+
+class StandInRepository(object):
+    """
+    Serves the test scripts at /scripts/load.sh and /scripts/load.ps1, failing requests with a 503.
+    """
+    def __init__(self, faults):
+        self.faults = faults
+        self.requests = 0
+        self._lock = threading.Lock()
+        repository = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with repository._lock:
+                    repository.requests += 1
+                repository.faults.delay()
+                if repository.faults.should_fail():
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content = WINDOWS_SCRIPT if self.path.split('?')[0].endswith('.ps1') else LINUX_SCRIPT
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('ETag', '"load-test"')
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s/scripts/' % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _StandInSftpHandle(paramiko.SFTPHandle):
+    def write(self, offset, data):
+        return paramiko.SFTP_OK
+
+
+class _StandInSftp(paramiko.SFTPServerInterface):
+    """
+    Accepts the uploads and discards them.
+    """
+    def open(self, path, flags, attr):
+        return _StandInSftpHandle(flags)
+
+
+class _StandInSshInterface(paramiko.ServerInterface):
+    def __init__(self, host):
+        """
+        :type host: StandInSshHost
+        """
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.host.run_command, args=(channel, command.decode('utf-8')), daemon=True)
+        channel.get_transport().started_on_success[channel.remote_chanid] = thread
+        return True
+
+
+class _StandInTransport(paramiko.Transport):
+    """
+    Starts the command of an exec request once the request is acknowledged: a command that closes its channel
+    before that fails the exec_command of the client ('Channel closed').
+    """
+    def __init__(self, sock):
+        super(_StandInTransport, self).__init__(sock)
+        self.started_on_success = {}
+
+    def _send_user_message(self, data):
+        super(_StandInTransport, self)._send_user_message(data)
+        message = data.asbytes()
+        if message[:1] == paramiko.common.cMSG_CHANNEL_SUCCESS:
+            thread = self.started_on_success.pop(struct.unpack('>I', message[1:5])[0], None)
+            if thread:
+                thread.start()
+
+
+class StandInSshHost(object):
+    """
+    A linux host answering the commands of LinuxScriptExecutor: 'mktemp -d' prints a path, 'scp -t' and sftp accept
+    the upload, the script run fails at the injected rate, every other command succeeds. Each command takes the
+    injected latency.
+    """
+    def __init__(self, address, host_key, faults):
+        self.address = address
+        self.host_key = host_key
+        self.faults = faults
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((address, 0))
+        self._socket.listen(1024)
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            # the handshake blocks, it must not hold up the next connections
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        transport = _StandInTransport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _StandInSftp)
+        with self._lock:
+            self.connections += 1
+            self._transports = [t for t in self._transports if t.is_active()] + [transport]
+        try:
+            transport.start_server(server=_StandInSshInterface(self))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def run_command(self, channel, command):
+        try:
+            if command.startswith('scp ') and ' -t ' in command:
+                self._scp_sink(channel)
+                exit_code, std_out, std_err = 0, '', ''
+            else:
+                if command.startswith('tar ') or 'cat >' in command:
+                    while channel.recv(64 * 1024):
+                        pass
+                self.faults.delay()
+                exit_code, std_out, std_err = self._reply(command)
+            channel.sendall(std_out.encode('utf-8'))
+            channel.sendall_stderr(std_err.encode('utf-8'))
+            channel.send_exit_status(exit_code)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+    def _reply(self, command):
+        if command.startswith('mktemp -d'):
+            return 0, '/tmp/tmp.%s\n' % uuid.uuid4().hex[:10], ''
+        if 'exec sh ' in command and self.faults.should_fail():
+            return 1, '', 'injected failure'
+        return 0, 'load test\n' if 'exec sh ' in command else '', ''
+
+    def _scp_sink(self, channel):
+        channel.sendall(b'\x00')
+        header = b''
+        while not header.endswith(b'\n'):
+            data = channel.recv(1)
+            if not data:
+                return
+            header += data
+        size = int(header.split(b' ')[1])
+        channel.sendall(b'\x00')
+        remaining = size + 1  # the content, then a \0
+        while remaining > 0:
+            data = channel.recv(min(remaining, 64 * 1024))
+            if not data:
+                return
+            remaining -= len(data)
+        channel.sendall(b'\x00')
+        while channel.recv(1024):
+            pass
+
+    def close(self):
+        self._socket.close()
+        with self._lock:
+            for transport in self._transports:
+                transport.close()
+
+
+class StandInWinRmHost(object):
+    """
+    A windows host answering the WS-Management requests of pywinrm (Create / Command / Receive / Signal / Delete),
+    with the same command semantics as StandInSshHost. Each request takes the injected latency.
+    """
+    ENVELOPE = '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" ' \
+               'xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressing" ' \
+               'xmlns:w="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd" ' \
+               'xmlns:rsp="http://schemas.microsoft.com/wbem/wsman/1/windows/shell">' \
+               '<s:Header><a:RelatesTo>%s</a:RelatesTo></s:Header><s:Body>%s</s:Body></s:Envelope>'
+
+    def __init__(self, address, faults):
+        self.faults = faults
+        self.requests = 0
+        self._commands = {}
+        self._lock = threading.Lock()
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                body = host.handle(request).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/soap+xml;charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((address, 0), Handler)
+        self.httpd.daemon_threads = True
+        self.target = '%s:%s' % (address, self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def handle(self, request):
+        with self._lock:
+            self.requests += 1
+        self.faults.delay()
+        action = re.search(r'<a:Action[^>]*>[^<]*/([A-Za-z]+)</a:Action>', request).group(1)
+        if action == 'Create':
+            shell_id = str(uuid.uuid4()).upper()
+            body = '<x:ResourceCreated xmlns:x="http://schemas.xmlsoap.org/ws/2004/09/transfer"><a:ReferenceParameters>' \
+                   '<w:SelectorSet><w:Selector Name="ShellId">%s</w:Selector></w:SelectorSet>' \
+                   '</a:ReferenceParameters></x:ResourceCreated>' % shell_id
+        elif action == 'Command':
+            command_id = str(uuid.uuid4()).upper()
+            with self._lock:
+                self._commands[command_id] = self._reply(request)
+            body = '<rsp:CommandResponse><rsp:CommandId>%s</rsp:CommandId></rsp:CommandResponse>' % command_id
+        elif action == 'Receive':
+            command_id = re.search(r'CommandId="([^"]+)"', request).group(1)
+            with self._lock:
+                exit_code, std_out, std_err = self._commands.pop(command_id, (0, '', ''))
+            body = '<rsp:ReceiveResponse>' \
+                   '<rsp:Stream Name="stdout" CommandId="{0}">{1}</rsp:Stream>' \
+                   '<rsp:Stream Name="stderr" CommandId="{0}">{2}</rsp:Stream>' \
+                   '<rsp:CommandState CommandId="{0}" ' \
+                   'State="http://schemas.microsoft.com/wbem/wsman/1/windows/shell/CommandState/Done">' \
+                   '<rsp:ExitCode>{3}</rsp:ExitCode></rsp:CommandState></rsp:ReceiveResponse>'.format(
+                command_id, base64.b64encode(std_out.encode('utf-8')).decode('ascii'),
+                base64.b64encode(std_err.encode('utf-8')).decode('ascii'), exit_code)
+        elif action == 'Signal':
+            body = '<rsp:SignalResponse/>'
+        else:
+            body = ''
+        return self.ENVELOPE % (re.search(r'<a:MessageID>([^<]+)</a:MessageID>', request).group(1), body)
+
+    def _reply(self, request):
+        command = re.search(r'<rsp:Command>([^<]*)</rsp:Command>', request).group(1)
+        arguments = re.search(r'<rsp:Arguments>([^<]*)</rsp:Arguments>', request)
+        if command.startswith('@echo'):
+            return 0, command[len('@echo '):] + (arguments.group(1) if arguments else '') + '\r\n', ''
+        code = base64.b64decode(command.split('-encodedcommand ')[-1]).decode('utf_16_le')
+        if 'NewGuid' in code:
+            return 0, 'C:\\Temp\\%s\r\n' % uuid.uuid4(), ''
+        if 'Invoke-Expression' in code:
+            if self.faults.should_fail():
+                return 1, '', 'injected failure'
+            return 0, 'load test\r\n', ''
+        return 0, '', ''
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _StandInApi(object):
+    """
+    The CloudShell API calls of the driver.
+    """
+    class _Value(object):
+        def __init__(self, value):
+            self.Value = value
+
+    class _Status(object):
+        def __init__(self, status):
+            self.ReservationSlimStatus = type('ReservationSlimStatus', (object,), {'Status': status})()
+
+    def __init__(self):
+        self.output_messages = 0
+        self._lock = threading.Lock()
+
+    def DecryptPassword(self, value):
+        return _StandInApi._Value(value)
+
+    def WriteMessageToReservationOutput(self, reservation_id, message):
+        with self._lock:
+            self.output_messages += 1
+
+    def GetReservationStatus(self, reservation_id):
+        return _StandInApi._Status('Started')
+
+
+class ResourceSampler(object):
+    """
+    Samples the thread count, open file descriptors and RSS of the process (psutil, or /proc on linux).
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+        self._start_time = None
+        self._thread = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        self.samples.append({'seconds': round(time.perf_counter() - self._start_time, 3),
+                             'threads': threading.active_count(),
+                             'open_fds': self._open_fds(),
+                             'rss_mb': self._rss_mb()})
+
+    def _open_fds(self):
+        if psutil:
+            return psutil.Process().num_fds()
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return None
+
+    def _rss_mb(self):
+        if psutil:
+            rss = psutil.Process().memory_info().rss
+        else:
+            try:
+                with open('/proc/self/statm') as f:
+                    rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except (OSError, ValueError):
+                return None
+        return round(rss / 1024.0 / 1024.0, 2)
+
+    def summary(self):
+        result = {'samples': self.samples}
+        for key in ('threads', 'open_fds', 'rss_mb'):
+            values = [sample[key] for sample in self.samples if sample[key] is not None]
+            result['max_' + key] = max(values) if values else None
+        return result
+
+
+def _percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    index = max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1)
+    return round(values[min(index, len(values) - 1)], 4)
+
+
+def _host_json(host):
+    if host['protocol'] == 'ssh':
+        return {'ip': host['ip'], 'connectionMethod': 'ssh', 'username': 'load', 'password': 'load'}
+    return {'ip': host['ip'], 'connectionMethod': 'winrm', 'username': 'load', 'password': 'load',
+            'parameters': [{'name': 'winrm_transport', 'value': 'http'}]}
+
+
+def _script_json(repository, host):
+    script = 'load.sh' if host['protocol'] == 'ssh' else 'load.ps1'
+    return {'repositoryDetails': {'url': repository.url + script}, 'hostsDetails': [_host_json(host)]}
+
+
+def _command_context(reservation_id):
+    reservation = ReservationContextDetails('load-test', 'load-test', 'Global', '', 'admin', '', reservation_id,
+                                            '', '', 'admin', '')
+    return ResourceCommandContext(None, None, reservation, [])
+
+
+class _Call(object):
+    def __init__(self, index, method, configuration, cancel_after):
+        self.index = index
+        self.method = method
+        self.configuration = configuration
+        self.cancel_after = cancel_after
+
+
+def _make_calls(count, hosts, repository, args, rnd):
+    calls = []
+    for index in range(count):
+        if rnd.random() < args.batch_ratio:
+            batch = [_script_json(repository, rnd.choice(hosts)) for _ in range(args.batch_size)]
+            method, configuration = 'execute_scripts', json.dumps(batch)
+        else:
+            method, configuration = 'execute_script', json.dumps(_script_json(repository, rnd.choice(hosts)))
+        cancel_after = rnd.uniform(0, args.cancel_after_seconds) if rnd.random() < args.cancel_rate else None
+        calls.append(_Call(index, method, configuration, cancel_after))
+    return calls
+
+
+def _run_call(driver, call, level):
+    """
+    :return: (method, seconds, outcome) - outcome is 'ok', 'cancelled' or the error.
+    """
+    cancellation_context = CancellationContext()
+    cancellation_context.is_cancelled = False
+    timer = None
+    if call.cancel_after is not None:
+        timer = threading.Timer(call.cancel_after, setattr, (cancellation_context, 'is_cancelled', True))
+        timer.start()
+    context = _command_context('load-%s-%s' % (level, call.index))
+    start = time.perf_counter()
+    try:
+        getattr(driver, call.method)(context, call.configuration, cancellation_context)
+        outcome = 'ok'
+    except Exception as e:
+        if type(e).__name__ == 'CancellationException':
+            outcome = 'cancelled'
+        else:
+            outcome = '%s: %s' % (type(e).__name__, str(e).strip().split('\n')[0][:120])
+    finally:
+        if timer:
+            timer.cancel()
+    return call.method, time.perf_counter() - start, outcome
+
+
+def _run_level(concurrency, calls, sample_interval):
+    driver = CustomScriptShellDriver()
+    sampler = ResourceSampler(sample_interval)
+    sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda call: _run_call(driver, call, concurrency), calls))
+    wall_seconds = time.perf_counter() - start
+    sampler.stop()
+
+    latencies = sorted(seconds for _, seconds, _ in results)
+    errors = {}
+    for _, _, outcome in results:
+        if outcome not in ('ok', 'cancelled'):
+            errors[outcome] = errors.get(outcome, 0) + 1
+    by_method = {}
+    for method in ('execute_script', 'execute_scripts'):
+        method_latencies = sorted(seconds for m, seconds, _ in results if m == method)
+        if method_latencies:
+            by_method[method] = {'calls': len(method_latencies), 'p50': _percentile(method_latencies, 50),
+                                 'p95': _percentile(method_latencies, 95), 'p99': _percentile(method_latencies, 99)}
+    return {
+        'concurrency': concurrency,
+        'calls': len(results),
+        'succeeded': len([r for r in results if r[2] == 'ok']),
+        'cancelled': len([r for r in results if r[2] == 'cancelled']),
+        'failed': sum(errors.values()),
+        'errors': dict(sorted(errors.items(), key=lambda item: -item[1])),
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_per_second': round(len(results) / wall_seconds, 3) if wall_seconds else None,
+        'latency_seconds': {'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95),
+                            'p99': _percentile(latencies, 99), 'max': _percentile(latencies, 100),
+                            'mean': round(sum(latencies) / len(latencies), 4) if latencies else None},
+        'latency_by_method': by_method,
+        'resources': sampler.summary(),
+    }
+
+
+@contextmanager
+def _stand_in_session(api, logger, ssh_ports):
+    """
+    Replaces the CloudShell API session and the command logger of the driver, and redirects the ssh connections of
+    the stand-in hosts to their ports.
+    """
+    @contextmanager
+    def api_session(command_context):
+        yield api
+
+    @contextmanager
+    def logging_session(command_context):
+        yield logger
+
+    ssh_connect = paramiko.SSHClient.connect
+
+    def connect(client, hostname, *args, **kwargs):
+        if hostname in ssh_ports:
+            kwargs['port'] = ssh_ports[hostname]
+            kwargs.setdefault('look_for_keys', False)
+            kwargs.setdefault('allow_agent', False)
+        return ssh_connect(client, hostname, *args, **kwargs)
+
+    with patch.object(customscript_shell, 'CloudShellSessionContext', api_session), \
+            patch.object(customscript_shell, 'LoggingSessionContext', logging_session), \
+            patch.object(paramiko.SSHClient, 'connect', connect):
+        yield
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--calls', type=int, default=None, help='Calls per level (default: 2 x the concurrency).')
+    parser.add_argument('--hosts', type=int, default=10, help='Stand-in hosts per protocol.')
+    parser.add_argument('--protocols', nargs='+', choices=['ssh', 'winrm'], default=['ssh', 'winrm'])
+    parser.add_argument('--batch-ratio', type=float, default=0.2, help='Share of the calls made with execute_scripts.')
+    parser.add_argument('--batch-size', type=int, default=3)
+    parser.add_argument('--latency-ms', type=float, default=5, help='Latency of every ssh / WinRM command.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of the script runs that fail.')
+    parser.add_argument('--repository-latency-ms', type=float, default=5)
+    parser.add_argument('--repository-failure-rate', type=float, default=0.0)
+    parser.add_argument('--cancel-rate', type=float, default=0.0, help='Share of the calls cancelled midway.')
+    parser.add_argument('--cancel-after-seconds', type=float, default=2.0)
+    parser.add_argument('--sample-interval', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='CRITICAL')
+    parser.add_argument('--output', default=None, help='Where the json summary is written (default: stdout).')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr)
+    logger = logging.getLogger('load_test')
+    logger.setLevel(args.log_level)
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    host_faults = _Faults(args.latency_ms, args.failure_rate, args.seed)
+    repository = StandInRepository(_Faults(args.repository_latency_ms, args.repository_failure_rate, args.seed + 1))
+    host_key = paramiko.RSAKey.generate(2048)
+    hosts, stand_ins, ssh_ports = [], [], {}
+    for i in range(args.hosts):
+        address = '127.0.0.%s' % (i + 1)
+        if 'ssh' in args.protocols:
+            ssh_host = StandInSshHost(address, host_key, host_faults)
+            stand_ins.append(ssh_host)
+            ssh_ports[address] = ssh_host.port
+            hosts.append({'protocol': 'ssh', 'ip': address})
+        if 'winrm' in args.protocols:
+            winrm_host = StandInWinRmHost(address, host_faults)
+            stand_ins.append(winrm_host)
+            hosts.append({'protocol': 'winrm', 'ip': winrm_host.target})
+
+    api = _StandInApi()
+    rnd = random.Random(args.seed)
+    levels = []
+    try:
+        with _stand_in_session(api, logger, ssh_ports):
+            for concurrency in args.concurrency:
+                calls = _make_calls(args.calls or 2 * concurrency, hosts, repository, args, rnd)
+                # the executors print the commands they run
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    level = _run_level(concurrency, calls, args.sample_interval)
+                levels.append(level)
+                latency = level['latency_seconds']
+                print('concurrency %5s  calls %6s  ok %6s  failed %6s  cancelled %5s  p50 %8.3fs  p95 %8.3fs  '
+                      'p99 %8.3fs  %8.2f calls/s  threads %5s  fds %5s  rss %8s MB' % (
+                          concurrency, level['calls'], level['succeeded'], level['failed'], level['cancelled'],
+                          latency['p50'], latency['p95'], latency['p99'], level['throughput_per_second'],
+                          level['resources']['max_threads'], level['resources']['max_open_fds'],
+                          level['resources']['max_rss_mb']), file=sys.stderr)
+    finally:
+        repository.close()
+        for stand_in in stand_ins:
+            stand_in.close()
+
+    summary = {
+        'configuration': {key: value for key, value in vars(args).items() if key not in ('output', 'log_level')},
+        'stand_ins': {'repository_requests': repository.requests,
+                      'ssh_connections': sum(getattr(s, 'connections', 0) for s in stand_ins),
+                      'winrm_requests': sum(getattr(s, 'requests', 0) for s in stand_ins),
+                      'reservation_output_messages': api.output_messages},
+        'levels': levels,
+    }
+    text = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Microbenchmarks of the functions that run on every execution with a cost proportional to their input:
+
+    escape                 LinuxScriptExecutor._escape (the value of an environment variable)
+    remove_illegal_chars   ReservationOutputWriter._remove_illegal_chars (the output of a script)
+    windows_copy_script    WindowsScriptExecutor.copy_script (bulks, base64 and powershell code - no WinRM calls)
+    decode_error_xml       WindowsScriptExecutor._try_decode_error_xml (a CLIXML stderr)
+    get_filename           ScriptDownloader._get_filename (a long signed url with many dots and parameters)
+    content_disposition    filename_parser.parse_content_disposition (a header of many escaped quoted strings)
+
+Each target runs on inputs of 1 KB to 100 MB (escape up to 10 MB):
+
+    python benchmarks/microbenchmarks.py --sizes-kb 1 1024 102400 --targets escape get_filename
+    python benchmarks/microbenchmarks.py --save-baseline benchmarks/baselines/microbenchmarks.json
+    python benchmarks/microbenchmarks.py --compare benchmarks/baselines/microbenchmarks.json --threshold 0.3
+
+A target is timed until --min-seconds have passed (at most --max-repeat times) and the best time is kept.
+--compare reports the ratio of every case to the baseline and exits with 1 when a case is slower by more than
+--threshold (or fails where the baseline did not), so an optimization is measured and a regression is caught.
+The inputs of get_filename and content_disposition are adversarial (every '.sh' candidate but the last one is
+rejected, every quoted string is escaped): their MB/s must stay flat from 1 KB to 100 MB - a parser that
+backtracks slows down with the size of its input.
+Baselines are machine specific: compare runs of the same machine.
+Run it from the repository root (or with the package installed).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import urllib.parse
+
+from requests.structures import CaseInsensitiveDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+
+from cloudshell.cm.customscript.domain.filename_parser import parse_content_disposition
+from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_downloader import ScriptDownloader
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.windows_script_executor import WindowsScriptExecutor
+
+DEFAULT_SIZES_KB = [1, 64, 1024, 10 * 1024, 100 * 1024]
+
+
+class _NotCancelled(object):
+    def is_cancelled(self):
+        return False
+
+    def throw_if_canceled(self):
+        pass
+
+
+class _Response(object):
+    def __init__(self, url, headers = None):
+        self.url = url
+        self.headers = CaseInsensitiveDict(headers or {})
+
+
+class _Success(object):
+    status_code = 0
+    std_out = b''
+    std_err = ''
+
+
+def _repeat(text, size):
+    return (text * (size // len(text) + 1))[:size]
+
+
+def _escape(logger, size):
+    executor = LinuxScriptExecutor(logger, HostConfiguration(), _NotCancelled())
+    value = _repeat('value with spaces, "quotes" & symbols ', size)
+    return lambda: executor._escape(value)
+
+
+def _remove_illegal_chars(logger, size):
+    writer = ReservationOutputWriter(None, type('Context', (object,), {
+        'reservation': type('Reservation', (object,), {'reservation_id': 'res1'})()})())
+    output = _repeat('line of script output\n' * 20 + '\x00', size)
+    return lambda: writer._remove_illegal_chars(output)
+
+
+def _windows_host():
+    host = HostConfiguration()
+    host.ip = '127.0.0.1'
+    host.username = 'benchmark'
+    host.password = 'benchmark'
+    host.parameters = {'winrm_transport': 'http'}
+    return host
+
+
+def _windows_copy_script(logger, size):
+    executor = WindowsScriptExecutor(logger, _windows_host(), _NotCancelled())
+    executor._run_cancelable = lambda code, *args, **kwargs: _Success()
+    script_file = ScriptFile('script.ps1', _repeat('Write-Output "some powershell"\r\n', size))
+    return lambda: executor.copy_script('C:\\Temp\\folder', script_file)
+
+
+def _decode_error_xml(logger, size):
+    executor = WindowsScriptExecutor(logger, _windows_host(), _NotCancelled())
+    item = '<S S="Error">Something failed at line 1_x000D__x000A_</S><S S="verbose">details</S>'
+    head = '#< CLIXML\r\n<Objs Version="1.1.0.1" xmlns="http://schemas.microsoft.com/powershell/2004/04">'
+    tail = '</Objs>'
+    body = item * max(1, (size - len(head) - len(tail)) // len(item))
+    return lambda: executor._try_decode_error_xml(head + body + tail)
+
+
+def _get_filename(logger, size):
+    downloader = ScriptDownloader(logger, _NotCancelled())
+    # no script name in the path: every query parameter is scanned up to the last one
+    url = 'https://repo.example.com/a.b/c.d/download.v1?X-Amz-Signature='
+    response = _Response(url + _repeat('a.b&c.d=', max(0, size - len(url) - 16)) + '&file=setup.v1.sh')
+
+    def run():
+        urllib.parse.urlsplit.cache_clear()  # urlsplit caches its results
+        downloader._get_filename(response)
+    return run
+
+
+def _content_disposition(logger, size):
+    header = 'attachment; ' + _repeat('filename="a.sh\\";', max(0, size - 12))
+    return lambda: parse_content_disposition(header)
+
+
+# target: (input factory, largest input in KB - _escape holds a string per character, 100 MB would not fit in memory)
+TARGETS = {
+    'escape': (_escape, 10 * 1024),
+    'remove_illegal_chars': (_remove_illegal_chars, None),
+    'windows_copy_script': (_windows_copy_script, None),
+    'decode_error_xml': (_decode_error_xml, None),
+    'get_filename': (_get_filename, None),
+    'content_disposition': (_content_disposition, None),
+}
+
+
+def _measure(run, min_seconds, max_repeat):
+    """
+    Small inputs are run several times per timing (like timeit's autorange), so each timing spans at least a
+    millisecond and the timer resolution does not add noise.
+    :return: The timings of a single run, in seconds.
+    :rtype list[float]
+    """
+    number = 1
+    while True:
+        run_start = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - run_start
+        if elapsed >= 0.001 or number >= 100000:
+            break
+        number *= 10
+
+    timings = [elapsed / number]
+    start = time.perf_counter()
+    while len(timings) < max_repeat and time.perf_counter() - start < min_seconds:
+        run_start = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append((time.perf_counter() - run_start) / number)
+    return timings
+
+
+def run_benchmarks(targets, sizes_kb, min_seconds, max_repeat):
+    """
+    :rtype dict
+    """
+    logger = logging.getLogger('microbenchmarks')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    cases = {}
+    for target in targets:
+        factory, max_size_kb = TARGETS[target]
+        for size_kb in sizes_kb:
+            if max_size_kb and size_kb > max_size_kb:
+                continue
+            size = int(size_kb * 1024)
+            key = '%s/%s' % (target, size)
+            try:
+                run = factory(logger, size)
+                timings = sorted(_measure(run, min_seconds, max_repeat))
+            except Exception as e:
+                cases[key] = {'target': target, 'size_bytes': size, 'error': '%s: %s' % (type(e).__name__, str(e))}
+                print('%-22s %10s B  error: %s' % (target, size, cases[key]['error']), file=sys.stderr)
+                continue
+            best = timings[0]
+            cases[key] = {'target': target, 'size_bytes': size, 'runs': len(timings),
+                          'best_seconds': round(best, 7), 'median_seconds': round(timings[len(timings) // 2], 7),
+                          'mb_per_second': round(size / best / 1024 / 1024, 2) if best else None}
+            print('%-22s %10s B  best %12.6fs  %10.2f MB/s  (%s runs)' % (
+                target, size, best, cases[key]['mb_per_second'] or 0, len(timings)), file=sys.stderr)
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cases': cases}
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: The comparison of every case, and whether any case regressed.
+    :rtype tuple[list[dict], bool]
+    """
+    report = []
+    regressed = False
+    for key, case in sorted(results['cases'].items()):
+        base = baseline['cases'].get(key)
+        entry = {'case': key, 'baseline_seconds': base and base.get('best_seconds'),
+                 'seconds': case.get('best_seconds'), 'ratio': None}
+        if base is None:
+            entry['status'] = 'new'
+        elif 'error' in case:
+            entry['status'] = 'still failing' if 'error' in base else 'regression (fails)'
+        elif 'error' in base:
+            entry['status'] = 'fixed'
+        else:
+            entry['ratio'] = round(case['best_seconds'] / base['best_seconds'], 3) if base['best_seconds'] else None
+            if entry['ratio'] is not None and entry['ratio'] > 1 + threshold:
+                entry['status'] = 'regression'
+            elif entry['ratio'] is not None and entry['ratio'] < 1 / (1 + threshold):
+                entry['status'] = 'improvement'
+            else:
+                entry['status'] = 'same'
+        regressed = regressed or entry['status'].startswith('regression')
+        report.append(entry)
+    return report, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', nargs='+', choices=sorted(TARGETS), default=sorted(TARGETS))
+    parser.add_argument('--sizes-kb', type=float, nargs='+', default=DEFAULT_SIZES_KB)
+    parser.add_argument('--min-seconds', type=float, default=0.5)
+    parser.add_argument('--max-repeat', type=int, default=50)
+    parser.add_argument('--save-baseline', default=None, help='Where the results are written as the new baseline.')
+    parser.add_argument('--compare', default=None, help='The baseline the results are compared to.')
+    parser.add_argument('--threshold', type=float, default=0.3, help='Slowdown ratio reported as a regression.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.targets, args.sizes_kb, args.min_seconds, args.max_repeat)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if not args.compare:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    report, regressed = compare(results, baseline, args.threshold)
+    for entry in report:
+        print('%-36s %14s %14s %8s  %s' % (
+            entry['case'], '%.6fs' % entry['baseline_seconds'] if entry['baseline_seconds'] is not None else '-',
+            '%.6fs' % entry['seconds'] if entry['seconds'] is not None else '-',
+            '%.3f' % entry['ratio'] if entry['ratio'] is not None else '-', entry['status']), file=sys.stderr)
+    print(json.dumps({'results': results, 'comparison': report, 'regressed': regressed}, indent=2, sort_keys=True))
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the ssh upload backends of LinuxScriptExecutor (scp vs. pipelined sftp) against a real target host.
+
+    python benchmarks/upload_benchmark.py --host 10.0.0.5 --username root --password secret \
+        --sizes-mb 1 10 50 --outstanding 1 16 64 --repeat 3
+
+Run it from the repository root (or with the package installed). High latency links can be simulated on a
+linux target with: tc qdisc add dev eth0 root netem delay 100ms
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+
+from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration, UploadConfiguration
+from cloudshell.cm.customscript.domain.script_file import ScriptBundle
+
+
+class _NotCancelled(object):
+    def is_cancelled(self):
+        return False
+
+    def throw_if_canceled(self):
+        pass
+
+
+def _upload_seconds(host_conf, upload, payload, logger):
+    host_conf.upload = upload
+    executor = LinuxScriptExecutor(logger, host_conf, _NotCancelled())
+    executor.connect()
+    try:
+        tmp_folder = executor.create_temp_folder()
+        try:
+            start = time.perf_counter()
+            executor.copy_script(tmp_folder, payload)
+            return time.perf_counter() - start
+        finally:
+            executor.delete_temp_folder(tmp_folder)
+    finally:
+        executor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', required=True)
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 10])
+    parser.add_argument('--outstanding', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--window-size', type=int, default=None)
+    parser.add_argument('--max-packet-size', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logger = logging.getLogger('upload_benchmark')
+    host_conf = HostConfiguration()
+    host_conf.ip = args.host
+    host_conf.username = args.username
+    host_conf.password = args.password
+
+    backends = [('scp', UploadConfiguration(UploadConfiguration.SCP))]
+    for outstanding in args.outstanding:
+        backends.append(('sftp/%s' % outstanding, UploadConfiguration(
+            UploadConfiguration.SFTP, outstanding, args.window_size, args.max_packet_size)))
+
+    results = []
+    for size_mb in args.sizes_mb:
+        size = int(size_mb * 1024 * 1024)
+        for name, upload in backends:
+            timings = []
+            for _ in range(args.repeat):
+                # a bundle name keeps the payload binary (no text encoding in the measured path)
+                payload = ScriptBundle('payload.bin', os.urandom(size))
+                payload.name = 'payload.bin'
+                timings.append(_upload_seconds(host_conf, upload, payload, logger))
+            best = min(timings)
+            results.append({'backend': name, 'size_bytes': size, 'best_seconds': round(best, 4),
+                            'mb_per_second': round(size / best / 1024 / 1024, 2)})
+            print('%-10s %8.1f MB  best %8.3fs  %8.2f MB/s' % (name, size_mb, best, size / best / 1024 / 1024))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
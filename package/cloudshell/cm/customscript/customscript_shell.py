@@ -1,71 +1,816 @@
-import json
 import os
 
 import errno
 
+import threading
 import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from urllib.parse import urlsplit
+
 from cloudshell.core.context.error_handling_context import ErrorHandlingContext
 from cloudshell.shell.core.session.cloudshell_session import CloudShellSessionContext
 from cloudshell.shell.core.session.logging_session import LoggingSessionContext
 
-from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+from cloudshell.cm.customscript.domain import json_backend
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler, CancellationException, \
+    LinkedCancellationSampler
+from cloudshell.cm.customscript.domain.concurrency_governor import ConcurrencyGovernor, ConcurrencySlot
+from cloudshell.cm.customscript.domain.download_cache import DownloadCache
+from cloudshell.cm.customscript.domain.execution_result import ExecutionResult, HostResult, ScriptResult, record_phase
+from cloudshell.cm.customscript.domain.host_executor_pool import HostExecutorPool
+from cloudshell.cm.customscript.domain.memory_profiler import MemoryProfiler, profile_phase
+from cloudshell.cm.customscript.domain.prefetcher import Prefetcher
 from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
+from cloudshell.cm.customscript.domain.result_cache import ResultCache
+from cloudshell.cm.customscript.domain.script_dag import ScriptDag, DagNode
 from cloudshell.cm.customscript.domain.script_configuration import ScriptConfigurationParser, ScriptRepository, \
     HostConfiguration
 from cloudshell.cm.customscript.domain.script_downloader import ScriptDownloader, HttpAuth
 from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ExcutorConnectionError
 from cloudshell.cm.customscript.domain.script_executor_selector import ScriptExecutorSelector
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
+from cloudshell.cm.customscript.domain.workspace_manager import WorkspaceManager
 
 
 class CustomScriptShell(object):
+    PREFLIGHT_MAX_WORKERS = 16
+    DEFAULT_DAG_MAX_WORKERS = 16
+    ENV_PREFETCH_DEPTH = 'CUSTOMSCRIPT_BATCH_PREFETCH_DEPTH'
+    ENV_DAG_MAX_WORKERS = 'CUSTOMSCRIPT_BATCH_MAX_WORKERS'
+    ENV_PREFLIGHT_ABORT = 'CUSTOMSCRIPT_BATCH_PREFLIGHT_ABORT'
+
+    def __init__(self, governor = None, result_cache = None, download_cache = None, prefetch_depth = None,
+                 dag_max_workers = None, preflight_abort = None):
+        """
+        :param governor: Limits the scripts run concurrently (None = the governor shared by the driver process).
+        :type governor: ConcurrencyGovernor
+        :param result_cache: The successful runs, for the configurations with "resultCache" (None = the cache shared
+                             by the driver process).
+        :type result_cache: ResultCache
+        :param download_cache: Disk cache of the downloaded scripts (None = the cache of the folder configured for the
+                               driver process, see DownloadCache.get_default).
+        :type download_cache: DownloadCache
+        :param prefetch_depth: Scripts of an ordered execute_scripts batch downloaded ahead of the one running
+                               (None = ENV_PREFETCH_DEPTH, unset means 0 - no prefetch).
+        :type prefetch_depth: int
+        :param dag_max_workers: Configurations of a dependency graph run at once (None = ENV_DAG_MAX_WORKERS, unset
+                                means DEFAULT_DAG_MAX_WORKERS). Never more than the total limit of the governor.
+        :type dag_max_workers: int
+        :param preflight_abort: Fail an execute_scripts batch before any script runs when a host could not be
+                                connected to, instead of failing only the scripts of that host (None =
+                                ENV_PREFLIGHT_ABORT, unset means False).
+        :type preflight_abort: bool
+        """
+        self.governor = governor or ConcurrencyGovernor.get_default()
+        self.result_cache = result_cache or ResultCache.get_default()
+        self.download_cache = download_cache or DownloadCache.get_default()
+        self.prefetch_depth = self._get_env_prefetch_depth() if prefetch_depth is None else prefetch_depth
+        self.dag_max_workers = self._get_env_dag_max_workers() if dag_max_workers is None else dag_max_workers
+        self.preflight_abort = self._get_env_preflight_abort() if preflight_abort is None else preflight_abort
+
+    @staticmethod
+    def _get_env_prefetch_depth():
+        value = os.environ.get(CustomScriptShell.ENV_PREFETCH_DEPTH)
+        if not value:
+            return 0
+        if not value.isdigit():
+            raise ValueError('Environment variable "%s" must be a non negative integer.' % CustomScriptShell.ENV_PREFETCH_DEPTH)
+        return int(value)
 
-    def __init__(self):
-        pass
+    @staticmethod
+    def _get_env_dag_max_workers():
+        value = os.environ.get(CustomScriptShell.ENV_DAG_MAX_WORKERS)
+        if not value:
+            return CustomScriptShell.DEFAULT_DAG_MAX_WORKERS
+        if not value.isdigit() or int(value) <= 0:
+            raise ValueError('Environment variable "%s" must be a positive integer.' % CustomScriptShell.ENV_DAG_MAX_WORKERS)
+        return int(value)
+
+    @staticmethod
+    def _get_env_preflight_abort():
+        value = os.environ.get(CustomScriptShell.ENV_PREFLIGHT_ABORT)
+        if not value:
+            return False
+        if value.lower() not in ('true', 'false'):
+            raise ValueError('Environment variable "%s" must be true or false.' % CustomScriptShell.ENV_PREFLIGHT_ABORT)
+        return value.lower() == 'true'
 
     def execute_script(self, command_context, script_conf_json, cancellation_context):
         """
         :type command_context: ResourceCommandContext
-        :type ansi_conf_json: str
+        :param script_conf_json: The configuration json string, or an already decoded configuration dict.
+        :type script_conf_json: str | dict
         :type cancellation_context: CancellationContext
+        :return: The result document as compact json (see ExecutionResult).
         :rtype str
         """
+        document = ExecutionResult()
         with LoggingSessionContext(command_context) as logger:
-            logger.debug('\'execute_script\' is called with the configuration json: \n' + script_conf_json)
+            logger.debug('\'execute_script\' is called with the configuration json: \n%s', script_conf_json)
 
             with ErrorHandlingContext(logger):
-                with CloudShellSessionContext(command_context) as api:
+                with CloudShellSessionContext(command_context) as api, self._recording(document, logger):
                     cancel_sampler = CancellationSampler(cancellation_context)
-                    script_conf = ScriptConfigurationParser(api).json_to_object(script_conf_json)
+                    output_writer = ReservationOutputWriter(api, command_context)
+                    self.result_cache.evict_ended_reservations(api, logger)
+                    self._execute_script(script_conf_json, api, logger, cancel_sampler, output_writer,
+                                         command_context.reservation.reservation_id, document)
+        return document.to_json()
 
+    def execute_scripts(self, command_context, script_confs_json, cancellation_context):
+        """
+        Executes a json array of configurations one after the other, logging in to the CloudShell API and
+        creating the logger only once for the whole batch.
+        The items of the array are decoded and converted one at a time, so only one of them is held as decoded json
+        at once - but every converted configuration is kept for the whole batch (the preflight and the dependency
+        graph need all of them), the memory still grows with the size of the batch.
+        Before any script runs, every distinct host of the batch is connected to concurrently (preflight), so all
+        the unreachable hosts are reported at once, up front: the scripts of an unreachable host fail right away
+        (without retrying to connect), the others run - or, with preflight_abort, the batch fails before any script
+        runs. The connection of a host is kept open for its scripts, and closed once the last of them ran.
+        Each host gets one workspace for the whole batch, its scripts run in subfolders of it, and the workspaces are
+        deleted once the batch ends, whatever the outcome (see WorkspaceManager).
+        The api session sends every request through its own urllib3 connection pool, so it (and the output
+        writer built on it) can safely be shared by configurations running on different threads.
+        Configurations with "id" / "dependsOn" run as a dependency graph instead (see ScriptDag and _execute_dag).
+        Otherwise, with a prefetch depth, the next scripts are downloaded while the current one runs (see
+        _execute_in_order) - the scripts still run strictly one after the other.
+        :type command_context: ResourceCommandContext
+        :type script_confs_json: str
+        :type cancellation_context: CancellationContext
+        :return: The result document as compact json, with every host and configuration (see ExecutionResult).
+        :rtype str
+        """
+        document = ExecutionResult()
+        with LoggingSessionContext(command_context) as logger:
+            logger.debug('\'execute_scripts\' is called with the configurations json: \n%s', script_confs_json)
+
+            with ErrorHandlingContext(logger):
+                with CloudShellSessionContext(command_context) as api, self._recording(document, logger):
+                    cancel_sampler = CancellationSampler(cancellation_context)
                     output_writer = ReservationOutputWriter(api, command_context)
+                    self.result_cache.evict_ended_reservations(api, logger)
+                    parser = ScriptConfigurationParser(api)
+                    script_confs = [parser.json_to_object(script_conf_json)
+                                    for script_conf_json in json_backend.iter_array(script_confs_json)]
+                    # validated before connecting to any host
+                    dag = ScriptDag(script_confs) if ScriptDag.is_dag(script_confs) else None
+                    script_results = [document.add_script(script_conf) for script_conf in script_confs]
+                    workspaces = WorkspaceManager(logger)
+                    services, failures = self._preflight(script_confs, logger, cancel_sampler, workspaces, document)
+                    try:
+                        if failures:
+                            output_writer.write_warning(self._format_preflight_failures(failures, services))
+                        if dag:
+                            self._execute_dag(dag, services, logger, cancel_sampler, output_writer,
+                                              command_context.reservation.reservation_id, script_results, workspaces,
+                                              failures)
+                        else:
+                            self._execute_in_order(script_confs, services, logger, cancel_sampler, output_writer,
+                                                   command_context.reservation.reservation_id, script_results,
+                                                   workspaces, failures)
+                    finally:
+                        workspaces.close()
+                        for service in services.values():
+                            service.close()
+        return document.to_json()
 
-                    logger.info('Downloading file from \'%s\' ...' % script_conf.script_repo.url)
-                    script_file = self._download_script(script_conf.script_repo, logger, cancel_sampler, script_conf.verify_certificate)
-                    logger.info('Done (%s, %s chars).' % (script_file.name, len(script_file.text)))
+    @contextmanager
+    def _recording(self, document, logger):
+        """
+        Finishes the result document of a command with its outcome, and logs it - also when the command failed
+        (the document is returned only on success).
+        :type document: ExecutionResult
+        :type logger: Logger
+        """
+        try:
+            yield
+        except Exception as e:
+            document.finish(e)
+            raise
+        else:
+            document.finish()
+        finally:
+            try:
+                logger.info('Result: %s' % document.to_json())
+            except Exception as e:
+                # never hides the outcome of the command
+                logger.warning('Failed to encode the result document: %s' % str(e))
+
+    def _execute_in_order(self, script_confs, services, logger, cancel_sampler, output_writer, reservation_id,
+                          script_results, workspaces=None, failures=None):
+        """
+        Runs the configurations one after the other, until one fails. With a prefetch depth K, the scripts of the
+        next K configurations are downloaded (each in its repository slot of the governor) while the current one runs;
+        the hosts are already connected by the preflight. Streamed scripts are downloaded while they are uploaded,
+        they are not prefetched. The prefetched scripts that do not run (failure, cancellation) are closed.
+        A host is released (see _release_host) after its last configuration.
+        :type script_confs: list[ScriptConfiguration]
+        :param services: The connected executors by host key (see _preflight).
+        :type services: dict
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type output_writer: ReservationOutputWriter
+        :type reservation_id: str
+        :param script_results: The results of the configurations, in the same order.
+        :type script_results: list[ScriptResult]
+        :param workspaces: The workspaces of the hosts (None = no workspaces).
+        :type workspaces: WorkspaceManager
+        :param failures: The hosts the preflight could not connect to, by host key (see _preflight).
+        :type failures: dict
+        """
+        failures = failures or {}
+        last_indexes = dict((self._get_host_key(script_conf.host_conf), index)
+                            for index, script_conf in enumerate(script_confs))
+        prefetcher = None
+        if self.prefetch_depth > 0 and len(script_confs) > 1:
+            def fetch(index):
+                script_conf = script_confs[index]
+                if script_conf.stream_transfer:
+                    return None
+                return self._download_in_slot(script_conf, logger, cancel_sampler, reservation_id,
+                                              script_result=script_results[index])
+
+            logger.info('Prefetching the scripts of the next %s configuration(s) ...' % self.prefetch_depth)
+            prefetcher = Prefetcher(fetch, len(script_confs), self.prefetch_depth, cancel_sampler,
+                                    discard=lambda script_file: script_file.close())
+        try:
+            for index, script_conf in enumerate(script_confs):
+                cancel_sampler.throw_if_canceled()
+                script_file = prefetcher.take(index) if prefetcher else None
+                key = self._get_host_key(script_conf.host_conf)
+                if key in failures:
+                    if script_file:
+                        script_file.close()
+                    self._fail_unreachable(failures[key], script_results[index])
+                self._execute_configuration(script_conf, logger, cancel_sampler, output_writer, reservation_id,
+                                            services[key], script_file, script_results[index])
+                if last_indexes[key] == index:
+                    self._release_host(key, services, workspaces)
+        finally:
+            if prefetcher:
+                prefetcher.close()
+
+    def _execute_dag(self, dag, services, logger, cancel_sampler, output_writer, reservation_id, script_results,
+                     workspaces=None, failures=None):
+        """
+        Runs the configurations of the graph as soon as their dependencies succeeded, up to dag_max_workers at once
+        (within the limits of the governor). Configurations of the same host run at once only when its executors are
+        multiplexed, each with an executor of its own, up to the per host limit of the governor (see
+        HostExecutorPool) - otherwise one at a time, on the executor of the preflight. The configurations of an
+        unreachable host fail (and their dependents are skipped), a host is released (see _release_host) once all its
+        configurations ran. Reports the critical path, then fails when any configuration failed.
+        :type dag: ScriptDag
+        :param services: The connected executors by host key (see _preflight).
+        :type services: dict
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type output_writer: ReservationOutputWriter
+        :type reservation_id: str
+        :param script_results: The results of the configurations, in the order of the nodes.
+        :type script_results: list[ScriptResult]
+        :param workspaces: Opens the workspace of the executors opened for the graph (None = no workspaces).
+        :type workspaces: WorkspaceManager
+        :param failures: The hosts the preflight could not connect to, by host key (see _preflight).
+        :type failures: dict
+        """
+        failures = failures or {}
+        results_by_conf = dict((node.script_conf, script_results[node.index]) for node in dag.nodes)
+        remaining = Counter(self._get_host_key(node.script_conf.host_conf) for node in dag.nodes)
+        remaining_lock = threading.Lock()
 
-                    service = ScriptExecutorSelector.get(script_conf.host_conf, logger, cancel_sampler)
+        def open_executor(script_conf):
+            return self._open_host(script_conf, logger, cancel_sampler, workspaces, results_by_conf[script_conf])
 
-                    self._warn_for_unexpected_file_type(script_conf.host_conf, service, script_file, output_writer)
+        def close_executor(service):
+            if workspaces:
+                workspaces.release(service)
+            service.close()
 
-                    logger.info('Connecting ...')
-                    self._connect(service, cancel_sampler, script_conf.timeout_minutes)
-                    logger.info('Done.')
+        executors = HostExecutorPool(services, open_executor, close_executor, self.governor.max_per_host)
 
-                    service.execute(script_file, script_conf.host_conf.parameters, output_writer, script_conf.print_output)
+        def run_node(script_conf):
+            key = self._get_host_key(script_conf.host_conf)
+            if key in failures:
+                self._fail_unreachable(failures[key], results_by_conf[script_conf])
+            service = executors.acquire(key, script_conf, cancel_sampler)
+            try:
+                self._execute_configuration(script_conf, logger, cancel_sampler, output_writer, reservation_id,
+                                            service, script_result=results_by_conf[script_conf])
+            finally:
+                executors.release(key, service)
+                with remaining_lock:
+                    remaining[key] -= 1
+                    last = remaining[key] == 0
+                if last:
+                    executors.retire(key)
+                    self._release_host(key, services, workspaces)
+
+        max_workers = self.dag_max_workers
+        if self.governor.max_total is not None:
+            # more workers would only wait in the queue of the governor
+            max_workers = min(max_workers, self.governor.max_total)
+        logger.info('Running %s configurations by their dependencies (up to %s at once) ...' % (
+            len(dag.nodes), max_workers))
+        try:
+            dag.run(run_node, max_workers, cancel_sampler)
+        finally:
+            executors.close()
+            for node in dag.get_nodes(DagNode.SKIPPED):
+                script_results[node.index].set_status(ScriptResult.SKIPPED)
+            summary = dag.format_summary()
+            logger.info(summary)
+            output_writer.write(summary)
 
-    def _download_script(self, script_repo, logger, cancel_sampler, verify_certificate):
+        failed = dag.get_nodes(DagNode.FAILED)
+        if failed:
+            raise Exception('%s of %s configuration(s) failed, %s skipped:%s%s' % (
+                len(failed), len(dag.nodes), len(dag.get_nodes(DagNode.SKIPPED)), os.linesep,
+                os.linesep.join('%s: %s' % (node.name, str(node.error)) for node in failed)))
+
+    def _execute_script(self, script_conf_json, api, logger, cancel_sampler, output_writer, reservation_id=None,
+                        document=None):
+        """
+        :type script_conf_json: str | dict
+        :type api: CloudShellAPISession
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type output_writer: ReservationOutputWriter
+        :param reservation_id: The reservation the script runs for (its requests are queued fairly with other
+                               reservations, when the concurrency limits are reached).
+        :type reservation_id: str
+        :param document: Where the result of the configuration is recorded (None = not recorded).
+        :type document: ExecutionResult
+        """
+        script_conf = ScriptConfigurationParser(api).json_to_object(script_conf_json)
+        script_result = document.add_script(script_conf) if document else None
+        self._execute_configuration(script_conf, logger, cancel_sampler, output_writer, reservation_id,
+                                    script_result=script_result)
+
+    def _execute_configuration(self, script_conf, logger, cancel_sampler, output_writer, reservation_id=None,
+                               service=None, script_file=None, script_result=None):
+        """
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type output_writer: ReservationOutputWriter
+        :type reservation_id: str
+        :param service: An executor already connected to the host (None = connect now).
+        :type service: IScriptExecutor
+        :param script_file: The script, already downloaded (None = download it now).
+        :type script_file: ScriptFile
+        :param script_result: Records the phases and outcome of the configuration (None = not recorded).
+        :type script_result: ScriptResult
+        """
+        profiler = None
+        if script_conf.memory_profiling:
+            # the path only - the query of the url may hold a token
+            script_path = urlsplit(script_conf.script_repo.url or '').path
+            profiler = MemoryProfiler(logger, '"%s" on host %s' % (script_path, script_conf.host_conf.ip),
+                                      script_conf.memory_profiling.top_sites, script_conf.memory_profiling.report_file)
+            profiler.start()
+        if script_result:
+            script_result.start()
+        try:
+            self._execute_phases(script_conf, logger, cancel_sampler, output_writer, reservation_id, service, profiler,
+                                 script_file, script_result)
+        except Exception as e:
+            if script_result:
+                script_result.finish(e)
+            raise
+        else:
+            if script_result:
+                script_result.finish()
+        finally:
+            if profiler:
+                profiler.stop()
+                profiler.report()
+
+    def _execute_phases(self, script_conf, logger, cancel_sampler, output_writer, reservation_id, service, profiler,
+                        script_file=None, script_result=None):
+        """
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type output_writer: ReservationOutputWriter
+        :type reservation_id: str
+        :type service: IScriptExecutor
+        :param profiler: Profiles the memory of the phases (None = no profiling).
+        :type profiler: MemoryProfiler
+        :param script_file: The script, already downloaded (None = download it now).
+        :type script_file: ScriptFile
+        :param script_result: Records the phases of the configuration (None = not recorded).
+        :type script_result: ScriptResult
+        """
+        host = script_conf.host_conf.ip
+        repository = self._get_repository_origin(script_conf.script_repo.url)
+
+        if script_conf.stream_transfer:
+            if script_conf.result_cache:
+                logger.info('The result of a streamed script is not known up front, it is not memoized.')
+            # the script is downloaded while it is uploaded to the host - hold both for the whole run
+            with self._acquire_slot(logger, reservation_id, cancel_sampler, host=host, repository=repository,
+                                    script_result=script_result):
+                with profile_phase(profiler, 'download'), record_phase(script_result, 'download'):
+                    script_file = self._download(script_conf, logger, cancel_sampler)
+                if script_result:
+                    script_result.set_script(script_file.name)
+                try:
+                    self._run_on_host(script_conf, script_file, logger, cancel_sampler, output_writer, service,
+                                      profiler=profiler, script_result=script_result)
+                finally:
+                    # streamed while it was uploaded
+                    if script_result:
+                        script_result.add_bytes('downloaded', script_file.transferred_size())
+        else:
+            owned_service = None
+            if script_file is None and service is None:
+                with profile_phase(profiler, 'download+connect'):
+                    script_file, owned_service = self._download_and_connect(script_conf, logger, cancel_sampler,
+                                                                            reservation_id, script_result)
+                service = owned_service
+            elif script_file is None:
+                script_file = self._download_in_slot(script_conf, logger, cancel_sampler, reservation_id, profiler,
+                                                     script_result)
+
+            try:
+                result_key = None
+                if script_conf.result_cache:
+                    result_key = ResultCache.get_key(reservation_id, script_conf.host_conf, script_file)
+                    if self.result_cache.contains(reservation_id, result_key):
+                        script_file.close()
+                        self._report_skipped(script_conf, script_file, logger, output_writer, script_result)
+                        return
+
+                with self._acquire_slot(logger, reservation_id, cancel_sampler, host=host, script_result=script_result):
+                    self._run_on_host(script_conf, script_file, logger, cancel_sampler, output_writer, service,
+                                      result_key, profiler, script_result)
+                if result_key:
+                    self.result_cache.add(reservation_id, result_key)
+            finally:
+                if owned_service:
+                    owned_service.close()
+
+    def _download_and_connect(self, script_conf, logger, cancel_sampler, reservation_id, script_result=None):
+        """
+        Downloads the script and connects to the host (with the retries of _connect) at the same time, so the
+        command waits for the slower of the two instead of both. The first one to fail cancels the other, and its
+        error is raised once both finished (closing what the other one opened).
+        The connection is made before the host slot of the governor is granted (like the preflight of a batch).
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type reservation_id: str
+        :type script_result: ScriptResult
+        :return: The script and the connected executor (owned by the caller).
+        :rtype tuple[ScriptFile, IScriptExecutor]
+        """
+        download_sampler = LinkedCancellationSampler(cancel_sampler)
+        connect_sampler = LinkedCancellationSampler(cancel_sampler)
+        pool = ThreadPool(processes=2)
+        try:
+            download = pool.apply_async(self._download_in_slot, (script_conf, logger, download_sampler, reservation_id),
+                                        {'script_result': script_result})
+            connect = pool.apply_async(self._connect_host, (script_conf, logger, cancel_sampler, connect_sampler,
+                                                            script_result))
+            # each one with the sampler of the other one
+            pending = [(download, connect_sampler), (connect, download_sampler)]
+            error = None
+            while pending:
+                pending[0][0].wait(0.1)
+                for async_result, other_sampler in [p for p in pending if p[0].ready()]:
+                    pending.remove((async_result, other_sampler))
+                    if not async_result.successful() and error is None:
+                        try:
+                            async_result.get()
+                        except Exception as e:
+                            error = e
+                        other_sampler.cancel()
+        finally:
+            pool.close()
+
+        if error is not None:
+            if download.successful():
+                download.get().close()
+            if connect.successful():
+                connect.get().close()
+            raise error
+        return download.get(), connect.get()
+
+    def _preflight(self, script_confs, logger, cancel_sampler, workspaces=None, document=None):
+        """
+        Connects to every distinct host of the configurations concurrently. With preflight_abort, fails when any
+        host could not be connected to.
+        :type script_confs: list[ScriptConfiguration]
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :param workspaces: Opens the workspace of every host once it is connected (None = no workspaces).
+        :type workspaces: WorkspaceManager
+        :param document: Where the connection of every host is recorded (None = not recorded).
+        :type document: ExecutionResult
+        :return: The connected executors by host key (see _get_host_key), and the error of every host that could not be
+                 connected to by host key.
+        :rtype (dict, dict)
+        """
+        first_confs = OrderedDict()
+        for script_conf in script_confs:
+            first_confs.setdefault(self._get_host_key(script_conf.host_conf), script_conf)
+        if not first_confs:
+            return OrderedDict(), OrderedDict()
+
+        logger.info('Preflight: connecting to %s host(s) ...' % len(first_confs))
+        pool = ThreadPool(processes=min(len(first_confs), self.PREFLIGHT_MAX_WORKERS))
+        try:
+            async_results = [(key, script_conf, pool.apply_async(self._prepare_host, (
+                script_conf, logger, cancel_sampler, workspaces, document.add_host(script_conf.host_conf) if document else None)))
+                             for key, script_conf in first_confs.items()]
+            services = OrderedDict()
+            failures = OrderedDict()
+            cancellation = None
+            for key, script_conf, async_result in async_results:
+                try:
+                    services[key] = async_result.get()
+                except CancellationException as e:
+                    cancellation = e
+                except Exception as e:
+                    failures[key] = '%s (%s): %s' % (script_conf.host_conf.ip, script_conf.host_conf.connection_method, str(e))
+        finally:
+            pool.close()
+
+        if cancellation or (failures and self.preflight_abort):
+            if workspaces:
+                workspaces.close()
+            for service in services.values():
+                service.close()
+            if cancellation:
+                raise cancellation
+            raise Exception(self._format_preflight_failures(failures, services))
+        if failures:
+            logger.error(self._format_preflight_failures(failures, services))
+        else:
+            logger.info('Done.')
+        return services, failures
+
+    def _format_preflight_failures(self, failures, services):
+        """
+        :type failures: dict
+        :type services: dict
+        :rtype str
+        """
+        return 'Preflight failed, %s of %s host(s) could not be connected to:%s%s' % (
+            len(failures), len(failures) + len(services), os.linesep, os.linesep.join(failures.values()))
+
+    def _fail_unreachable(self, failure, script_result=None):
+        """
+        Fails a configuration of a host the preflight could not connect to, without trying to connect again.
+        :param failure: The preflight error of the host.
+        :type failure: str
+        :type script_result: ScriptResult
+        """
+        error = Exception('The host could not be connected to by the preflight: %s' % failure)
+        if script_result:
+            script_result.start()
+            script_result.finish(error)
+        raise error
+
+    def _release_host(self, key, services, workspaces=None):
+        """
+        Deletes the workspace of a host and closes its connection once the batch has no more configurations for it,
+        instead of holding the connection until the whole batch ends.
+        :type key: tuple
+        :param services: The connected executors by host key, the one of the host is removed.
+        :type services: dict
+        :type workspaces: WorkspaceManager
+        """
+        service = services.pop(key, None)
+        if service is None:
+            return
+        if workspaces:
+            workspaces.release(service)
+        service.close()
+
+    def _prepare_host(self, script_conf, logger, cancel_sampler, workspaces=None, host_result=None):
+        """
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type workspaces: WorkspaceManager
+        :type host_result: HostResult
+        :rtype IScriptExecutor
+        """
+        if host_result:
+            host_result.start()
+        try:
+            service = self._open_host(script_conf, logger, cancel_sampler, workspaces, host_result)
+        except Exception as e:
+            if host_result:
+                host_result.finish(e)
+            raise
+        if host_result:
+            host_result.finish()
+        return service
+
+    def _open_host(self, script_conf, logger, cancel_sampler, workspaces=None, recorded_result=None):
+        """
+        Connects an executor to the host, and opens its workspace.
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type workspaces: WorkspaceManager
+        :param recorded_result: Records the connect and workspace phases (None = not recorded).
+        :type recorded_result: HostResult | ScriptResult
+        :rtype IScriptExecutor
+        """
+        service = self._connect_host(script_conf, logger, cancel_sampler, recorded_result=recorded_result)
+        if workspaces:
+            try:
+                with record_phase(recorded_result, 'workspace'):
+                    workspaces.open(service)
+            except:
+                service.close()
+                raise
+        return service
+
+    def _connect_host(self, script_conf, logger, cancel_sampler, retry_sampler=None, recorded_result=None):
+        """
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :param retry_sampler: Stops the connection retries (None = cancel_sampler).
+        :type retry_sampler: CancellationSampler
+        :param recorded_result: Records the connect phase and its retries (HostResult / ScriptResult, None = not
+                                recorded).
+        :rtype IScriptExecutor
+        """
+        service = ScriptExecutorSelector.get(script_conf.host_conf, logger, cancel_sampler)
+        try:
+            self._connect(service, retry_sampler or cancel_sampler, script_conf.timeout_minutes, recorded_result)
+        except:
+            service.close()
+            raise
+        return service
+
+    def _get_host_key(self, host_conf):
+        """
+        Configurations with the same key can share a connection.
+        :type host_conf: HostConfiguration
+        :rtype tuple
+        """
+        return (host_conf.ip, host_conf.connection_method, host_conf.connection_secured, host_conf.username,
+                host_conf.password, host_conf.access_key, host_conf.parameters.get('winrm_transport'))
+
+    def _download_in_slot(self, script_conf, logger, cancel_sampler, reservation_id, profiler=None, script_result=None):
+        """
+        Downloads the script in a repository slot of the governor.
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type reservation_id: str
+        :type profiler: MemoryProfiler
+        :type script_result: ScriptResult
+        :rtype ScriptFile
+        """
+        repository = self._get_repository_origin(script_conf.script_repo.url)
+        with self._acquire_slot(logger, reservation_id, cancel_sampler, repository=repository,
+                                script_result=script_result):
+            with profile_phase(profiler, 'download'), record_phase(script_result, 'download'):
+                script_file = self._download(script_conf, logger, cancel_sampler)
+        if script_result:
+            script_result.set_script(script_file.name)
+            script_result.add_bytes('downloaded', script_file.transferred_size())
+        return script_file
+
+    def _download(self, script_conf, logger, cancel_sampler):
+        """
+        :type script_conf: ScriptConfiguration
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :rtype ScriptFile
+        """
+        logger.info('Downloading file from \'%s\' ...' % script_conf.script_repo.url)
+        script_file = self._download_script(script_conf.script_repo, logger, cancel_sampler, script_conf.verify_certificate,
+                                            script_conf.stream_transfer)
+        logger.info('Done (%s, size: %s).' % (script_file.name, script_file.size()))
+        return script_file
+
+    def _run_on_host(self, script_conf, script_file, logger, cancel_sampler, output_writer, service=None,
+                     result_key=None, profiler=None, script_result=None):
+        """
+        :type script_conf: ScriptConfiguration
+        :type script_file: ScriptFile
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type output_writer: ReservationOutputWriter
+        :param service: An executor already connected to the host (owned by the caller), None = connect now.
+        :type service: IScriptExecutor
+        :param result_key: The ResultCache key of the run, when it is memoized (for the marker on the host).
+        :type result_key: str
+        :param profiler: Profiles the memory of the connect / upload / run phases (None = no profiling).
+        :type profiler: MemoryProfiler
+        :param script_result: Records the connect / upload / run phases (None = not recorded).
+        :type script_result: ScriptResult
+        """
+        owned = service is None
+        try:
+            if owned:
+                service = ScriptExecutorSelector.get(script_conf.host_conf, logger, cancel_sampler)
+            else:
+                # same host and credentials, but the upload / execution options are per configuration
+                service.target_host = script_conf.host_conf
+            service.profiler = profiler
+            service.script_result = script_result
+
+            self._warn_for_unexpected_file_type(script_conf.host_conf, service, script_file, output_writer)
+
+            if owned or not service.is_connected():
+                logger.info('Connecting ...')
+                with profile_phase(profiler, 'connect'):
+                    self._connect(service, cancel_sampler, script_conf.timeout_minutes, script_result)
+                logger.info('Done.')
+
+            marker_on_host = result_key and script_conf.result_cache.marker_on_host
+            if marker_on_host and service.has_result_marker(result_key):
+                self._report_skipped(script_conf, script_file, logger, output_writer, script_result)
+                return
+
+            service.execute(script_file, script_conf.host_conf.parameters, output_writer, script_conf.print_output)
+
+            if marker_on_host:
+                try:
+                    service.write_result_marker(result_key)
+                except Exception as e:
+                    # the script succeeded, a missing marker only means it may run again
+                    logger.warning('Failed to write the result marker on host %s: %s' % (script_conf.host_conf.ip, str(e)))
+        finally:
+            script_file.close()
+            if owned and service is not None:
+                service.close()
+
+    def _report_skipped(self, script_conf, script_file, logger, output_writer, script_result=None):
+        """
+        :type script_conf: ScriptConfiguration
+        :type script_file: ScriptFile
+        :type logger: Logger
+        :type output_writer: ReservationOutputWriter
+        :type script_result: ScriptResult
+        """
+        if script_result:
+            script_result.set_status(ScriptResult.CACHED)
+        message = 'Script "%s" already ran successfully on host %s with the same parameters, skipped.' % (
+            script_file.name, script_conf.host_conf.ip)
+        logger.info(message)
+        output_writer.write(message)
+
+    def _acquire_slot(self, logger, reservation_id, cancel_sampler, host=None, repository=None, script_result=None):
+        """
+        Waits for a concurrency slot, and reports the time spent in the queue.
+        :type logger: Logger
+        :type reservation_id: str
+        :type cancel_sampler: CancellationSampler
+        :type host: str
+        :type repository: str
+        :param script_result: Records the time spent in the queue (None = not recorded).
+        :type script_result: ScriptResult
+        :rtype ConcurrencySlot
+        """
+        slot = self.governor.acquire(reservation_id, cancel_sampler, host=host, repository=repository)
+        logger.info('Queue wait: %.3f seconds (host: %s, repository: %s).' % (slot.wait_seconds, host, repository))
+        if script_result:
+            script_result.add_phase('queue', slot.wait_seconds)
+        return slot
+
+    def _get_repository_origin(self, url):
+        """
+        :type url: str
+        :return: scheme://host[:port] of the url.
+        :rtype str
+        """
+        parts = urlsplit(url or '')
+        return '%s://%s' % (parts.scheme.lower(), parts.netloc.lower().rpartition('@')[2])
+
+    def _download_script(self, script_repo, logger, cancel_sampler, verify_certificate, stream_transfer=False):
         """
         :type script_repo: ScriptRepository
         :type logger: Logger
         :type cancel_sampler: CancellationSampler
+        :param stream_transfer: Pipe mode - stream the script to the target host while it is being downloaded.
+        :type stream_transfer: bool
         :rtype ScriptFile
         """
         url = script_repo.url
         auth = None
         if script_repo.username or script_repo.token:
             auth = HttpAuth(script_repo.username, script_repo.password, script_repo.token)
-        return ScriptDownloader(logger, cancel_sampler).download(url, auth, verify_certificate)
+        downloader = ScriptDownloader(logger, cancel_sampler, self.download_cache)
+        if stream_transfer:
+            script_file = downloader.open_stream(url, auth, verify_certificate)
+        else:
+            script_file = downloader.download(url, auth, verify_certificate)
+        if isinstance(script_file, ScriptBundle):
+            script_file.set_entry_point(script_repo.entry_point)
+        return script_file
 
     def _warn_for_unexpected_file_type(self, target_host, service, script_file, output_writer):
         """
@@ -78,10 +823,12 @@ class CustomScriptShell(object):
         if not file_ext in service.get_expected_file_extensions():
             output_writer.write_warning('Trying to run "%s" file via %s on host %s' % (file_ext, target_host.connection_method, target_host.ip))
 
-    def _connect(self, executor, cancel_sampler, timeout_minutes):
+    def _connect(self, executor, cancel_sampler, timeout_minutes, recorded_result=None):
         """
         :type executor: IScriptExecutor
         :type cancel_sampler: CancellationSampler
+        :param recorded_result: Records the connect phase and its retries (None = not recorded).
+        :type recorded_result: HostResult | ScriptResult
         """
         # 10060  ETIMEDOUT                      Operation timed out
         # 10061  ECONNREFUSED                   Connection refused (happense when host found, port not)
@@ -94,17 +841,20 @@ class CustomScriptShell(object):
         valid_errnos = [10060, 10061, 10064, 10065, 500, 113, 111, 110]
         interval_seconds = 10
         start_time = time.time()
-        while True:
-            cancel_sampler.throw_if_canceled()
-            try:
-                executor.connect()
-                break
-            except ExcutorConnectionError as e:
-                if not e.errno in valid_errnos:
-                    raise e.inner_error
-                if time.time() - start_time >= timeout_minutes*60:
-                    raise e.inner_error
-                time.sleep(interval_seconds)
+        with record_phase(recorded_result, 'connect'):
+            while True:
+                cancel_sampler.throw_if_canceled()
+                try:
+                    executor.connect()
+                    break
+                except ExcutorConnectionError as e:
+                    if not e.errno in valid_errnos:
+                        raise e.inner_error
+                    if time.time() - start_time >= timeout_minutes*60:
+                        raise e.inner_error
+                    if recorded_result:
+                        recorded_result.add_retry('connect')
+                    time.sleep(interval_seconds)
 
 # conf = '''{
 # 	"repositoryDetails": {
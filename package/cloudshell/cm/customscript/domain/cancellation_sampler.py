@@ -21,4 +21,25 @@ class CancellationSampler(object):
 
 
 class CancellationException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class LinkedCancellationSampler(CancellationSampler):
+    def __init__(self, parent):
+        '''
+        Cancelled with its parent (the command), or on its own with 'cancel' - e.g. to stop an operation when the
+        one running next to it failed.
+        :type parent: CancellationSampler
+        '''
+        self.parent = parent
+        self._cancelled = False
+
+    def is_cancelled(self):
+        return self._cancelled or self.parent.is_cancelled()
+
+    def throw_if_canceled(self):
+        if self._cancelled:
+            self.throw()
+        self.parent.throw_if_canceled()
+
+    def cancel(self):
+        self._cancelled = True
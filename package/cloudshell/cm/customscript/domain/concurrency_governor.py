@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque, Counter
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+
+
+class ConcurrencySlot(object):
+    def __init__(self, governor, request, wait_seconds):
+        """
+        A granted slot, released when leaving the 'with' block (or with 'release').
+        :type governor: ConcurrencyGovernor
+        :param wait_seconds: Time spent in the queue before the slot was granted.
+        :type wait_seconds: float
+        """
+        self.governor = governor
+        self.request = request
+        self.wait_seconds = wait_seconds
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.governor._release(self.request)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class ConcurrencyGovernor(object):
+    """
+    Limits how many scripts the driver process works on at once: in total, per target host and per repository
+    origin (scheme://host:port of the script url). Limits of None are unlimited.
+    Waiting requests are queued per reservation and slots are granted to the reservations in turns (round robin),
+    so a reservation with many configurations cannot starve the others sharing the driver process. Within a
+    reservation requests are served in order, skipping those whose host / repository is still at its limit.
+    """
+    ENV_MAX_TOTAL = 'CUSTOMSCRIPT_MAX_CONCURRENT_SCRIPTS'
+    ENV_MAX_PER_HOST = 'CUSTOMSCRIPT_MAX_CONCURRENT_SCRIPTS_PER_HOST'
+    ENV_MAX_PER_REPOSITORY = 'CUSTOMSCRIPT_MAX_CONCURRENT_DOWNLOADS_PER_REPOSITORY'
+    CANCEL_CHECK_INTERVAL_SECONDS = 1
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    class _Request(object):
+        def __init__(self, reservation_id, host, repository):
+            self.reservation_id = reservation_id
+            self.host = host
+            self.repository = repository
+            self.granted = False
+
+    def __init__(self, max_total = None, max_per_host = None, max_per_repository = None):
+        """
+        :type max_total: int
+        :type max_per_host: int
+        :type max_per_repository: int
+        """
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.max_per_repository = max_per_repository
+        self._condition = threading.Condition()
+        self._running_total = 0
+        self._running_per_host = Counter()
+        self._running_per_repository = Counter()
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._wait_count = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    @staticmethod
+    def get_default():
+        """
+        The governor shared by the whole driver process, with the limits of the environment variables
+        (ENV_MAX_TOTAL, ENV_MAX_PER_HOST, ENV_MAX_PER_REPOSITORY - unset means unlimited).
+        :rtype ConcurrencyGovernor
+        """
+        with ConcurrencyGovernor._default_lock:
+            if ConcurrencyGovernor._default is None:
+                ConcurrencyGovernor._default = ConcurrencyGovernor(
+                    ConcurrencyGovernor._get_env_limit(ConcurrencyGovernor.ENV_MAX_TOTAL),
+                    ConcurrencyGovernor._get_env_limit(ConcurrencyGovernor.ENV_MAX_PER_HOST),
+                    ConcurrencyGovernor._get_env_limit(ConcurrencyGovernor.ENV_MAX_PER_REPOSITORY))
+            return ConcurrencyGovernor._default
+
+    @staticmethod
+    def _get_env_limit(name):
+        value = os.environ.get(name)
+        if not value:
+            return None
+        if not value.isdigit() or int(value) <= 0:
+            raise ValueError('Environment variable "%s" must be a positive integer.' % name)
+        return int(value)
+
+    def acquire(self, reservation_id, cancel_sampler, host = None, repository = None):
+        """
+        Blocks until a slot is available for the host / repository (either may be None, when the caller does not
+        work against it), or the command is cancelled.
+        :type reservation_id: str
+        :type cancel_sampler: CancellationSampler
+        :type host: str
+        :type repository: str
+        :rtype ConcurrencySlot
+        """
+        start_time = time.time()
+        request = ConcurrencyGovernor._Request(reservation_id, host, repository)
+        with self._condition:
+            self._queues.setdefault(reservation_id, deque()).append(request)
+            self._queued += 1
+            self._dispatch()
+            while not request.granted:
+                if cancel_sampler.is_cancelled():
+                    self._remove(request)
+                    cancel_sampler.throw()
+                self._condition.wait(self.CANCEL_CHECK_INTERVAL_SECONDS)
+
+            wait_seconds = time.time() - start_time
+            self._wait_count += 1
+            self._total_wait_seconds += wait_seconds
+            self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+        return ConcurrencySlot(self, request, wait_seconds)
+
+    def metrics(self):
+        """
+        :return: Queue wait statistics and the current load.
+        :rtype dict
+        """
+        with self._condition:
+            return {
+                'slots_granted': self._wait_count,
+                'total_queue_wait_seconds': self._total_wait_seconds,
+                'max_queue_wait_seconds': self._max_wait_seconds,
+                'queued': self._queued,
+                'running': self._running_total,
+            }
+
+    def _release(self, request):
+        with self._condition:
+            self._running_total -= 1
+            if request.host is not None:
+                self._decrement(self._running_per_host, request.host)
+            if request.repository is not None:
+                self._decrement(self._running_per_repository, request.repository)
+            self._dispatch()
+
+    def _decrement(self, counter, key):
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    def _remove(self, request):
+        queue = self._queues.get(request.reservation_id)
+        if queue is not None and request in queue:
+            queue.remove(request)
+            self._queued -= 1
+            if not queue:
+                del self._queues[request.reservation_id]
+
+    def _dispatch(self):
+        """
+        Grants slots to the waiting requests, one reservation at a time: the served reservation moves to the end of
+        the line. Must be called holding the condition lock.
+        """
+        granted = False
+        while True:
+            request = None
+            for queue in self._queues.values():
+                request = next((r for r in queue if self._fits(r)), None)
+                if request is not None:
+                    break
+            if request is None:
+                break
+            self._remove(request)
+            if request.reservation_id in self._queues:
+                self._queues.move_to_end(request.reservation_id)
+            self._running_total += 1
+            if request.host is not None:
+                self._running_per_host[request.host] += 1
+            if request.repository is not None:
+                self._running_per_repository[request.repository] += 1
+            request.granted = True
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def _fits(self, request):
+        if self.max_total is not None and self._running_total >= self.max_total:
+            return False
+        if request.host is not None and self.max_per_host is not None and \
+                self._running_per_host[request.host] >= self.max_per_host:
+            return False
+        if request.repository is not None and self.max_per_repository is not None and \
+                self._running_per_repository[request.repository] >= self.max_per_repository:
+            return False
+        return True
@@ -0,0 +1,194 @@
+import codecs
+import threading
+import time
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.detached_poller import DetachedPoller
+from cloudshell.cm.customscript.domain.script_executor import ErrorMsg
+
+
+class DetachedPollResult(object):
+    def __init__(self, exit_code, std_out, std_err):
+        """
+        :param exit_code: The exit code of the script, None while it is still running.
+        :type exit_code: int
+        :param std_out: New stdout bytes since the previous poll.
+        :type std_out: bytes
+        :param std_err: New stderr bytes since the previous poll.
+        :type std_err: bytes
+        """
+        self.exit_code = exit_code
+        self.std_out = std_out
+        self.std_err = std_err
+
+
+class DetachedExecution(object):
+    """
+    Tracks a script that was launched detached from the connection (see ExecutionConfiguration.detached), by polling
+    its exit code and reading only the output bytes written since the previous poll.
+    The polls run in the threads of the DetachedPoller shared by the driver process, over the connection of the
+    executor (in the polling thread, not in the pool of the executor): no channel or winrm command is held open
+    between polls, and the calling thread only writes the output it is handed and watches for cancellation and for
+    the deadline. A failed poll (e.g. a dropped connection) is retried after reconnecting, since the script itself
+    keeps running on the target. On cancellation or when the deadline passes, the process tree of the script is
+    killed on the target.
+    """
+    MAX_CONSECUTIVE_POLL_FAILURES = 30
+    MAX_READ_BYTES = 1024 * 1024
+    CHECK_INTERVAL_SECONDS = 1
+
+    def __init__(self, executor, tmp_folder, logger, cancel_sampler, poll_interval_seconds, deadline_minutes = None,
+                 poller = None):
+        """
+        :param executor: An executor implementing 'poll_detached(tmp_folder, stdout_offset, stderr_offset,
+                         max_read_bytes)', 'kill_script(tmp_folder)' and 'connect()', with a 'script_result'
+                         recording its exit code, output and poll retries (None = not recorded).
+        :type tmp_folder: str
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type poll_interval_seconds: float
+        :param deadline_minutes: Max run time, counted from now (None = no deadline).
+        :type deadline_minutes: float
+        :param poller: Runs the polls (None = the one of the driver process).
+        :type poller: DetachedPoller
+        """
+        self.executor = executor
+        self.tmp_folder = tmp_folder
+        self.logger = logger
+        self.cancel_sampler = cancel_sampler
+        self.poll_interval_seconds = poll_interval_seconds
+        self.deadline_minutes = deadline_minutes
+        self.deadline = time.time() + deadline_minutes * 60 if deadline_minutes else None
+        self.poller = poller or DetachedPoller.get_default()
+
+        self._print_output = True
+        self._stdout_offset = self._stderr_offset = 0
+        self._stdout_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._stderr_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._std_err = []
+        self._failures = 0
+        self._reconnect = False
+        self._output = []
+        self._output_lock = threading.Lock()
+        self._woken = threading.Event()
+        self._stopped = False
+        self._done = False
+        self._exit_code = None
+        self._error = None
+
+    def wait(self, output_writer, print_output=True):
+        """
+        Waits until the script exits, writing its output to the reservation as it is produced.
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        """
+        self._print_output = print_output
+        try:
+            self._throw_if_canceled_or_expired()
+            self.poller.track(self)
+            try:
+                while not self._done:
+                    self._woken.wait(self.CHECK_INTERVAL_SECONDS)
+                    self._woken.clear()
+                    self._write_output(output_writer)
+                    self._throw_if_canceled_or_expired()
+            finally:
+                self._stopped = True
+        except CancellationException:
+            self._kill()
+            raise
+        self._write_output(output_writer)
+
+        if self._error is not None:
+            raise Exception(ErrorMsg.RUN_SCRIPT % ('Lost track of the script (it may still be running on the '
+                                                   'target machine): %s' % str(self._error)))
+        self.logger.debug('ReturnedCode:' + str(self._exit_code))
+        if self.executor.script_result:
+            self.executor.script_result.set_exit_code(self._exit_code)
+        if self._exit_code != 0:
+            raise Exception(ErrorMsg.RUN_SCRIPT % ''.join(self._std_err))
+
+    def poll_once(self):
+        """
+        Polls the script once, in a thread of the poller. Never raises: the output and the outcome are handed to wait.
+        :return: The seconds until the next poll, None once the polling is over.
+        :rtype float
+        """
+        if self._stopped:
+            return None
+        if self._reconnect:
+            self._reconnect = False
+            self._try_reconnect()
+        try:
+            result = self.executor.poll_detached(self.tmp_folder, self._stdout_offset, self._stderr_offset,
+                                                 self.MAX_READ_BYTES)
+        except Exception as e:
+            self._failures += 1
+            if self.executor.script_result:
+                self.executor.script_result.add_retry('poll')
+            if self._failures >= self.MAX_CONSECUTIVE_POLL_FAILURES:
+                self._error = e
+                return self._finish()
+            self.logger.warning('Failed to poll the detached script (%s/%s): %s' %
+                                (self._failures, self.MAX_CONSECUTIVE_POLL_FAILURES, str(e)))
+            self._reconnect = True
+            return self.poll_interval_seconds
+        self._failures = 0
+
+        self._stdout_offset += len(result.std_out)
+        self._stderr_offset += len(result.std_err)
+        new_std_out = self._stdout_decoder.decode(result.std_out)
+        new_std_err = self._stderr_decoder.decode(result.std_err)
+        self._std_err.append(new_std_err)
+        if self._print_output:
+            with self._output_lock:
+                self._output.append((new_std_out, new_std_err))
+
+        more_to_read = len(result.std_out) >= self.MAX_READ_BYTES or len(result.std_err) >= self.MAX_READ_BYTES
+        if result.exit_code is not None and not more_to_read:
+            self._exit_code = result.exit_code
+            return self._finish()
+        self._woken.set()
+        return 0 if more_to_read else self.poll_interval_seconds
+
+    def _finish(self):
+        self._done = True
+        self._woken.set()
+        return None
+
+    def _write_output(self, output_writer):
+        with self._output_lock:
+            output, self._output = self._output, []
+        for std_out, std_err in output:
+            if self.executor.script_result:
+                self.executor.script_result.add_output(std_out, std_err)
+            output_writer.write(std_out)
+            output_writer.write(std_err)
+
+    def _throw_if_canceled_or_expired(self):
+        self.cancel_sampler.throw_if_canceled()
+        if self.deadline is not None and time.time() >= self.deadline:
+            self._kill()
+            raise Exception(ErrorMsg.RUN_SCRIPT % (ErrorMsg.DEADLINE_EXCEEDED % self.deadline_minutes))
+
+    def _kill(self):
+        self._stopped = True
+        self.logger.info('Killing the detached script on target machine ...')
+        try:
+            self.executor.kill_script(self.tmp_folder)
+        except Exception as e:
+            # the connection may have been closed by the cancellation (or dropped), the script is still running
+            self.logger.warning('Failed to kill the detached script (%s), reconnecting ...' % str(e))
+            try:
+                self.executor.connect()
+                self.executor.kill_script(self.tmp_folder)
+            except Exception as e:
+                self.logger.error('Failed to kill the detached script on target machine: %s' % str(e))
+                return
+        self.logger.info('Done.')
+
+    def _try_reconnect(self):
+        try:
+            self.executor.connect()
+        except Exception as e:
+            self.logger.warning('Failed to reconnect to the target machine: %s' % str(e))
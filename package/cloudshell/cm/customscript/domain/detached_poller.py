@@ -0,0 +1,76 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class DetachedPoller(object):
+    """
+    Polls the detached scripts of the whole driver process (see DetachedExecution) with a handful of threads: the
+    runs wait in a queue ordered by their next poll time, and the first free thread polls a run once it is due - so
+    hundreds of detached scripts are tracked by DEFAULT_THREADS threads, instead of each holding a thread between
+    polls. A poll goes over the connection of the executor of its run, so with ssh multiplexing the runs of a host
+    are polled over the connections shared in the SshConnectionPool.
+    """
+    DEFAULT_THREADS = 4
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, threads = DEFAULT_THREADS):
+        """
+        :param threads: Max threads polling at once, started as runs are tracked.
+        :type threads: int
+        """
+        self.threads = threads
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._workers = []
+
+    @staticmethod
+    def get_default():
+        """
+        The poller shared by the whole driver process.
+        :rtype DetachedPoller
+        """
+        with DetachedPoller._default_lock:
+            if DetachedPoller._default is None:
+                DetachedPoller._default = DetachedPoller()
+            return DetachedPoller._default
+
+    def track(self, run):
+        """
+        Polls the run right away, then again and again until it is over.
+        :param run: An object implementing 'poll_once()', which polls once and returns the seconds until the next
+                    poll (None = over), without raising.
+        """
+        with self._condition:
+            if len(self._workers) < self.threads:
+                worker = threading.Thread(target=self._work, name='DetachedPoller-%s' % len(self._workers))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._schedule(run, 0)
+
+    def workers_count(self):
+        """
+        :rtype int
+        """
+        with self._condition:
+            return len(self._workers)
+
+    def _schedule(self, run, delay):
+        with self._condition:
+            heapq.heappush(self._queue, (time.time() + delay, next(self._sequence), run))
+            self._condition.notify()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.time():
+                    self._condition.wait(self._queue[0][0] - time.time() if self._queue else None)
+                _, _, run = heapq.heappop(self._queue)
+            delay = run.poll_once()
+            if delay is not None:
+                self._schedule(run, delay)
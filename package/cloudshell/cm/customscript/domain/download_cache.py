@@ -0,0 +1,496 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class CachedDownload(object):
+    def __init__(self, url_key, file_name, sha256, size, etag = None, last_modified = None):
+        """
+        An entry of the download cache index.
+        :param url_key: sha256 of the url (the url itself may hold a token, it is not kept on disk).
+        :type url_key: str
+        :type file_name: str
+        :param sha256: Hex digest of the content, also the name of its blob.
+        :type sha256: str
+        :type size: int
+        :param etag: The 'ETag' validator of the response.
+        :type etag: str
+        :param last_modified: The 'Last-Modified' validator of the response.
+        :type last_modified: str
+        """
+        self.url_key = url_key
+        self.file_name = file_name
+        self.sha256 = sha256
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def get_validator_headers(self):
+        """
+        The headers of a conditional request, answered with '304 Not Modified' while the cached content is current.
+        :rtype dict
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class PartialDownload(object):
+    def __init__(self, path, lock_file, cache_lock = None):
+        """
+        The content received so far of an interrupted download, kept so a later attempt - of this or of another driver
+        process - resumes it. Held exclusively (lock_file) until closed.
+        :param path: The content file, its validator is kept in '<path>.validator'.
+        :type path: str
+        :type lock_file: file
+        :param cache_lock: Returns the lock of the whole cache, held to remove the lock file when the partial content
+                           is discarded (None = the lock file is kept).
+        :type cache_lock: () -> _FileLock
+        """
+        self.path = path
+        self.validator_path = path + '.validator'
+        self.lock_file = lock_file
+        self.cache_lock = cache_lock
+        self._file = None
+
+    def load(self, validator):
+        """
+        :param validator: The ETag / Last-Modified of the content being downloaded.
+        :type validator: str
+        :return: The size of the content received so far (see iter_content), 0 when it was received for another
+                 validator (a previous version of the file).
+        :rtype int
+        """
+        try:
+            with open(self.validator_path, 'rb') as f:
+                stored_validator = f.read().decode('utf-8')
+            if stored_validator == validator:
+                size = os.path.getsize(self.path)
+                self._file = open(self.path, 'ab')
+                return size
+        except (OSError, ValueError):
+            pass
+        self.reset(validator)
+        return 0
+
+    def iter_content(self, chunk_size):
+        """
+        The content received so far, read from the disk chunk by chunk.
+        :type chunk_size: int
+        :rtype collections.Iterable[bytes]
+        """
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def reset(self, validator):
+        """
+        Starts over, for the content of the validator.
+        :type validator: str
+        """
+        if self._file:
+            self._file.close()
+        self._file = open(self.path, 'wb')
+        with open(self.validator_path, 'wb') as f:
+            f.write(validator.encode('utf-8'))
+
+    def append(self, data):
+        """
+        :type data: bytes
+        """
+        self._file.write(data)
+
+    def discard(self):
+        """
+        Removes the partial content (the download completed), and closes it. The lock file is removed under the lock
+        of the whole cache, which the partial contents are opened under (see DownloadCache.open_partial): removed
+        while it is held, another download could lock a new file of the same name while a third one still holds
+        the removed one.
+        """
+        if self._file:
+            self._file.close()
+            self._file = None
+        for path in (self.path, self.validator_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if self.cache_lock is None:
+            self.close()
+            return
+        with self.cache_lock():
+            self.close()
+            _remove_lock_file(self.path)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.lock_file:
+            _unlock_file(self.lock_file)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class DownloadCache(object):
+    """
+    Keeps downloaded scripts on disk, so they survive the recycling of the driver process.
+    The content is stored once per sha256 (blobs/<sha256>), the index maps the urls to their blob, file name and
+    http validators (ETag / Last-Modified). A cached content is served only after the repository answered a
+    conditional request (with the caller's credentials) with '304 Not Modified'.
+    Any number of driver processes can share the folder: the index is read and replaced under a file lock, and blobs
+    and index are written to a temp file first and renamed into place. The least recently used entries are evicted
+    when the total size exceeds the cap, and a blob that does not match its digest is dropped on read.
+    """
+    ENV_FOLDER = 'CUSTOMSCRIPT_DOWNLOAD_CACHE_DIR'
+    ENV_MAX_MB = 'CUSTOMSCRIPT_DOWNLOAD_CACHE_MAX_MB'
+    DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = 'index.lock'
+    BLOBS_FOLDER = 'blobs'
+    PARTIAL_FOLDER = 'partial'
+    PARTIAL_MAX_AGE_SECONDS = 24 * 3600
+    ORPHAN_BLOB_AGE_SECONDS = 3600
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, folder, max_bytes = DEFAULT_MAX_BYTES):
+        """
+        :type folder: str
+        :param max_bytes: Cap of the total size of the cached content.
+        :type max_bytes: int
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.blobs_folder = os.path.join(folder, self.BLOBS_FOLDER)
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.blobs_folder):
+            os.makedirs(self.blobs_folder, exist_ok=True)
+
+    @staticmethod
+    def get_default():
+        """
+        The cache of the folder in ENV_FOLDER (capped to ENV_MAX_MB, DEFAULT_MAX_BYTES when unset).
+        :return: The cache, None when ENV_FOLDER is not set (no disk cache).
+        :rtype DownloadCache
+        """
+        with DownloadCache._default_lock:
+            folder = os.environ.get(DownloadCache.ENV_FOLDER)
+            if not folder:
+                return None
+            if DownloadCache._default is None or DownloadCache._default.folder != folder:
+                max_mb = os.environ.get(DownloadCache.ENV_MAX_MB)
+                if max_mb and (not max_mb.isdigit() or int(max_mb) <= 0):
+                    raise ValueError('Environment variable "%s" must be a positive integer.' % DownloadCache.ENV_MAX_MB)
+                max_bytes = int(max_mb) * 1024 * 1024 if max_mb else DownloadCache.DEFAULT_MAX_BYTES
+                DownloadCache._default = DownloadCache(folder, max_bytes)
+            return DownloadCache._default
+
+    @staticmethod
+    def get_url_key(url):
+        """
+        :type url: str
+        :rtype str
+        """
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def lookup(self, url):
+        """
+        :type url: str
+        :rtype CachedDownload
+        """
+        url_key = self.get_url_key(url)
+        with self._index_lock():
+            entry = self._read_index().get(url_key)
+        if entry is None:
+            return None
+        return CachedDownload(url_key, entry['file_name'], entry['sha256'], entry['size'], entry.get('etag'),
+                              entry.get('last_modified'))
+
+    def read(self, cached):
+        """
+        Maps the blob of the entry into memory and verifies it against its digest, marking the entry as used.
+        :type cached: CachedDownload
+        :return: The content (a read only mmap, closed by the caller - e.g. with ScriptBundle.close -, bytes when
+                 empty), None when the blob is missing or corrupted - the entry is dropped then.
+        :rtype mmap.mmap | bytes
+        """
+        data = self._map_blob(cached.sha256)
+        if data is None or len(data) != cached.size or hashlib.sha256(data).hexdigest() != cached.sha256:
+            if hasattr(data, 'close'):
+                data.close()
+            with self._index_lock():
+                index = self._read_index()
+                index.pop(cached.url_key, None)
+                self._remove_unreferenced_blobs(index, [cached.sha256])
+                self._write_index(index)
+            return None
+
+        with self._index_lock():
+            index = self._read_index()
+            if cached.url_key in index:
+                index[cached.url_key]['last_used'] = time.time()
+                self._write_index(index)
+        return data
+
+    def store(self, url, file_name, data, etag = None, last_modified = None):
+        """
+        Adds (or replaces) the content of the url, evicting the least recently used entries beyond the size cap.
+        :type url: str
+        :type file_name: str
+        :type data: bytes
+        :type etag: str
+        :type last_modified: str
+        :return: False when the content alone exceeds the size cap (nothing is stored).
+        :rtype bool
+        """
+        if len(data) > self.max_bytes:
+            return False
+        sha256 = hashlib.sha256(data).hexdigest()
+        self._write_blob(sha256, data)
+
+        with self._index_lock():
+            index = self._read_index()
+            previous = index.get(self.get_url_key(url))
+            index[self.get_url_key(url)] = {'file_name': file_name, 'sha256': sha256, 'size': len(data),
+                                            'etag': etag, 'last_modified': last_modified, 'last_used': time.time()}
+            removed = [previous['sha256']] if previous else []
+            removed += self._evict(index)
+            removed += self._get_orphan_blobs()
+            self._remove_unreferenced_blobs(index, removed)
+            self._write_index(index)
+        return True
+
+    def open_partial(self, url):
+        """
+        The partial content of the url (see PartialDownload), partial contents not resumed for
+        PARTIAL_MAX_AGE_SECONDS are removed.
+        :type url: str
+        :return: None when the url is being downloaded by another thread or process.
+        :rtype PartialDownload
+        """
+        folder = os.path.join(self.folder, self.PARTIAL_FOLDER)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        self._remove_stale_partials(folder)
+
+        path = os.path.join(folder, self.get_url_key(url))
+        with self._index_lock():
+            self._remove_stale_partials(folder)
+            lock_file = open(path + '.lock', 'a+b')
+            if not _try_lock_file(lock_file):
+                lock_file.close()
+                return None
+        return PartialDownload(path, lock_file, self._index_lock)
+
+    def _remove_stale_partials(self, folder):
+        """
+        Removes the partial contents not resumed for PARTIAL_MAX_AGE_SECONDS, and the lock files left without a
+        content (e.g. by a process that died). Called under the lock of the whole cache.
+        :type folder: str
+        """
+        now = time.time()
+        for name in os.listdir(folder):
+            if not name.endswith('.lock'):
+                continue
+            path = os.path.join(folder, name[:-len('.lock')])
+            try:
+                if os.path.exists(path) and now - os.path.getmtime(path) <= self.PARTIAL_MAX_AGE_SECONDS:
+                    continue
+                lock_file = open(path + '.lock', 'a+b')
+            except OSError:
+                continue
+            if _try_lock_file(lock_file):
+                PartialDownload(path, lock_file).discard()
+                _remove_lock_file(path)
+            else:
+                lock_file.close()
+
+    def _evict(self, index):
+        """
+        :type index: dict
+        :return: The digests of the evicted entries.
+        :rtype list[str]
+        """
+        sizes = dict((entry['sha256'], entry['size']) for entry in index.values())
+        total = sum(sizes.values())
+        evicted = []
+        for url_key, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            del index[url_key]
+            evicted.append(entry['sha256'])
+            if not any(e['sha256'] == entry['sha256'] for e in index.values()):
+                total -= sizes[entry['sha256']]
+        return evicted
+
+    def _get_orphan_blobs(self):
+        """
+        The blobs that could not be removed when they were dropped (still mapped on windows), or whose process died
+        before indexing them. Recent blobs may be about to be indexed by another process, they are left alone.
+        :rtype list[str]
+        """
+        orphans = []
+        now = time.time()
+        for name in os.listdir(self.blobs_folder):
+            try:
+                if not name.startswith('.') and now - os.path.getmtime(self._get_blob_path(name)) > self.ORPHAN_BLOB_AGE_SECONDS:
+                    orphans.append(name)
+            except OSError:
+                pass
+        return orphans
+
+    def _remove_unreferenced_blobs(self, index, sha256s):
+        referenced = set(entry['sha256'] for entry in index.values())
+        for sha256 in set(sha256s) - referenced:
+            try:
+                os.remove(self._get_blob_path(sha256))
+            except OSError:
+                # already removed, or still mapped (windows) - removed later as an orphan
+                pass
+
+    def _get_blob_path(self, sha256):
+        return os.path.join(self.blobs_folder, sha256)
+
+    def _map_blob(self, sha256):
+        try:
+            with open(self._get_blob_path(sha256), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    def _write_blob(self, sha256, data):
+        path = self._get_blob_path(sha256)
+        try:
+            if os.path.getsize(path) == len(data):
+                # content addressed - the same content was already written (a corrupted blob is dropped on read),
+                # refreshed so it is not taken for an orphan before it is indexed
+                os.utime(path, None)
+                return
+        except OSError:
+            pass
+        self._write_atomic(path, data)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.folder, self.INDEX_FILE), 'rb') as f:
+                index = json.loads(f.read().decode('utf-8'))
+            return index if isinstance(index, dict) else {}
+        except (OSError, ValueError):
+            # missing, or corrupted - starting over, the blobs are dropped as the entries are re-added
+            return {}
+
+    def _write_index(self, index):
+        self._write_atomic(os.path.join(self.folder, self.INDEX_FILE), json.dumps(index).encode('utf-8'))
+
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _index_lock(self):
+        return _FileLock(os.path.join(self.folder, self.LOCK_FILE), self._lock)
+
+
+def _try_lock_file(lock_file):
+    """
+    Locks the file exclusively, without waiting.
+    :rtype bool
+    """
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _remove_lock_file(path):
+    """
+    Removes the (closed) lock file of a partial content, under the lock of the whole cache.
+    :param path: The content file of the partial content.
+    :type path: str
+    """
+    try:
+        os.remove(path + '.lock')
+    except OSError:
+        pass
+
+
+def _unlock_file(lock_file):
+    if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class _FileLock(object):
+    """
+    An exclusive lock shared by the threads (thread_lock) and the processes (a lock on lock_path) using the cache.
+    """
+    def __init__(self, lock_path, thread_lock):
+        self.lock_path = lock_path
+        self.thread_lock = thread_lock
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            self._file = open(self.lock_path, 'a+b')
+            if fcntl:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        self._file.seek(0)
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after 10 seconds
+                        pass
+        except:
+            if self._file:
+                self._file.close()
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            _unlock_file(self._file)
+        finally:
+            self._file.close()
+            self.thread_lock.release()
@@ -0,0 +1,342 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from cloudshell.cm.customscript.domain import json_backend
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+
+# longer errors (e.g. with the stderr of a script) keep their head and tail, see _truncate_error
+MAX_ERROR_LENGTH = 2000
+# per output stream of a script, see _TruncatedOutput
+MAX_OUTPUT_LENGTH = 4000
+
+
+def _truncate_error(error):
+    """
+    :type error: Exception
+    :return: The message of the error, and whether it was truncated.
+    :rtype tuple[str, bool]
+    """
+    text = str(error)
+    if len(text) <= MAX_ERROR_LENGTH:
+        return text, False
+    half = MAX_ERROR_LENGTH // 2
+    return _join_truncated(text[:half], len(text) - 2 * half, text[-half:]), True
+
+
+def _join_truncated(head, truncated_count, tail):
+    return '%s ...[%s characters truncated]... %s' % (head, truncated_count, tail)
+
+
+class _TruncatedOutput(object):
+    """
+    An output stream of a script, appended as it is produced (e.g. by the polls of a detached script): only its head
+    and tail are kept, up to MAX_OUTPUT_LENGTH characters in all - the middle of a longer output is dropped.
+    """
+
+    def __init__(self):
+        self._head = ''
+        self._tail = ''
+        self.length = 0
+
+    def append(self, text):
+        """
+        :type text: str
+        """
+        half = MAX_OUTPUT_LENGTH // 2
+        self.length += len(text)
+        if len(self._head) < half:
+            taken = half - len(self._head)
+            self._head += text[:taken]
+            text = text[taken:]
+        self._tail = (self._tail + text)[-half:]
+
+    @property
+    def truncated(self):
+        """
+        :rtype bool
+        """
+        return self.length > MAX_OUTPUT_LENGTH
+
+    def __str__(self):
+        if not self.truncated:
+            return self._head + self._tail
+        return _join_truncated(self._head, self.length - len(self._head) - len(self._tail), self._tail)
+
+
+class _RecordedResult(object):
+    """
+    The status, phase timings and retry counts of a host or a script, updated as the phases complete (from the
+    threads of the batch, hence the lock).
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    SKIPPED = 'skipped'
+    CACHED = 'cached'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status = self.PENDING
+        self.error = None
+        self.error_truncated = False
+        self.phases = OrderedDict()
+        self.retries = {}
+        self._start_time = None
+        self._end_time = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the run time of the 'with' block to the phase 'name' (a phase that runs again, e.g. a reconnection,
+        adds up), also when it fails.
+        :type name: str
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start_time)
+
+    def add_phase(self, name, seconds):
+        """
+        :type name: str
+        :type seconds: float
+        """
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + float(seconds)
+
+    def add_retry(self, name):
+        """
+        :param name: What was retried (e.g. 'connect').
+        :type name: str
+        """
+        with self._lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def start(self):
+        with self._lock:
+            self.status = self.RUNNING
+            self._start_time = time.time()
+
+    def finish(self, error = None):
+        """
+        :param error: The error the host or script failed with (None = succeeded).
+        :type error: Exception
+        """
+        with self._lock:
+            self._end_time = time.time()
+            if error is None:
+                # a cached or skipped run keeps its status
+                if self.status in (self.PENDING, self.RUNNING):
+                    self.status = self.SUCCEEDED
+                return
+            self.status = self.CANCELLED if isinstance(error, CancellationException) else self.FAILED
+            self.error, self.error_truncated = _truncate_error(error)
+
+    def set_status(self, status):
+        """
+        :type status: str
+        """
+        with self._lock:
+            self.status = status
+
+    def _to_dict(self):
+        # wall time: phases may overlap (e.g. the download and the connection of execute_script)
+        seconds = 0.0
+        if self._start_time is not None:
+            seconds = (self._end_time or time.time()) - self._start_time
+        return OrderedDict([
+            ('status', self.status),
+            ('seconds', round(seconds, 3)),
+            ('phases', OrderedDict((name, round(seconds, 3)) for name, seconds in self.phases.items())),
+            ('retries', dict(self.retries)),
+            ('error', self.error),
+            ('errorTruncated', self.error_truncated),
+        ])
+
+
+class HostResult(_RecordedResult):
+    def __init__(self, host_conf):
+        """
+        A host connected to once for the whole batch (preflight).
+        :type host_conf: HostConfiguration
+        """
+        super(HostResult, self).__init__()
+        self.host = host_conf.ip
+        self.connection_method = host_conf.connection_method
+
+    def to_dict(self):
+        """
+        :rtype dict
+        """
+        with self._lock:
+            result = OrderedDict([('host', self.host), ('connectionMethod', self.connection_method)])
+            result.update(self._to_dict())
+            return result
+
+
+class ScriptResult(_RecordedResult):
+    def __init__(self, index, script_conf):
+        """
+        :param index: Position of the configuration in the command.
+        :type index: int
+        :type script_conf: ScriptConfiguration
+        """
+        super(ScriptResult, self).__init__()
+        self.index = index
+        self.id = script_conf.id
+        self.host = script_conf.host_conf.ip
+        self.connection_method = script_conf.host_conf.connection_method
+        # the path only - the query of the url may hold a token
+        self.url = urlsplit(script_conf.script_repo.url or '').path
+        self.script = None
+        self.exit_code = None
+        self.bytes = OrderedDict([('downloaded', 0), ('uploaded', 0)])
+        self.stdout = _TruncatedOutput()
+        self.stderr = _TruncatedOutput()
+
+    def add_bytes(self, direction, count):
+        """
+        :param direction: 'downloaded' or 'uploaded'.
+        :type direction: str
+        :type count: int
+        """
+        with self._lock:
+            self.bytes[direction] += int(count or 0)
+
+    def add_output(self, std_out, std_err):
+        """
+        Appends the output the script produced (all of it, or what is new since the previous call).
+        :type std_out: str | bytes
+        :type std_err: str | bytes
+        """
+        with self._lock:
+            self.stdout.append(self._to_text(std_out))
+            self.stderr.append(self._to_text(std_err))
+
+    @staticmethod
+    def _to_text(output):
+        if isinstance(output, bytes):
+            return output.decode('utf-8', errors='replace')
+        return str(output or '')
+
+    def set_exit_code(self, exit_code):
+        """
+        :type exit_code: int
+        """
+        with self._lock:
+            self.exit_code = int(exit_code)
+
+    def set_script(self, name):
+        """
+        :param name: The file name of the downloaded script (the entry point of a bundle).
+        :type name: str
+        """
+        with self._lock:
+            self.script = str(name)
+
+    def to_dict(self):
+        """
+        :rtype dict
+        """
+        with self._lock:
+            result = OrderedDict([('index', self.index), ('id', self.id), ('host', self.host),
+                                  ('connectionMethod', self.connection_method), ('url', self.url),
+                                  ('script', self.script), ('exitCode', self.exit_code)])
+            result.update(self._to_dict())
+            result['bytes'] = dict(self.bytes)
+            result['stdout'] = str(self.stdout)
+            result['stderr'] = str(self.stderr)
+            result['outputTruncated'] = self.stdout.truncated or self.stderr.truncated
+            return result
+
+
+class ExecutionResult(object):
+    """
+    The result document returned by execute_script / execute_scripts: every host connected to up front and every
+    script of the command, with its status, exit code, phase timings (queue, download, connect, upload, run, in
+    seconds), bytes transferred, retry counts, output (of the scripts that print it, see print_output) and error.
+    An error longer than MAX_ERROR_LENGTH, or an output stream longer than MAX_OUTPUT_LENGTH, is cut in the middle
+    and marked with "errorTruncated" / "outputTruncated". It is filled in as the phases complete, so the document of
+    a failed or cancelled command (see to_json) shows how far each script got.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self.hosts = []
+        self.scripts = []
+        self.status = _RecordedResult.RUNNING
+        self.error = None
+        self.seconds = None
+
+    def add_host(self, host_conf):
+        """
+        :type host_conf: HostConfiguration
+        :rtype HostResult
+        """
+        host_result = HostResult(host_conf)
+        with self._lock:
+            self.hosts.append(host_result)
+        return host_result
+
+    def add_script(self, script_conf):
+        """
+        :type script_conf: ScriptConfiguration
+        :rtype ScriptResult
+        """
+        with self._lock:
+            script_result = ScriptResult(len(self.scripts), script_conf)
+            self.scripts.append(script_result)
+        return script_result
+
+    def finish(self, error = None):
+        """
+        :param error: The error the command failed with (None = succeeded).
+        :type error: Exception
+        """
+        with self._lock:
+            self.seconds = time.time() - self._start_time
+            if error is None:
+                self.status = _RecordedResult.SUCCEEDED
+            else:
+                self.status = _RecordedResult.CANCELLED if isinstance(error, CancellationException) \
+                    else _RecordedResult.FAILED
+                self.error = _truncate_error(error)[0]
+
+    def to_dict(self):
+        """
+        :rtype dict
+        """
+        with self._lock:
+            hosts, scripts = list(self.hosts), list(self.scripts)
+            seconds = self.seconds if self.seconds is not None else time.time() - self._start_time
+            result = OrderedDict([('status', self.status), ('seconds', round(seconds, 3)), ('error', self.error)])
+        result['hosts'] = [host_result.to_dict() for host_result in hosts]
+        result['scripts'] = [script_result.to_dict() for script_result in scripts]
+        return result
+
+    def to_json(self):
+        """
+        :return: The document as compact json.
+        :rtype str
+        """
+        return json_backend.dumps(self.to_dict())
+
+
+@contextmanager
+def record_phase(recorded_result, name):
+    """
+    HostResult / ScriptResult .phase, when recording (recorded_result is not None).
+    :type name: str
+    """
+    if recorded_result is None:
+        yield
+    else:
+        with recorded_result.phase(name):
+            yield
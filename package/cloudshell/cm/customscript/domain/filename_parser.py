@@ -0,0 +1,125 @@
+import codecs
+import re
+import urllib.parse
+
+SCRIPT_EXTENSIONS = ('.sh', '.bash', '.ps1', '.tar.gz', '.tgz', '.zip')
+
+# no pattern can backtrack: single character classes, an unrolled loop of disjoint classes, a bounded match
+_PARAMETER_NAME_END = re.compile(r'[=;]')
+_QUOTED_STRING = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_QUOTED_PAIR = re.compile(r'\\(.)', re.DOTALL)
+_WHITESPACE = ' \t'
+# a bounded match, at most one per parameter (it must end the parameter)
+_QUERY_SCRIPT_EXTENSION = re.compile(r'(?:\.|%2e)(?:sh|bash|ps1|tar(?:\.|%2e)gz|tgz|zip)(?=&|$)', re.IGNORECASE)
+
+
+def get_script_name(name):
+    """
+    :param name: A file name or path (e.g. of a header), only its last component is kept.
+    :type name: str
+    :return: The name if it has a supported script extension, None otherwise.
+    :rtype str
+    """
+    if not name:
+        return None
+    name = name[max(name.rfind('/'), name.rfind('\\')) + 1:].strip()
+    lower_name = name.lower()
+    for ext in SCRIPT_EXTENSIONS:
+        if lower_name.endswith(ext) and len(name) > len(ext):
+            return name
+    return None
+
+
+def parse_content_disposition(value):
+    """
+    The file name of a Content-Disposition header (RFC 6266), in a single pass over the value: 'filename*' (an
+    RFC 5987 ext-value, e.g. UTF-8''na%C3%AFve.sh) takes precedence over 'filename' (a token or a quoted string).
+    The disposition type is not checked - unknown types are handled as 'attachment'.
+    :type value: str
+    :return: The file name, None when the header has none.
+    :rtype str
+    """
+    parameters = _parse_parameters(value or '')
+    if 'filename*' in parameters:
+        file_name = _decode_ext_value(parameters['filename*'])
+        if file_name:
+            return file_name
+    return parameters.get('filename') or None
+
+
+def get_url_filename(url):
+    """
+    The script file name of a url: the last segment of its path, the one before it (the gitlab api structure,
+    e.g. '/repository/files/testfile%2Eps1/raw?ref=master'), or the value of a query parameter
+    (e.g. '/download?file=scripts/setup.sh') - the first one with a supported script extension.
+    :type url: str
+    :rtype str
+    """
+    try:
+        parts = urllib.parse.urlsplit(url or '')
+    except ValueError:
+        return None
+    segments = parts.path.rsplit('/', 2)
+    for segment in reversed(segments[1:]):
+        file_name = get_script_name(urllib.parse.unquote(segment))
+        if file_name:
+            return file_name
+    # only the parameters ending with an extension are decoded, a long signed query is not split up
+    query = parts.query
+    for match in _QUERY_SCRIPT_EXTENSION.finditer(query):
+        parameter = query[query.rfind('&', 0, match.start()) + 1:match.end()]
+        file_name = get_script_name(urllib.parse.unquote_plus(parameter.partition('=')[2]))
+        if file_name:
+            return file_name
+    return None
+
+
+def _parse_parameters(value):
+    """
+    :return: The parameters of a header value ('type; name=value; name="quoted value"'), by lower case name.
+             The first occurrence of a parameter wins.
+    :rtype dict
+    """
+    parameters = {}
+    length = len(value)
+    pos = value.find(';')
+    while 0 <= pos < length:
+        name_end = _PARAMETER_NAME_END.search(value, pos + 1)
+        if name_end is None:
+            break
+        name = value[pos + 1:name_end.start()].strip(_WHITESPACE).lower()
+        pos = name_end.start()
+        if value[pos] == ';':
+            continue
+
+        pos += 1
+        while pos < length and value[pos] in _WHITESPACE:
+            pos += 1
+        if pos < length and value[pos] == '"':
+            quoted = _QUOTED_STRING.match(value, pos + 1)
+            parameter = _QUOTED_PAIR.sub(r'\1', quoted.group())
+            pos = value.find(';', quoted.end())
+        else:
+            end = value.find(';', pos)
+            parameter = value[pos:end if end >= 0 else length].strip(_WHITESPACE)
+            pos = end
+        parameters.setdefault(name, parameter)
+    return parameters
+
+
+def _decode_ext_value(value):
+    """
+    :param value: charset'language'percent-encoded value
+    :type value: str
+    :return: The decoded value, None when it is malformed or of an unknown charset.
+    :rtype str
+    """
+    charset, quote, rest = value.partition("'")
+    _, quote2, encoded = rest.partition("'")
+    if not quote or not quote2:
+        return None
+    try:
+        # unquote only decodes the escaped bytes, an unknown charset must be caught up front
+        return urllib.parse.unquote(encoded, encoding=codecs.lookup(charset or 'utf-8').name, errors='strict')
+    except (LookupError, UnicodeDecodeError):
+        return None
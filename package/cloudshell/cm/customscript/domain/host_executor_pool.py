@@ -0,0 +1,99 @@
+import threading
+from collections import Counter, defaultdict
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor
+
+
+class HostExecutorPool(object):
+    """
+    The executors the configurations of a dependency graph run with, per host: a configuration takes an idle executor
+    of its host, or opens another one while the host has fewer than its limit - so configurations of the same host run
+    at the same time, each with an executor of its own. The limit of a host is max_per_host when its executors are
+    multiplexed (see IScriptExecutor.is_multiplexed), otherwise 1: the scripts of the host run one at a time on the
+    executor of the preflight, instead of each opening a connection.
+    """
+    CANCEL_CHECK_INTERVAL_SECONDS = 1
+
+    def __init__(self, services, open_executor, close_executor, max_per_host = None):
+        """
+        :param services: The connected executors of the preflight by host key, owned by the caller.
+        :type services: dict
+        :param open_executor: Opens another executor of a host for a configuration.
+        :type open_executor: (ScriptConfiguration) -> IScriptExecutor
+        :param close_executor: Closes an executor opened by open_executor (see close).
+        :type close_executor: (IScriptExecutor) -> None
+        :param max_per_host: Max executors of a multiplexed host (None = unlimited).
+        :type max_per_host: int
+        """
+        self._open_executor = open_executor
+        self._close_executor = close_executor
+        self._limits = dict((key, max_per_host if service.is_multiplexed() else 1) for key, service in services.items())
+        self._idle = defaultdict(list)
+        for key, service in services.items():
+            self._idle[key].append(service)
+        self._counts = Counter(services.keys())
+        self._opened = []
+        self._condition = threading.Condition()
+
+    def acquire(self, key, script_conf, cancel_sampler):
+        """
+        Waits for an idle executor of the host, or opens another one when the host is below its limit.
+        :type key: tuple
+        :type script_conf: ScriptConfiguration
+        :type cancel_sampler: CancellationSampler
+        :rtype IScriptExecutor
+        """
+        with self._condition:
+            while not self._idle[key]:
+                limit = self._limits[key]
+                if limit is None or self._counts[key] < limit:
+                    self._counts[key] += 1
+                    break
+                cancel_sampler.throw_if_canceled()
+                self._condition.wait(self.CANCEL_CHECK_INTERVAL_SECONDS)
+            else:
+                return self._idle[key].pop()
+
+        try:
+            executor = self._open_executor(script_conf)
+        except:
+            with self._condition:
+                self._counts[key] -= 1
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._opened.append(executor)
+        return executor
+
+    def release(self, key, executor):
+        """
+        :type key: tuple
+        :type executor: IScriptExecutor
+        """
+        with self._condition:
+            self._idle[key].append(executor)
+            self._condition.notify_all()
+
+    def retire(self, key):
+        """
+        Closes the idle executors the pool opened for a host that has nothing more to run, without waiting for the
+        others to finish - the executor of the preflight is closed by its owner.
+        :type key: tuple
+        """
+        with self._condition:
+            idle = self._idle.pop(key, [])
+            opened = [executor for executor in idle if executor in self._opened]
+            for executor in opened:
+                self._opened.remove(executor)
+        for executor in opened:
+            self._close_executor(executor)
+
+    def close(self):
+        """
+        Closes the executors opened by the pool - the ones of the preflight are closed by their owner.
+        """
+        with self._condition:
+            opened, self._opened = self._opened, []
+        for executor in opened:
+            self._close_executor(executor)
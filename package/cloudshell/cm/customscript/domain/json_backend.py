@@ -0,0 +1,79 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def loads(text):
+    """
+    Decodes a json document, using orjson when it is installed.
+    :type text: str | bytes
+    :rtype object
+    """
+    if orjson is not None:
+        return orjson.loads(text)  # orjson.JSONDecodeError is a json.JSONDecodeError (ValueError)
+    return json.loads(text)
+
+
+def dumps(obj):
+    """
+    Encodes a compact json document (no whitespace), using orjson when it is installed.
+    :rtype str
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def iter_array(text):
+    """
+    Lazily decodes the items of a top level json array, one item at a time, so only the item being
+    processed is held as python objects (the input string itself is never copied or fully decoded).
+    Always decoded by the json module, even with orjson installed: orjson has no incremental decoding, and decoding
+    the whole array with it would hold every item at once - for no gain, building the python objects dominates (a
+    20000 items array decodes in the same time, and item by item, finding the end of every item in python first,
+    several times slower).
+    :type text: str | bytes
+    :rtype collections.Iterable[object]
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+
+    pos = _skip_whitespace(text, 0)
+    if not text.startswith('[', pos):
+        raise ValueError('Expected a json array at position %s' % pos)
+    pos = _skip_whitespace(text, pos + 1)
+    if text.startswith(']', pos):
+        _expect_end(text, pos + 1)
+        return
+
+    while True:
+        item, pos = _decoder.raw_decode(text, pos)
+        yield item
+        pos = _skip_whitespace(text, pos)
+        if text.startswith(',', pos):
+            pos = _skip_whitespace(text, pos + 1)
+        elif text.startswith(']', pos):
+            _expect_end(text, pos + 1)
+            return
+        else:
+            raise ValueError('Expected "," or "]" at position %s' % pos)
+
+
+def _skip_whitespace(text, pos):
+    length = len(text)
+    while pos < length and text[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _expect_end(text, pos):
+    pos = _skip_whitespace(text, pos)
+    if pos != len(text):
+        raise ValueError('Extra data at position %s' % pos)
@@ -1,31 +1,48 @@
+import hashlib
 import os
 import socket
+import threading
 import sys
 from io import StringIO
 import io
 from multiprocessing.pool import ThreadPool
 from threading import Thread
+import base64
 import binascii
 
 import time
-from paramiko import SSHClient, AutoAddPolicy, RSAKey
-from paramiko.ssh_exception import NoValidConnectionsError
+from paramiko import SSHClient, AutoAddPolicy, RSAKey, SFTPClient
+from paramiko.ssh_exception import NoValidConnectionsError, SSHException
 from scp import SCPClient, SCPException
 
 from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+from cloudshell.cm.customscript.domain.detached_execution import DetachedExecution, DetachedPollResult
+from cloudshell.cm.customscript.domain.execution_result import record_phase
+from cloudshell.cm.customscript.domain.memory_profiler import profile_phase
 from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
-from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration, UploadConfiguration
 from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ErrorMsg, ExcutorConnectionError
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
+from cloudshell.cm.customscript.domain.ssh_connection_pool import SshConnectionPool
 
 
 class LinuxScriptExecutor(IScriptExecutor):
     PasswordEnvVarName = 'cs_machine_pass'
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    DETACHED_STDOUT = '.cs_stdout'
+    DETACHED_STDERR = '.cs_stderr'
+    DETACHED_EXIT_CODE = '.cs_exit_code'
+    DETACHED_PID = '.cs_pid'
+    KILL_GRACE_SECONDS = 5
+    KEEPALIVE_SECONDS = 30
+    RESULT_MARKERS_PATH = '$HOME/.cloudshell/script_results'
+    RESULT_MARKERS_MAX_AGE_DAYS = 30
 
     class ExecutionResult(object):
         def __init__(self, exit_code, std_out, std_err):
             self.std_err = std_err
             self.std_out = std_out
+            self.exit_code = exit_code
             self.success = exit_code == 0
 
     def __init__(self, logger, target_host, cancel_sampler):
@@ -40,19 +57,31 @@ class LinuxScriptExecutor(IScriptExecutor):
         self.session = SSHClient()
         self.session.set_missing_host_key_policy(AutoAddPolicy())
         self.target_host = target_host
+        self._sftp_supported = None
+        self._shared_connection = None
+        self._channels = set()
+        self._channels_lock = threading.Lock()
+        self._workspace_folders = 0
+        # workspace subfolders not created yet, the first upload command into one creates it
+        self._pending_folders = set()
 
     def connect(self):
+        """
+        With ssh multiplexing, the connection is leased from the process wide SshConnectionPool (shared with the
+        other executors of the host) instead of opening one of its own. Every run still gets its own temp folder.
+        """
         try:
-            if self.target_host.password:
-                self.session.connect(self.target_host.ip, username=self.target_host.username, password=self.target_host.password)
-            elif self.target_host.access_key:
-                key_stream = StringIO(self.target_host.access_key)
-                key_obj = RSAKey.from_private_key(key_stream)
-                self.session.connect(self.target_host.ip, username=self.target_host.username, pkey=key_obj)
-            elif self.target_host.username:
-                raise Exception('Both password and access key are empty.')
+            multiplexing = self.target_host.ssh_multiplexing
+            if multiplexing:
+                if self._shared_connection:
+                    # reconnecting (e.g. the connection dropped): dead connections are not leased again
+                    self._shared_connection.release()
+                    self._shared_connection = None
+                self._shared_connection = SshConnectionPool.get_default().acquire(
+                    self._get_connection_key(), multiplexing.max_sessions, self._connect_shared_session)
+                self.session = self._shared_connection.client
             else:
-                raise Exception('Machine credentials are empty.')
+                self._connect_session(self.session)
         except NoValidConnectionsError as e:
             error_code = next(iter(e.errors.values()), type('e', (object,), {'errno': 0})).errno
             raise ExcutorConnectionError(error_code, e)
@@ -61,6 +90,67 @@ class LinuxScriptExecutor(IScriptExecutor):
         except Exception as e:
             raise ExcutorConnectionError(0, e)
 
+    def _connect_shared_session(self):
+        """
+        :rtype SSHClient
+        """
+        session = SSHClient()
+        session.set_missing_host_key_policy(AutoAddPolicy())
+        try:
+            self._connect_session(session)
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    def _connect_session(self, session):
+        """
+        :type session: SSHClient
+        """
+        if self.target_host.password:
+            session.connect(self.target_host.ip, username=self.target_host.username, password=self.target_host.password)
+        elif self.target_host.access_key:
+            key_stream = StringIO(self.target_host.access_key)
+            key_obj = RSAKey.from_private_key(key_stream)
+            session.connect(self.target_host.ip, username=self.target_host.username, pkey=key_obj)
+        elif self.target_host.username:
+            raise Exception('Both password and access key are empty.')
+        else:
+            raise Exception('Machine credentials are empty.')
+        # keeps the connection from being dropped by idle timeouts while it waits for its turn (batch preflight)
+        session.get_transport().set_keepalive(self.KEEPALIVE_SECONDS)
+
+    def _get_connection_key(self):
+        """
+        Only executors of the same host, user and credentials share a connection (the credentials are hashed).
+        :rtype tuple
+        """
+        credentials = hashlib.sha256(('%s\n%s' % (self.target_host.password or '', self.target_host.access_key or ''))
+                                     .encode('utf-8')).hexdigest()
+        return self.target_host.ip, self.target_host.username, credentials
+
+    def is_connected(self):
+        """
+        :rtype bool
+        """
+        transport = self.session.get_transport()
+        return transport is not None and transport.is_active()
+
+    def is_multiplexed(self):
+        """
+        With ssh multiplexing, the executors of the host lease channels of a shared connection (see connect).
+        :rtype bool
+        """
+        return self.target_host.ssh_multiplexing is not None
+
+    def close(self):
+        if self._shared_connection:
+            self._shared_connection.release()
+            self._shared_connection = None
+        else:
+            self.session.close()
+        self.pool.close()
+
     def get_expected_file_extensions(self):
         """
         :rtype list[str]
@@ -76,26 +166,51 @@ class LinuxScriptExecutor(IScriptExecutor):
         :type output_writer: ReservationOutputWriter
         :type print_output: bool
         """
-        self.logger.info('Creating temp folder on target machine ...')
-        tmp_folder = self.create_temp_folder()
-        self.logger.info('Done (%s).' % tmp_folder)
+        in_workspace = self.workspace is not None
+        if in_workspace:
+            tmp_folder = self._new_workspace_folder()
+            self.logger.info('Using "%s" folder of the workspace.' % tmp_folder)
+        else:
+            self.logger.info('Creating temp folder on target machine ...')
+            tmp_folder = self.create_temp_folder()
+            self.logger.info('Done (%s).' % tmp_folder)
 
         try:
-            self.logger.info('Copying "%s" (%s chars) to "%s" target machine ...' % (script_file.name, len(script_file.text), tmp_folder))
-            self.copy_script(tmp_folder, script_file)
-            self.logger.info('Done.')
+            with profile_phase(self.profiler, 'upload'), record_phase(self.script_result, 'upload'):
+                self.logger.info('Copying "%s" (size: %s) to "%s" target machine ...' % (script_file.name, script_file.size(), tmp_folder))
+                script_cache = self.target_host.script_cache
+                if isinstance(script_file, ScriptBundle):
+                    self.copy_bundle(tmp_folder, script_file)
+                    self._record_upload(script_file)
+                    self.logger.info('Done.')
+                elif script_cache and not script_file.is_streamed and \
+                        self.copy_script_from_cache(script_cache, tmp_folder, script_file):
+                    self.logger.info('Done (taken from the remote script cache).')
+                else:
+                    self.copy_script(tmp_folder, script_file)
+                    self._record_upload(script_file)
+                    if script_cache:
+                        self.store_script_in_cache(script_cache, tmp_folder, script_file)
+                    self.logger.info('Done.')
 
-            self.logger.info('Running "%s" on target machine ...' % script_file.name)
-            self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
-            self.logger.info('Done.')
+            with profile_phase(self.profiler, 'run'), record_phase(self.script_result, 'run'):
+                self.logger.info('Running "%s" on target machine ...' % script_file.name)
+                if self.target_host.execution.detached:
+                    self.run_script_detached(tmp_folder, script_file, env_vars, output_writer, print_output)
+                else:
+                    self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
+                self.logger.info('Done.')
 
         finally:
-            try:
-                self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
-                self.delete_temp_folder(tmp_folder)
-                self.logger.info('Done.')
-            except Exception as e:
-                self.logger.error('Failed to delete temp folder "%s" from target machine: %s' % (tmp_folder, str(e)))
+            # a workspace subfolder is deleted with the workspace (see close_workspace)
+            self._pending_folders.discard(tmp_folder)
+            if not in_workspace:
+                try:
+                    self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
+                    self.delete_temp_folder(tmp_folder)
+                    self.logger.info('Done.')
+                except Exception as e:
+                    self.logger.error('Failed to delete temp folder "%s" from target machine: %s' % (tmp_folder, str(e)))
 
     def create_temp_folder(self):
         """
@@ -106,24 +221,239 @@ class LinuxScriptExecutor(IScriptExecutor):
             raise Exception(ErrorMsg.CREATE_TEMP_FOLDER % result.std_err)
         return result.std_out.rstrip('\n')
 
+    def open_workspace(self):
+        self.logger.info('Creating workspace on target machine ...')
+        self.workspace = self.create_temp_folder()
+        self.logger.info('Done (%s).' % self.workspace)
+
+    def close_workspace(self):
+        workspace, self.workspace = self.workspace, None
+        if workspace is None:
+            return
+        try:
+            self.logger.info('Deleting "%s" workspace from target machine ...' % workspace)
+            if not self.is_connected():
+                # a cancelled command closes the session
+                self.connect()
+            result = self._run('rm -rf "%s"' % workspace)
+            if not result.success:
+                raise Exception(ErrorMsg.DELETE_TEMP_FOLDER % result.std_err)
+            self.logger.info('Done.')
+        except Exception as e:
+            self.logger.error('Failed to delete workspace "%s" from target machine: %s' % (workspace, str(e)))
+
+    def _new_workspace_folder(self):
+        """
+        :return: A subfolder of the workspace, created by the upload into it (see _take_mkdir_code).
+        :rtype str
+        """
+        self._workspace_folders += 1
+        tmp_folder = '%s/%s' % (self.workspace, self._workspace_folders)
+        self._pending_folders.add(tmp_folder)
+        return tmp_folder
+
+    def _take_mkdir_code(self, tmp_folder):
+        """
+        :return: The code creating the folder, to prefix the first command writing into it with ('' once created).
+        :rtype str
+        """
+        if tmp_folder not in self._pending_folders:
+            return ''
+        self._pending_folders.discard(tmp_folder)
+        return 'mkdir -p "%s" && ' % tmp_folder
+
     def copy_script(self, tmp_folder, script_file):
         """
         :type tmp_folder: str
         :type script_file: ScriptFile
         """
+        self._upload(tmp_folder, script_file.name, script_file)
+
+    def copy_bundle(self, tmp_folder, script_bundle):
+        """
+        Extracts the archive into the temp folder. tar.gz archives are piped straight into 'tar -xz' (one round
+        trip), zip archives are uploaded and extracted with 'unzip'.
+        :type tmp_folder: str
+        :type script_bundle: ScriptBundle
+        """
+        if script_bundle.archive_type == ScriptBundle.TAR_GZ:
+            result = self._run_cancelable(self._take_mkdir_code(tmp_folder).replace('%', '%%') + 'tar -xzf - -C "%s"',
+                                          tmp_folder, stdin_chunks=script_bundle.iter_content())
+        else:
+            self._upload(tmp_folder, script_bundle.archive_name, script_bundle)
+            result = self._run_cancelable('cd "{0}" && unzip -q -o "{1}" && rm -f "{1}"'.format(
+                tmp_folder, script_bundle.archive_name))
+        if not result.success:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _upload(self, tmp_folder, file_name, script_file):
+        """
+        Uploads with pipelined sftp writes when the server supports sftp (and the upload method allows it),
+        otherwise with scp - or through a piped 'cat' for streamed content, whose size scp needs up front.
+        :type tmp_folder: str
+        :type file_name: str
+        :type script_file: ScriptFile
+        """
+        remote_path = tmp_folder + '/' + file_name
+        sftp = self._open_sftp()
+        if sftp:
+            try:
+                if self._take_mkdir_code(tmp_folder):
+                    sftp.mkdir(tmp_folder)
+                self._sftp_upload(sftp, remote_path, script_file)
+            finally:
+                sftp.close()
+        elif script_file.is_streamed:
+            self._pipe_to_file(tmp_folder, file_name, script_file)
+        else:
+            mkdir_code = self._take_mkdir_code(tmp_folder)
+            if mkdir_code:
+                result = self._run_cancelable(mkdir_code + 'true')
+                if not result.success:
+                    raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+            self._scp_upload(remote_path, script_file)
+
+    def _open_sftp(self):
+        """
+        :return: An sftp client, None when scp should be used.
+        :rtype SFTPClient
+        """
+        upload = self.target_host.upload
+        if upload.method == UploadConfiguration.SCP or self._sftp_supported is False:
+            return None
+        try:
+            sftp = SFTPClient.from_transport(self.session.get_transport(), window_size=upload.window_size,
+                                             max_packet_size=upload.max_packet_size)
+            if sftp is None:
+                raise SSHException('Failed to open an sftp channel')
+            self._sftp_supported = True
+            return sftp
+        except (SSHException, EOFError) as e:
+            if upload.method == UploadConfiguration.SFTP:
+                raise Exception(ErrorMsg.COPY_SCRIPT % str(e)).with_traceback(sys.exc_info()[2])
+            self.logger.info('Sftp is not available on the target machine (%s), falling back to scp.' % str(e))
+            self._sftp_supported = False
+            return None
+
+    def _sftp_upload(self, sftp, remote_path, script_file):
+        """
+        :type sftp: SFTPClient
+        :type remote_path: str
+        :type script_file: ScriptFile
+        """
+        max_outstanding_requests = self.target_host.upload.max_outstanding_requests
+        try:
+            with sftp.open(remote_path, 'wb') as remote_file:
+                remote_file.set_pipelined(True)
+                for chunk in script_file.iter_content(self.UPLOAD_CHUNK_SIZE):
+                    self.cancel_sampler.throw_if_canceled()
+                    remote_file.write(chunk)
+                    self._wait_for_acks(remote_file, max_outstanding_requests)
+        except (IOError, SSHException) as e:
+            raise Exception(ErrorMsg.COPY_SCRIPT % str(e)).with_traceback(sys.exc_info()[2])
+
+    def _wait_for_acks(self, remote_file, max_outstanding_requests):
+        """
+        Pipelined SFTPFile writes do not wait for the server acknowledgements (paramiko only drains them past 100
+        requests, and only if a response is already waiting). Read the oldest acknowledgements so at most
+        max_outstanding_requests writes are in flight - enough to fill the link, without unbounded queuing.
+        Relies on SFTPFile internals of the pinned paramiko version.
+        :type remote_file: SFTPFile
+        :type max_outstanding_requests: int
+        """
+        requests = remote_file._reqs
+        while len(requests) > max_outstanding_requests:
+            remote_file.sftp._read_response(requests.popleft())
+
+    def _scp_upload(self, remote_path, script_file):
+        """
+        :type remote_path: str
+        :type script_file: ScriptFile
+        """
         scp = SCPClient(self.session.get_transport())
+        fl = io.BytesIO(script_file.get_bytes())
         try:
-            fl = io.BytesIO()
-            fl.write(script_file.text.encode('utf-8'))
-            fl.seek(0)
-            remote_path = tmp_folder + '/' + script_file.name
             scp.putfo(fl, remote_path=remote_path)
         except SCPException as e:
             raise Exception(ErrorMsg.COPY_SCRIPT % str(e)).with_traceback(sys.exc_info()[2])
         finally:
-            if scp:
-                scp.close()
-                fl.close()
+            scp.close()
+            fl.close()
+
+    def _pipe_to_file(self, tmp_folder, file_name, script_file):
+        """
+        Writes the content to a file through the stdin of a remote 'cat', as the content arrives.
+        :type tmp_folder: str
+        :type file_name: str
+        :type script_file: ScriptFile
+        """
+        result = self._run_cancelable(self._take_mkdir_code(tmp_folder).replace('%', '%%') + 'cat > "%s/%s"',
+                                      tmp_folder, file_name, stdin_chunks=script_file.iter_content())
+        if not result.success:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def copy_script_from_cache(self, script_cache, tmp_folder, script_file):
+        """
+        Copies the script from the remote cache into the temp folder, if the cache holds a file with the same sha256.
+        :type script_cache: ScriptCacheConfiguration
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :return: True on a cache hit.
+        :rtype bool
+        """
+        digest = script_file.sha256()
+        cached = '%s/%s' % (self._get_cache_path(script_cache), digest)
+        code = self._take_mkdir_code(tmp_folder) + 'if [ -f "{0}" ] && [ "$(sha256sum "{0}" | cut -d" " -f1)" = "{1}" ]; ' \
+               'then touch "{0}" && cp "{0}" "{2}/{3}" && echo hit; fi'.format(cached, digest, tmp_folder, script_file.name)
+        result = self._run_cancelable(code)
+        return result.success and result.std_out.strip() == 'hit'
+
+    def store_script_in_cache(self, script_cache, tmp_folder, script_file):
+        """
+        Stores the uploaded script in the remote cache and evicts entries older than max_age_days, then the least
+        recently used entries until the cache fits in max_size_mb. Failures are only logged.
+        :type script_cache: ScriptCacheConfiguration
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        cache_path = self._get_cache_path(script_cache)
+        digest = script_file.sha256()
+        code = 'mkdir -p "{0}" && cp "{2}/{3}" "{0}/{1}.$$" && mv -f "{0}/{1}.$$" "{0}/{1}" && '.format(
+            cache_path, digest, tmp_folder, script_file.name)
+        if script_cache.max_age_days:
+            # in minutes: -mtime counts whole days only (a max age of 0.5 days would keep entries for a day), and at
+            # least one, so the entry just stored is never evicted
+            max_age_minutes = max(1, int(script_cache.max_age_days * 24 * 60))
+            code += 'find "{0}" -maxdepth 1 -type f -mmin +{1} -exec rm -f {{}} + ; '.format(cache_path, max_age_minutes)
+        code += 'total=$(du -sk "{0}" | cut -f1); ' \
+                'for f in $(ls -1tr "{0}"); do [ "$total" -le {1} ] && break; ' \
+                's=$(du -k "{0}/$f" | cut -f1); rm -f "{0}/$f"; total=$((total-s)); done'.format(
+            cache_path, int(script_cache.max_size_mb * 1024))
+        result = self._run_cancelable(code)
+        if not result.success:
+            self.logger.warning('Failed to store "%s" in the remote script cache: %s' % (script_file.name, result.std_err))
+
+    def _get_cache_path(self, script_cache):
+        return (script_cache.path or '$HOME/.cloudshell/script_cache').rstrip('/')
+
+    def has_result_marker(self, key):
+        """
+        :type key: str
+        :rtype bool
+        """
+        result = self._run_cancelable('[ -f "%s/%s" ] && echo hit', self.RESULT_MARKERS_PATH, key)
+        return result.success and result.std_out.strip() == 'hit'
+
+    def write_result_marker(self, key):
+        """
+        Writes the marker and removes the markers older than RESULT_MARKERS_MAX_AGE_DAYS. Failures are only logged.
+        :type key: str
+        """
+        code = 'mkdir -p "{0}" && touch "{0}/{1}" && find "{0}" -maxdepth 1 -type f -mtime +{2} -exec rm -f {{}} +'.format(
+            self.RESULT_MARKERS_PATH, key, self.RESULT_MARKERS_MAX_AGE_DAYS)
+        result = self._run_cancelable(code)
+        if not result.success:
+            self.logger.warning('Failed to write the result marker on target machine: %s' % result.std_err)
 
     def run_script(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
         """
@@ -133,20 +463,110 @@ class LinuxScriptExecutor(IScriptExecutor):
         :type output_writer: ReservationOutputWriter
         :type print_output: bool
         """
-        code = ''
-        for key, value in (env_vars or {}).items():
-            code += 'export %s=%s;' % (key,self._escape(value))
-        if self.target_host.password:
-            code += 'export %s=%s;' % (self.PasswordEnvVarName, self._escape(self.target_host.password))
+        code = self._get_exports(env_vars)
+        # the command shell leads its own process group (sshd runs it with setsid), record it for kill_script
+        code += 'echo $$ > "%s/%s"; exec ' % (tmp_folder, self.DETACHED_PID)
         code += 'sh '+tmp_folder+'/'+script_file.name
         print(code)
-        result = self._run_cancelable(code)
+        result = self._run_cancelable(code, deadline_minutes=self.target_host.execution.deadline_minutes,
+                                      on_abort=lambda: self.kill_script(tmp_folder))
+        self._record_exit_code(result.exit_code)
         if print_output:
+            self._record_output(result.std_out, result.std_err)
             output_writer.write(result.std_out)
             output_writer.write(result.std_err)
         if not result.success:
             raise Exception(ErrorMsg.RUN_SCRIPT % result.std_err)
 
+    def run_script_detached(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
+        """
+        Launches the script in the background and polls for its completion (see ExecutionConfiguration.detached).
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type env_vars: dict
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        """
+        self.launch_detached(tmp_folder, script_file, env_vars)
+        execution = self.target_host.execution
+        DetachedExecution(self, tmp_folder, self.logger, self.cancel_sampler, execution.poll_interval_seconds,
+                          execution.deadline_minutes).wait(output_writer, print_output)
+
+    def launch_detached(self, tmp_folder, script_file, env_vars):
+        """
+        Runs the script under nohup, in its own session (setsid, when available) so it survives the ssh connection,
+        with stdout/stderr redirected to files in the temp folder. The exit code file is written (atomically) only
+        once the script exits.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type env_vars: dict
+        :return: The pid of the launched process.
+        :rtype str
+        """
+        code = self._get_exports(env_vars)
+        code += 'nohup $(command -v setsid) sh -c \'sh "$0"; echo $? > "$1.tmp" && mv -f "$1.tmp" "$1"\' ' \
+                '"{0}/{1}" "{0}/{2}" > "{0}/{3}" 2> "{0}/{4}" < /dev/null & echo $! > "{0}/{5}"; cat "{0}/{5}"'.format(
+            tmp_folder, script_file.name, self.DETACHED_EXIT_CODE, self.DETACHED_STDOUT, self.DETACHED_STDERR,
+            self.DETACHED_PID)
+        result = self._run_cancelable(code)
+        if not result.success:
+            raise Exception(ErrorMsg.RUN_SCRIPT % result.std_err)
+        pid = result.std_out.strip()
+        self.logger.info('Launched detached (pid: %s).' % pid)
+        return pid
+
+    def poll_detached(self, tmp_folder, stdout_offset, stderr_offset, max_read_bytes):
+        """
+        Reads the exit code (if the script exited) and the output written since the given offsets, in one round trip.
+        The exit code is read before the output, so once it is set the output read is complete.
+        Runs on a channel of its own, in the calling thread (a thread of the DetachedPoller), not in the pool.
+        :type tmp_folder: str
+        :type stdout_offset: int
+        :type stderr_offset: int
+        :type max_read_bytes: int
+        :rtype DetachedPollResult
+        """
+        code = 'c=""; [ -f "{0}/{1}" ] && c=$(cat "{0}/{1}"); ' \
+               'o=$(tail -c +{4} "{0}/{2}" 2>/dev/null | head -c {6} | base64 | tr -d "\\n"); ' \
+               'e=$(tail -c +{5} "{0}/{3}" 2>/dev/null | head -c {6} | base64 | tr -d "\\n"); ' \
+               'echo "$c|$o|$e"'.format(tmp_folder, self.DETACHED_EXIT_CODE, self.DETACHED_STDOUT,
+                                        self.DETACHED_STDERR, stdout_offset + 1, stderr_offset + 1, max_read_bytes)
+        result = self._run(code)
+        if not result.success:
+            raise Exception(result.std_err)
+        exit_code, std_out, std_err = result.std_out.strip().split('|')
+        return DetachedPollResult(int(exit_code) if exit_code else None,
+                                  base64.b64decode(std_out), base64.b64decode(std_err))
+
+    def kill_script(self, tmp_folder):
+        """
+        Kills the process group of the script (recorded in the temp folder when it was started, falling back to the
+        process itself when it does not lead a group): SIGTERM first, then SIGKILL to whatever is left after
+        KILL_GRACE_SECONDS. Runs on its own channel, in the calling thread, so it can be used while the pool thread
+        still waits for the script.
+        :type tmp_folder: str
+        """
+        code = 'pid=$(cat "{0}/{1}" 2>/dev/null); [ -z "$pid" ] && exit 0; ' \
+               't=-$pid; kill -0 $t 2>/dev/null || t=$pid; ' \
+               'kill -TERM $t 2>/dev/null || exit 0; ' \
+               'i=0; while [ $i -lt {2} ] && kill -0 $t 2>/dev/null; do sleep 1; i=$((i+1)); done; ' \
+               'kill -KILL $t 2>/dev/null; exit 0'.format(tmp_folder, self.DETACHED_PID, self.KILL_GRACE_SECONDS)
+        result = self._run(code)
+        if not result.success:
+            raise Exception(result.std_err)
+
+    def _get_exports(self, env_vars):
+        """
+        :type env_vars: dict
+        :rtype str
+        """
+        code = ''
+        for key, value in (env_vars or {}).items():
+            code += 'export %s=%s;' % (key,self._escape(value))
+        if self.target_host.password:
+            code += 'export %s=%s;' % (self.PasswordEnvVarName, self._escape(self.target_host.password))
+        return code
+
     def delete_temp_folder(self, tmp_folder):
         """
         :type tmp_folder: str
@@ -155,15 +575,26 @@ class LinuxScriptExecutor(IScriptExecutor):
         if not result.success:
             raise Exception(ErrorMsg.DELETE_TEMP_FOLDER % result.std_err)
 
-    def _run(self, code):
+    def _run(self, code, stdin_chunks=None):
         self.logger.debug('BashScript:' + code)
 
         #stdin, stdout, stderr = self._run_cancelable(code)
         stdin, stdout, stderr = self.session.exec_command(code)
+        with self._channels_lock:
+            self._channels.add(stdout.channel)
+        try:
+            if stdin_chunks is not None:
+                for chunk in stdin_chunks:
+                    stdin.write(chunk)
+                stdin.flush()
+                stdin.channel.shutdown_write()
 
-        exit_code = stdout.channel.recv_exit_status()
-        stdout_txt = ''.join(stdout.readlines())
-        stderr_txt = ''.join(stderr.readlines())
+            exit_code = stdout.channel.recv_exit_status()
+            stdout_txt = ''.join(stdout.readlines())
+            stderr_txt = ''.join(stderr.readlines())
+        finally:
+            with self._channels_lock:
+                self._channels.discard(stdout.channel)
 
         self.logger.debug('ReturnedCode:' + str(exit_code))
         self.logger.debug('Stdout:' + stdout_txt)
@@ -171,17 +602,49 @@ class LinuxScriptExecutor(IScriptExecutor):
 
         return LinuxScriptExecutor.ExecutionResult(exit_code, stdout_txt, stderr_txt)
 
-    def _run_cancelable(self, txt, *args):
-        async_result = self.pool.apply_async(self._run, kwds={'code': txt % args})
+    def _run_cancelable(self, txt, *args, stdin_chunks=None, deadline_minutes=None, on_abort=None):
+        """
+        :param deadline_minutes: Max run time of the command (None = no deadline).
+        :param on_abort: Called on cancellation or when the deadline passes, before giving up on the command
+                         (e.g. to kill the remote processes, which closing the session alone does not).
+        """
+        deadline = time.time() + deadline_minutes * 60 if deadline_minutes else None
+        # formatted only with args: most commands come formatted, and may hold a % (e.g. in a path)
+        code = txt % args if args else txt
+        async_result = self.pool.apply_async(self._run, kwds={'code': code, 'stdin_chunks': stdin_chunks})
 
         while not async_result.ready():
             if self.cancel_sampler.is_cancelled():
-                self.session.close()
+                self._abort(async_result, on_abort)
                 self.cancel_sampler.throw()
+            if deadline and time.time() >= deadline:
+                self._abort(async_result, on_abort)
+                raise Exception(ErrorMsg.RUN_SCRIPT % (ErrorMsg.DEADLINE_EXCEEDED % deadline_minutes))
             time.sleep(1)
 
         return async_result.get()
 
+    def _abort(self, async_result, on_abort):
+        """
+        Releases the pool thread waiting for the command: once on_abort killed the remote processes the command
+        exits by itself (and the session stays usable for the cleanup), otherwise the session is closed - or only
+        the channels of this executor, when the session is shared (see SshConnectionPool).
+        """
+        if on_abort:
+            try:
+                on_abort()
+                async_result.wait(self.KILL_GRACE_SECONDS)
+            except Exception as e:
+                self.logger.error('Failed to kill the script on target machine: %s' % str(e))
+        if not async_result.ready():
+            if self._shared_connection:
+                with self._channels_lock:
+                    channels = list(self._channels)
+                for channel in channels:
+                    channel.close()
+            else:
+                self.session.close()
+
     def _escape(self, value):
         escaped_str = "$'" + '\\x' + '\\x'.join([binascii.hexlify(x.encode('utf-8')).decode() for x in str(value)]) + "'"
         return escaped_str
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class PhaseMemory(object):
+    def __init__(self, name, peak_bytes, retained_bytes, seconds, top_sites):
+        """
+        :type name: str
+        :param peak_bytes: Highest traced memory during the phase, above the traced memory at its start (None = not
+                           known, see MemoryProfiler.phase).
+        :type peak_bytes: int
+        :param retained_bytes: Traced memory at the end of the phase, minus the one at its start.
+        :type retained_bytes: int
+        :type seconds: float
+        :param top_sites: The allocation sites that retained the most memory, as (site, size_diff, count_diff).
+        :type top_sites: list[tuple[str, int, int]]
+        """
+        self.name = name
+        self.peak_bytes = peak_bytes
+        self.retained_bytes = retained_bytes
+        self.seconds = seconds
+        self.top_sites = top_sites
+
+
+class MemoryProfiler(object):
+    """
+    Opt-in memory profiling of a command (see MemoryProfilingConfiguration), with tracemalloc.
+    Records the peak and retained allocations of each phase (download, connect, upload, run, ...) and the sites that
+    retained the most memory, and writes them as a report to the log or to a file.
+    tracemalloc traces the whole driver process: the numbers include the allocations of the commands running
+    concurrently. It is started by the first profiled command and stopped by the last one.
+    The peak of a phase needs tracemalloc.reset_peak (Python 3.9+), whose counter is shared by the whole process: it
+    is not known on older Pythons, nor for a phase that overlapped a profiled phase of another command.
+    """
+    _lock = threading.Lock()
+    _active = 0
+    _owns_tracing = False
+    # the phases being profiled (by any command), see phase
+    _running_phases = []
+
+    def __init__(self, logger, title, top_sites = 10, report_file = None):
+        """
+        :type logger: Logger
+        :param title: What is profiled (e.g. the script and host), the header of the report.
+        :type title: str
+        :param top_sites: Number of allocation sites reported per phase.
+        :type top_sites: int
+        :param report_file: Where the report is appended (None = the log).
+        :type report_file: str
+        """
+        self.logger = logger
+        self.title = title
+        self.top_sites = top_sites
+        self.report_file = report_file
+        self.phases = []
+        self._started = False
+
+    def start(self):
+        with MemoryProfiler._lock:
+            if MemoryProfiler._active == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                MemoryProfiler._owns_tracing = True
+            MemoryProfiler._active += 1
+        self._started = True
+
+    def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        with MemoryProfiler._lock:
+            MemoryProfiler._active -= 1
+            # tracing started by someone else (e.g. PYTHONTRACEMALLOC) is left on
+            if MemoryProfiler._active == 0 and MemoryProfiler._owns_tracing:
+                tracemalloc.stop()
+                MemoryProfiler._owns_tracing = False
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Profiles the code of the 'with' block as the phase 'name'.
+        :type name: str
+        """
+        start_snapshot = self._take_snapshot() if self.top_sites else None
+        # the peak is shared by the process: it is reset only by a phase running alone, a phase that overlaps
+        # another one (of any command) has no peak of its own
+        state = {'peak_known': hasattr(tracemalloc, 'reset_peak')}
+        with MemoryProfiler._lock:
+            for running in MemoryProfiler._running_phases:
+                running['peak_known'] = False
+            if MemoryProfiler._running_phases:
+                state['peak_known'] = False
+            MemoryProfiler._running_phases.append(state)
+            if state['peak_known']:
+                tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            with MemoryProfiler._lock:
+                MemoryProfiler._running_phases.remove(state)
+                end_memory, peak_memory = tracemalloc.get_traced_memory()
+            seconds = time.time() - start_time
+            top_sites = []
+            if self.top_sites:
+                diff = self._take_snapshot().compare_to(start_snapshot, 'lineno')
+                top_sites = [(str(stat.traceback), stat.size_diff, stat.count_diff)
+                             for stat in diff[:self.top_sites] if stat.size_diff > 0]
+            peak_bytes = max(0, peak_memory - start_memory) if state['peak_known'] else None
+            self.phases.append(PhaseMemory(name, peak_bytes, end_memory - start_memory, seconds, top_sites))
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def report(self):
+        """
+        Writes the report of the recorded phases.
+        """
+        text = self.format_report()
+        if not self.report_file:
+            self.logger.info(text)
+            return
+        try:
+            with open(self.report_file, 'a') as f:
+                f.write(text + os.linesep)
+            self.logger.info('The memory profile was written to "%s".' % self.report_file)
+        except Exception as e:
+            self.logger.warning('Failed to write the memory profile to "%s": %s' % (self.report_file, str(e)))
+            self.logger.info(text)
+
+    def format_report(self):
+        """
+        :rtype str
+        """
+        lines = ['Memory profile of %s (tracemalloc, whole process):' % self.title,
+                 '  %-12s %14s %14s %10s' % ('Phase', 'Peak (KB)', 'Retained (KB)', 'Seconds')]
+        for phase in self.phases:
+            peak = 'n/a' if phase.peak_bytes is None else '%.1f' % (phase.peak_bytes / 1024.0)
+            lines.append('  %-12s %14s %14.1f %10.3f' % (phase.name, peak, phase.retained_bytes / 1024.0,
+                                                         phase.seconds))
+        if any(phase.peak_bytes is None for phase in self.phases):
+            lines.append('  (n/a: the peak is not known on Python < 3.9, nor while profiled commands overlap)')
+        for phase in self.phases:
+            if phase.top_sites:
+                lines.append('  Top allocation sites of "%s" (retained):' % phase.name)
+                for site, size_diff, count_diff in phase.top_sites:
+                    lines.append('    %s: %+.1f KB (%+d blocks)' % (site, size_diff / 1024.0, count_diff))
+        return os.linesep.join(lines)
+
+
+@contextmanager
+def profile_phase(profiler, name):
+    """
+    MemoryProfiler.phase, when profiling (profiler is not None).
+    :type profiler: MemoryProfiler
+    :type name: str
+    """
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
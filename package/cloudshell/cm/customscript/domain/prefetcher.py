@@ -0,0 +1,68 @@
+from multiprocessing.pool import ThreadPool
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
+
+
+class Prefetcher(object):
+    """
+    Fetches the items of a sequence ahead of the one consuming them in order: taking item i starts the fetches of
+    items i..i+depth that did not start yet, so at most depth + 1 fetched items are held at once and at most depth
+    fetches run at the same time.
+    Fetches are expected to honor the cancellation themselves (e.g. ScriptDownloader), taking an item stops waiting
+    for it on cancellation.
+    """
+    WAIT_INTERVAL_SECONDS = 1
+
+    def __init__(self, fetch, count, depth, cancel_sampler, discard = None):
+        """
+        :param fetch: Fetches the item of an index.
+        :type fetch: (int) -> object
+        :param count: Number of items.
+        :type count: int
+        :param depth: Number of items fetched ahead of the one taken.
+        :type depth: int
+        :type cancel_sampler: CancellationSampler
+        :param discard: Releases a fetched item that was not taken (see close).
+        :type discard: (object) -> None
+        """
+        self._fetch = fetch
+        self._count = count
+        self._depth = depth
+        self._cancel_sampler = cancel_sampler
+        self._discard = discard
+        self._pool = ThreadPool(processes=max(1, depth))
+        self._results = {}
+        self._next_index = 0
+        self._closed = False
+
+    def take(self, index):
+        """
+        Waits for the item (fetching it now if it was not prefetched) and raises the error of its fetch.
+        :type index: int
+        :rtype object
+        """
+        self._start_fetches(min(self._count, index + 1 + self._depth))
+        async_result = self._results.pop(index)
+        while not async_result.ready():
+            self._cancel_sampler.throw_if_canceled()
+            async_result.wait(self.WAIT_INTERVAL_SECONDS)
+        return async_result.get()
+
+    def _start_fetches(self, end_index):
+        while not self._closed and self._next_index < end_index:
+            self._results[self._next_index] = self._pool.apply_async(self._fetch, (self._next_index,))
+            self._next_index += 1
+
+    def close(self):
+        """
+        Starts no more fetches, waits for the running ones and discards the items that were not taken.
+        """
+        self._closed = True
+        self._pool.close()
+        for index in sorted(self._results):
+            async_result = self._results.pop(index)
+            async_result.wait()
+            if self._discard and async_result.successful():
+                item = async_result.get()
+                if item is not None:
+                    self._discard(item)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import threading
+import time
+
+
+class ResultCache(object):
+    """
+    Remembers the scripts that already ran successfully, per reservation, so re-running the same configuration
+    (e.g. a retried setup) skips the hosts it already succeeded on.
+    A result is keyed by the reservation, the host, the sha256 of the script and a hash of its parameters - any
+    change of the script or its inputs runs it again. The results of a reservation are evicted once it is no longer
+    active (whatever its final status), and - without asking CloudShell - once no result was added to it for
+    max_age_seconds, or when more than max_reservations reservations have results (the least recently added first),
+    so the cache stays bounded even when no later command checks the reservations.
+    """
+    RESERVATION_CHECK_INTERVAL_SECONDS = 600
+    ACTIVE_STATUSES = ('Pending', 'Started')
+    DEFAULT_MAX_AGE_SECONDS = 7 * 24 * 3600
+    DEFAULT_MAX_RESERVATIONS = 1000
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_age_seconds = DEFAULT_MAX_AGE_SECONDS, max_reservations = DEFAULT_MAX_RESERVATIONS):
+        """
+        :param max_age_seconds: Evicts the results of a reservation once none was added to it for this long.
+        :type max_age_seconds: int
+        :param max_reservations: Max reservations with results - the least recently added to are evicted first.
+        :type max_reservations: int
+        """
+        self.max_age_seconds = max_age_seconds
+        self.max_reservations = max_reservations
+        self._lock = threading.Lock()
+        self._results = {}
+        self._checked = {}
+        self._added = {}
+
+    @staticmethod
+    def get_default():
+        """
+        The cache shared by the whole driver process.
+        :rtype ResultCache
+        """
+        with ResultCache._default_lock:
+            if ResultCache._default is None:
+                ResultCache._default = ResultCache()
+            return ResultCache._default
+
+    @staticmethod
+    def get_key(reservation_id, host_conf, script_file):
+        """
+        :type reservation_id: str
+        :type host_conf: HostConfiguration
+        :type script_file: ScriptFile
+        :return: The result key, None when the script content is not known up front (streamed).
+        :rtype str
+        """
+        script_sha256 = script_file.sha256()
+        if script_sha256 is None:
+            return None
+        parameters = json.dumps(sorted((str(k), str(v)) for k, v in host_conf.parameters.items()))
+        key_parts = [reservation_id or '', host_conf.ip or '', script_file.name or '', script_sha256, parameters]
+        return hashlib.sha256('\n'.join(key_parts).encode('utf-8')).hexdigest()
+
+    def contains(self, reservation_id, key):
+        """
+        :type reservation_id: str
+        :type key: str
+        :rtype bool
+        """
+        with self._lock:
+            self._evict_expired(time.time())
+            return key in self._results.get(reservation_id, ())
+
+    def add(self, reservation_id, key):
+        """
+        :type reservation_id: str
+        :type key: str
+        """
+        now = time.time()
+        with self._lock:
+            self._results.setdefault(reservation_id, set()).add(key)
+            self._checked.setdefault(reservation_id, now)
+            self._added.pop(reservation_id, None)
+            self._added[reservation_id] = now
+            self._evict_expired(now)
+            while len(self._added) > self.max_reservations:
+                self._evict(next(iter(self._added)))
+
+    def evict(self, reservation_id):
+        """
+        :type reservation_id: str
+        """
+        with self._lock:
+            self._evict(reservation_id)
+
+    def evict_ended_reservations(self, api, logger):
+        """
+        Evicts the results of the reservations that are no longer active (or no longer exist), and the expired ones.
+        Each reservation is looked up at most once per RESERVATION_CHECK_INTERVAL_SECONDS.
+        :type api: CloudShellAPISession
+        :type logger: Logger
+        """
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            due = [reservation_id for reservation_id, checked in self._checked.items()
+                   if now - checked >= self.RESERVATION_CHECK_INTERVAL_SECONDS]
+            for reservation_id in due:
+                self._checked[reservation_id] = now
+
+        for reservation_id in due:
+            try:
+                status = api.GetReservationStatus(reservation_id).ReservationSlimStatus.Status
+            except Exception as e:
+                logger.debug('Failed to get the status of reservation %s: %s' % (reservation_id, str(e)))
+                status = None
+            if status not in self.ACTIVE_STATUSES:
+                logger.info('Evicting the cached script results of reservation %s (status %s).'
+                            % (reservation_id, status))
+                self.evict(reservation_id)
+
+    def _evict_expired(self, now):
+        # _added is in the order of the last add, the oldest first
+        for reservation_id, added in list(self._added.items()):
+            if now - added < self.max_age_seconds:
+                break
+            self._evict(reservation_id)
+
+    def _evict(self, reservation_id):
+        self._results.pop(reservation_id, None)
+        self._checked.pop(reservation_id, None)
+        self._added.pop(reservation_id, None)
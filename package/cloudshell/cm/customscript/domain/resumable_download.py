@@ -0,0 +1,279 @@
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler, CancellationException
+from cloudshell.cm.customscript.domain.download_cache import PartialDownload
+
+
+class _IncompleteContent(IOError):
+    pass
+
+
+class _ContentChanged(Exception):
+    pass
+
+
+class ResumableDownload(object):
+    """
+    Reads the content of a download response, resuming it with a 'Range' request when the connection fails midway.
+    Every resume request carries an 'If-Range' with the validator of the response (a strong ETag, or Last-Modified),
+    so a file that changed in the meantime is downloaded again from its start instead of being stitched together.
+    The received content can be kept in a PartialDownload, so even a later download of the url resumes it.
+    Large contents can be fetched with several range requests in parallel (parallel_parts).
+    Responses without a validator, without 'Accept-Ranges: bytes' or with a content encoding (the range offsets
+    are in encoded bytes) are read as before, without resuming.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    MAX_RESUME_ATTEMPTS = 5
+    RESUME_DELAY_SECONDS = 2
+    PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+    STRIPPED_REQUEST_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since', 'Content-Length')
+
+    def __init__(self, logger, cancel_sampler, verify_certificate, parallel_parts = 1):
+        """
+        :type logger: Logger
+        :type cancel_sampler: CancellationSampler
+        :type verify_certificate: bool
+        :param parallel_parts: Number of range requests a content of PARALLEL_MIN_BYTES or more is fetched with.
+        :type parallel_parts: int
+        """
+        self.logger = logger
+        self.cancel_sampler = cancel_sampler
+        self.verify_certificate = verify_certificate
+        self.parallel_parts = parallel_parts
+        self._aborted = threading.Event()
+
+    def read(self, response, partial = None):
+        """
+        :param response: A successful (streamed) response of the download request.
+        :type response: requests.Response
+        :param partial: Where the received content is kept until the download completes (None = in memory only),
+                        discarded once it did. Closing it is up to the caller.
+        :type partial: PartialDownload
+        :rtype bytearray
+        """
+        validator = self._get_validator(response)
+        size = self._get_content_length(response)
+        if validator is None:
+            return self._read_serial(response, None, size, bytearray())
+
+        if size is not None and self.parallel_parts > 1 and size >= self.PARALLEL_MIN_BYTES:
+            response.close()
+            try:
+                data = self._read_parallel(response, validator, size)
+                if partial is not None:
+                    partial.discard()
+                return data
+            except _ContentChanged:
+                self.logger.info('The file changed during the download, downloading it again ...')
+                response = self._request(response)
+                if response.status_code != 200:
+                    response.close()
+                    raise IOError('Failed to download the file: %s %s' % (response.status_code, response.reason))
+                validator = self._get_validator(response)
+                size = self._get_content_length(response)
+
+        data = bytearray()
+        resume = False
+        if partial is not None and validator is not None:
+            offset = partial.load(validator)
+            if size is not None and offset >= size:
+                partial.reset(validator)
+            elif offset:
+                self.logger.info('Resuming the download from byte %s ...' % offset)
+                for chunk in partial.iter_content(self.CHUNK_SIZE):
+                    data += chunk
+                response.close()
+                resume = True
+        data = self._read_serial(response, validator, size, data, partial, resume)
+        if partial is not None:
+            partial.discard()
+        return data
+
+    def _read_serial(self, response, validator, size, data, partial = None, resume = False):
+        """
+        :type response: requests.Response
+        :param validator: None when the response cannot be resumed.
+        :type validator: str
+        :param size: The total size of the content, if known.
+        :type size: int
+        :param data: The content received so far (continued by the response).
+        :type data: bytearray
+        :type partial: PartialDownload
+        :param resume: Continue 'data' with a range request, instead of reading the response.
+        :type resume: bool
+        :rtype bytearray
+        """
+        attempts = 0
+        previous_response = None
+        if resume:
+            previous_response, response = response, None
+        while True:
+            try:
+                if response is None:
+                    response, validator, size = self._resume(previous_response, validator, size, data, partial)
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    if chunk:
+                        data += chunk
+                        if partial is not None:
+                            partial.append(chunk)
+                    self.cancel_sampler.throw_if_canceled()
+                if size is not None and len(data) < size:
+                    raise _IncompleteContent('Received %s of %s bytes' % (len(data), size))
+                return data
+            except CancellationException:
+                raise
+            except IOError as e:
+                attempts += 1
+                if validator is None or attempts > self.MAX_RESUME_ATTEMPTS:
+                    raise
+                self.logger.warning('The download was interrupted at byte %s (%s), resuming (%s/%s) ...' %
+                                    (len(data), str(e), attempts, self.MAX_RESUME_ATTEMPTS))
+                self._sleep()
+                previous_response, response = response or previous_response, None
+
+    def _resume(self, response, validator, size, data, partial):
+        """
+        Requests the rest of the content, from len(data). When the file changed, the new response has its whole
+        content: 'data' (and the partial content) is cleared then.
+        :type response: requests.Response
+        :type validator: str
+        :type size: int
+        :type data: bytearray
+        :type partial: PartialDownload
+        :return: The new response, with the validator and total size of the content it continues.
+        :rtype tuple[requests.Response, str, int]
+        """
+        new_response = self._request(response, {'Range': 'bytes=%s-' % len(data), 'If-Range': validator})
+        start = self._get_range_start(new_response)
+        if new_response.status_code == 206 and start == len(data):
+            return new_response, validator, size
+        if new_response.status_code == 200:
+            self.logger.info('The file changed during the download, downloading it again ...')
+            del data[:]
+            validator = self._get_validator(new_response)
+            if partial is not None:
+                partial.reset(validator or '')
+            return new_response, validator, self._get_content_length(new_response)
+        new_response.close()
+        raise IOError('Failed to resume the download: %s %s' % (new_response.status_code, new_response.reason))
+
+    def _read_parallel(self, response, validator, size):
+        """
+        :type response: requests.Response
+        :type validator: str
+        :type size: int
+        :rtype bytearray
+        """
+        data = bytearray(size)
+        part_size = (size + self.parallel_parts - 1) // self.parallel_parts
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        self.logger.info('Downloading %s bytes with %s parallel range requests ...' % (size, len(ranges)))
+
+        self._aborted.clear()
+        pool = ThreadPool(processes=len(ranges))
+        try:
+            view = memoryview(data)
+            async_results = [pool.apply_async(self._read_part, (response, validator, view, start, end))
+                             for start, end in ranges]
+            try:
+                for async_result in async_results:
+                    async_result.get()
+            except:
+                self._aborted.set()
+                raise
+            finally:
+                for async_result in async_results:
+                    async_result.wait()
+                view.release()
+        finally:
+            pool.close()
+        return data
+
+    def _read_part(self, response, validator, view, start, end):
+        """
+        Reads the bytes start..end (inclusive) of the content into the view, resuming on failures.
+        :type response: requests.Response
+        :type validator: str
+        :type view: memoryview
+        :type start: int
+        :type end: int
+        """
+        offset = start
+        attempts = 0
+        while offset <= end:
+            try:
+                part_response = self._request(response, {'Range': 'bytes=%s-%s' % (offset, end), 'If-Range': validator})
+                try:
+                    if part_response.status_code == 200:
+                        raise _ContentChanged()
+                    if part_response.status_code != 206 or self._get_range_start(part_response) != offset:
+                        raise IOError('Unexpected response to a range request: %s %s' %
+                                      (part_response.status_code, part_response.reason))
+                    for chunk in part_response.iter_content(self.CHUNK_SIZE):
+                        length = min(len(chunk), end + 1 - offset)
+                        view[offset:offset + length] = chunk[:length]
+                        offset += length
+                        if self._aborted.is_set():
+                            return
+                        self.cancel_sampler.throw_if_canceled()
+                finally:
+                    part_response.close()
+                if offset <= end:
+                    raise _IncompleteContent('Received %s of %s bytes' % (offset - start, end + 1 - start))
+            except (CancellationException, _ContentChanged):
+                raise
+            except IOError as e:
+                attempts += 1
+                if attempts > self.MAX_RESUME_ATTEMPTS or self._aborted.is_set():
+                    raise
+                self.logger.warning('The download of bytes %s-%s was interrupted at byte %s (%s), resuming (%s/%s) ...' %
+                                    (start, end, offset, str(e), attempts, self.MAX_RESUME_ATTEMPTS))
+                self._sleep()
+
+    def _request(self, response, headers = None):
+        """
+        Requests the final url of the response again, with the same request headers (e.g. the authorization).
+        :type response: requests.Response
+        :type headers: dict
+        :rtype requests.Response
+        """
+        request_headers = CaseInsensitiveDict(response.request.headers)
+        for name in self.STRIPPED_REQUEST_HEADERS:
+            request_headers.pop(name, None)
+        request_headers['Accept-Encoding'] = 'identity'
+        request_headers.update(headers or {})
+        return requests.get(response.url, headers=request_headers, stream=True, verify=self.verify_certificate)
+
+    def _get_validator(self, response):
+        """
+        :return: The If-Range validator of a response that can be resumed, None otherwise.
+        :rtype str
+        """
+        headers = CaseInsensitiveDict(response.headers or {})
+        if response.status_code != 200 or headers.get('accept-ranges', '').lower() != 'bytes' or \
+                headers.get('content-encoding', 'identity').lower() != 'identity':
+            return None
+        etag = headers.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.get('last-modified')
+
+    def _get_content_length(self, response):
+        content_length = CaseInsensitiveDict(response.headers or {}).get('content-length')
+        return int(content_length) if content_length and content_length.isdigit() else None
+
+    def _get_range_start(self, response):
+        matching = re.match(r'bytes\s+(\d+)-', CaseInsensitiveDict(response.headers or {}).get('content-range', ''))
+        return int(matching.group(1)) if matching else None
+
+    def _sleep(self):
+        end_time = time.time() + self.RESUME_DELAY_SECONDS
+        while time.time() < end_time:
+            self.cancel_sampler.throw_if_canceled()
+            time.sleep(min(0.5, max(0, end_time - time.time())))
@@ -1,6 +1,7 @@
-import json
 import numbers
 
+from cloudshell.cm.customscript.domain import json_backend
+
 
 class ScriptConfiguration(object):
     def __init__(self, script_repo = None, host_conf = None, timeout_minutes = None, print_output = True):
@@ -15,6 +16,39 @@ class ScriptConfiguration(object):
         self.host_conf = host_conf or HostConfiguration()
         self.print_output = print_output
         self.verify_certificate = True
+        self.stream_transfer = False
+        self.result_cache = None
+        self.memory_profiling = None
+        # execute_scripts: the name of the configuration, and the ones that must succeed before it runs (see ScriptDag)
+        self.id = None
+        self.depends_on = []
+
+
+class ResultCacheConfiguration(object):
+    def __init__(self, marker_on_host = False):
+        """
+        Opt-in: skip the script when it already ran successfully on the host, with the same content and parameters,
+        in the same reservation.
+        :param marker_on_host: Also keep a marker file of the result on the target machine, so the result survives
+                               a restart of the driver process.
+        :type marker_on_host: bool
+        """
+        self.marker_on_host = marker_on_host
+
+
+class MemoryProfilingConfiguration(object):
+    DEFAULT_TOP_SITES = 10
+
+    def __init__(self, top_sites = None, report_file = None):
+        """
+        Opt-in: profile the memory of the command with tracemalloc (see MemoryProfiler).
+        :param top_sites: Number of allocation sites reported per phase (None = DEFAULT_TOP_SITES, 0 = none).
+        :type top_sites: int
+        :param report_file: File the report is appended to (None = the log).
+        :type report_file: str
+        """
+        self.top_sites = self.DEFAULT_TOP_SITES if top_sites is None else top_sites
+        self.report_file = report_file
 
 
 class ScriptRepository(object):
@@ -23,6 +57,7 @@ class ScriptRepository(object):
         self.username = None
         self.password = None
         self.token = None
+        self.entry_point = None
 
 
 class HostConfiguration(object):
@@ -34,6 +69,99 @@ class HostConfiguration(object):
         self.password = None
         self.access_key = None
         self.parameters = {}
+        self.script_cache = None
+        self.ssh_multiplexing = None
+        self.upload = UploadConfiguration()
+        self.execution = ExecutionConfiguration()
+
+
+class UploadConfiguration(object):
+    AUTO = 'auto'
+    SFTP = 'sftp'
+    SCP = 'scp'
+    METHODS = (AUTO, SFTP, SCP)
+    DEFAULT_MAX_OUTSTANDING_REQUESTS = 64
+    DEFAULT_PARALLEL_SHELLS = 1
+
+    def __init__(self, method = AUTO, max_outstanding_requests = None, window_size = None, max_packet_size = None,
+                 parallel_shells = None):
+        """
+        How scripts are uploaded (method to max_packet_size: over ssh, parallel_shells: over winrm).
+        :param method: 'auto' (sftp when the server supports it, otherwise scp), 'sftp' or 'scp'.
+        :type method: str
+        :param max_outstanding_requests: Max sftp write requests sent before waiting for their acknowledgements
+                                         (None = DEFAULT_MAX_OUTSTANDING_REQUESTS).
+        :type max_outstanding_requests: int
+        :param window_size: Sftp channel window size in bytes (None = paramiko default).
+        :type window_size: int
+        :param max_packet_size: Sftp channel max packet size in bytes (None = paramiko default).
+        :type max_packet_size: int
+        :param parallel_shells: Max winrm shells a large script is uploaded over, as parts written concurrently and
+                                joined (and hash verified) on the target machine (1 = a single shell, in sequence,
+                                None = DEFAULT_PARALLEL_SHELLS).
+        :type parallel_shells: int
+        """
+        self.method = method
+        self.max_outstanding_requests = UploadConfiguration.DEFAULT_MAX_OUTSTANDING_REQUESTS \
+            if max_outstanding_requests is None else max_outstanding_requests
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.parallel_shells = UploadConfiguration.DEFAULT_PARALLEL_SHELLS if parallel_shells is None else parallel_shells
+
+
+class ExecutionConfiguration(object):
+    DEFAULT_POLL_INTERVAL_SECONDS = 10
+
+    def __init__(self, detached = False, poll_interval_seconds = None, deadline_minutes = None):
+        """
+        How the script is run on the target machine.
+        :param detached: Launch the script in the background (detached from the connection, with its output
+                         redirected to files) and poll for its completion, instead of holding a command channel
+                         open until it exits.
+        :type detached: bool
+        :param poll_interval_seconds: Interval between polls of a detached script.
+        :type poll_interval_seconds: float
+        :param deadline_minutes: Max run time of the script, after which (or on cancellation) its process tree is
+                                 killed on the target machine (None = no deadline).
+        :type deadline_minutes: float
+        """
+        self.detached = detached
+        self.poll_interval_seconds = ExecutionConfiguration.DEFAULT_POLL_INTERVAL_SECONDS \
+            if poll_interval_seconds is None else poll_interval_seconds
+        self.deadline_minutes = deadline_minutes
+
+
+class ScriptCacheConfiguration(object):
+    DEFAULT_MAX_SIZE_MB = 512
+    DEFAULT_MAX_AGE_DAYS = 30
+
+    def __init__(self, path = None, max_size_mb = None, max_age_days = None):
+        """
+        Opt-in cache folder on the target machine, holding previously uploaded scripts by their sha256.
+        :param path: Cache folder on the target machine (None = executor default).
+        :type path: str
+        :type max_size_mb: float
+        :param max_age_days: Entries not used for longer are evicted (0 = no eviction by age). Counted in whole
+                             minutes, at least one.
+        :type max_age_days: float
+        """
+        self.path = path
+        self.max_size_mb = ScriptCacheConfiguration.DEFAULT_MAX_SIZE_MB if max_size_mb is None else max_size_mb
+        self.max_age_days = ScriptCacheConfiguration.DEFAULT_MAX_AGE_DAYS if max_age_days is None else max_age_days
+
+
+class SshMultiplexingConfiguration(object):
+    DEFAULT_MAX_SESSIONS = 10
+
+    def __init__(self, max_sessions = None):
+        """
+        Opt-in sharing of one authenticated ssh connection by the scripts running on the same host at the same time,
+        each one on channels of its own (and in a temp folder of its own).
+        :param max_sessions: Max channels open at once on one connection - the MaxSessions of the sshd of the host
+                             (10 by default). More scripts than it allows get another connection.
+        :type max_sessions: int
+        """
+        self.max_sessions = SshMultiplexingConfiguration.DEFAULT_MAX_SESSIONS if max_sessions is None else max_sessions
 
 
 class ScriptConfigurationParser(object):
@@ -50,21 +178,39 @@ class ScriptConfigurationParser(object):
         :type json_str: str
         :rtype ScriptConfiguration
         """
-        json_obj = json.loads(json_str)
-        ScriptConfigurationParser._validate(json_obj)
+        if isinstance(json_str, dict):
+            return self.dict_to_object(json_str)
+        return self.dict_to_object(json_backend.loads(json_str))
+
+    def dict_to_object(self, json_obj):
+        """
+        Converts an already decoded json object to an ScriptConfiguration instance.
+        :type json_obj: dict
+        :rtype ScriptConfiguration
+        """
+        repo, host = ScriptConfigurationParser._validate(json_obj)
 
         script_conf = ScriptConfiguration()
         script_conf.timeout_minutes = json_obj.get('timeoutMinutes', 0.0)
         script_conf.print_output = bool_parse(json_obj.get('printOutput', True))
-        script_conf.verify_certificate = json_obj.get('verifyCertificate', 'true').lower()=='true'
+        script_conf.verify_certificate = str(json_obj.get('verifyCertificate', 'true')).lower()=='true'
+        script_conf.stream_transfer = bool_parse(json_obj.get('streamTransfer', False))
+        script_conf.id = json_obj.get('id')
+        script_conf.depends_on = list(json_obj.get('dependsOn') or [])
+        result_cache = json_obj.get('resultCache')
+        if result_cache is not None:
+            script_conf.result_cache = ResultCacheConfiguration(bool_parse(result_cache.get('markerOnHost', False)))
+        memory_profiling = json_obj.get('memoryProfiling')
+        if memory_profiling is not None:
+            script_conf.memory_profiling = MemoryProfilingConfiguration(memory_profiling.get('topSites'),
+                                                                        memory_profiling.get('reportFile'))
 
-        repo = json_obj['repositoryDetails']
         script_conf.script_repo.url = repo.get('url')
         script_conf.script_repo.username = repo.get('username')
         script_conf.script_repo.password = repo.get('password')
         script_conf.script_repo.token = repo.get('token')
+        script_conf.script_repo.entry_point = repo.get('entryPoint')
 
-        host = json_obj['hostsDetails'][0]
         script_conf.host_conf = HostConfiguration()
         script_conf.host_conf.ip = host.get('ip')
         script_conf.host_conf.connection_method = host['connectionMethod'].lower()
@@ -74,6 +220,23 @@ class ScriptConfigurationParser(object):
         script_conf.host_conf.access_key = self._get_access_key(host)
         if host.get('parameters'):
             script_conf.host_conf.parameters = dict((i['name'], i['value']) for i in host['parameters'])
+        upload = host.get('upload')
+        if upload is not None:
+            script_conf.host_conf.upload = UploadConfiguration(
+                upload.get('method', UploadConfiguration.AUTO).lower(), upload.get('maxOutstandingRequests'),
+                upload.get('windowSize'), upload.get('maxPacketSize'), upload.get('parallelShells'))
+        execution = host.get('execution')
+        if execution is not None:
+            script_conf.host_conf.execution = ExecutionConfiguration(
+                bool_parse(execution.get('detached', False)), execution.get('pollIntervalSeconds'),
+                execution.get('deadlineMinutes'))
+        cache = host.get('scriptCache')
+        if cache is not None:
+            script_conf.host_conf.script_cache = ScriptCacheConfiguration(
+                cache.get('path'), cache.get('maxSizeMb'), cache.get('maxAgeDays'))
+        multiplexing = host.get('sshMultiplexing')
+        if multiplexing is not None:
+            script_conf.host_conf.ssh_multiplexing = SshMultiplexingConfiguration(multiplexing.get('maxSessions'))
 
         return script_conf
 
@@ -94,37 +257,121 @@ class ScriptConfigurationParser(object):
     @staticmethod
     def _validate(json_obj):
         """
-        :type json_obj: json
-        :rtype bool
+        Validates the configuration in a single pass, looking up each node only once.
+        :type json_obj: dict
+        :return: The repository node and the (single) host node.
+        :rtype tuple[dict, dict]
         """
         basic_msg = 'Failed to parse script configuration input json: '
 
-        if json_obj.get('timeoutMinutes'):
+        if not isinstance(json_obj, dict):
+            raise SyntaxError(basic_msg + 'Configuration must be a json object.')
 
-            if not isinstance(json_obj.get('timeoutMinutes'), numbers.Number):
+        timeout = json_obj.get('timeoutMinutes')
+        if timeout:
+
+            if not isinstance(timeout, numbers.Number):
                 raise SyntaxError(basic_msg + 'Node "timeoutMinutes" must be numeric type.')
 
-            if json_obj.get('timeoutMinutes') < 0:
+            if timeout < 0:
                 raise SyntaxError(basic_msg + 'Node "timeoutMinutes" must be greater/equal to zero.')
 
-        if json_obj.get('repositoryDetails') is None:
+        conf_id = json_obj.get('id')
+        if conf_id is not None and (not isinstance(conf_id, str) or not conf_id):
+            raise SyntaxError(basic_msg + 'Node "id" must be a non empty string.')
+
+        depends_on = json_obj.get('dependsOn')
+        if depends_on is not None and (not isinstance(depends_on, list) or
+                                       not all(isinstance(d, str) and d for d in depends_on)):
+            raise SyntaxError(basic_msg + 'Node "dependsOn" must be an array of configuration ids.')
+
+        result_cache = json_obj.get('resultCache')
+        if result_cache is not None and not isinstance(result_cache, dict):
+            raise SyntaxError(basic_msg + 'Node "resultCache" must be an object.')
+
+        memory_profiling = json_obj.get('memoryProfiling')
+        if memory_profiling is not None:
+            if not isinstance(memory_profiling, dict):
+                raise SyntaxError(basic_msg + 'Node "memoryProfiling" must be an object.')
+            top_sites = memory_profiling.get('topSites')
+            if top_sites is not None and (isinstance(top_sites, bool) or not isinstance(top_sites, int) or top_sites < 0):
+                raise SyntaxError(basic_msg + 'Node "memoryProfiling.topSites" must be an integer greater/equal to zero.')
+
+        repo = json_obj.get('repositoryDetails')
+        if repo is None:
             raise SyntaxError(basic_msg + 'Missing "repositoryDetails" node.')
 
-        if not json_obj.get('repositoryDetails').get('url'):
+        if not isinstance(repo, dict) or not repo.get('url'):
             raise SyntaxError(basic_msg + 'Missing/Empty "repositoryDetails.url" node.')
 
-        if not json_obj.get('hostsDetails'):
+        hosts = json_obj.get('hostsDetails')
+        if not hosts:
             raise SyntaxError(basic_msg + 'Missing/Empty "hostsDetails" node.')
 
-        if len(json_obj.get('hostsDetails')) > 1:
+        if len(hosts) > 1:
             raise SyntaxError(basic_msg + 'Node "hostsDetails" must contain only one item.')
 
-        if not json_obj.get('hostsDetails')[0].get('ip'):
+        host = hosts[0]
+        if not isinstance(host, dict) or not host.get('ip'):
             raise SyntaxError(basic_msg + 'Missing/Empty "hostsDetails[0].ip" node.')
 
-        if not json_obj.get('hostsDetails')[0].get('connectionMethod'):
+        if not host.get('connectionMethod'):
             raise SyntaxError(basic_msg + 'Missing/Empty "hostsDetails[0].connectionMethod" node.')
 
+        upload = host.get('upload')
+        if upload is not None:
+
+            if not isinstance(upload, dict):
+                raise SyntaxError(basic_msg + 'Node "hostsDetails[0].upload" must be an object.')
+
+            if str(upload.get('method', UploadConfiguration.AUTO)).lower() not in UploadConfiguration.METHODS:
+                raise SyntaxError(basic_msg + 'Node "hostsDetails[0].upload.method" must be one of: %s.'
+                                  % ', '.join(UploadConfiguration.METHODS))
+
+            for node in ('maxOutstandingRequests', 'windowSize', 'maxPacketSize', 'parallelShells'):
+                value = upload.get(node)
+                # bool is an int too
+                if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+                    raise SyntaxError(basic_msg + 'Node "hostsDetails[0].upload.%s" must be a positive integer.' % node)
+
+        execution = host.get('execution')
+        if execution is not None:
+
+            if not isinstance(execution, dict):
+                raise SyntaxError(basic_msg + 'Node "hostsDetails[0].execution" must be an object.')
+
+            for node in ('pollIntervalSeconds', 'deadlineMinutes'):
+                value = execution.get(node)
+                # bool is a number too
+                if value is not None and (isinstance(value, bool) or not isinstance(value, numbers.Number) or value <= 0):
+                    raise SyntaxError(basic_msg + 'Node "hostsDetails[0].execution.%s" must be a positive number.' % node)
+
+        cache = host.get('scriptCache')
+        if cache is not None:
+
+            if not isinstance(cache, dict):
+                raise SyntaxError(basic_msg + 'Node "hostsDetails[0].scriptCache" must be an object.')
+
+            for node in ('maxSizeMb', 'maxAgeDays'):
+                value = cache.get(node)
+                # bool is a number too
+                if value is not None and (isinstance(value, bool) or not isinstance(value, numbers.Number) or value < 0):
+                    raise SyntaxError(basic_msg + 'Node "hostsDetails[0].scriptCache.%s" must be a non negative number.' % node)
+
+        multiplexing = host.get('sshMultiplexing')
+        if multiplexing is not None:
+
+            if not isinstance(multiplexing, dict):
+                raise SyntaxError(basic_msg + 'Node "hostsDetails[0].sshMultiplexing" must be an object.')
+
+            max_sessions = multiplexing.get('maxSessions')
+            # bool is an int too
+            if max_sessions is not None and (isinstance(max_sessions, bool) or not isinstance(max_sessions, int) or
+                                             max_sessions <= 0):
+                raise SyntaxError(basic_msg + 'Node "hostsDetails[0].sshMultiplexing.maxSessions" must be a positive integer.')
+
+        return repo, host
+
 
 def bool_parse(b):
     if b is None:
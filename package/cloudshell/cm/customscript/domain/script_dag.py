@@ -0,0 +1,246 @@
+import queue
+import time
+from multiprocessing.pool import ThreadPool
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler, CancellationException
+
+
+class DagNode(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, index, script_conf):
+        """
+        :param index: Position of the configuration in the batch.
+        :type index: int
+        :type script_conf: ScriptConfiguration
+        """
+        self.index = index
+        self.script_conf = script_conf
+        self.name = script_conf.id or '#%s' % (index + 1)
+        self.dependencies = []
+        self.dependents = []
+        self.state = DagNode.PENDING
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def seconds(self):
+        """
+        :return: Run time of the node, 0 when it did not run.
+        :rtype float
+        """
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+class ScriptDag(object):
+    """
+    The configurations of an execute_scripts batch as a dependency graph: a configuration with "dependsOn" runs
+    once all the configurations with those "id"s succeeded, and is skipped (with its own dependents) when one of them
+    failed or was skipped. Configurations without dependencies are ready right away. Ready configurations run
+    concurrently, in batch order, up to max_workers at a time.
+    """
+
+    def __init__(self, script_confs):
+        """
+        Builds and validates the graph.
+        :type script_confs: list[ScriptConfiguration]
+        :raises SyntaxError: On a duplicate id, an unknown dependency or a dependency cycle.
+        """
+        basic_msg = 'Failed to parse script configurations input json: '
+        self.nodes = [DagNode(index, script_conf) for index, script_conf in enumerate(script_confs)]
+        by_id = {}
+        for node in self.nodes:
+            if node.script_conf.id is None:
+                continue
+            if node.script_conf.id in by_id:
+                raise SyntaxError(basic_msg + 'Configuration id "%s" is not unique.' % node.script_conf.id)
+            by_id[node.script_conf.id] = node
+
+        for node in self.nodes:
+            for dependency_id in node.script_conf.depends_on:
+                dependency = by_id.get(dependency_id)
+                if dependency is None:
+                    raise SyntaxError(basic_msg + 'Configuration "%s" depends on an unknown id "%s".' % (
+                        node.name, dependency_id))
+                if dependency not in node.dependencies:
+                    node.dependencies.append(dependency)
+                    dependency.dependents.append(node)
+
+        cycle = self._find_cycle()
+        if cycle:
+            raise SyntaxError(basic_msg + 'Node "dependsOn" forms a cycle: %s.' % ' -> '.join(n.name for n in cycle))
+
+    @staticmethod
+    def is_dag(script_confs):
+        """
+        Batches without any "dependsOn" keep running in order, one configuration at a time.
+        :type script_confs: list[ScriptConfiguration]
+        :rtype bool
+        """
+        return any(script_conf.depends_on for script_conf in script_confs)
+
+    def _find_cycle(self):
+        """
+        Depth first search, without recursion (a long chain would exceed the recursion limit).
+        :return: The nodes of a cycle (the first one repeated at the end), None when there is none.
+        :rtype list[DagNode]
+        """
+        visiting, visited = set(), set()
+        for root in self.nodes:
+            if root in visited:
+                continue
+            path = [root]
+            iterators = [iter(root.dependencies)]
+            visiting.add(root)
+            while iterators:
+                dependency = next(iterators[-1], None)
+                if dependency is None:
+                    node = path.pop()
+                    iterators.pop()
+                    visiting.discard(node)
+                    visited.add(node)
+                elif dependency in visiting:
+                    cycle = path[path.index(dependency):] + [dependency]
+                    # reported in execution order: the dependency first
+                    return list(reversed(cycle))
+                elif dependency not in visited:
+                    path.append(dependency)
+                    iterators.append(iter(dependency.dependencies))
+                    visiting.add(dependency)
+        return None
+
+    def run(self, run_node, max_workers, cancel_sampler):
+        """
+        Runs the nodes with run_node(script_conf), a node once its dependencies succeeded.
+        On cancellation no new node is started, the running ones are waited for (they see the cancellation too).
+        :type run_node: (ScriptConfiguration) -> None
+        :type max_workers: int
+        :type cancel_sampler: CancellationSampler
+        :raises CancellationException: When cancelled.
+        """
+        done = queue.Queue()
+        ready = [node for node in self.nodes if not node.dependencies]
+        running = 0
+        cancellation = None
+        pool = ThreadPool(processes=max(1, min(max_workers, len(self.nodes))))
+        try:
+            while ready or running:
+                if cancellation is None and cancel_sampler.is_cancelled():
+                    try:
+                        cancel_sampler.throw()
+                    except CancellationException as e:
+                        cancellation = e
+                if cancellation is not None:
+                    ready = []
+                    if not running:
+                        break
+
+                while ready and running < max_workers:
+                    node = ready.pop(0)
+                    node.state = DagNode.RUNNING
+                    pool.apply_async(self._run_node, (node, run_node, done))
+                    running += 1
+
+                try:
+                    node = done.get(timeout=1)
+                except queue.Empty:
+                    continue
+                running -= 1
+                if isinstance(node.error, CancellationException):
+                    cancellation = cancellation or node.error
+                if node.state == DagNode.SUCCEEDED:
+                    ready.extend(d for d in node.dependents if d.state == DagNode.PENDING and
+                                 all(dependency.state == DagNode.SUCCEEDED for dependency in d.dependencies))
+                    ready.sort(key=lambda n: n.index)
+                else:
+                    self._skip_dependents(node)
+        finally:
+            pool.close()
+
+        if cancellation is not None:
+            raise cancellation
+
+    def _run_node(self, node, run_node, done):
+        node.start_time = time.time()
+        try:
+            run_node(node.script_conf)
+            node.state = DagNode.SUCCEEDED
+        except Exception as e:
+            node.error = e
+            node.state = DagNode.FAILED
+        finally:
+            node.end_time = time.time()
+            done.put(node)
+
+    def _skip_dependents(self, node):
+        pending = list(node.dependents)
+        while pending:
+            dependent = pending.pop()
+            if dependent.state == DagNode.PENDING:
+                dependent.state = DagNode.SKIPPED
+                pending.extend(dependent.dependents)
+
+    def get_nodes(self, state):
+        """
+        :type state: str
+        :rtype list[DagNode]
+        """
+        return [node for node in self.nodes if node.state == state]
+
+    def critical_path(self):
+        """
+        The chain of dependencies with the longest total run time - the time the batch could not finish faster than,
+        however many configurations ran at once.
+        :return: The nodes of the path in execution order, and its total run time.
+        :rtype tuple[list[DagNode], float]
+        """
+        finish = {}
+        previous = {}
+        for node in self._topological_order():
+            longest = max(node.dependencies, key=lambda d: finish[d], default=None)
+            previous[node] = longest
+            finish[node] = node.seconds + (finish[longest] if longest else 0.0)
+        if not finish:
+            return [], 0.0
+        node = max(self.nodes, key=lambda n: finish[n])
+        total = finish[node]
+        path = []
+        while node is not None:
+            path.append(node)
+            node = previous[node]
+        return list(reversed(path)), total
+
+    def _topological_order(self):
+        """
+        :rtype list[DagNode]
+        """
+        remaining = dict((node, len(node.dependencies)) for node in self.nodes)
+        order = [node for node in self.nodes if not node.dependencies]
+        for node in order:
+            for dependent in node.dependents:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    order.append(dependent)
+        return order
+
+    def format_summary(self):
+        """
+        :rtype str
+        """
+        path, total = self.critical_path()
+        lines = ['Critical path (%.1f seconds): %s' % (
+            total, ' -> '.join('%s (%.1fs)' % (node.name, node.seconds) for node in path))]
+        failed = self.get_nodes(DagNode.FAILED)
+        skipped = self.get_nodes(DagNode.SKIPPED)
+        if failed:
+            lines.append('Failed: %s' % ', '.join('%s (%s)' % (node.name, str(node.error)) for node in failed))
+        if skipped:
+            lines.append('Skipped (a dependency did not succeed): %s' % ', '.join(node.name for node in skipped))
+        return '\n'.join(lines)
@@ -1,11 +1,16 @@
-import urllib.request, urllib.parse, urllib.error
+import itertools
+import os
 from logging import Logger
 
-import re
 import requests
 
 from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationSampler
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.download_cache import DownloadCache, CachedDownload, PartialDownload
+from cloudshell.cm.customscript.domain.filename_parser import get_script_name, get_url_filename, \
+    parse_content_disposition
+from cloudshell.cm.customscript.domain.resumable_download import ResumableDownload
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
+from cloudshell.cm.customscript.domain.stream_pipe import StreamPipe
 from requests.models import HTTPBasicAuth
 
 
@@ -18,20 +23,23 @@ class HttpAuth(object):
 
 class ScriptDownloader(object):
     CHUNK_SIZE = 1024 * 1024
+    STREAM_CHUNK_SIZE = 64 * 1024
+    ENV_PARALLEL_RANGES = 'CUSTOMSCRIPT_DOWNLOAD_PARALLEL_RANGES'
 
-    def __init__(self, logger, cancel_sampler):
+    def __init__(self, logger, cancel_sampler, cache = None, parallel_ranges = None):
         """
         :type logger: Logger
         :type cancel_sampler: CancellationSampler
+        :param cache: Disk cache of the downloaded scripts, also keeping the interrupted downloads (None = no cache).
+        :type cache: DownloadCache
+        :param parallel_ranges: Number of parallel range requests a large file is downloaded with (None = the
+                                ENV_PARALLEL_RANGES environment variable, 1 when unset).
+        :type parallel_ranges: int
         """
         self.logger = logger
-        self.cancel_sampler = cancel_sampler        
-        self.filename_pattern = r"(?P<filename>^.*\.?[^/\\&\?]+\.(sh|bash|ps1)(?=([\?&].*$|$)))" #this regex is to extract the filename from the url, works for cases: filename is at the end, parameter token is at the end
-        self.filename_patterns = {
-            "content-disposition": "\s*((?i)inline|attachment|extension-token)\s*;\s*filename=" + self.filename_pattern,
-            "x-artifactory-filename": self.filename_pattern
-        }
-
+        self.cancel_sampler = cancel_sampler
+        self.cache = cache
+        self.parallel_ranges = parallel_ranges or self._get_env_parallel_ranges()
 
     def download(self, url, auth, verify_certificate):
         """
@@ -39,18 +47,166 @@ class ScriptDownloader(object):
         :type auth: HttpAuth
         :rtype ScriptFile
         """
-        file_txt = ''
+        cached = self._lookup_cache(url)
+        response, file_name = self._get_response(url, auth, verify_certificate,
+                                                 cached.get_validator_headers() if cached else None)
+
+        file_data = None
+        if response.status_code == 304:
+            response.close()
+            file_name = cached.file_name
+            file_data = self._read_cache(cached)
+            if file_data is None:
+                self.logger.warning('The cached copy of the script is corrupted, downloading it again ...')
+                response, file_name = self._get_response(url, auth, verify_certificate)
+
+        if file_data is None:
+            partial = self._open_partial(url)
+            try:
+                file_data = ResumableDownload(self.logger, self.cancel_sampler, verify_certificate,
+                                              self.parallel_ranges).read(response, partial)
+            finally:
+                if partial is not None:
+                    partial.close()
+            self._store_cache(url, file_name, file_data, response)
+
+        if ScriptBundle.get_archive_type(file_name):
+            bundle = ScriptBundle(archive_name=file_name, data=file_data)
+            try:
+                self._validate_bundle(file_name, file_data)
+            except:
+                bundle.close()
+                raise
+            return bundle
+
+        file_txt = str(file_data, 'utf-8')
+        if hasattr(file_data, 'close'):
+            file_data.close()
+        self._validate_file(file_txt)
+
+        return ScriptFile(name=file_name, text=file_txt)
+
+    def _get_env_parallel_ranges(self):
+        value = os.environ.get(self.ENV_PARALLEL_RANGES)
+        if not value:
+            return 1
+        if not value.isdigit() or int(value) <= 0:
+            raise ValueError('Environment variable "%s" must be a positive integer.' % self.ENV_PARALLEL_RANGES)
+        return int(value)
+
+    def _open_partial(self, url):
+        """
+        :type url: str
+        :return: The partial content of the url in the cache, None without a cache (or when the url is already
+                 being downloaded by another thread or process).
+        :rtype PartialDownload
+        """
+        if self.cache is None:
+            return None
+        try:
+            return self.cache.open_partial(url)
+        except Exception as e:
+            self.logger.warning('Failed to open the partial download in the cache: %s' % str(e))
+            return None
+
+    def _lookup_cache(self, url):
+        """
+        :type url: str
+        :rtype CachedDownload
+        """
+        if self.cache is None:
+            return None
+        try:
+            cached = self.cache.lookup(url)
+        except Exception as e:
+            self.logger.warning('Failed to read the download cache: %s' % str(e))
+            return None
+        if cached is not None:
+            self.logger.info('Found a cached copy of the script, checking whether it is current ...')
+        return cached
+
+    def _read_cache(self, cached):
+        """
+        :type cached: CachedDownload
+        :return: The cached content, None when it is corrupted (or cannot be read).
+        :rtype mmap.mmap | bytes
+        """
+        try:
+            file_data = self.cache.read(cached)
+        except Exception as e:
+            self.logger.warning('Failed to read the download cache: %s' % str(e))
+            return None
+        if file_data is not None:
+            self.logger.info('Not modified, using the cached copy (%s bytes).' % cached.size)
+        return file_data
+
+    def _store_cache(self, url, file_name, file_data, response):
+        """
+        Caches a content that can be validated later, i.e. whose response came with an ETag or Last-Modified.
+        :type url: str
+        :type file_name: str
+        :type file_data: bytes
+        :type response: requests.Response
+        """
+        if self.cache is None:
+            return
+        headers = response.headers or {}
+        etag = headers.get('etag')
+        last_modified = headers.get('last-modified')
+        if not etag and not last_modified:
+            return
+        try:
+            self.cache.store(url, file_name, file_data, etag, last_modified)
+        except Exception as e:
+            self.logger.warning('Failed to write the download cache: %s' % str(e))
+
+    def open_stream(self, url, auth, verify_certificate):
+        """
+        Pipe mode: returns a script file (or bundle) whose content is streamed from the http response through a
+        bounded buffer, instead of being downloaded into memory first. Only the first chunk is read here (to
+        validate the content), the rest is downloaded while the consumer uploads it to the target host.
+        :type url: str
+        :type auth: HttpAuth
+        :rtype ScriptFile
+        """
+        response, file_name = self._get_response(url, auth, verify_certificate)
+        chunks = response.iter_content(ScriptDownloader.STREAM_CHUNK_SIZE)
+        first_chunk = next((chunk for chunk in chunks if chunk), b'')
+
+        archive_type = ScriptBundle.get_archive_type(file_name)
+        if archive_type:
+            self._validate_bundle(file_name, first_chunk)
+        else:
+            self._validate_file(first_chunk.decode('utf-8', 'ignore'))
+
+        stream = StreamPipe(itertools.chain([first_chunk], chunks), self.cancel_sampler, on_close=response.close)
+        content_length = response.headers.get('content-length')
+        stream_size = int(content_length) if content_length and content_length.isdigit() else None
+        if archive_type:
+            return ScriptBundle(archive_name=file_name, stream=stream, stream_size=stream_size)
+        return ScriptFile(name=file_name, stream=stream, stream_size=stream_size)
+
+    def _get_response(self, url, auth, verify_certificate, validator_headers = None):
+        """
+        :type url: str
+        :type auth: HttpAuth
+        :param validator_headers: Makes the requests conditional (see CachedDownload.get_validator_headers), the
+                                  response may then be a '304 Not Modified' - without a file name.
+        :type validator_headers: dict
+        :return: The valid (streamed) response and the script file name.
+        :rtype tuple[requests.Response, str]
+        """
         response_valid = False
 
         # assume repo is public, try to download without credentials
         self.logger.info("Starting download script as public...")
         if not verify_certificate:
             self.logger.info("Skipping server certificate")
-        response = requests.get(url, auth=None, stream=True, verify=verify_certificate)
+        response = self._get(url, validator_headers, auth=None, stream=True, verify=verify_certificate)
         response_valid = self._is_response_valid(response, "public")
 
         if response_valid:
-            file_name = self._get_filename(response)
+            file_name = self._get_response_filename(response)
 
         # if fails on public and no auth - no point carry on, user need to fix his URL or add credentials
         if not response_valid and auth is None:
@@ -60,49 +216,65 @@ class ScriptDownloader(object):
         if not response_valid and auth.token is not None:
             self.logger.info("Token provided. Starting download script with Token...")
             headers = {"Authorization": "Bearer %s" % auth.token }
-            response = requests.get(url, stream=True, headers=headers, verify=verify_certificate, allow_redirects=False)
+            response = self._get(url, validator_headers, stream=True, headers=headers, verify=verify_certificate, allow_redirects=False)
             while response.status_code==302:
-                response = requests.get(response.headers['location'], stream=True,headers=headers, verify=verify_certificate, allow_redirects=False)
+                response = self._get(response.headers['location'], validator_headers, stream=True,headers=headers, verify=verify_certificate, allow_redirects=False)
             
             response_valid = self._is_response_valid(response, "Token")
 
             if response_valid:
-                file_name = self._get_filename(response)
+                file_name = self._get_response_filename(response)
         
         # try again with authorization {"Private-Token": "%s" % token}, since gitlab uses that pattern
         if not response_valid and auth.token is not None:
             self.logger.info("Token provided. Starting download script with Token (private-token pattern)...")
             headers = {"Private-Token": "Bearer %s" % auth.token }
-            response = requests.get(url, stream=True, headers=headers, verify=verify_certificate)
+            response = self._get(url, validator_headers, stream=True, headers=headers, verify=verify_certificate)
             
             response_valid = self._is_response_valid(response, "Token")
 
             if response_valid:
-                file_name = self._get_filename(response)
+                file_name = self._get_response_filename(response)
 
         # repo is private and credentials provided, and Token did not provided or did not work. this will NOT work for github. github require Token
         if not response_valid and (auth.username is not None and auth.password is not None):
             self.logger.info("username\password provided, Starting download script with username\password...")
-            response = requests.get(url, auth=(auth.username, auth.password) , stream=True, verify=verify_certificate)
-            file_name = self._get_filename(response)
+            response = self._get(url, validator_headers, auth=(auth.username, auth.password) , stream=True, verify=verify_certificate)
+            file_name = self._get_response_filename(response)
 
             response_valid = self._is_response_valid(response, "username\password")
 
             if response_valid:
-                file_name = self._get_filename(response)
+                file_name = self._get_response_filename(response)
 
         if not response_valid:
             raise Exception('Failed to download script file. please check the logs for more details.')
 
-        for chunk in response.iter_content(ScriptDownloader.CHUNK_SIZE):
-            if chunk:
-                file_txt += ''.join(str(chunk.decode()))
-            self.cancel_sampler.throw_if_canceled()
+        return response, file_name
 
-        self._validate_file(file_txt)
+    def _get(self, url, validator_headers, headers = None, **kwargs):
+        """
+        requests.get, adding the validator headers (if any) to the request headers.
+        :type url: str
+        :type validator_headers: dict
+        :type headers: dict
+        :rtype requests.Response
+        """
+        if validator_headers:
+            headers = dict(headers or {}, **validator_headers)
+        if headers is not None:
+            kwargs['headers'] = headers
+        return requests.get(url, **kwargs)
+
+    def _get_response_filename(self, response):
+        """
+        :return: The script file name, None for a '304 Not Modified' (the name is the cached one).
+        :rtype str
+        """
+        if response.status_code == 304:
+            return None
+        return self._get_filename(response)
 
-        return ScriptFile(name=file_name, text=file_txt)
-    
     def _is_response_valid(self, response, request_method):
         try:
             self._validate_response(response)
@@ -118,34 +290,33 @@ class ScriptDownloader(object):
         if content.lstrip('\n\r').lower().startswith('<!doctype html>'):
             raise Exception('Failed to download script file: url points to an html file')
 
+    def _validate_bundle(self, file_name, data):
+        header = data[:4]
+        if ScriptBundle.get_archive_type(file_name) == ScriptBundle.ZIP:
+            valid = header.startswith(b'PK\x03\x04') or header.startswith(b'PK\x05\x06')
+        else:
+            valid = header.startswith(b'\x1f\x8b')
+        if not valid:
+            raise Exception('Failed to download script bundle: "%s" is not a valid archive' % file_name)
+
     def _validate_response(self, response):
+        if response.status_code == 304:
+            return
         if response.status_code < 200 or response.status_code > 300:            
             raise Exception('Failed to download script file: '+str(response.status_code)+' '+response.reason+
                               '. Please make sure the URL is valid, and the credentials are correct and necessary.')
 
     def _get_filename(self, response):
-        file_name = None
-        for header_value, pattern in self.filename_patterns.items():
-            matching = re.match(pattern, response.headers.get(header_value, ""))
-            if matching:
-                file_name = matching.group('filename')
-                break
-
-        # fallback, couldn't find file name from header, get it from url
-        if not file_name:
-            file_name_from_url = urllib.parse.unquote(response.url[response.url.rfind('/') + 1:])
-            matching = re.match(self.filename_pattern, file_name_from_url)
-            if matching:
-                file_name = matching.group('filename')
-
-        # fallback, couldn't find file name regular URL, check gitlab structure (filename in [-2] position)
-        # example for gitlab URL structure - '/repository/files/testfile%2Eps1/raw?ref=master'
-        if not file_name:
-            file_name_from_url = urllib.parse.unquote(response.url.split('/')[-2])
-            matching = re.match(self.filename_pattern, file_name_from_url)
-            if matching:
-                file_name = matching.group('filename')
-
+        """
+        The script file name, from the Content-Disposition header, the X-Artifactory-Filename header or the url
+        (see filename_parser - linear time, also for long signed urls).
+        :type response: requests.Response
+        :rtype str
+        """
+        headers = response.headers or {}
+        file_name = get_script_name(parse_content_disposition(headers.get('content-disposition'))) or \
+            get_script_name(headers.get('x-artifactory-filename')) or \
+            get_url_filename(response.url)
         if not file_name:
-            raise Exception("Script file of supported types: '.sh', '.bash', '.ps1' was not found")
-        return file_name.strip()
\ No newline at end of file
+            raise Exception("Script file of supported types: '.sh', '.bash', '.ps1', '.tar.gz', '.tgz', '.zip' was not found")
+        return file_name
\ No newline at end of file
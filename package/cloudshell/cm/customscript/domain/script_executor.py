@@ -5,6 +5,13 @@ from cloudshell.cm.customscript.domain.script_file import ScriptFile
 
 
 class IScriptExecutor(object, metaclass=ABCMeta):
+    # profiles the phases of 'execute' when set (see MemoryProfiler)
+    profiler = None
+    # records the phases, bytes uploaded and exit code of 'execute' when set (see ExecutionResult)
+    script_result = None
+    # the temp folder shared by the scripts of a batch, when open (see open_workspace)
+    workspace = None
+
     @abstractmethod
     def connect(self):
         pass
@@ -24,12 +31,85 @@ class IScriptExecutor(object, metaclass=ABCMeta):
         """
         pass
 
+    def is_connected(self):
+        """
+        Whether a connection opened earlier (e.g. kept warm between scripts) is still usable.
+        :rtype bool
+        """
+        return True
+
+    def close(self):
+        """
+        Releases the connection and threads of the executor.
+        """
+        pass
+
+    def is_multiplexed(self):
+        """
+        Whether more executors of the host can run scripts at the same time without a connection of their own
+        (e.g. ssh multiplexing), so the scripts of a host need not run one at a time.
+        :rtype bool
+        """
+        return False
+
+    def open_workspace(self):
+        """
+        Creates a temp folder on the target machine shared by the next scripts: each one runs in a subfolder of it,
+        created with its upload, instead of creating and deleting a temp folder of its own.
+        """
+        pass
+
+    def close_workspace(self):
+        """
+        Deletes the workspace with everything the scripts left in it. Not cancelable, so it also runs once the
+        command was cancelled. Failures are only logged.
+        """
+        pass
+
+    def _record_upload(self, script_file):
+        """
+        :type script_file: ScriptFile
+        """
+        if self.script_result:
+            self.script_result.add_bytes('uploaded', script_file.transferred_size())
+
+    def _record_output(self, std_out, std_err):
+        """
+        :type std_out: str | bytes
+        :type std_err: str | bytes
+        """
+        if self.script_result:
+            self.script_result.add_output(std_out, std_err)
+
+    def _record_exit_code(self, exit_code):
+        """
+        :type exit_code: int
+        """
+        if self.script_result:
+            self.script_result.set_exit_code(exit_code)
+
+    def has_result_marker(self, key):
+        """
+        Whether the target machine holds the marker of a successful run (see ResultCache).
+        :type key: str
+        :rtype bool
+        """
+        return False
+
+    def write_result_marker(self, key):
+        """
+        Leaves the marker of a successful run on the target machine (see ResultCache).
+        :type key: str
+        """
+        pass
+
 
 class ErrorMsg(object):
     CREATE_TEMP_FOLDER = 'Failed to create temp folder on target machine. Error: ' + os.linesep + '%s'
     DELETE_TEMP_FOLDER = 'Failed to delete the temp folder from target machine. Error: ' + os.linesep + '%s'
     COPY_SCRIPT = 'Failed to copy the script to target machine. Error: ' + os.linesep + '%s'
     RUN_SCRIPT = 'Failed to run the script on target machine. Error: ' + os.linesep + '%s'
+    DEADLINE_EXCEEDED = 'The script did not finish within its execution deadline (%s minutes) and was terminated.'
 
 
 class ExcutorConnectionError(EnvironmentError):
@@ -1,8 +1,28 @@
-from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
-from cloudshell.cm.customscript.domain.windows_script_executor import WindowsScriptExecutor
+import importlib
 
 
 class ScriptExecutorSelector(object):
+    """
+    Lazy registry of the script executors.
+    Executors are registered by their import path and imported only on first use, so a driver process that
+    only talks ssh never imports winrm/ntlm (and vice versa).
+    """
+    DEFAULT_CONNECTION_METHOD = 'winrm'
+    _executors = {
+        'ssh': 'cloudshell.cm.customscript.domain.linux_script_executor.LinuxScriptExecutor',
+        'winrm': 'cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor',
+    }
+
+    @staticmethod
+    def register(connection_method, executor_path):
+        """
+        :param connection_method: The (lower case) connection method of the host configuration.
+        :type connection_method: str
+        :param executor_path: Full import path of the executor class, e.g. 'package.module.ClassName'.
+        :type executor_path: str
+        """
+        ScriptExecutorSelector._executors[connection_method] = executor_path
+
     @staticmethod
     def get(host_conf, logger, cancel_sampler):
         """
@@ -11,7 +31,18 @@ class ScriptExecutorSelector(object):
         :type cancel_sampler: CancellationSampler
         :rtype IScriptExecutor
         """
-        if host_conf.connection_method == 'ssh':
-            return LinuxScriptExecutor(logger, host_conf, cancel_sampler)
-        else:
-            return WindowsScriptExecutor(logger, host_conf, cancel_sampler)
+        executor_class = ScriptExecutorSelector.get_class(host_conf.connection_method)
+        return executor_class(logger, host_conf, cancel_sampler)
+
+    @staticmethod
+    def get_class(connection_method):
+        """
+        Imports (on first use) and returns the executor class for the given connection method.
+        Unknown connection methods fall back to the winrm executor.
+        :type connection_method: str
+        :rtype type
+        """
+        executors = ScriptExecutorSelector._executors
+        executor_path = executors.get(connection_method) or executors[ScriptExecutorSelector.DEFAULT_CONNECTION_METHOD]
+        module_name, class_name = executor_path.rsplit('.', 1)
+        return getattr(importlib.import_module(module_name), class_name)
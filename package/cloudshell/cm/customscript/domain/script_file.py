@@ -1,5 +1,168 @@
+import hashlib
+import posixpath
+
 
 class ScriptFile(object):
-    def __init__(self, name = None, text = None):
+    CONTENT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, name = None, text = None, stream = None, stream_size = None):
+        """
+        :param stream: Iterable of byte chunks to read the content from, instead of holding it in 'text'
+                       (pipe mode). A stream can be read only once.
+        :param stream_size: Expected size of a streamed content, if known (None otherwise).
+        :type name: str
+        :type text: str
+        :type stream_size: int
+        """
         self.name = name
-        self.text = text
\ No newline at end of file
+        self.text = text
+        self.stream = stream
+        self.stream_size = stream_size
+        self._stream_consumed = False
+        self._sha256 = None
+        self.streamed_bytes = 0
+
+    @property
+    def is_streamed(self):
+        """
+        :rtype bool
+        """
+        return self.stream is not None
+
+    def size(self):
+        """
+        :return: The content size in bytes (as written to the target machine), None for a stream of unknown size.
+        :rtype int
+        """
+        if self.is_streamed:
+            return self.stream_size
+        if self.text is None:
+            return 0
+        # one byte per character in ascii, utf-8 needs the encoding for the others
+        return len(self.text) if self.text.isascii() else len(self.get_bytes())
+
+    def transferred_size(self):
+        """
+        :return: The content size, for a stream the bytes streamed so far.
+        :rtype int
+        """
+        if self.is_streamed:
+            return self.streamed_bytes
+        return self.size()
+
+    def sha256(self):
+        """
+        Hex digest of the content as it is written to the target machine (utf-8).
+        For a streamed content the digest is known only once the stream was fully read (None until then).
+        :rtype str
+        """
+        if self._sha256 is None and not self.is_streamed:
+            self._sha256 = hashlib.sha256(self.get_bytes()).hexdigest()
+        return self._sha256
+
+    def iter_content(self, chunk_size = CONTENT_CHUNK_SIZE):
+        """
+        Yields the content as byte chunks. In-memory content is sliced without copying it as a whole,
+        a streamed content is passed through as it arrives.
+        :type chunk_size: int
+        :rtype collections.Iterable[bytes]
+        """
+        if not self.is_streamed:
+            # released as soon as the content was read, so a mapped content can be closed
+            with memoryview(self.get_bytes()) as data:
+                for i in range(0, len(data), chunk_size):
+                    yield data[i:i + chunk_size].tobytes()
+            return
+
+        if self._stream_consumed:
+            raise Exception('The content of "%s" was already streamed to the target machine.' % self.name)
+        self._stream_consumed = True
+        digest = hashlib.sha256()
+        for chunk in self.stream:
+            digest.update(chunk)
+            self.streamed_bytes += len(chunk)
+            yield chunk
+        self._sha256 = digest.hexdigest()
+
+    def close(self):
+        """
+        Releases a streamed content (and the connection it is read from). Does nothing for in-memory content.
+        """
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+    def get_bytes(self):
+        """
+        The in-memory content, as written to the target machine.
+        :rtype bytes
+        """
+        return self.text.encode('utf-8')
+
+
+class ScriptBundle(ScriptFile):
+    TAR_GZ = 'tar.gz'
+    ZIP = 'zip'
+    ARCHIVE_TYPES = {'.tar.gz': TAR_GZ, '.tgz': TAR_GZ, '.zip': ZIP}
+
+    def __init__(self, archive_name = None, data = None, stream = None, stream_size = None):
+        """
+        A compressed archive of scripts, extracted as a whole on the target machine.
+        The 'name' of a bundle is its entry point - the archive relative path of the script to run once the
+        archive is extracted - and is set with 'set_entry_point'.
+        :type archive_name: str
+        :param data: The archive, or a read only mmap of it (a cached download, unmapped by 'close').
+        :type data: bytes | mmap.mmap
+        """
+        super(ScriptBundle, self).__init__(stream=stream, stream_size=stream_size)
+        self.archive_name = archive_name
+        self.data = data
+
+    @property
+    def archive_type(self):
+        """
+        :rtype str
+        """
+        return ScriptBundle.get_archive_type(self.archive_name)
+
+    @staticmethod
+    def get_archive_type(file_name):
+        """
+        :type file_name: str
+        :return: One of TAR_GZ / ZIP, None if the file is not a supported archive.
+        :rtype str
+        """
+        lower_name = (file_name or '').lower()
+        for ext, archive_type in ScriptBundle.ARCHIVE_TYPES.items():
+            if lower_name.endswith(ext):
+                return archive_type
+        return None
+
+    def set_entry_point(self, entry_point):
+        """
+        :type entry_point: str
+        """
+        normalized = posixpath.normpath((entry_point or '').replace('\\', '/'))
+        if not entry_point or normalized.startswith('/') or normalized == '..' or normalized.startswith('../'):
+            raise Exception('Script bundle "%s" requires a relative "repositoryDetails.entryPoint" inside the archive.'
+                            % self.archive_name)
+        self.name = normalized
+
+    def size(self):
+        if self.is_streamed:
+            return self.stream_size
+        return len(self.data)
+
+    def close(self):
+        """
+        Also unmaps a content read from the download cache (and closes its file), see DownloadCache.read.
+        """
+        super(ScriptBundle, self).close()
+        if hasattr(self.data, 'close'):
+            try:
+                self.data.close()
+            except BufferError:
+                # still exported by a read that did not finish (e.g. an aborted upload), unmapped once it is released
+                pass
+
+    def get_bytes(self):
+        return self.data
@@ -0,0 +1,136 @@
+import threading
+
+
+class SharedSshConnection(object):
+    def __init__(self, pool, key):
+        """
+        An ssh client shared by the executors that acquired it, released with 'release'.
+        :type pool: SshConnectionPool
+        :type key: tuple
+        """
+        self.pool = pool
+        self.key = key
+        self.client = None
+        self.leases = 0
+        self.error = None
+        self._ready = threading.Event()
+
+    def is_active(self):
+        """
+        :rtype bool
+        """
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
+
+
+class SshConnectionLease(object):
+    def __init__(self, connection):
+        """
+        :type connection: SharedSshConnection
+        """
+        self.connection = connection
+        self.client = connection.client
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.connection.pool._release(self.connection)
+
+
+class SshConnectionPool(object):
+    """
+    Authenticated ssh connections shared by the executors working on the same host (with the same credentials) at
+    the same time, see SshMultiplexingConfiguration: each executor runs its commands on channels of its own over the
+    shared transport, so only the first one pays for the handshake (and for the sshd process of the connection).
+    An executor holds up to CHANNELS_PER_EXECUTOR channels at once (a command, and the kill of it or an sftp
+    session), so a connection is shared by at most max_sessions / CHANNELS_PER_EXECUTOR executors - the next ones
+    get another connection, the MaxSessions of the sshd is never exceeded. A connection is closed when the last of
+    its executors releases it.
+    """
+    CHANNELS_PER_EXECUTOR = 2
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    @staticmethod
+    def get_default():
+        """
+        The pool shared by the whole driver process.
+        :rtype SshConnectionPool
+        """
+        with SshConnectionPool._default_lock:
+            if SshConnectionPool._default is None:
+                SshConnectionPool._default = SshConnectionPool()
+            return SshConnectionPool._default
+
+    def acquire(self, key, max_sessions, connect):
+        """
+        Leases a connection with room for one more executor, or creates one with 'connect'. Executors asking for a
+        connection that is still being created wait for it (and fail with its error).
+        :param key: Who the connection is for (host, port, user and credentials) - only equal keys share it.
+        :type key: tuple
+        :param max_sessions: Max channels open at once on one connection.
+        :type max_sessions: int
+        :param connect: Creates a connected paramiko SSHClient.
+        :type connect: () -> paramiko.SSHClient
+        :rtype SshConnectionLease
+        """
+        max_leases = max(1, max_sessions // self.CHANNELS_PER_EXECUTOR)
+        with self._lock:
+            connections = self._connections.setdefault(key, [])
+            # a connection that is not ready yet is taken as alive, its creator removes it if it fails
+            connection = next((c for c in connections if c.leases < max_leases and
+                               (not c._ready.is_set() or c.is_active())), None)
+            created = connection is None
+            if created:
+                connection = SharedSshConnection(self, key)
+                connections.append(connection)
+            connection.leases += 1
+
+        if created:
+            try:
+                connection.client = connect()
+            except Exception as e:
+                connection.error = e
+                self._discard(connection)
+                raise
+            finally:
+                connection._ready.set()
+        else:
+            connection._ready.wait()
+            if connection.error is not None:
+                raise connection.error
+        return SshConnectionLease(connection)
+
+    def connections_count(self, key):
+        """
+        :type key: tuple
+        :rtype int
+        """
+        with self._lock:
+            return len(self._connections.get(key, []))
+
+    def _release(self, connection):
+        with self._lock:
+            connection.leases -= 1
+            if connection.leases > 0:
+                return
+            self._remove(connection)
+        if connection.client is not None:
+            connection.client.close()
+
+    def _discard(self, connection):
+        with self._lock:
+            self._remove(connection)
+
+    def _remove(self, connection):
+        connections = self._connections.get(connection.key, [])
+        if connection in connections:
+            connections.remove(connection)
+        if not connections:
+            self._connections.pop(connection.key, None)
@@ -0,0 +1,82 @@
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+
+
+class StreamPipe(object):
+    """
+    Bounded buffer between a producer (e.g. an http response) and a consumer (e.g. an upload to the target host).
+    A background thread reads the source into a queue of at most 'max_chunks' chunks, so the consumer can start
+    before the source is exhausted, while no more than max_chunks * chunk size bytes are held in memory.
+    Errors of the producer (including cancellation) are re-raised to the consumer, and a consumer waiting for a
+    chunk (e.g. of a stalled source) stops on cancellation too.
+    """
+    DEFAULT_MAX_CHUNKS = 8
+    PUT_TIMEOUT_SECONDS = 0.5
+    GET_TIMEOUT_SECONDS = 0.5
+
+    _END = object()
+
+    def __init__(self, source, cancel_sampler, max_chunks = DEFAULT_MAX_CHUNKS, on_close = None):
+        """
+        :type source: collections.Iterable[bytes]
+        :type cancel_sampler: CancellationSampler
+        :type max_chunks: int
+        :param on_close: Called (once) when the pipe is closed, e.g. to release the http response.
+        """
+        self.cancel_sampler = cancel_sampler
+        self.on_close = on_close
+        self._source = source
+        self._queue = Queue(maxsize=max_chunks)
+        self._closed = Event()
+        self._error = None
+        self._thread = Thread(target=self._produce, name='stream-pipe')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=StreamPipe.GET_TIMEOUT_SECONDS)
+                except Empty:
+                    self.cancel_sampler.throw_if_canceled()
+                    continue
+                if item is StreamPipe._END:
+                    break
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        # unblock the producer if it waits on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+        if self.on_close:
+            self.on_close()
+
+    def _produce(self):
+        try:
+            for chunk in self._source:
+                self.cancel_sampler.throw_if_canceled()
+                if chunk and not self._put(chunk):
+                    return
+        except Exception as e:
+            self._error = e
+        self._put(StreamPipe._END)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=StreamPipe.PUT_TIMEOUT_SECONDS)
+                return True
+            except Full:
+                continue
+        return False
@@ -1,5 +1,6 @@
 import base64
 import os
+import threading
 
 import time
 from multiprocessing.pool import ThreadPool
@@ -11,14 +12,26 @@ from logging import Logger
 import xml.etree.ElementTree as ET
 from winrm.exceptions import WinRMTransportError
 
+from cloudshell.cm.customscript.domain.detached_execution import DetachedExecution, DetachedPollResult
+from cloudshell.cm.customscript.domain.execution_result import record_phase
+from cloudshell.cm.customscript.domain.memory_profiler import profile_phase
 from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
 from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
 from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor, ErrorMsg, ExcutorConnectionError
+from cloudshell.cm.customscript.domain.script_file import ScriptBundle
 from requests import ConnectionError, ConnectTimeout
 
 
 class WindowsScriptExecutor(IScriptExecutor):
     COPY_BULK_SIZE = 2000
+    PARALLEL_PART_MIN_SIZE = 256 * 1024
+    DETACHED_LAUNCHER = '.cs_run.ps1'
+    DETACHED_STDOUT = '.cs_stdout'
+    DETACHED_STDERR = '.cs_stderr'
+    DETACHED_EXIT_CODE = '.cs_exit_code'
+    DETACHED_PID = '.cs_pid'
+    RESULT_MARKERS_PATH = '$env:LOCALAPPDATA\\CloudShell\\ScriptResults'
+    RESULT_MARKERS_MAX_AGE_DAYS = 30
 
     def __init__(self, logger, target_host, cancel_sampler):
         """
@@ -29,24 +42,37 @@ class WindowsScriptExecutor(IScriptExecutor):
         self.logger = logger
         self.cancel_sampler = cancel_sampler
         self.pool = ThreadPool(processes=1)
+        self.target_host = target_host
+
+        self._host_shell_limit = None
+        self._host_shell_limit_read = False
+        self._workspace_folders = 0
 
         # if parameter does not specify winrm_transport, try ssl, then fall back to http
         if target_host.parameters.get('winrm_transport')=='ssl':
             self.logger.info('SSL only WinRM session')
-            self.session = winrm.Session(target_host.ip, auth=(target_host.username, target_host.password), transport='ssl', server_cert_validation='ignore')
+            self.session = self._create_session(transport='ssl', server_cert_validation='ignore')
         elif target_host.parameters.get('winrm_transport')=='http':
             self.logger.info('http only WinRM session')
-            self.session = winrm.Session(target_host.ip, auth=(target_host.username, target_host.password))
+            self.session = self._create_session()
         else:
             self.logger.info('identifying whether host is ssl or http')
-            self.session = winrm.Session(target_host.ip, auth=(target_host.username, target_host.password), transport='ssl', server_cert_validation='ignore')
+            self.session = self._create_session(transport='ssl', server_cert_validation='ignore')
             try:
                 self.session.run_cmd('@echo connected')
                 self.logger.info('connecting via ssl')
             except ConnectionError:
-                self.session = winrm.Session(target_host.ip, auth=(target_host.username, target_host.password))
+                self.session = self._create_session()
                 self.logger.info('falling back to http')
 
+    def _create_session(self, **kwargs):
+        """
+        The arguments are kept, for the extra sessions of a parallel upload (see _copy_data_parallel).
+        :rtype winrm.Session
+        """
+        self._session_kwargs = kwargs
+        return winrm.Session(self.target_host.ip, auth=(self.target_host.username, self.target_host.password), **kwargs)
+
     def connect(self):
         try:
             uid = str(uuid4())
@@ -68,6 +94,17 @@ class WindowsScriptExecutor(IScriptExecutor):
         except Exception as e:
             raise ExcutorConnectionError(0, e)
 
+    def close(self):
+        # winrm is stateless http, every command opens (and closes) its own shell
+        self.pool.close()
+
+    def is_multiplexed(self):
+        """
+        Every command runs in a winrm shell of its own, there is no connection to share.
+        :rtype bool
+        """
+        return True
+
     def get_expected_file_extensions(self):
         """
         :rtype list[str]
@@ -83,27 +120,51 @@ class WindowsScriptExecutor(IScriptExecutor):
         :type output_writer: ReservationOutputWriter
         :type print_output: bool
         """
-        self.logger.info('Creating temp folder on target machine ...')
-        tmp_folder = self.create_temp_folder()
-        self.logger.info('Done (%s).' % tmp_folder)
+        in_workspace = self.workspace is not None
+        if in_workspace:
+            tmp_folder = self._new_workspace_folder()
+            self.logger.info('Using "%s" folder of the workspace.' % tmp_folder)
+        else:
+            self.logger.info('Creating temp folder on target machine ...')
+            tmp_folder = self.create_temp_folder()
+            self.logger.info('Done (%s).' % tmp_folder)
 
         try:
-            self.logger.info('Copying "%s" (%s chars) to "%s" target machine ...' % (
-            script_file.name, len(script_file.text), tmp_folder))
-            self.copy_script(tmp_folder, script_file)
-            self.logger.info('Done.')
+            with profile_phase(self.profiler, 'upload'), record_phase(self.script_result, 'upload'):
+                self.logger.info('Copying "%s" (size: %s) to "%s" target machine ...' % (
+                script_file.name, script_file.size(), tmp_folder))
+                script_cache = self.target_host.script_cache
+                if isinstance(script_file, ScriptBundle):
+                    self.copy_bundle(tmp_folder, script_file)
+                    self._record_upload(script_file)
+                    self.logger.info('Done.')
+                elif script_cache and not script_file.is_streamed and \
+                        self.copy_script_from_cache(script_cache, tmp_folder, script_file):
+                    self.logger.info('Done (taken from the remote script cache).')
+                else:
+                    self.copy_script(tmp_folder, script_file)
+                    self._record_upload(script_file)
+                    if script_cache:
+                        self.store_script_in_cache(script_cache, tmp_folder, script_file)
+                    self.logger.info('Done.')
 
-            self.logger.info('Running "%s" on target machine ...' % script_file.name)
-            self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
-            self.logger.info('Done.')
+            with profile_phase(self.profiler, 'run'), record_phase(self.script_result, 'run'):
+                self.logger.info('Running "%s" on target machine ...' % script_file.name)
+                if self.target_host.execution.detached:
+                    self.run_script_detached(tmp_folder, script_file, env_vars, output_writer, print_output)
+                else:
+                    self.run_script(tmp_folder, script_file, env_vars, output_writer, print_output)
+                self.logger.info('Done.')
 
         finally:
-            try:
-                self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
-                self.delete_temp_folder(tmp_folder)
-                self.logger.info('Done.')
-            except Exception as e:
-                self.logger.error('Failed to delete temp folder "%s" from target machine: %s' % (tmp_folder, str(e)))
+            # a workspace subfolder is deleted with the workspace (see close_workspace)
+            if not in_workspace:
+                try:
+                    self.logger.info('Deleting "%s" folder from target machine ...' % tmp_folder)
+                    self.delete_temp_folder(tmp_folder)
+                    self.logger.info('Done.')
+                except Exception as e:
+                    self.logger.error('Failed to delete temp folder "%s" from target machine: %s' % (tmp_folder, str(e)))
 
     def create_temp_folder(self):
         """
@@ -119,27 +180,338 @@ Write-Output $fullPath
             raise Exception(ErrorMsg.CREATE_TEMP_FOLDER % result.std_err)
         return result.std_out.decode('utf-8').rstrip('\r\n')
 
+    def open_workspace(self):
+        self.logger.info('Creating workspace on target machine ...')
+        self.workspace = self.create_temp_folder()
+        self.logger.info('Done (%s).' % self.workspace)
+
+    def close_workspace(self):
+        workspace, self.workspace = self.workspace, None
+        if workspace is None:
+            return
+        try:
+            self.logger.info('Deleting "%s" workspace from target machine ...' % workspace)
+            # winrm is stateless, the command runs in a shell of its own even once the command was cancelled
+            result = self._run(self.session, '\nRemove-Item "%s" -Recurse -Force\n' % workspace)
+            if result.status_code != 0:
+                raise Exception(ErrorMsg.DELETE_TEMP_FOLDER % result.std_err)
+            self.logger.info('Done.')
+        except Exception as e:
+            self.logger.error('Failed to delete workspace "%s" from target machine: %s' % (workspace, str(e)))
+
+    def _new_workspace_folder(self):
+        """
+        :return: A subfolder of the workspace, created by the upload into it (see _get_create_folder_code).
+        :rtype str
+        """
+        self._workspace_folders += 1
+        return '%s\\%s' % (self.workspace, self._workspace_folders)
+
+    def _get_create_folder_code(self, tmp_folder):
+        """
+        Every upload command into a workspace subfolder creates it: CreateDirectory does nothing when it exists, so
+        it does not matter which command (e.g. which part of a parallel upload) runs first.
+        :rtype str
+        """
+        if self.workspace is None or not tmp_folder.startswith(self.workspace + '\\'):
+            return ''
+        return '\n[System.IO.Directory]::CreateDirectory("%s") | Out-Null' % tmp_folder
+
     def copy_script(self, tmp_folder, script_file):
         """
         :type tmp_folder: str
         :type script_file: ScriptFile
         """
-        all_size = len(script_file.text)
-        bulk_zise = WindowsScriptExecutor.COPY_BULK_SIZE
-        bulks = [script_file.text[i:min(all_size,i+bulk_zise)] for i in range(0, all_size, bulk_zise)]
-        self.logger.debug("Bulks sizes (%s): %s" % (len(bulks), ', '.join([str(len(b)) for b in bulks])))
+        self._copy_file(tmp_folder, script_file.name, script_file)
 
-        for bulk in bulks:
-            encoded_bulk = base64.b64encode(bulk.encode("utf-8"))
-            code = """
+    def copy_bundle(self, tmp_folder, script_bundle):
+        """
+        Copies the archive to the temp folder and extracts it there (Expand-Archive for zip, tar for tar.gz).
+        :type tmp_folder: str
+        :type script_bundle: ScriptBundle
+        """
+        self._copy_file(tmp_folder, script_bundle.archive_name, script_bundle)
+        if script_bundle.archive_type == ScriptBundle.ZIP:
+            extract = 'Expand-Archive -Path $archive -DestinationPath $folder -Force'
+        else:
+            extract = 'tar.exe -xzf $archive -C $folder; if ($LASTEXITCODE -ne 0) { exit $LASTEXITCODE }'
+        code = """
+$ErrorActionPreference = "Stop"
+$folder  = "{0}"
+$archive = Join-Path $folder "{1}"
+{2}
+Remove-Item $archive
+""".format(tmp_folder, script_bundle.archive_name, extract)
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+
+    def _copy_file(self, tmp_folder, file_name, script_file):
+        """
+        Copies a large file over several shells at once (see UploadConfiguration.parallel_shells), otherwise over one.
+        :type tmp_folder: str
+        :type file_name: str
+        :type script_file: ScriptFile
+        """
+        parts = self._get_parallel_parts(script_file)
+        if parts > 1:
+            self._copy_data_parallel(tmp_folder, file_name, script_file, parts)
+        else:
+            self._copy_data(tmp_folder, file_name, script_file.iter_content())
+
+    def _copy_data(self, tmp_folder, file_name, chunks):
+        """
+        Appends the content to the remote file in bulks of COPY_BULK_SIZE bytes, as the chunks arrive.
+        :type tmp_folder: str
+        :type file_name: str
+        :type chunks: collections.Iterable[bytes]
+        """
+        bulks_count = 0
+        for bulk in self._to_bulks(chunks, WindowsScriptExecutor.COPY_BULK_SIZE):
+            bulks_count += 1
+            result = self._run_cancelable(self._get_append_code(tmp_folder, file_name, bulk))
+            if result.status_code != 0:
+                raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+        self.logger.debug('Copied "%s" in %s bulks' % (file_name, bulks_count))
+
+    def _get_append_code(self, tmp_folder, file_name, bulk):
+        """
+        :type bulk: bytes
+        :rtype str
+        """
+        return self._get_create_folder_code(tmp_folder) + """
 $path   = Join-Path "{0}" "{1}"
 $data   = [System.Convert]::FromBase64String("{2}")
 Add-Content -value $data -encoding byte -path $path
-""".format(tmp_folder, script_file.name, encoded_bulk.decode('utf-8'))
+""".format(tmp_folder, file_name, base64.b64encode(bulk).decode('utf-8'))
+
+    def _get_parallel_parts(self, script_file):
+        """
+        The number of parts (and shells) a file is copied in: at most parallel_shells, at least
+        PARALLEL_PART_MIN_SIZE bytes per part, and one shell less than the shells a user may open on the host (and
+        the operations it may run at once), so the shell of the executor is not starved.
+        Streamed content is copied as it arrives, in one part.
+        :type script_file: ScriptFile
+        :rtype int
+        """
+        max_shells = self.target_host.upload.parallel_shells or 1
+        if max_shells <= 1 or script_file.is_streamed:
+            return 1
+        parts = min(max_shells, script_file.size() // self.PARALLEL_PART_MIN_SIZE)
+        if parts <= 1:
+            return 1
+        host_limit = self._get_host_shell_limit()
+        if host_limit:
+            parts = min(parts, host_limit - 1)
+        return max(parts, 1)
+
+    def _get_host_shell_limit(self):
+        """
+        The lowest of the MaxShellsPerUser and MaxConcurrentOperationsPerUser settings of the host, read once.
+        :return: None when they cannot be read (e.g. the user is not an administrator).
+        :rtype int
+        """
+        if not self._host_shell_limit_read:
+            self._host_shell_limit_read = True
+            code = """
+foreach ($setting in 'WSMan:\\localhost\\Shell\\MaxShellsPerUser', 'WSMan:\\localhost\\Service\\MaxConcurrentOperationsPerUser') {
+    Write-Output (Get-Item $setting -ErrorAction SilentlyContinue).Value
+}
+exit 0
+"""
             result = self._run_cancelable(code)
+            limits = [int(value) for value in result.std_out.decode('utf-8').split() if value.isdigit()]
+            if result.status_code == 0 and limits:
+                self._host_shell_limit = min(limits)
+            else:
+                self.logger.debug('Failed to read the shell limits of the target machine: %s' % result.std_err)
+        return self._host_shell_limit
+
+    def _copy_data_parallel(self, tmp_folder, file_name, script_file, parts):
+        """
+        Copies the file as 'parts' part files, each one over its own session and shell at the same time, then joins
+        them and verifies the sha256 of the joined file on the target machine, in a single command.
+        The parts are left in the temp folder on failure (and deleted with it).
+        :type tmp_folder: str
+        :type file_name: str
+        :type script_file: ScriptFile
+        :type parts: int
+        """
+        data = memoryview(script_file.get_bytes())
+        part_size = -(-len(data) // parts)
+        self.logger.debug('Copying "%s" in %s parts over %s shells' % (file_name, parts, parts))
+        aborted = threading.Event()
+        pool = ThreadPool(processes=parts)
+        try:
+            async_results = [pool.apply_async(self._copy_part, (tmp_folder, '%s.part%s' % (file_name, i),
+                                                                data[i * part_size:(i + 1) * part_size], aborted))
+                             for i in range(parts)]
+            try:
+                pending = async_results
+                while pending:
+                    if self.cancel_sampler.is_cancelled():
+                        self.cancel_sampler.throw()
+                    pending[0].wait(1)
+                    for async_result in pending:
+                        if async_result.ready() and not async_result.successful():
+                            async_result.get()
+                    pending = [async_result for async_result in pending if not async_result.ready()]
+            finally:
+                # the other parts stop at their next bulk
+                aborted.set()
+                for async_result in async_results:
+                    async_result.wait()
+        finally:
+            pool.close()
+
+        code = """
+$ErrorActionPreference = "Stop"
+$folder = "{0}"
+$path   = Join-Path $folder "{1}"
+$file   = [System.IO.File]::Open($path, [System.IO.FileMode]::Create)
+try {{
+    foreach ($i in 0..{2}) {{
+        $part   = Join-Path $folder ("{1}.part" + $i)
+        $stream = [System.IO.File]::OpenRead($part)
+        try {{ $stream.CopyTo($file) }} finally {{ $stream.Close() }}
+        Remove-Item $part
+    }}
+}} finally {{
+    $file.Close()
+}}
+$hash = (Get-FileHash $path -Algorithm SHA256).Hash
+if ($hash -ne "{3}") {{
+    Remove-Item $path
+    throw ("The joined file does not match the uploaded content (sha256: " + $hash + ")")
+}}
+""".format(tmp_folder, file_name, parts - 1, script_file.sha256())
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
+        self.logger.debug('Copied "%s" in %s parts' % (file_name, parts))
+
+    def _copy_part(self, tmp_folder, part_name, data, aborted):
+        """
+        Runs in a thread of _copy_data_parallel, with a session of its own (a winrm.Session is not thread safe).
+        :type tmp_folder: str
+        :type part_name: str
+        :type data: memoryview
+        :type aborted: threading.Event
+        """
+        session = winrm.Session(self.target_host.ip, auth=(self.target_host.username, self.target_host.password),
+                                **self._session_kwargs)
+        for start in range(0, len(data), WindowsScriptExecutor.COPY_BULK_SIZE):
+            if aborted.is_set():
+                return
+            bulk = data[start:start + WindowsScriptExecutor.COPY_BULK_SIZE]
+            result = self._run(session, self._get_append_code(tmp_folder, part_name, bulk))
             if result.status_code != 0:
                 raise Exception(ErrorMsg.COPY_SCRIPT % result.std_err)
 
+    def _to_bulks(self, chunks, bulk_size):
+        """
+        Re-slices a stream of chunks (of any size) to bulks of exactly bulk_size bytes (except the last one).
+        :type chunks: collections.Iterable[bytes]
+        :type bulk_size: int
+        :rtype collections.Iterable[bytes]
+        """
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer.extend(chunk)
+            while len(buffer) >= bulk_size:
+                yield bytes(buffer[:bulk_size])
+                del buffer[:bulk_size]
+        if buffer:
+            yield bytes(buffer)
+
+    def copy_script_from_cache(self, script_cache, tmp_folder, script_file):
+        """
+        Copies the script from the remote cache into the temp folder, if the cache holds a file with the same sha256.
+        :type script_cache: ScriptCacheConfiguration
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :return: True on a cache hit.
+        :rtype bool
+        """
+        code = self._get_create_folder_code(tmp_folder) + """
+$cached = Join-Path "{0}" "{1}"
+if ((Test-Path $cached) -and ((Get-FileHash $cached -Algorithm SHA256).Hash -eq "{1}")) {{
+    (Get-Item $cached).LastWriteTime = Get-Date
+    Copy-Item $cached (Join-Path "{2}" "{3}")
+    Write-Output "hit"
+}}
+""".format(self._get_cache_path(script_cache), script_file.sha256(), tmp_folder, script_file.name)
+        result = self._run_cancelable(code)
+        return result.status_code == 0 and result.std_out.decode('utf-8').strip() == 'hit'
+
+    def store_script_in_cache(self, script_cache, tmp_folder, script_file):
+        """
+        Stores the uploaded script in the remote cache and evicts entries older than max_age_days, then the least
+        recently used entries until the cache fits in max_size_mb. Failures are only logged.
+        :type script_cache: ScriptCacheConfiguration
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        """
+        code = """
+$cache = "{0}"
+New-Item $cache -type directory -Force | Out-Null
+$partial = Join-Path $cache ("{1}." + [System.Guid]::NewGuid().ToString())
+Copy-Item (Join-Path "{2}" "{3}") $partial
+Move-Item $partial (Join-Path $cache "{1}") -Force
+if ({4} -gt 0) {{
+    Get-ChildItem $cache -File | Where-Object {{ $_.LastWriteTime -lt (Get-Date).AddMinutes(-{4}) }} | Remove-Item -Force
+}}
+$total = 0
+foreach ($f in (Get-ChildItem $cache -File | Sort-Object LastWriteTime -Descending)) {{
+    $total += $f.Length
+    if ($total -gt {5}) {{ Remove-Item $f.FullName -Force }}
+}}
+""".format(self._get_cache_path(script_cache), script_file.sha256(), tmp_folder, script_file.name,
+           self._get_max_age_minutes(script_cache), int(script_cache.max_size_mb * 1024 * 1024))
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            self.logger.warning('Failed to store "%s" in the remote script cache: %s' % (script_file.name, result.std_err))
+
+    def _get_cache_path(self, script_cache):
+        return (script_cache.path or '$env:LOCALAPPDATA\\CloudShell\\ScriptCache').rstrip('\\')
+
+    def _get_max_age_minutes(self, script_cache):
+        """
+        At least one minute, so the entry just stored (copied with the time it was uploaded) is never evicted.
+        :type script_cache: ScriptCacheConfiguration
+        :return: 0 when the entries are not evicted by age.
+        :rtype int
+        """
+        if not script_cache.max_age_days:
+            return 0
+        return max(1, int(script_cache.max_age_days * 24 * 60))
+
+    def has_result_marker(self, key):
+        """
+        :type key: str
+        :rtype bool
+        """
+        code = """
+if (Test-Path (Join-Path "{0}" "{1}")) {{ Write-Output "hit" }}
+""".format(self.RESULT_MARKERS_PATH, key)
+        result = self._run_cancelable(code)
+        return result.status_code == 0 and result.std_out.decode('utf-8').strip() == 'hit'
+
+    def write_result_marker(self, key):
+        """
+        Writes the marker and removes the markers older than RESULT_MARKERS_MAX_AGE_DAYS. Failures are only logged.
+        :type key: str
+        """
+        code = """
+$folder = "{0}"
+New-Item $folder -type directory -Force | Out-Null
+Set-Content -Path (Join-Path $folder "{1}") -Value ""
+Get-ChildItem $folder -File | Where-Object {{ $_.LastWriteTime -lt (Get-Date).AddDays(-{2}) }} | Remove-Item -Force
+""".format(self.RESULT_MARKERS_PATH, key, self.RESULT_MARKERS_MAX_AGE_DAYS)
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            self.logger.warning('Failed to write the result marker on target machine: %s' % result.std_err)
+
     def run_script(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
         """
         :type tmp_folder: str
@@ -155,13 +527,125 @@ Add-Content -value $data -encoding byte -path $path
 $path = Join-Path "{0}" "{1}"
 Invoke-Expression "& '$path'"
 """.format(tmp_folder, script_file.name)
-        result = self._run_cancelable(code)
+        result = self._run_cancelable(code, deadline_minutes=self.target_host.execution.deadline_minutes)
+        self._record_exit_code(result.status_code)
         if print_output:
+            self._record_output(result.std_out, result.std_err)
             output_writer.write(result.std_out)
             output_writer.write(result.std_err)
         if result.status_code != 0:
             raise Exception(ErrorMsg.RUN_SCRIPT % result.std_err)
 
+    def run_script_detached(self, tmp_folder, script_file, env_vars, output_writer, print_output=True):
+        """
+        Launches the script in the background and polls for its completion (see ExecutionConfiguration.detached).
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type env_vars: dict
+        :type output_writer: ReservationOutputWriter
+        :type print_output: bool
+        """
+        self.launch_detached(tmp_folder, script_file, env_vars)
+        execution = self.target_host.execution
+        DetachedExecution(self, tmp_folder, self.logger, self.cancel_sampler, execution.poll_interval_seconds,
+                          execution.deadline_minutes).wait(output_writer, print_output)
+
+    def launch_detached(self, tmp_folder, script_file, env_vars):
+        """
+        Processes started from a winrm shell are killed with the shell, so the script is started through
+        Win32_Process.Create (outside of the shell job) by a launcher that sets the environment variables, runs the
+        script with stdout/stderr redirected to files in the temp folder, and writes the exit code file (atomically)
+        once the script exits.
+        :type tmp_folder: str
+        :type script_file: ScriptFile
+        :type env_vars: dict
+        :return: The pid of the launched process.
+        :rtype str
+        """
+        launcher = ''
+        for key, value in (env_vars or {}).items():
+            launcher += '$env:%s = "%s"\n' % (key, str(value))
+        launcher += "& (Join-Path $PSScriptRoot '%s')\nexit $LASTEXITCODE\n" % script_file.name
+        self._copy_data(tmp_folder, self.DETACHED_LAUNCHER, [b'\xef\xbb\xbf' + launcher.encode('utf-8')])
+
+        code = """
+$folder  = "{0}"
+$command = 'cmd.exe /v:on /c "powershell.exe -NoProfile -NonInteractive -ExecutionPolicy Bypass -File "{1}" > "{2}" 2> "{3}" & echo !ERRORLEVEL! > "{4}.tmp" & move /y "{4}.tmp" "{4}" > nul"'
+$result  = Invoke-CimMethod -ClassName Win32_Process -MethodName Create -Arguments @{{ CommandLine = $command; CurrentDirectory = $folder }}
+if ($result.ReturnValue -ne 0) {{
+    Write-Error ("Win32_Process.Create failed with " + $result.ReturnValue)
+    exit 1
+}}
+Set-Content -Path (Join-Path $folder "{5}") -Value $result.ProcessId
+Write-Output $result.ProcessId
+""".format(tmp_folder, self.DETACHED_LAUNCHER, self.DETACHED_STDOUT, self.DETACHED_STDERR, self.DETACHED_EXIT_CODE,
+           self.DETACHED_PID)
+        result = self._run_cancelable(code)
+        if result.status_code != 0:
+            raise Exception(ErrorMsg.RUN_SCRIPT % result.std_err)
+        pid = result.std_out.decode('utf-8').strip()
+        self.logger.info('Launched detached (pid: %s).' % pid)
+        return pid
+
+    def poll_detached(self, tmp_folder, stdout_offset, stderr_offset, max_read_bytes):
+        """
+        Reads the exit code (if the script exited) and the output written since the given offsets, in one round trip.
+        The exit code is read before the output, so once it is set the output read is complete.
+        Runs in a shell of its own, in the calling thread (a thread of the DetachedPoller), not in the pool.
+        :type tmp_folder: str
+        :type stdout_offset: int
+        :type stderr_offset: int
+        :type max_read_bytes: int
+        :rtype DetachedPollResult
+        """
+        code = """
+$folder = "{0}"
+function Read-NewBytes($name, $offset) {{
+    $path = Join-Path $folder $name
+    if (-not (Test-Path $path)) {{ return "" }}
+    $stream = [System.IO.File]::Open($path, 'Open', 'Read', 'ReadWrite')
+    try {{
+        $count = [Math]::Min($stream.Length - $offset, {6})
+        if ($count -le 0) {{ return "" }}
+        $buffer = New-Object byte[] $count
+        $stream.Seek($offset, 'Begin') | Out-Null
+        $read = $stream.Read($buffer, 0, $count)
+        return [System.Convert]::ToBase64String($buffer, 0, $read)
+    }} finally {{
+        $stream.Close()
+    }}
+}}
+$exitCode = ""
+$exitFile = Join-Path $folder "{1}"
+if (Test-Path $exitFile) {{ $exitCode = (Get-Content $exitFile -Raw).Trim() }}
+Write-Output ($exitCode + "|" + (Read-NewBytes "{2}" {4}) + "|" + (Read-NewBytes "{3}" {5}))
+""".format(tmp_folder, self.DETACHED_EXIT_CODE, self.DETACHED_STDOUT, self.DETACHED_STDERR,
+           stdout_offset, stderr_offset, max_read_bytes)
+        result = self._run(self.session, code)
+        if result.status_code != 0:
+            raise Exception(result.std_err)
+        exit_code, std_out, std_err = result.std_out.decode('utf-8').strip().split('|')
+        return DetachedPollResult(int(exit_code) if exit_code else None,
+                                  base64.b64decode(std_out), base64.b64decode(std_err))
+
+    def kill_script(self, tmp_folder):
+        """
+        Kills the process tree of a detached script (recorded in the temp folder when it was launched).
+        Attached scripts run in the job object of their winrm shell, which is terminated when the shell is closed.
+        Not cancelable: it runs on cancellation (or when the deadline passed) too, in the calling thread.
+        :type tmp_folder: str
+        """
+        code = """
+$pidFile = Join-Path "{0}" "{1}"
+if (Test-Path $pidFile) {{
+    taskkill.exe /PID (Get-Content $pidFile -Raw).Trim() /T /F | Out-Null
+}}
+exit 0
+""".format(tmp_folder, self.DETACHED_PID)
+        result = self._run(self.session, code)
+        if result.status_code != 0:
+            raise Exception(result.std_err)
+
     def delete_temp_folder(self, tmp_folder):
         """
         :type tmp_folder: str
@@ -181,27 +665,60 @@ Remove-Item $path -recurse
     #     self.logger.debug('Stderr:' + result.std_err)
     #     return result
 
-    def _run_cancelable(self, ps_code):
+    def _run_cancelable(self, ps_code, deadline_minutes=None):
         """
+        Closing the shell (also on cancellation or when the deadline passes) terminates the job object of the shell,
+        with every process the command started.
         :type ps_code: str
+        :param deadline_minutes: Max run time of the command (None = no deadline).
+        :type deadline_minutes: float
         """
+        deadline = time.time() + deadline_minutes * 60 if deadline_minutes else None
         self.logger.debug('PowerShellScript:' + ps_code)
 
-        bat_code = 'powershell -encodedcommand %s' % base64.b64encode(ps_code.encode('utf_16_le')).decode('ascii')
         shell_id = self.session.protocol.open_shell()
-        command_id = self.session.protocol.run_command(shell_id, bat_code)
+        command_id = self.session.protocol.run_command(shell_id, self._to_bat_code(ps_code))
 
         async_result = self.pool.apply_async(self.session.protocol.get_command_output, kwds={'shell_id': shell_id, 'command_id': command_id})
         try:
             while not async_result.ready():
                 if self.cancel_sampler.is_cancelled():
                     self.cancel_sampler.throw()
+                if deadline and time.time() >= deadline:
+                    raise Exception(ErrorMsg.RUN_SCRIPT % (ErrorMsg.DEADLINE_EXCEEDED % deadline_minutes))
                 time.sleep(1)
             result = winrm.Response(async_result.get())
         finally:
             self.session.protocol.cleanup_command(shell_id, command_id)
             self.session.protocol.close_shell(shell_id)
 
+        return self._decode_result(result)
+
+    def _run(self, session, ps_code):
+        """
+        Runs the command in a shell of the given session and waits for it, in the calling thread.
+        :type session: winrm.Session
+        :type ps_code: str
+        """
+        shell_id = session.protocol.open_shell()
+        try:
+            command_id = session.protocol.run_command(shell_id, self._to_bat_code(ps_code))
+            try:
+                result = winrm.Response(session.protocol.get_command_output(shell_id, command_id))
+            finally:
+                session.protocol.cleanup_command(shell_id, command_id)
+        finally:
+            session.protocol.close_shell(shell_id)
+        return self._decode_result(result)
+
+    def _to_bat_code(self, ps_code):
+        return 'powershell -encodedcommand %s' % base64.b64encode(ps_code.encode('utf_16_le')).decode('ascii')
+
+    def _decode_result(self, result):
+        """
+        :type result: winrm.Response
+        :rtype winrm.Response
+        """
         self.logger.debug('ReturnedCode:' + str(result.status_code))
         self.logger.debug('Stdout:' + result.std_out.decode('utf-8'))
         self.logger.debug('Stderr:' + result.std_err.decode('utf-8'))
@@ -0,0 +1,56 @@
+import threading
+
+from cloudshell.cm.customscript.domain.script_executor import IScriptExecutor
+
+
+class WorkspaceManager(object):
+    """
+    The workspaces of the hosts of an execute_scripts batch, one per host (see IScriptExecutor.open_workspace): the
+    scripts of the batch run in subfolders of the workspace of their host, so a script costs no round trip to create
+    and none to delete its temp folder. The workspaces are deleted at once when the batch ends (close) - also when it
+    failed or was cancelled.
+    """
+
+    def __init__(self, logger):
+        """
+        :type logger: Logger
+        """
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._services = []
+
+    def open(self, service):
+        """
+        Opens the workspace of a connected executor. Safe to call from several threads (one per host).
+        :type service: IScriptExecutor
+        """
+        service.open_workspace()
+        with self._lock:
+            self._services.append(service)
+
+    def release(self, service):
+        """
+        Deletes the workspace of one executor (e.g. before it is closed, ahead of the others). Never raises.
+        :type service: IScriptExecutor
+        """
+        with self._lock:
+            if service not in self._services:
+                return
+            self._services.remove(service)
+        self._close_workspace(service)
+
+    def close(self):
+        """
+        Deletes every workspace that was opened, before the executors are closed. Never raises: the executors log
+        their own failures, a failure on one host does not keep the others from being cleaned up.
+        """
+        with self._lock:
+            services, self._services = self._services, []
+        for service in services:
+            self._close_workspace(service)
+
+    def _close_workspace(self, service):
+        try:
+            service.close_workspace()
+        except Exception as e:
+            self.logger.error('Failed to delete the workspace of %s: %s' % (service.target_host.ip, str(e)))
@@ -21,6 +21,7 @@ setup(
         test_requires=required_for_tests,
         package_data={'': ['*.txt']},
         install_requires=required,
+        extras_require={'fast-json': ['orjson']},
         version=version_from_file,
         include_package_data=True,
         keywords="custom-script cloudshell configuration configuration-manager",
@@ -1,3 +1,9 @@
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
 class Any(object):
     def __init__(self, predicate=None):
         self.predicate = predicate
@@ -69,4 +75,96 @@ def mocked_requests_get(*args, **kwargs):
                 response = MockResponse(repo_dict['content'], 200, {"Content-Type": "text/plain"}, repo_dict['private_cred'])
                 return response
 
-    return MockResponse(None, 404, None, None)
\ No newline at end of file
+    return MockResponse(None, 404, None, None)
+
+
+class LocalHttpServer(object):
+    '''
+    A local stand-in of a script repository, serving 'content' at any path with ETag / Last-Modified validators and
+    'Range' / 'If-Range' support. Each value of 'fail_after' makes a request drop its connection after that many
+    bytes of the body (one value per request, in order).
+    '''
+    def __init__(self, content, etag='"v1"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT', accept_ranges=True,
+                 fail_after=None, bytes_per_second=None):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.accept_ranges = accept_ranges
+        self.fail_after = list(fail_after or [])
+        self.bytes_per_second = bytes_per_second
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests.append(dict(self.headers))
+                    fail_after = server.fail_after.pop(0) if server.fail_after else None
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    self._serve(fail_after)
+                except (ConnectionResetError, BrokenPipeError):
+                    # the client closed the response before reading all of it
+                    pass
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def _serve(self, fail_after):
+                content = server.content
+                start, end = 0, len(content) - 1
+                status = 200
+                range_header = self.headers.get('Range')
+                if_range = self.headers.get('If-Range')
+                if server.accept_ranges and range_header and (if_range is None or
+                                                              if_range in (server.etag, server.last_modified)):
+                    first, _, last = range_header[len('bytes='):].partition('-')
+                    start = int(first)
+                    end = min(int(last), len(content) - 1) if last else len(content) - 1
+                    status = 206
+                body = content[start:end + 1]
+
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                if server.etag:
+                    self.send_header('ETag', server.etag)
+                if server.last_modified:
+                    self.send_header('Last-Modified', server.last_modified)
+                if server.accept_ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                if status == 206:
+                    self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(content)))
+                self.end_headers()
+
+                if fail_after is not None:
+                    body = body[:fail_after]
+                step = 64 * 1024
+                for i in range(0, len(body), step):
+                    self.wfile.write(body[i:i + step])
+                    if server.bytes_per_second:
+                        time.sleep(float(step) / server.bytes_per_second)
+                if fail_after is not None:
+                    self.wfile.flush()
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s/scripts/a.sh' % self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
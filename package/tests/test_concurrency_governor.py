@@ -0,0 +1,130 @@
+import threading
+import time
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.concurrency_governor import ConcurrencyGovernor
+
+
+class TestConcurrencyGovernor(TestCase):
+
+    def setUp(self):
+        self.cancel_sampler = Mock()
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.threads = []
+        self.granted = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def _acquire_in_thread(self, governor, name, reservation_id, host=None, repository=None, hold=None):
+        """
+        Starts a thread that acquires a slot, records its name once granted, then releases it (after 'hold' is set).
+        Returns once the request is queued (or granted).
+        """
+        queued = governor.metrics()['queued'] + governor.metrics()['slots_granted']
+
+        def run():
+            with governor.acquire(reservation_id, self.cancel_sampler, host=host, repository=repository):
+                self.granted.append(name)
+                if hold:
+                    hold.wait(5)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        self._wait_for(lambda: governor.metrics()['queued'] + governor.metrics()['slots_granted'] > queued)
+
+    def _wait_for(self, predicate):
+        end_time = time.time() + 5
+        while not predicate():
+            self.assertLess(time.time(), end_time)
+            time.sleep(0.01)
+
+    def test_unlimited_by_default(self):
+        governor = ConcurrencyGovernor()
+        slots = [governor.acquire('r', self.cancel_sampler, host='h', repository='o') for _ in range(10)]
+        self.assertEqual(10, governor.metrics()['running'])
+        for slot in slots:
+            slot.release()
+        self.assertEqual(0, governor.metrics()['running'])
+
+    def test_release_is_idempotent(self):
+        governor = ConcurrencyGovernor(max_total=1)
+        slot = governor.acquire('r', self.cancel_sampler)
+        slot.release()
+        slot.release()
+        self.assertEqual(0, governor.metrics()['running'])
+
+    def test_per_host_limit_blocks_only_the_same_host(self):
+        governor = ConcurrencyGovernor(max_per_host=1)
+        slot = governor.acquire('r', self.cancel_sampler, host='h1')
+        self._acquire_in_thread(governor, 'h1', 'r', host='h1')
+        self._acquire_in_thread(governor, 'h2', 'r', host='h2')
+        self._wait_for(lambda: self.granted == ['h2'])
+        slot.release()
+        self._wait_for(lambda: self.granted == ['h2', 'h1'])
+
+    def test_per_repository_limit(self):
+        governor = ConcurrencyGovernor(max_per_repository=1)
+        slot = governor.acquire('r', self.cancel_sampler, repository='http://repo')
+        self._acquire_in_thread(governor, 'same', 'r', repository='http://repo')
+        self._acquire_in_thread(governor, 'host only', 'r', host='h')
+        self._wait_for(lambda: self.granted == ['host only'])
+        slot.release()
+        self._wait_for(lambda: self.granted == ['host only', 'same'])
+
+    def test_reservations_are_served_in_turns(self):
+        governor = ConcurrencyGovernor(max_total=1)
+        slot = governor.acquire('big', self.cancel_sampler)
+        for name in ('big1', 'big2', 'big3'):
+            self._acquire_in_thread(governor, name, 'big')
+        self._acquire_in_thread(governor, 'small1', 'small')
+        self._acquire_in_thread(governor, 'small2', 'small')
+        slot.release()
+        self._wait_for(lambda: len(self.granted) == 5)
+        self.assertEqual(['big1', 'small1', 'big2', 'small2', 'big3'], self.granted)
+
+    def test_queue_wait_is_measured(self):
+        governor = ConcurrencyGovernor(max_total=1)
+        slot = governor.acquire('r', self.cancel_sampler)
+        self.assertLess(slot.wait_seconds, 1)
+        hold = threading.Event()
+        self._acquire_in_thread(governor, 'waiting', 'r', hold=hold)
+        time.sleep(0.2)
+        slot.release()
+        self._wait_for(lambda: self.granted == ['waiting'])
+        hold.set()
+        metrics = governor.metrics()
+        self.assertEqual(2, metrics['slots_granted'])
+        self.assertGreaterEqual(metrics['max_queue_wait_seconds'], 0.2)
+        self.assertGreaterEqual(metrics['total_queue_wait_seconds'], 0.2)
+
+    def test_cancel_while_queued(self):
+        governor = ConcurrencyGovernor(max_total=1)
+        governor.CANCEL_CHECK_INTERVAL_SECONDS = 0.01
+        slot = governor.acquire('r', self.cancel_sampler)
+        self.cancel_sampler.is_cancelled = Mock(return_value=True)
+        self.cancel_sampler.throw = Mock(side_effect=CancellationException('cancelled'))
+        with self.assertRaises(CancellationException):
+            governor.acquire('r', self.cancel_sampler)
+        self.assertEqual(0, governor.metrics()['queued'])
+        slot.release()
+        self.assertEqual(0, governor.metrics()['running'])
+
+    def test_limits_from_environment(self):
+        with patch.dict('os.environ', {ConcurrencyGovernor.ENV_MAX_TOTAL: '20', ConcurrencyGovernor.ENV_MAX_PER_HOST: '2'}):
+            with patch.object(ConcurrencyGovernor, '_default', None):
+                governor = ConcurrencyGovernor.get_default()
+                self.assertIs(governor, ConcurrencyGovernor.get_default())
+        self.assertEqual(20, governor.max_total)
+        self.assertEqual(2, governor.max_per_host)
+        self.assertIsNone(governor.max_per_repository)
+
+    def test_invalid_limit_in_environment(self):
+        with patch.dict('os.environ', {ConcurrencyGovernor.ENV_MAX_PER_HOST: '-1'}):
+            with self.assertRaises(ValueError):
+                ConcurrencyGovernor._get_env_limit(ConcurrencyGovernor.ENV_MAX_PER_HOST)
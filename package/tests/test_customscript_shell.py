@@ -1,12 +1,18 @@
+import json
+import threading
+import time
 from unittest import TestCase
 
 from cloudshell.cm.customscript.domain.script_executor import ExcutorConnectionError
-from mock import patch, Mock
+from mock import patch, Mock, MagicMock
 
 from cloudshell.cm.customscript.customscript_shell import CustomScriptShell
+from cloudshell.cm.customscript.domain.concurrency_governor import ConcurrencyGovernor
 from cloudshell.cm.customscript.domain.reservation_output_writer import ReservationOutputWriter
-from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.result_cache import ResultCache
+from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration, ResultCacheConfiguration, \
+    MemoryProfilingConfiguration
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
 from tests.helpers import Any
 
 
@@ -22,11 +28,12 @@ class TestCustomScriptShell(TestCase):
         self.api_session = Mock()
         self.script_conf = ScriptConfiguration()
         self.logger_patcher = patch('cloudshell.cm.customscript.customscript_shell.LoggingSessionContext')
-        self.logger_patcher.start()
+        self.logger_ctor = self.logger_patcher.start()
         self.error_patcher = patch('cloudshell.cm.customscript.customscript_shell.ErrorHandlingContext')
         self.error_patcher.start()
         self.api_patcher = patch('cloudshell.cm.customscript.customscript_shell.CloudShellSessionContext')
-        self.api_patcher.start().return_value.__enter__ = Mock(return_value=self.api_session)
+        self.api_ctor = self.api_patcher.start()
+        self.api_ctor.return_value.__enter__ = Mock(return_value=self.api_session)
         self.parser_patcher = patch('cloudshell.cm.customscript.customscript_shell.ScriptConfigurationParser.json_to_object')
         self.parser_patcher.start().return_value = self.script_conf
         self.downloader_patcher = patch('cloudshell.cm.customscript.customscript_shell.ScriptDownloader.download')
@@ -141,6 +148,654 @@ class TestCustomScriptShell(TestCase):
             CustomScriptShell().execute_script(self.context, '', self.cancel_context)
         self.assertEqual(inner_error, error.exception)
 
+    def test_bundle_entry_point_is_set(self):
+        self.script_conf.script_repo.entry_point = 'dir/run.sh'
+        bundle = ScriptBundle('b.zip', b'')
+        self.downloader.return_value = bundle
+
+        CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.assertEqual('dir/run.sh', bundle.name)
+        self.executor.execute.assert_called_with(bundle, Any(), Any(), Any())
+
+    def test_stream_transfer_opens_a_stream(self):
+        self.script_conf.script_repo.url = 'some url'
+        self.script_conf.stream_transfer = True
+        with patch('cloudshell.cm.customscript.customscript_shell.ScriptDownloader.open_stream') as open_stream:
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        open_stream.assert_called_with('some url', None, True)
+        self.downloader.assert_not_called()
+        open_stream.return_value.close.assert_called_once()
+
+    def test_download_and_execution_take_separate_slots(self):
+        self.script_conf.script_repo.url = 'https://User@Repo.local:8081/a/b.sh'
+        self.script_conf.host_conf.ip = '1.2.3.4'
+        self.context.reservation.reservation_id = 'res1'
+        governor = MagicMock()
+        governor.acquire.return_value.wait_seconds = 0
+
+        CustomScriptShell(governor).execute_script(self.context, '', self.cancel_context)
+
+        # the download runs next to the connection, with a sampler of its own (cancelled by a connection failure)
+        download_sampler = governor.acquire.call_args_list[0][0][1]
+        self.assertIs(self.cancel_sampler, download_sampler.parent)
+        self.assertEqual([(('res1', download_sampler), {'host': None, 'repository': 'https://repo.local:8081'}),
+                          (('res1', self.cancel_sampler), {'host': '1.2.3.4', 'repository': None})],
+                         [(c[0], c[1]) for c in governor.acquire.call_args_list])
+
+    def test_stream_transfer_takes_a_single_slot(self):
+        self.script_conf.script_repo.url = 'http://repo/b.sh'
+        self.script_conf.host_conf.ip = '1.2.3.4'
+        self.script_conf.stream_transfer = True
+        governor = MagicMock()
+        governor.acquire.return_value.wait_seconds = 0
+        with patch('cloudshell.cm.customscript.customscript_shell.ScriptDownloader.open_stream'):
+            CustomScriptShell(governor).execute_script(self.context, '', self.cancel_context)
+
+        governor.acquire.assert_called_once_with(Any(), self.cancel_sampler, host='1.2.3.4', repository='http://repo')
+
+    def test_result_cache_skips_a_script_that_already_succeeded(self):
+        self.context.reservation.reservation_id = 'res1'
+        self.script_conf.result_cache = ResultCacheConfiguration()
+        self.downloader.side_effect = lambda *args: ScriptFile('a.sh', 'echo 1')
+        shell = CustomScriptShell(result_cache=ResultCache())
+
+        shell.execute_script(self.context, '', self.cancel_context)
+        shell.execute_script(self.context, '', self.cancel_context)
+
+        self.executor.execute.assert_called_once()
+
+    def test_result_cache_runs_again_when_the_parameters_change(self):
+        self.context.reservation.reservation_id = 'res1'
+        self.script_conf.result_cache = ResultCacheConfiguration()
+        self.downloader.side_effect = lambda *args: ScriptFile('a.sh', 'echo 1')
+        shell = CustomScriptShell(result_cache=ResultCache())
+
+        shell.execute_script(self.context, '', self.cancel_context)
+        self.script_conf.host_conf.parameters = {'a': '1'}
+        shell.execute_script(self.context, '', self.cancel_context)
+
+        self.assertEqual(2, self.executor.execute.call_count)
+
+    def test_result_cache_does_not_remember_a_failed_run(self):
+        self.context.reservation.reservation_id = 'res1'
+        self.script_conf.result_cache = ResultCacheConfiguration()
+        self.downloader.side_effect = lambda *args: ScriptFile('a.sh', 'echo 1')
+        self.executor.execute.side_effect = [Exception('failed'), None]
+        shell = CustomScriptShell(result_cache=ResultCache())
+
+        with self.assertRaises(Exception):
+            shell.execute_script(self.context, '', self.cancel_context)
+        shell.execute_script(self.context, '', self.cancel_context)
+
+        self.assertEqual(2, self.executor.execute.call_count)
+
+    def test_result_cache_skips_when_the_marker_is_on_the_host(self):
+        self.context.reservation.reservation_id = 'res1'
+        self.script_conf.result_cache = ResultCacheConfiguration(marker_on_host=True)
+        self.downloader.return_value = ScriptFile('a.sh', 'echo 1')
+        self.executor.has_result_marker.return_value = True
+
+        CustomScriptShell(result_cache=ResultCache()).execute_script(self.context, '', self.cancel_context)
+
+        self.executor.execute.assert_not_called()
+        self.executor.write_result_marker.assert_not_called()
+
+    def test_result_cache_writes_the_marker_on_the_host(self):
+        self.context.reservation.reservation_id = 'res1'
+        self.script_conf.result_cache = ResultCacheConfiguration(marker_on_host=True)
+        self.downloader.return_value = ScriptFile('a.sh', 'echo 1')
+        self.executor.has_result_marker.return_value = False
+
+        CustomScriptShell(result_cache=ResultCache()).execute_script(self.context, '', self.cancel_context)
+
+        self.executor.execute.assert_called_once()
+        self.executor.write_result_marker.assert_called_once_with(self.executor.has_result_marker.call_args[0][0])
+
+    def test_memory_profiling_reports_the_phases(self):
+        self.script_conf.script_repo.url = 'http://repo/a.sh?token=secret'
+        self.script_conf.memory_profiling = MemoryProfilingConfiguration(top_sites=0)
+        logger = self.logger_ctor.return_value.__enter__.return_value
+
+        CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        report = [c[0][0] for c in logger.info.call_args_list if 'Memory profile' in str(c[0][0])][0]
+        self.assertIn('"/a.sh"', report)
+        self.assertNotIn('secret', report)
+        self.assertIn('download', report)
+        self.assertIn('connect', report)
+        self.assertIsNotNone(self.executor.profiler)
+
+    def test_execute_scripts_shares_api_session_and_logger(self):
+        CustomScriptShell().execute_scripts(self.context, '[{}, {}, {}]', self.cancel_context)
+
+        self.api_ctor.assert_called_once()
+        self.logger_ctor.assert_called_once()
+        self.assertEqual(3, self.executor.execute.call_count)
+
+    def _batch_confs(self, *ips):
+        confs = []
+        for ip in ips:
+            conf = ScriptConfiguration()
+            conf.host_conf.ip = ip
+            conf.host_conf.connection_method = 'ssh'
+            confs.append(conf)
+        self.parser_patcher.stop()
+        self.parser_patcher = patch('cloudshell.cm.customscript.customscript_shell.ScriptConfigurationParser.json_to_object')
+        self.parser_patcher.start().side_effect = confs
+        return '[' + ', '.join(['{}'] * len(ips)) + ']'
+
+    def test_execute_scripts_connects_once_per_host_and_reuses_the_connection(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        for executor in executors.values():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+
+        CustomScriptShell().execute_scripts(self.context, self._batch_confs('1.1.1.1', '2.2.2.2', '1.1.1.1'), self.cancel_context)
+
+        self.assertEqual(2, self.selector_get.call_count)
+        executors['1.1.1.1'].connect.assert_called_once()
+        executors['2.2.2.2'].connect.assert_called_once()
+        self.assertEqual(2, executors['1.1.1.1'].execute.call_count)
+        self.assertEqual(1, executors['2.2.2.2'].execute.call_count)
+        executors['1.1.1.1'].close.assert_called_once()
+        executors['2.2.2.2'].close.assert_called_once()
+
+    def test_execute_scripts_reports_all_unreachable_hosts_before_running(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock(), '3.3.3.3': Mock()}
+        executors['1.1.1.1'].connect.side_effect = ExcutorConnectionError(0, Exception('auth failed'))
+        executors['3.3.3.3'].connect.side_effect = ExcutorConnectionError(0, Exception('no route'))
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+
+        with self.assertRaises(Exception) as error:
+            CustomScriptShell(preflight_abort=True).execute_scripts(
+                self.context, self._batch_confs('1.1.1.1', '2.2.2.2', '3.3.3.3'), self.cancel_context)
+
+        self.assertIn('2 of 3 host(s)', str(error.exception))
+        self.assertIn('1.1.1.1 (ssh): auth failed', str(error.exception))
+        self.assertIn('3.3.3.3 (ssh): no route', str(error.exception))
+        self.downloader.assert_not_called()
+        for executor in executors.values():
+            executor.execute.assert_not_called()
+            executor.close.assert_called_once()
+
+    def test_execute_scripts_fails_only_the_scripts_of_unreachable_hosts(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock(), '3.3.3.3': Mock()}
+        executors['2.2.2.2'].get_expected_file_extensions = Mock(return_value=[])
+        executors['1.1.1.1'].connect.side_effect = ExcutorConnectionError(0, Exception('auth failed'))
+        executors['3.3.3.3'].connect.side_effect = ExcutorConnectionError(0, Exception('no route'))
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+
+        with patch('cloudshell.cm.customscript.customscript_shell.ReservationOutputWriter') as output_writer:
+            with self.assertRaises(Exception) as error:
+                CustomScriptShell().execute_scripts(
+                    self.context, self._batch_confs('2.2.2.2', '1.1.1.1', '3.3.3.3'), self.cancel_context)
+
+        # all the unreachable hosts are reported before any script runs
+        warning = output_writer.return_value.write_warning.call_args_list[0][0][0]
+        self.assertIn('2 of 3 host(s)', warning)
+        self.assertIn('3.3.3.3 (ssh): no route', warning)
+        self.assertIn('1.1.1.1 (ssh): auth failed', str(error.exception))
+        executors['2.2.2.2'].execute.assert_called_once()
+        executors['1.1.1.1'].connect.assert_called_once()
+        document = self._logged_result()
+        self.assertEqual(['succeeded', 'failed', 'pending'], [script['status'] for script in document['scripts']])
+
+    def test_preflight_abort_from_the_environment(self):
+        self.assertFalse(CustomScriptShell().preflight_abort)
+        with patch.dict('os.environ', {CustomScriptShell.ENV_PREFLIGHT_ABORT: 'True'}):
+            self.assertTrue(CustomScriptShell().preflight_abort)
+        with patch.dict('os.environ', {CustomScriptShell.ENV_PREFLIGHT_ABORT: 'yes'}):
+            with self.assertRaises(ValueError):
+                CustomScriptShell()
+
+    def test_execute_scripts_closes_a_host_after_its_last_script(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        for executor in executors.values():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+        closed_before = []
+        executors['2.2.2.2'].execute.side_effect = lambda *args: closed_before.append(
+            (executors['1.1.1.1'].close_workspace.called, executors['1.1.1.1'].close.called))
+
+        CustomScriptShell().execute_scripts(self.context, self._batch_confs('1.1.1.1', '2.2.2.2'), self.cancel_context)
+
+        self.assertEqual([(True, True)], closed_before)
+        for executor in executors.values():
+            executor.close_workspace.assert_called_once()
+            executor.close.assert_called_once()
+
+    def test_execute_scripts_reconnects_a_dropped_connection(self):
+        self.executor.is_connected = Mock(return_value=False)
+
+        CustomScriptShell().execute_scripts(self.context, self._batch_confs('1.1.1.1'), self.cancel_context)
+
+        self.assertEqual(2, self.executor.connect.call_count)
+        self.executor.execute.assert_called_once()
+
+    def test_execute_scripts_opens_one_workspace_per_host_and_deletes_it_at_the_end(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        for executor in executors.values():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+
+        CustomScriptShell().execute_scripts(self.context, self._batch_confs('1.1.1.1', '2.2.2.2', '1.1.1.1'), self.cancel_context)
+
+        for executor in executors.values():
+            executor.open_workspace.assert_called_once()
+            executor.close_workspace.assert_called_once()
+            self.assertEqual(['connect', 'open_workspace'], [c[0] for c in executor.method_calls
+                                                             if c[0] in ('connect', 'open_workspace')])
+            self.assertEqual(['close_workspace', 'close'], [c[0] for c in executor.method_calls][-2:])
+
+    def test_execute_scripts_deletes_the_workspaces_when_a_script_fails(self):
+        self.executor.execute.side_effect = Exception('script failed')
+
+        with self.assertRaises(Exception):
+            CustomScriptShell().execute_scripts(self.context, self._batch_confs('1.1.1.1', '1.1.1.1'), self.cancel_context)
+
+        self.executor.close_workspace.assert_called_once()
+        self.executor.close.assert_called_once()
+
+    def test_execute_scripts_preflight_failure_deletes_the_opened_workspaces(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        executors['1.1.1.1'].connect.side_effect = ExcutorConnectionError(0, Exception('auth failed'))
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+
+        with self.assertRaises(Exception):
+            CustomScriptShell(preflight_abort=True).execute_scripts(
+                self.context, self._batch_confs('1.1.1.1', '2.2.2.2'), self.cancel_context)
+
+        executors['1.1.1.1'].open_workspace.assert_not_called()
+        executors['2.2.2.2'].close_workspace.assert_called_once()
+        executors['2.2.2.2'].close.assert_called_once()
+
+    def test_execute_scripts_closes_the_executor_when_its_workspace_cannot_be_opened(self):
+        self.executor.open_workspace.side_effect = Exception('disk full')
+
+        with self.assertRaises(Exception) as error:
+            CustomScriptShell().execute_scripts(self.context, self._batch_confs('1.1.1.1'), self.cancel_context)
+
+        self.assertIn('1.1.1.1 (ssh): disk full', str(error.exception))
+        self.executor.execute.assert_not_called()
+        self.executor.close_workspace.assert_not_called()
+        self.executor.close.assert_called_once()
+
+    def _dag_confs(self, *specs):
+        """
+        :param specs: (ip, id, depends_on) per configuration
+        """
+        confs = []
+        for ip, conf_id, depends_on in specs:
+            conf = ScriptConfiguration()
+            conf.host_conf.ip = ip
+            conf.host_conf.connection_method = 'ssh'
+            conf.script_repo.url = 'http://repo/%s.sh' % conf_id
+            conf.id = conf_id
+            conf.depends_on = depends_on
+            confs.append(conf)
+        self.parser_patcher.stop()
+        self.parser_patcher = patch('cloudshell.cm.customscript.customscript_shell.ScriptConfigurationParser.json_to_object')
+        self.parser_patcher.start().side_effect = confs
+        return '[' + ', '.join(['{}'] * len(specs)) + ']'
+
+    def test_execute_scripts_runs_a_dependency_graph(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock(), '3.3.3.3': Mock()}
+        order = []
+        for ip, executor in executors.items():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+            executor.execute.side_effect = lambda script_file, *args, ip=ip: order.append(ip)
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.downloader.return_value = ScriptFile('a.sh', '')
+
+        CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+            ('2.2.2.2', 'app1', ['db']), ('3.3.3.3', 'app2', ['db']), ('1.1.1.1', 'db', [])), self.cancel_context)
+
+        self.assertEqual('1.1.1.1', order[0])
+        self.assertEqual({'2.2.2.2', '3.3.3.3'}, set(order[1:]))
+        summary = [c[0][1] for c in self.api_session.WriteMessageToReservationOutput.call_args_list
+                   if 'Critical path' in c[0][1]]
+        self.assertIn('db (', summary[0])
+        for executor in executors.values():
+            executor.close.assert_called_once()
+
+    def test_execute_scripts_skips_the_dependents_of_a_failure(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        for executor in executors.values():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+        executors['1.1.1.1'].execute.side_effect = Exception('db failed')
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.downloader.return_value = ScriptFile('a.sh', '')
+
+        with self.assertRaises(Exception) as error:
+            CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+                ('1.1.1.1', 'db', []), ('2.2.2.2', 'app', ['db']), ('2.2.2.2', 'other', [])), self.cancel_context)
+
+        self.assertIn('1 of 3 configuration(s) failed, 1 skipped', str(error.exception))
+        self.assertIn('db: db failed', str(error.exception))
+        self.assertEqual(1, executors['2.2.2.2'].execute.call_count)  # 'other' only
+
+    def test_execute_scripts_result_document_marks_skipped_dependents(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        for executor in executors.values():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+        executors['1.1.1.1'].execute.side_effect = Exception('db failed')
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.downloader.return_value = ScriptFile('a.sh', '')
+
+        with self.assertRaises(Exception):
+            CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+                ('1.1.1.1', 'db', []), ('2.2.2.2', 'app', ['db']), ('2.2.2.2', 'other', [])), self.cancel_context)
+
+        document = self._logged_result()
+        self.assertEqual('failed', document['status'])
+        self.assertEqual([('db', 'failed'), ('app', 'skipped'), ('other', 'succeeded')],
+                         [(script['id'], script['status']) for script in document['scripts']])
+        self.assertEqual('db failed', document['scripts'][0]['error'])
+
+    def test_execute_scripts_graph_fails_only_the_nodes_of_unreachable_hosts(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        executors['2.2.2.2'].get_expected_file_extensions = Mock(return_value=[])
+        executors['1.1.1.1'].connect.side_effect = ExcutorConnectionError(0, Exception('auth failed'))
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.downloader.return_value = ScriptFile('a.sh', '')
+
+        with self.assertRaises(Exception):
+            CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+                ('1.1.1.1', 'db', []), ('2.2.2.2', 'app', ['db']), ('2.2.2.2', 'other', [])), self.cancel_context)
+
+        document = self._logged_result()
+        self.assertEqual([('db', 'failed'), ('app', 'skipped'), ('other', 'succeeded')],
+                         [(script['id'], script['status']) for script in document['scripts']])
+        self.assertIn('1.1.1.1 (ssh): auth failed', document['scripts'][0]['error'])
+        executors['1.1.1.1'].connect.assert_called_once()
+        executors['2.2.2.2'].execute.assert_called_once()
+
+    def test_execute_scripts_validates_the_graph_before_connecting(self):
+        with self.assertRaises(SyntaxError):
+            CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+                ('1.1.1.1', 'a', ['b']), ('1.1.1.1', 'b', ['a'])), self.cancel_context)
+        self.executor.connect.assert_not_called()
+
+    def _same_host_executors(self, multiplexed):
+        executors = []
+
+        def get(host_conf, logger, cancel_sampler):
+            executor = Mock()
+            executor.get_expected_file_extensions = Mock(return_value=[])
+            executor.is_multiplexed = Mock(return_value=multiplexed)
+            executors.append(executor)
+            return executor
+        self.selector_get.side_effect = get
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.downloader.return_value = ScriptFile('a.sh', '')
+        return executors
+
+    def test_execute_scripts_runs_same_host_nodes_at_once_when_multiplexed(self):
+        executors = self._same_host_executors(True)
+        both_running = threading.Barrier(2, timeout=5)
+        # 'a' and 'b' finish only once both are running, 'c' runs after them
+        execute = Mock(side_effect=lambda *args: execute.call_count <= 2 and both_running.wait())
+
+        def get(host_conf, logger, cancel_sampler, get=self.selector_get.side_effect):
+            executor = get(host_conf, logger, cancel_sampler)
+            executor.execute = execute
+            return executor
+        self.selector_get.side_effect = get
+
+        CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+            ('1.1.1.1', 'a', []), ('1.1.1.1', 'b', []), ('1.1.1.1', 'c', ['a', 'b'])), self.cancel_context)
+
+        self.assertEqual(3, execute.call_count)
+        # the preflight executor, and one more for the second node running at the same time
+        self.assertEqual(2, len(executors))
+        for executor in executors:
+            executor.close.assert_called_once()
+        executors[1].open_workspace.assert_called_once()
+        executors[1].close_workspace.assert_called_once()
+
+    def test_execute_scripts_runs_same_host_nodes_one_at_a_time_when_not_multiplexed(self):
+        executors = self._same_host_executors(False)
+        running = []
+        overlaps = []
+
+        def execute(*args):
+            running.append(1)
+            overlaps.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+
+        def get(host_conf, logger, cancel_sampler, get=self.selector_get.side_effect):
+            executor = get(host_conf, logger, cancel_sampler)
+            executor.execute.side_effect = execute
+            return executor
+        self.selector_get.side_effect = get
+        self.sleep_patcher.stop()
+        try:
+            CustomScriptShell().execute_scripts(self.context, self._dag_confs(
+                ('1.1.1.1', 'a', []), ('1.1.1.1', 'b', []), ('1.1.1.1', 'c', ['a'])), self.cancel_context)
+        finally:
+            self.sleep_patcher.start()
+
+        self.assertEqual([1, 1, 1], overlaps)
+        self.assertEqual(1, len(executors))
+
+    def test_dag_max_workers_is_bounded_by_the_governor(self):
+        self._same_host_executors(True)
+        with patch('cloudshell.cm.customscript.customscript_shell.ScriptDag.run') as run:
+            CustomScriptShell(ConcurrencyGovernor(max_total=3), dag_max_workers=8).execute_scripts(
+                self.context, self._dag_confs(('1.1.1.1', 'a', []), ('1.1.1.1', 'b', ['a'])), self.cancel_context)
+        self.assertEqual(3, run.call_args[0][1])
+
+    def test_dag_max_workers_from_the_environment(self):
+        with patch.dict('os.environ', {CustomScriptShell.ENV_DAG_MAX_WORKERS: '4'}):
+            self.assertEqual(4, CustomScriptShell().dag_max_workers)
+        with patch.dict('os.environ', {CustomScriptShell.ENV_DAG_MAX_WORKERS: '0'}):
+            with self.assertRaises(ValueError):
+                CustomScriptShell()
+
+    def test_execute_scripts_prefetches_the_next_scripts(self):
+        second_downloaded = threading.Event()
+        files = [MagicMock(), MagicMock(), MagicMock()]
+        for f in files:
+            f.name = 'a.sh'
+
+        def download(*args):
+            index = self.downloader.call_count - 1
+            if index == 1:
+                second_downloaded.set()
+            return files[index]
+        self.downloader.side_effect = download
+        # the first script runs only once the next one was downloaded
+        self.executor.execute.side_effect = lambda *args: self.assertTrue(second_downloaded.wait(5))
+
+        CustomScriptShell(prefetch_depth=1).execute_scripts(
+            self.context, self._batch_confs('1.1.1.1', '1.1.1.1', '1.1.1.1'), self.cancel_context)
+
+        self.assertEqual(3, self.executor.execute.call_count)
+        self.assertEqual(files, [c[0][0] for c in self.executor.execute.call_args_list])
+
+    def test_execute_scripts_closes_the_prefetched_scripts_that_do_not_run(self):
+        files = [MagicMock(), MagicMock(), MagicMock()]
+        for f in files:
+            f.name = 'a.sh'
+        self.downloader.side_effect = files
+        self.executor.execute.side_effect = Exception('failed')
+
+        with self.assertRaises(Exception):
+            CustomScriptShell(prefetch_depth=2).execute_scripts(
+                self.context, self._batch_confs('1.1.1.1', '1.1.1.1', '1.1.1.1'), self.cancel_context)
+
+        self.executor.execute.assert_called_once()
+        for f in files:
+            f.close.assert_called()
+
+    def test_prefetch_depth_of_the_environment(self):
+        with patch.dict('os.environ', {CustomScriptShell.ENV_PREFETCH_DEPTH: '3'}):
+            self.assertEqual(3, CustomScriptShell().prefetch_depth)
+        with patch.dict('os.environ', {CustomScriptShell.ENV_PREFETCH_DEPTH: '-1'}):
+            with self.assertRaises(ValueError):
+                CustomScriptShell()
+
+    def test_execute_script_downloads_while_connecting(self):
+        connecting = threading.Event()
+        self.executor.connect.side_effect = lambda: self.assertTrue(connecting.wait(5))
+        self.downloader.side_effect = lambda *args: connecting.set() or ScriptFile('a.sh', '')
+
+        CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.executor.execute.assert_called_once()
+        self.executor.close.assert_called_once()
+
+    def test_execute_script_download_failure_cancels_the_connection(self):
+        self.script_conf.timeout_minutes = 10
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        self.cancel_sampler.throw_if_canceled = Mock()
+        downloaded = threading.Event()
+        self.executor.connect.side_effect = ExcutorConnectionError(10060, Exception('timeout'))
+        self.sleep.side_effect = lambda seconds: downloaded.wait(5)
+
+        def download(*args):
+            downloaded.set()
+            raise Exception('not found')
+        self.downloader.side_effect = download
+
+        with self.assertRaises(Exception) as e:
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.assertEqual('not found', str(e.exception))
+        self.executor.execute.assert_not_called()
+        self.executor.close.assert_called_once()
+
+    def test_execute_script_connection_failure_closes_the_download(self):
+        script_file = MagicMock()
+        self.downloader.return_value = script_file
+        self.executor.connect.side_effect = ExcutorConnectionError(0, Exception('auth failed'))
+
+        with self.assertRaises(Exception) as e:
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.assertEqual('auth failed', str(e.exception))
+        script_file.close.assert_called()
+        self.executor.execute.assert_not_called()
+
+    def test_execute_script_closes_the_executor(self):
+        CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        self.executor.close.assert_called_once()
+
+    def test_execute_scripts_stops_when_cancelled(self):
+        def throw_after_first_execution():
+            if self.executor.execute.called:
+                raise Exception('cancelled')
+        self.cancel_sampler.throw_if_canceled.side_effect = throw_after_first_execution
+
+        with self.assertRaises(Exception):
+            CustomScriptShell().execute_scripts(self.context, '[{}, {}, {}]', self.cancel_context)
+
+        self.assertEqual(1, self.executor.execute.call_count)
+
+
+    # result document
+
+    def _logged_result(self):
+        logger = self.logger_ctor.return_value.__enter__.return_value
+        logged = [c[0][0] for c in logger.info.call_args_list if str(c[0][0]).startswith('Result: ')]
+        return json.loads(logged[-1][len('Result: '):])
+
+    def test_execute_script_returns_the_result_document(self):
+        self.script_conf.script_repo.url = 'http://repo/a.sh?token=secret'
+        self.script_conf.host_conf.ip = '1.2.3.4'
+        self.script_conf.host_conf.connection_method = 'ssh'
+        self.downloader.return_value = ScriptFile('a.sh', 'echo 1')
+        self.executor.execute.side_effect = lambda *args: self.executor.script_result.set_exit_code(0)
+
+        document = json.loads(CustomScriptShell().execute_script(self.context, '', self.cancel_context))
+
+        self.assertEqual('succeeded', document['status'])
+        self.assertEqual([], document['hosts'])
+        script = document['scripts'][0]
+        self.assertEqual(('1.2.3.4', 'ssh', '/a.sh', 'a.sh', 0, 'succeeded'), (
+            script['host'], script['connectionMethod'], script['url'], script['script'], script['exitCode'],
+            script['status']))
+        self.assertEqual({'downloaded': 6, 'uploaded': 0}, script['bytes'])
+        self.assertTrue({'queue', 'download', 'connect'} <= set(script['phases']))
+
+    def test_execute_script_result_document_counts_connect_retries(self):
+        self.script_conf.timeout_minutes = 1
+        self.executor.connect.side_effect = [ExcutorConnectionError(10060, Exception()),
+                                             ExcutorConnectionError(10060, Exception()), None]
+
+        document = json.loads(CustomScriptShell().execute_script(self.context, '', self.cancel_context))
+
+        self.assertEqual({'connect': 2}, document['scripts'][0]['retries'])
+
+    def test_execute_script_logs_the_partial_result_document_on_failure(self):
+        self.downloader.return_value = ScriptFile('a.sh', 'echo 1')
+        self.executor.execute.side_effect = Exception('x' * 5000)
+
+        with self.assertRaises(Exception):
+            CustomScriptShell().execute_script(self.context, '', self.cancel_context)
+
+        document = self._logged_result()
+        self.assertEqual('failed', document['status'])
+        script = document['scripts'][0]
+        self.assertEqual('failed', script['status'])
+        self.assertTrue(script['errorTruncated'])
+        self.assertIn('characters truncated', script['error'])
+        self.assertIn('download', script['phases'])
+
+    def test_execute_script_result_document_marks_a_cached_result(self):
+        self.context.reservation.reservation_id = 'res1'
+        self.script_conf.result_cache = ResultCacheConfiguration()
+        self.downloader.side_effect = lambda *args: ScriptFile('a.sh', 'echo 1')
+        shell = CustomScriptShell(result_cache=ResultCache())
+
+        shell.execute_script(self.context, '', self.cancel_context)
+        document = json.loads(shell.execute_script(self.context, '', self.cancel_context))
+
+        self.assertEqual('cached', document['scripts'][0]['status'])
+
+    def test_execute_scripts_returns_every_host_and_script(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        for executor in executors.values():
+            executor.get_expected_file_extensions = Mock(return_value=[])
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+        self.downloader.side_effect = lambda *args: ScriptFile('a.sh', 'echo 1')
+
+        document = json.loads(CustomScriptShell().execute_scripts(
+            self.context, self._batch_confs('1.1.1.1', '2.2.2.2', '1.1.1.1'), self.cancel_context))
+
+        self.assertEqual('succeeded', document['status'])
+        self.assertEqual([('1.1.1.1', 'succeeded'), ('2.2.2.2', 'succeeded')],
+                         [(host['host'], host['status']) for host in document['hosts']])
+        self.assertIn('connect', document['hosts'][0]['phases'])
+        self.assertEqual([(0, '1.1.1.1'), (1, '2.2.2.2'), (2, '1.1.1.1')],
+                         [(script['index'], script['host']) for script in document['scripts']])
+        for script in document['scripts']:
+            self.assertEqual('succeeded', script['status'])
+            self.assertNotIn('connect', script['phases'])  # connected by the preflight
+
+    def test_execute_scripts_result_document_of_a_failed_preflight(self):
+        executors = {'1.1.1.1': Mock(), '2.2.2.2': Mock()}
+        executors['1.1.1.1'].connect.side_effect = ExcutorConnectionError(0, Exception('auth failed'))
+        self.selector_get.side_effect = lambda host_conf, logger, cancel_sampler: executors[host_conf.ip]
+
+        with self.assertRaises(Exception):
+            CustomScriptShell(preflight_abort=True).execute_scripts(
+                self.context, self._batch_confs('1.1.1.1', '2.2.2.2'), self.cancel_context)
+
+        document = self._logged_result()
+        self.assertEqual([('failed', 'auth failed'), ('succeeded', None)],
+                         [(host['status'], host['error']) for host in document['hosts']])
+        self.assertEqual(['pending', 'pending'], [script['status'] for script in document['scripts']])
+
+
             # def test_flow(self):
     #     script_file = ScriptFile('name','text')
     #     env_vars = Mock()
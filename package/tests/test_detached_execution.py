@@ -0,0 +1,145 @@
+import time
+from unittest import TestCase
+from mock import Mock, call, ANY
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.detached_execution import DetachedExecution, DetachedPollResult
+from cloudshell.cm.customscript.domain.script_executor import ErrorMsg
+
+
+class SyncPoller(object):
+    """
+    Polls a run until it is over, in the thread that tracks it.
+    """
+    def __init__(self):
+        self.delays = []
+
+    def track(self, run):
+        while True:
+            delay = run.poll_once()
+            if delay is None:
+                return
+            self.delays.append(delay)
+
+
+class TestDetachedExecution(TestCase):
+
+    def setUp(self):
+        self.executor = Mock()
+        self.logger = Mock()
+        self.cancel_sampler = Mock()
+        self.output_writer = Mock()
+        self.poller = SyncPoller()
+        self.detached = DetachedExecution(self.executor, 'tmp', self.logger, self.cancel_sampler, 0.01,
+                                          poller=self.poller)
+
+    def test_reads_only_new_output_until_exit(self):
+        self.executor.poll_detached.side_effect = [DetachedPollResult(None, b'ab', b''),
+                                                   DetachedPollResult(None, b'', b'e'),
+                                                   DetachedPollResult(0, b'c', b'')]
+        self.detached.wait(self.output_writer)
+        self.assertEqual([call('tmp', 0, 0, ANY), call('tmp', 2, 0, ANY), call('tmp', 2, 1, ANY)],
+                         self.executor.poll_detached.call_args_list)
+        self.assertEqual('abec', ''.join(c[0][0] for c in self.output_writer.write.call_args_list))
+
+    def test_output_is_not_written_when_print_output_is_off(self):
+        self.executor.poll_detached.return_value = DetachedPollResult(0, b'a', b'b')
+        self.detached.wait(self.output_writer, print_output=False)
+        self.output_writer.write.assert_not_called()
+
+    def test_utf8_split_across_polls(self):
+        data = u'ü'.encode('utf-8')
+        self.executor.poll_detached.side_effect = [DetachedPollResult(None, data[:1], b''),
+                                                   DetachedPollResult(0, data[1:], b'')]
+        self.detached.wait(self.output_writer)
+        self.assertEqual(u'ü', ''.join(c[0][0] for c in self.output_writer.write.call_args_list))
+
+    def test_non_zero_exit_code_raises_with_stderr(self):
+        self.executor.poll_detached.return_value = DetachedPollResult(2, b'', b'some error')
+        with self.assertRaises(Exception) as e:
+            self.detached.wait(self.output_writer)
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'some error', str(e.exception))
+
+    def test_keeps_reading_a_full_read_after_exit(self):
+        DetachedExecution.MAX_READ_BYTES, max_read_bytes = 2, DetachedExecution.MAX_READ_BYTES
+        try:
+            self.executor.poll_detached.side_effect = [DetachedPollResult(0, b'ab', b''),
+                                                       DetachedPollResult(0, b'c', b'')]
+            self.detached.wait(self.output_writer)
+        finally:
+            DetachedExecution.MAX_READ_BYTES = max_read_bytes
+        self.assertEqual(2, self.executor.poll_detached.call_count)
+        self.assertEqual([0], self.poller.delays)
+
+    def test_failed_poll_reconnects_and_retries(self):
+        self.executor.poll_detached.side_effect = [Exception('connection reset'), DetachedPollResult(0, b'', b'')]
+        self.detached.wait(self.output_writer)
+        self.executor.connect.assert_called_once()
+        self.assertEqual(2, self.executor.poll_detached.call_count)
+        self.assertEqual([0.01], self.poller.delays)
+
+    def test_records_the_exit_code_and_the_poll_retries(self):
+        self.executor.poll_detached.side_effect = [Exception('connection reset'), DetachedPollResult(2, b'', b'')]
+        with self.assertRaises(Exception):
+            self.detached.wait(self.output_writer)
+        self.executor.script_result.add_retry.assert_called_once_with('poll')
+        self.executor.script_result.set_exit_code.assert_called_once_with(2)
+
+    def test_records_the_new_output_of_every_poll(self):
+        self.executor.poll_detached.side_effect = [DetachedPollResult(None, b'out1', b''),
+                                                   DetachedPollResult(0, b'out2', b'err')]
+        self.detached.wait(self.output_writer)
+        self.assertEqual([('out1', ''), ('out2', 'err')],
+                         [c[0] for c in self.executor.script_result.add_output.call_args_list])
+
+    def test_gives_up_after_max_consecutive_poll_failures(self):
+        self.executor.poll_detached.side_effect = Exception('connection reset')
+        self.executor.connect.side_effect = Exception('no route to host')
+        with self.assertRaises(Exception) as e:
+            self.detached.wait(self.output_writer)
+        self.assertIn('connection reset', str(e.exception))
+        self.assertEqual(DetachedExecution.MAX_CONSECUTIVE_POLL_FAILURES, self.executor.poll_detached.call_count)
+
+    def test_cancellation_stops_polling_and_kills_the_script(self):
+        self.detached.poller = Mock()
+        self.detached.CHECK_INTERVAL_SECONDS = 0.01
+        self.cancel_sampler.throw_if_canceled.side_effect = [None, CancellationException('cancelled', None)]
+        self.executor.poll_detached.return_value = DetachedPollResult(None, b'', b'')
+        with self.assertRaises(CancellationException):
+            self.detached.wait(self.output_writer)
+        self.detached.poller.track.assert_called_once_with(self.detached)
+        self.executor.kill_script.assert_called_once_with('tmp')
+        self.assertIsNone(self.detached.poll_once())
+        self.executor.poll_detached.assert_not_called()
+
+    def test_writes_the_output_in_the_calling_thread_while_running(self):
+        self.detached.poller = Mock()
+        self.detached.CHECK_INTERVAL_SECONDS = 0.01
+        self.executor.poll_detached.return_value = DetachedPollResult(None, b'out', b'')
+        self.cancel_sampler.throw_if_canceled.side_effect = [None, None, CancellationException('cancelled', None)]
+        self.detached.poller.track.side_effect = lambda run: self.assertEqual(0.01, run.poll_once())
+        with self.assertRaises(CancellationException):
+            self.detached.wait(self.output_writer)
+        self.output_writer.write.assert_any_call('out')
+
+    def test_kill_reconnects_when_the_connection_was_closed(self):
+        self.cancel_sampler.throw_if_canceled.side_effect = CancellationException('cancelled', None)
+        self.executor.kill_script.side_effect = [Exception('SSH session not active'), None]
+        with self.assertRaises(CancellationException):
+            self.detached.wait(self.output_writer)
+        self.executor.connect.assert_called_once()
+        self.assertEqual(2, self.executor.kill_script.call_count)
+
+    def test_deadline_kills_the_script(self):
+        detached = DetachedExecution(self.executor, 'tmp', self.logger, self.cancel_sampler, 0.01, deadline_minutes=2,
+                                     poller=self.poller)
+        detached.deadline = time.time() - 1
+        self.executor.poll_detached.return_value = DetachedPollResult(None, b'', b'')
+        with self.assertRaises(Exception) as e:
+            detached.wait(self.output_writer)
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % (ErrorMsg.DEADLINE_EXCEEDED % 2), str(e.exception))
+        self.executor.kill_script.assert_called_once_with('tmp')
+        self.executor.poll_detached.assert_not_called()
+
+    def test_no_deadline_by_default(self):
+        self.assertIsNone(self.detached.deadline)
@@ -0,0 +1,46 @@
+import threading
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.detached_poller import DetachedPoller
+
+
+class TestDetachedPoller(TestCase):
+
+    def _run(self, polls, threads):
+        run = Mock()
+        delays = [0] * (polls - 1) + [None]
+
+        def poll_once():
+            threads.add(threading.current_thread().name)
+            return delays.pop(0)
+        run.poll_once = Mock(side_effect=poll_once)
+        return run
+
+    def test_polls_every_run_until_it_is_over(self):
+        poller = DetachedPoller(threads=2)
+        threads = set()
+        runs = [self._run(3, threads) for _ in range(20)]
+        for run in runs:
+            poller.track(run)
+        for _ in range(500):
+            if all(run.poll_once.call_count == 3 for run in runs):
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual([3] * 20, [run.poll_once.call_count for run in runs])
+        self.assertEqual(2, poller.workers_count())
+        self.assertLessEqual(len(threads), 2)
+
+    def test_polls_a_run_again_after_its_delay(self):
+        poller = DetachedPoller(threads=1)
+        polled = threading.Event()
+        run = Mock()
+        run.poll_once.side_effect = lambda: polled.set() or 60
+        poller.track(run)
+        self.assertTrue(polled.wait(5))
+        threading.Event().wait(0.1)
+        run.poll_once.assert_called_once()
+
+    def test_get_default_is_shared(self):
+        self.assertIs(DetachedPoller.get_default(), DetachedPoller.get_default())
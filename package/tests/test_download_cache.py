@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from cloudshell.cm.customscript.domain.download_cache import DownloadCache, CachedDownload
+
+
+class TestDownloadCache(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = DownloadCache(self.folder, max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _blobs(self):
+        return sorted(name for name in os.listdir(os.path.join(self.folder, 'blobs')) if not name.startswith('.'))
+
+    def test_store_and_read(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT')
+
+        cached = self.cache.lookup('http://repo/a.sh')
+        self.assertEqual('a.sh', cached.file_name)
+        self.assertEqual({'If-None-Match': '"e1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'},
+                         cached.get_validator_headers())
+        data = self.cache.read(cached)
+        self.assertEqual(b'echo 1', data[:])
+        data.close()
+
+    def test_survives_a_new_instance(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+
+        cache = DownloadCache(self.folder, max_bytes=100)
+
+        self.assertEqual(b'echo 1', cache.read(cache.lookup('http://repo/a.sh'))[:])
+
+    def test_lookup_of_unknown_url(self):
+        self.assertIsNone(self.cache.lookup('http://repo/a.sh'))
+
+    def test_url_is_not_kept_on_disk(self):
+        self.cache.store('http://repo/a.sh?token=secret', 'a.sh', b'echo 1', etag='"e1"')
+
+        with open(os.path.join(self.folder, 'index.json')) as f:
+            self.assertNotIn('secret', f.read())
+
+    def test_same_content_is_stored_once(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        self.cache.store('http://repo/b.sh', 'b.sh', b'echo 1', etag='"e2"')
+
+        self.assertEqual(1, len(self._blobs()))
+
+    def test_replaced_content_drops_the_old_blob(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 2', etag='"e2"')
+
+        self.assertEqual(1, len(self._blobs()))
+        self.assertEqual(b'echo 2', self.cache.read(self.cache.lookup('http://repo/a.sh'))[:])
+
+    def test_evicts_the_least_recently_used(self):
+        with patch('cloudshell.cm.customscript.domain.download_cache.time.time', side_effect=range(1000, 2000)):
+            self.cache.store('http://repo/a.sh', 'a.sh', b'a' * 40, etag='"a"')
+            self.cache.store('http://repo/b.sh', 'b.sh', b'b' * 40, etag='"b"')
+            self.cache.read(self.cache.lookup('http://repo/a.sh')).close()
+            self.cache.store('http://repo/c.sh', 'c.sh', b'c' * 40, etag='"c"')
+
+        self.assertIsNotNone(self.cache.lookup('http://repo/a.sh'))
+        self.assertIsNone(self.cache.lookup('http://repo/b.sh'))
+        self.assertIsNotNone(self.cache.lookup('http://repo/c.sh'))
+        self.assertEqual(2, len(self._blobs()))
+
+    def test_content_over_the_cap_is_not_stored(self):
+        self.assertFalse(self.cache.store('http://repo/a.sh', 'a.sh', b'a' * 101, etag='"a"'))
+
+        self.assertIsNone(self.cache.lookup('http://repo/a.sh'))
+
+    def test_corrupted_blob_is_dropped(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        cached = self.cache.lookup('http://repo/a.sh')
+        with open(os.path.join(self.folder, 'blobs', cached.sha256), 'wb') as f:
+            f.write(b'echo 2')
+
+        self.assertIsNone(self.cache.read(cached))
+        self.assertIsNone(self.cache.lookup('http://repo/a.sh'))
+        self.assertEqual([], self._blobs())
+
+    def test_missing_blob_is_dropped(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        cached = self.cache.lookup('http://repo/a.sh')
+        os.remove(os.path.join(self.folder, 'blobs', cached.sha256))
+
+        self.assertIsNone(self.cache.read(cached))
+        self.assertIsNone(self.cache.lookup('http://repo/a.sh'))
+
+    def test_corrupted_index_starts_over(self):
+        with open(os.path.join(self.folder, 'index.json'), 'wb') as f:
+            f.write(b'{"truncated')
+
+        self.assertIsNone(self.cache.lookup('http://repo/a.sh'))
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        self.assertIsNotNone(self.cache.lookup('http://repo/a.sh'))
+
+    def test_empty_content(self):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'', etag='"e1"')
+
+        self.assertEqual(b'', self.cache.read(self.cache.lookup('http://repo/a.sh')))
+
+    def test_orphan_blobs_are_removed(self):
+        orphan = os.path.join(self.folder, 'blobs', 'f' * 64)
+        with open(orphan, 'wb') as f:
+            f.write(b'x')
+        os.utime(orphan, (0, 0))
+
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_concurrent_stores_keep_a_consistent_index(self):
+        cache = DownloadCache(self.folder, max_bytes=10000)
+        caches = [cache, DownloadCache(self.folder, max_bytes=10000)]
+
+        def store(i):
+            caches[i % 2].store('http://repo/%s.sh' % i, '%s.sh' % i, b'echo %d' % i, etag='"%s"' % i)
+        threads = [threading.Thread(target=store, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(20):
+            self.assertEqual(b'echo %d' % i, cache.read(cache.lookup('http://repo/%s.sh' % i))[:])
+        self.assertEqual([], [name for name in os.listdir(self.folder) if name.startswith('.tmp-')])
+
+    def test_default_cache_is_configured_by_the_environment(self):
+        with patch.dict(os.environ, {DownloadCache.ENV_FOLDER: self.folder, DownloadCache.ENV_MAX_MB: '2'}):
+            cache = DownloadCache.get_default()
+        self.assertEqual(self.folder, cache.folder)
+        self.assertEqual(2 * 1024 * 1024, cache.max_bytes)
+
+        with patch.dict(os.environ, {DownloadCache.ENV_FOLDER: ''}):
+            self.assertIsNone(DownloadCache.get_default())
+
+    def test_validator_headers(self):
+        self.assertEqual({'If-None-Match': '"e1"'}, CachedDownload('k', 'a.sh', 's', 1, etag='"e1"').get_validator_headers())
+        self.assertEqual({}, CachedDownload('k', 'a.sh', 's', 1).get_validator_headers())
+
+    def _partial_files(self):
+        return sorted(os.listdir(os.path.join(self.folder, 'partial')))
+
+    def test_partial_content_is_loaded_as_an_offset_and_streamed(self):
+        partial = self.cache.open_partial('http://repo/a.sh')
+        self.assertEqual(0, partial.load('"e1"'))
+        partial.append(b'echo 1')
+        partial.close()
+
+        partial = self.cache.open_partial('http://repo/a.sh')
+        self.assertEqual(6, partial.load('"e1"'))
+        self.assertEqual([b'ech', b'o 1'], list(partial.iter_content(3)))
+        partial.close()
+
+    def test_lock_file_of_a_held_partial_content_is_kept(self):
+        url_key = DownloadCache.get_url_key('http://repo/a.sh')
+        held = self.cache.open_partial('http://repo/a.sh')
+        other = self.cache.open_partial('http://repo/b.sh')
+        other.load('"e1"')
+
+        other.discard()
+
+        self.assertEqual([url_key + '.lock'], self._partial_files())
+        self.assertIsNone(self.cache.open_partial('http://repo/a.sh'))
+        held.close()
+
+    def test_lock_files_left_without_a_content_are_removed(self):
+        self.cache.open_partial('http://repo/a.sh').close()
+        self.assertEqual(1, len(self._partial_files()))
+
+        self.cache.open_partial('http://repo/b.sh').close()
+
+        self.assertEqual([DownloadCache.get_url_key('http://repo/b.sh') + '.lock'], self._partial_files())
@@ -0,0 +1,116 @@
+import json
+from unittest import TestCase
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.execution_result import ExecutionResult, ScriptResult, MAX_ERROR_LENGTH, \
+    MAX_OUTPUT_LENGTH, record_phase
+from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
+
+
+class TestExecutionResult(TestCase):
+
+    def setUp(self):
+        self.script_conf = ScriptConfiguration()
+        self.script_conf.id = 'app'
+        self.script_conf.host_conf.ip = '1.2.3.4'
+        self.script_conf.host_conf.connection_method = 'ssh'
+        self.script_conf.script_repo.url = 'https://repo/scripts/setup.sh?token=secret'
+        self.document = ExecutionResult()
+
+    def test_script_is_recorded_as_its_phases_complete(self):
+        script_result = self.document.add_script(self.script_conf)
+        script_result.start()
+        with script_result.phase('download'):
+            pass
+        script_result.add_phase('run', 1.5)
+        script_result.add_phase('run', 0.5)
+        script_result.add_retry('connect')
+        script_result.add_bytes('downloaded', 10)
+        script_result.set_script('setup.sh')
+        running = self.document.to_dict()['scripts'][0]
+        self.assertEqual('running', running['status'])
+        self.assertEqual(['download', 'run'], list(running['phases']))
+        self.assertEqual(2.0, running['phases']['run'])
+
+        script_result.set_exit_code(0)
+        script_result.finish()
+        script = self.document.to_dict()['scripts'][0]
+        self.assertEqual((0, 'app', '1.2.3.4', 'ssh', '/scripts/setup.sh', 'setup.sh', 0, 'succeeded'), (
+            script['index'], script['id'], script['host'], script['connectionMethod'], script['url'],
+            script['script'], script['exitCode'], script['status']))
+        self.assertEqual({'connect': 1}, script['retries'])
+        self.assertEqual({'downloaded': 10, 'uploaded': 0}, script['bytes'])
+
+    def test_finish_with_an_error(self):
+        failed = self.document.add_script(self.script_conf)
+        failed.finish(Exception('boom'))
+        cancelled = self.document.add_script(self.script_conf)
+        cancelled.finish(CancellationException('cancelled', None))
+        self.assertEqual(('failed', 'boom', False), (failed.status, failed.error, failed.error_truncated))
+        self.assertEqual('cancelled', cancelled.status)
+
+    def test_cached_status_is_kept(self):
+        script_result = self.document.add_script(self.script_conf)
+        script_result.start()
+        script_result.set_status(ScriptResult.CACHED)
+        script_result.finish()
+        self.assertEqual('cached', script_result.status)
+
+    def test_long_error_keeps_its_head_and_tail(self):
+        script_result = self.document.add_script(self.script_conf)
+        script_result.finish(Exception('head' + 'x' * MAX_ERROR_LENGTH + 'tail'))
+        self.assertTrue(script_result.error_truncated)
+        self.assertTrue(script_result.error.startswith('headx'))
+        self.assertTrue(script_result.error.endswith('xtail'))
+        self.assertIn('...[8 characters truncated]...', script_result.error)
+
+    def test_output_is_recorded(self):
+        script_result = self.document.add_script(self.script_conf)
+        script_result.add_output('hello ', b'')
+        script_result.add_output(b'world', 'warning')
+        script = self.document.to_dict()['scripts'][0]
+        self.assertEqual(('hello world', 'warning', False),
+                         (script['stdout'], script['stderr'], script['outputTruncated']))
+
+    def test_oversized_output_keeps_its_head_and_tail(self):
+        script_result = self.document.add_script(self.script_conf)
+        # appended in chunks, as the polls of a detached script do
+        output = 'head' + 'x' * (MAX_OUTPUT_LENGTH * 3) + 'tail'
+        for index in range(0, len(output), 1000):
+            script_result.add_output(output[index:index + 1000], '')
+        script = self.document.to_dict()['scripts'][0]
+        self.assertTrue(script['outputTruncated'])
+        self.assertTrue(script['stdout'].startswith('headx'))
+        self.assertTrue(script['stdout'].endswith('xtail'))
+        self.assertIn('...[%s characters truncated]...' % (len(output) - MAX_OUTPUT_LENGTH), script['stdout'])
+        self.assertLess(len(script['stdout']), MAX_OUTPUT_LENGTH + 100)
+        self.assertEqual('', script['stderr'])
+
+    def test_output_of_the_max_length_is_not_truncated(self):
+        script_result = self.document.add_script(self.script_conf)
+        script_result.add_output('', 'e' * MAX_OUTPUT_LENGTH)
+        script = self.document.to_dict()['scripts'][0]
+        self.assertFalse(script['outputTruncated'])
+        self.assertEqual('e' * MAX_OUTPUT_LENGTH, script['stderr'])
+
+    def test_to_json(self):
+        self.document.add_host(self.script_conf.host_conf).finish()
+        self.document.add_script(self.script_conf)
+        self.document.finish(Exception('1 of 1 host(s) could not be connected to'))
+        text = self.document.to_json()
+        self.assertNotIn('": ', text)  # compact
+        document = json.loads(text)
+        self.assertEqual('failed', document['status'])
+        self.assertEqual('1.2.3.4', document['hosts'][0]['host'])
+        self.assertEqual('succeeded', document['hosts'][0]['status'])
+        self.assertEqual('pending', document['scripts'][0]['status'])
+        self.assertEqual(0.0, document['scripts'][0]['seconds'])
+
+    def test_record_phase_without_a_result(self):
+        with record_phase(None, 'download'):
+            pass
+        script_result = self.document.add_script(self.script_conf)
+        with self.assertRaises(ValueError):
+            with record_phase(script_result, 'download'):
+                raise ValueError()
+        self.assertIn('download', script_result.phases)
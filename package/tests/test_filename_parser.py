@@ -0,0 +1,73 @@
+import random
+import time
+from unittest import TestCase
+
+from cloudshell.cm.customscript.domain.filename_parser import get_script_name, get_url_filename, \
+    parse_content_disposition
+
+
+class TestFilenameParser(TestCase):
+
+    def test_script_name(self):
+        self.assertEqual('a.sh', get_script_name('a.sh'))
+        self.assertEqual('Setup.PS1', get_script_name(' Setup.PS1 '))
+        self.assertEqual('b.tar.gz', get_script_name('folder/sub\\b.tar.gz'))
+        self.assertIsNone(get_script_name('.sh'))
+        self.assertIsNone(get_script_name('a.txt'))
+        self.assertIsNone(get_script_name(None))
+
+    def test_content_disposition(self):
+        self.assertEqual('a.sh', parse_content_disposition('attachment; filename=a.sh'))
+        self.assertEqual('a.sh', parse_content_disposition('INLINE;FILENAME="a.sh"'))
+        self.assertEqual('my "x";.sh', parse_content_disposition(r'attachment; filename="my \"x\";.sh"; size=3'))
+        self.assertEqual('a.sh', parse_content_disposition('attachment; size=3; filename = a.sh ; x=y'))
+        self.assertIsNone(parse_content_disposition('attachment'))
+        self.assertIsNone(parse_content_disposition(''))
+        self.assertIsNone(parse_content_disposition(None))
+
+    def test_content_disposition_ext_value_takes_precedence(self):
+        self.assertEqual('naïve.sh', parse_content_disposition(
+            'attachment; filename="naive.sh"; filename*=UTF-8\'\'na%C3%AFve.sh'))
+        self.assertEqual('é.ps1', parse_content_disposition("attachment; filename*=iso-8859-1'en'%E9.ps1"))
+
+    def test_malformed_ext_value_falls_back_to_filename(self):
+        self.assertEqual('a.sh', parse_content_disposition("attachment; filename*=unknown''b.sh; filename=a.sh"))
+        self.assertEqual('a.sh', parse_content_disposition("attachment; filename*=b.sh; filename=a.sh"))
+        self.assertEqual('a.sh', parse_content_disposition("attachment; filename*=UTF-8''%FF.sh; filename=a.sh"))
+
+    def test_url_filename(self):
+        self.assertEqual('bashScript.sh', get_url_filename('https://repo.com/User/Repo/master/bashScript.sh'))
+        self.assertEqual('a b.sh', get_url_filename('https://repo.com/scripts/a%20b.sh?token=x.sh.zip&y=1'))
+        self.assertEqual('bashScript.sh', get_url_filename(
+            'https://gitlab.com/api/v4/projects/1/repository/files/bashScript%2Esh/raw?ref=master'))
+        self.assertEqual('setup.sh', get_url_filename('https://repo.com/download?id=1&file=scripts%2Fsetup.sh'))
+        self.assertEqual('a.tar.gz', get_url_filename('https://repo.com/a.tar.gz#fragment.zip'))
+        self.assertIsNone(get_url_filename('https://repo.com/scripts/readme.txt?x=1'))
+        self.assertIsNone(get_url_filename('http://[::1'))
+        self.assertIsNone(get_url_filename(None))
+
+    def test_fuzz(self):
+        rnd = random.Random(6266)
+        alphabet = 'ab.;="\'\\/%?&# \tsh'
+        for _ in range(2000):
+            value = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 60)))
+            file_name = parse_content_disposition(value)
+            self.assertTrue(file_name is None or isinstance(file_name, str))
+            file_name = get_url_filename('https://repo.com/' + value)
+            self.assertTrue(file_name is None or get_script_name(file_name) == file_name)
+
+            # a script name in a quoted parameter, or as the last path segment, is always found
+            self.assertEqual('x.sh', parse_content_disposition(
+                'attachment; filename="x.sh"; junk="%s"' % value.replace('\\', '').replace('"', '')))
+            self.assertEqual('x.sh', get_url_filename('https://repo.com/%s/x.sh?%s' % (
+                value.replace('?', '').replace('#', ''), value.replace('#', ''))))
+
+    def test_adversarial_input_does_not_backtrack(self):
+        # a single generous bound: a backtracking parser takes minutes on 4 MB (the growth with the size of the
+        # input is measured by the get_filename and content_disposition targets of benchmarks/microbenchmarks.py)
+        url = 'https://repo.com/a.b/c.sh.d/setup.v1.sh?sig=' + '.sh&.ps1=a.b' * (4 * 1024 * 1024 // 12)
+        header = 'attachment; ' + 'filename="a.sh\\";' * (4 * 1024 * 1024 // 18)
+        start = time.perf_counter()
+        self.assertEqual('setup.v1.sh', get_url_filename(url))
+        parse_content_disposition(header)
+        self.assertLess(time.perf_counter() - start, 30)
@@ -0,0 +1,90 @@
+import threading
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.host_executor_pool import HostExecutorPool
+
+
+class TestHostExecutorPool(TestCase):
+
+    def setUp(self):
+        self.cancel_sampler = Mock()
+        self.preflight = Mock()
+        self.opened = []
+
+        def open_executor(script_conf):
+            executor = Mock()
+            self.opened.append(executor)
+            return executor
+        self.open_executor = Mock(side_effect=open_executor)
+        self.close_executor = Mock()
+
+    def _pool(self, multiplexed, max_per_host=None):
+        self.preflight.is_multiplexed = Mock(return_value=multiplexed)
+        return HostExecutorPool({'host': self.preflight}, self.open_executor, self.close_executor, max_per_host)
+
+    def test_idle_preflight_executor_is_taken_first(self):
+        pool = self._pool(True)
+        self.assertIs(self.preflight, pool.acquire('host', Mock(), self.cancel_sampler))
+        self.open_executor.assert_not_called()
+
+    def test_multiplexed_host_opens_another_executor_when_busy(self):
+        pool = self._pool(True)
+        first = pool.acquire('host', Mock(), self.cancel_sampler)
+        second = pool.acquire('host', Mock(), self.cancel_sampler)
+        self.assertIs(self.preflight, first)
+        self.assertIs(self.opened[0], second)
+        pool.release('host', second)
+        self.assertIs(second, pool.acquire('host', Mock(), self.cancel_sampler))
+        self.assertEqual(1, self.open_executor.call_count)
+
+    def test_not_multiplexed_host_waits_for_its_executor(self):
+        pool = self._pool(False)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire('host', Mock(), self.cancel_sampler)))
+        thread.start()
+        thread.join(0.2)
+        self.assertEqual([], acquired)
+        pool.release('host', self.preflight)
+        thread.join(5)
+        self.assertEqual([self.preflight], acquired)
+        self.open_executor.assert_not_called()
+
+    def test_max_per_host_bounds_the_executors(self):
+        pool = self._pool(True, max_per_host=2)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        self.cancel_sampler.throw_if_canceled.side_effect = CancellationException('cancelled', None)
+        with self.assertRaises(CancellationException):
+            pool.acquire('host', Mock(), self.cancel_sampler)
+        self.assertEqual(1, self.open_executor.call_count)
+
+    def test_failed_open_frees_its_place(self):
+        pool = self._pool(True, max_per_host=2)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        self.open_executor.side_effect = [Exception('refused'), Mock()]
+        with self.assertRaises(Exception):
+            pool.acquire('host', Mock(), self.cancel_sampler)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        self.assertEqual(2, self.open_executor.call_count)
+
+    def test_retire_closes_the_idle_opened_executors_of_the_host(self):
+        pool = self._pool(True)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        opened = pool.acquire('host', Mock(), self.cancel_sampler)
+        pool.release('host', self.preflight)
+        pool.release('host', opened)
+        pool.retire('host')
+        self.close_executor.assert_called_once_with(opened)
+        pool.close()
+        self.close_executor.assert_called_once_with(opened)
+
+    def test_close_closes_only_the_opened_executors(self):
+        pool = self._pool(True)
+        pool.acquire('host', Mock(), self.cancel_sampler)
+        opened = pool.acquire('host', Mock(), self.cancel_sampler)
+        pool.close()
+        self.close_executor.assert_called_once_with(opened)
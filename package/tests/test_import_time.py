@@ -0,0 +1,32 @@
+import json
+import subprocess
+import sys
+from unittest import TestCase
+
+
+IMPORT_BUDGET_SECONDS = 1.5
+
+MEASURE_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import cloudshell.cm.customscript.customscript_shell
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": [m for m in %r if m in sys.modules]}))
+'''
+
+
+class TestImportTime(TestCase):
+
+    def _measure(self, modules):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE_CODE % (modules,)])
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def test_protocol_backends_are_not_imported_eagerly(self):
+        result = self._measure(['paramiko', 'scp', 'winrm', 'requests_ntlm', 'cryptography',
+                                'cloudshell.cm.customscript.domain.linux_script_executor',
+                                'cloudshell.cm.customscript.domain.windows_script_executor'])
+        self.assertEqual([], result['modules'])
+
+    def test_import_time_budget(self):
+        result = self._measure([])
+        self.assertLess(result['elapsed'], IMPORT_BUDGET_SECONDS)
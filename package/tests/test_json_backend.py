@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from cloudshell.cm.customscript.domain import json_backend
+
+
+class TestJsonBackend(TestCase):
+
+    def test_loads(self):
+        self.assertEqual({'a': [1, 2.5, 'x']}, json_backend.loads('{"a": [1, 2.5, "x"]}'))
+
+    def test_loads_invalid_json(self):
+        with self.assertRaises(ValueError):
+            json_backend.loads('{"a":')
+
+    def test_dumps_is_compact(self):
+        self.assertEqual('{"a":[1,2.5,"x"],"b":null}', json_backend.dumps({'a': [1, 2.5, 'x'], 'b': None}))
+
+    def test_iter_array(self):
+        items = list(json_backend.iter_array(' [ {"a": 1} ,{"b": [2, 3]},\n"c" ] '))
+        self.assertEqual([{'a': 1}, {'b': [2, 3]}, 'c'], items)
+
+    def test_iter_array_bytes(self):
+        self.assertEqual([1, 2], list(json_backend.iter_array(b'[1,2]')))
+
+    def test_iter_empty_array(self):
+        self.assertEqual([], list(json_backend.iter_array(' [ ] ')))
+
+    def test_iter_array_is_lazy(self):
+        items = json_backend.iter_array('[{"a": 1}, oops]')
+        self.assertEqual({'a': 1}, next(items))
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_iter_array_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(json_backend.iter_array('{"a": 1}'))
+
+    def test_iter_array_missing_separator(self):
+        with self.assertRaises(ValueError):
+            list(json_backend.iter_array('[1 2]'))
+
+    def test_iter_array_extra_data(self):
+        with self.assertRaises(ValueError):
+            list(json_backend.iter_array('[1, 2] 3'))
+
+    def test_iter_large_array(self):
+        text = '[' + ','.join(['{"repositoryDetails": {"url": "u%s"}}' % i for i in range(5000)]) + ']'
+        count = 0
+        for i, item in enumerate(json_backend.iter_array(text)):
+            self.assertEqual('u%s' % i, item['repositoryDetails']['url'])
+            count += 1
+        self.assertEqual(5000, count)
@@ -1,14 +1,22 @@
 from unittest import TestCase
-from mock import patch, Mock
+from mock import patch, Mock, MagicMock, call
 #from scpclient import SCPError
 from scp import SCPException
+from paramiko.ssh_exception import SSHException
 
-from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration, ScriptCacheConfiguration, \
+    UploadConfiguration, SshMultiplexingConfiguration, ScriptConfiguration
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.detached_execution import DetachedPollResult
+from cloudshell.cm.customscript.domain.execution_result import ScriptResult
 from cloudshell.cm.customscript.domain.script_executor import ErrorMsg
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
 from cloudshell.cm.customscript.domain.linux_script_executor import LinuxScriptExecutor
+from cloudshell.cm.customscript.domain.ssh_connection_pool import SshConnectionPool
 from tests.helpers import Any
 import io
+import collections
+import threading
 
 class TestLinuxScriptExecutor(TestCase):
 
@@ -26,12 +34,17 @@ class TestLinuxScriptExecutor(TestCase):
         self.scp_patcher = patch('cloudshell.cm.customscript.domain.linux_script_executor.SCPClient')
         self.scp_ctor = self.scp_patcher.start()
         self.scp_ctor.return_value = self.scp
+        self.sftp = MagicMock()
+        self.sftp_patcher = patch('cloudshell.cm.customscript.domain.linux_script_executor.SFTPClient')
+        self.sftp_ctor = self.sftp_patcher.start()
+        self.sftp_ctor.from_transport.side_effect = SSHException('subsystem request failed')  # scp fallback by default
 
         self.executor = LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler)
 
     def tearDown(self):
         self.session_patcher.stop()
         self.scp_patcher.stop()
+        self.sftp_patcher.stop()
 
     def _mock_session_answer(self, exit_code, stdout, stderr):
         stdout_mock = Mock()
@@ -48,6 +61,22 @@ class TestLinuxScriptExecutor(TestCase):
         executor.connect()
         self.session.connect.assert_called_with('1.2.3.4',  username='root', password='1234')
 
+    def test_connect_enables_keepalive(self):
+        self.host.username = 'root'
+        self.host.password = '1234'
+        self.executor.connect()
+        self.session.get_transport.return_value.set_keepalive.assert_called_with(LinuxScriptExecutor.KEEPALIVE_SECONDS)
+
+    def test_is_connected(self):
+        self.session.get_transport.return_value.is_active.return_value = True
+        self.assertTrue(self.executor.is_connected())
+        self.session.get_transport.return_value = None
+        self.assertFalse(self.executor.is_connected())
+
+    def test_close(self):
+        self.executor.close()
+        self.session.close.assert_called_once()
+
     def test_pem_file(self):
         self.host.username = 'root'
         self.host.access_key = 'just an access key'
@@ -126,6 +155,35 @@ class TestLinuxScriptExecutor(TestCase):
         output_writer.write.assert_any_call('some output')
         output_writer.write.assert_any_call('some error')
 
+    def test_run_script_records_the_exit_code(self):
+        self.executor.script_result = Mock()
+        self._mock_session_answer(3, '', 'some error')
+        with self.assertRaises(Exception):
+            self.executor.run_script('tmp123', ScriptFile('script1', 'code'), None, Mock())
+        self.executor.script_result.set_exit_code.assert_called_once_with(3)
+
+    def test_run_script_records_the_output(self):
+        self.executor.script_result = Mock()
+        self._mock_session_answer(0, 'some output', 'some warning')
+        self.executor.run_script('tmp123', ScriptFile('script1', 'code'), None, Mock())
+        self.executor.script_result.add_output.assert_called_once_with('some output', 'some warning')
+
+    def test_run_script_does_not_record_the_output_it_does_not_print(self):
+        self.executor.script_result = Mock()
+        self._mock_session_answer(0, 'secret', '')
+        self.executor.run_script('tmp123', ScriptFile('script1', 'code'), None, Mock(), print_output=False)
+        self.executor.script_result.add_output.assert_not_called()
+
+    def test_execute_records_the_upload_and_run_phases(self):
+        self.executor.script_result = ScriptResult(0, ScriptConfiguration())
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_script = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        self.executor.execute(ScriptFile('script1', 'code'), env_vars={}, output_writer=Mock())
+        self.assertEqual(['upload', 'run'], list(self.executor.script_result.phases))
+        self.assertEqual(4, self.executor.script_result.bytes['uploaded'])
+
     def test_delete_temp_folder_success(self):
         self._mock_session_answer(0,'','')
         self.executor.delete_temp_folder('tmp123')
@@ -154,6 +212,29 @@ class TestLinuxScriptExecutor(TestCase):
         self.executor.run_script.assert_called_with(create_temp_folder_result, script_file, {}, output_writer, True)
         self.executor.delete_temp_folder.assert_called_with(create_temp_folder_result)
 
+    def test_execute_detached(self):
+        self.host.execution.detached = True
+        output_writer = Mock()
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_script = Mock()
+        self.executor.run_script = Mock()
+        self.executor.run_script_detached = Mock()
+        self.executor.delete_temp_folder = Mock()
+        script_file = ScriptFile('script1', 'some script code')
+        self.executor.execute(script_file, env_vars={}, output_writer=output_writer)
+        self.executor.run_script_detached.assert_called_with('folder', script_file, {}, output_writer, True)
+        self.executor.run_script.assert_not_called()
+        self.executor.delete_temp_folder.assert_called_with('folder')
+
+    def test_execute_profiles_the_upload_and_run_phases(self):
+        self.executor.profiler = MagicMock()
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_script = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        self.executor.execute(ScriptFile('script1', 'some script code'), env_vars={}, output_writer=Mock())
+        self.assertEqual([call('upload'), call('run')], self.executor.profiler.phase.call_args_list)
+
     def test_execute_error_on_create_temp_folder_exits_before_executing_script(self):
         output_writer = Mock()
         self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
@@ -223,3 +304,461 @@ class TestLinuxScriptExecutor(TestCase):
         self.executor.delete_temp_folder.assert_called_with(create_temp_folder_result)
         self.logger.error.assert_called_with(
             f'Failed to delete temp folder "{create_temp_folder_result}" from target machine: error message')
+
+
+    # remote script cache
+
+    def test_copy_script_from_cache_hit(self):
+        self._mock_session_answer(0, 'hit\n', '')
+        script_file = ScriptFile('script1', 'some script code')
+        self.assertTrue(self.executor.copy_script_from_cache(ScriptCacheConfiguration('/cache'), 'tmp123', script_file))
+        code = self.session.exec_command.call_args[0][0]
+        self.assertIn('/cache/' + script_file.sha256(), code)
+        self.assertIn('tmp123/script1', code)
+
+    def test_copy_script_from_cache_miss(self):
+        self._mock_session_answer(0, '', '')
+        self.assertFalse(self.executor.copy_script_from_cache(ScriptCacheConfiguration(), 'tmp123', ScriptFile('script1', 'code')))
+
+    def test_store_script_in_cache_failure_is_only_logged(self):
+        self._mock_session_answer(1, '', 'some error')
+        self.executor.store_script_in_cache(ScriptCacheConfiguration('/cache', 1, 2), 'tmp123', ScriptFile('script1', 'code'))
+        code = self.session.exec_command.call_args[0][0]
+        self.assertIn('-mmin +2880', code)
+        self.assertIn('-le 1024', code)
+        self.logger.warning.assert_called_once()
+
+    def test_store_script_in_cache_with_a_fractional_max_age(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.store_script_in_cache(ScriptCacheConfiguration('/cache', 1, 0.5), 'tmp123', ScriptFile('script1', 'code'))
+        self.assertIn('-mmin +720 ', self.session.exec_command.call_args[0][0])
+
+    def test_store_script_in_cache_keeps_at_least_a_minute(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.store_script_in_cache(ScriptCacheConfiguration('/cache', 1, 0.0001), 'tmp123', ScriptFile('script1', 'code'))
+        self.assertIn('-mmin +1 ', self.session.exec_command.call_args[0][0])
+
+    def test_store_script_in_cache_without_max_age(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.store_script_in_cache(ScriptCacheConfiguration('/cache', 1, 0), 'tmp123', ScriptFile('script1', 'code'))
+        code = self.session.exec_command.call_args[0][0]
+        self.assertNotIn('-mmin', code)
+        self.assertIn('-le 1024', code)
+
+    def test_store_script_in_cache_with_a_percent_in_the_path(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.store_script_in_cache(ScriptCacheConfiguration('/cache%d', 1, 2), 'tmp%s', ScriptFile('script1', 'code'))
+        self.assertIn('cp "tmp%s/script1" "/cache%d/', self.session.exec_command.call_args[0][0])
+        self.logger.warning.assert_not_called()
+
+    def test_copy_script_from_cache_with_a_percent_in_the_path(self):
+        self._mock_session_answer(0, 'hit\n', '')
+        self.assertTrue(self.executor.copy_script_from_cache(ScriptCacheConfiguration('/cache%'), 'tmp123', ScriptFile('script1', 'code')))
+        self.assertIn('"/cache%/', self.session.exec_command.call_args[0][0])
+
+    def test_execute_with_cache_hit_skips_copy(self):
+        self.host.script_cache = ScriptCacheConfiguration()
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_script_from_cache = Mock(return_value=True)
+        self.executor.copy_script = Mock()
+        self.executor.store_script_in_cache = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        self.executor.execute(ScriptFile('script1', 'some script code'), env_vars={}, output_writer=Mock())
+        self.executor.copy_script.assert_not_called()
+        self.executor.store_script_in_cache.assert_not_called()
+        self.executor.run_script.assert_called_once()
+
+    def test_execute_with_cache_miss_copies_and_stores(self):
+        self.host.script_cache = ScriptCacheConfiguration()
+        script_file = ScriptFile('script1', 'some script code')
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_script_from_cache = Mock(return_value=False)
+        self.executor.copy_script = Mock()
+        self.executor.store_script_in_cache = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        self.executor.execute(script_file, env_vars={}, output_writer=Mock())
+        self.executor.copy_script.assert_called_with('folder', script_file)
+        self.executor.store_script_in_cache.assert_called_with(self.host.script_cache, 'folder', script_file)
+
+
+    # script bundles
+
+    def test_copy_tar_gz_bundle_is_piped_to_tar(self):
+        self._mock_session_answer(0, '', '')
+        stdin = Mock()
+        self.session.exec_command.return_value = (stdin,) + self.session.exec_command.return_value[1:]
+        self.executor.copy_bundle('tmp123', ScriptBundle('b.tar.gz', b'archive-bytes'))
+        self.session.exec_command.assert_called_with('tar -xzf - -C "tmp123"')
+        stdin.write.assert_called_with(b'archive-bytes')
+        stdin.channel.shutdown_write.assert_called_once()
+        self.scp.putfo.assert_not_called()
+
+    def test_copy_zip_bundle_uses_scp_and_unzip(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.copy_bundle('tmp123', ScriptBundle('b.zip', b'archive-bytes'))
+        self.scp.putfo.assert_called_once_with(Any(), remote_path='tmp123/b.zip')
+        self.session.exec_command.assert_called_with('cd "tmp123" && unzip -q -o "b.zip" && rm -f "b.zip"')
+
+    def test_copy_bundle_fail(self):
+        self._mock_session_answer(2, '', 'some error')
+        self.session.exec_command.return_value = (Mock(),) + self.session.exec_command.return_value[1:]
+        with self.assertRaises(Exception) as e:
+            self.executor.copy_bundle('tmp123', ScriptBundle('b.tgz', b'archive-bytes'))
+        self.assertEqual(ErrorMsg.COPY_SCRIPT % 'some error', str(e.exception))
+
+    def test_execute_bundle(self):
+        bundle = ScriptBundle('b.tgz', b'archive-bytes')
+        bundle.set_entry_point('run.sh')
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_bundle = Mock()
+        self.executor.copy_script = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        output_writer = Mock()
+        self.executor.execute(bundle, env_vars={}, output_writer=output_writer)
+        self.executor.copy_bundle.assert_called_with('folder', bundle)
+        self.executor.copy_script.assert_not_called()
+        self.executor.run_script.assert_called_with('folder', bundle, {}, output_writer, True)
+
+
+    # pipe mode
+
+    def test_copy_streamed_script_is_piped_to_cat(self):
+        self._mock_session_answer(0, '', '')
+        stdin = Mock()
+        self.session.exec_command.return_value = (stdin,) + self.session.exec_command.return_value[1:]
+        self.executor.copy_script('tmp123', ScriptFile('script1', stream=iter([b'a', b'b'])))
+        self.session.exec_command.assert_called_with('cat > "tmp123/script1"')
+        self.assertEqual([((b'a',),), ((b'b',),)], stdin.write.call_args_list)
+        self.scp.putfo.assert_not_called()
+
+    def test_execute_streamed_script_skips_cache_lookup(self):
+        self.host.script_cache = ScriptCacheConfiguration()
+        script_file = ScriptFile('script1', stream=iter([b'a']))
+        self.executor.create_temp_folder = Mock(return_value='folder')
+        self.executor.copy_script_from_cache = Mock()
+        self.executor.copy_script = Mock()
+        self.executor.store_script_in_cache = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        self.executor.execute(script_file, env_vars={}, output_writer=Mock())
+        self.executor.copy_script_from_cache.assert_not_called()
+        self.executor.copy_script.assert_called_with('folder', script_file)
+        self.executor.store_script_in_cache.assert_called_once()
+
+
+    # sftp upload
+
+    def _enable_sftp(self):
+        self.sftp_ctor.from_transport.side_effect = None
+        self.sftp_ctor.from_transport.return_value = self.sftp
+        remote_file = self.sftp.open.return_value.__enter__.return_value
+        remote_file._reqs = []
+        return remote_file
+
+    def test_copy_script_uses_pipelined_sftp_when_supported(self):
+        remote_file = self._enable_sftp()
+        self.host.upload = UploadConfiguration(window_size=4194304, max_packet_size=65536)
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'some script code'))
+        self.sftp_ctor.from_transport.assert_called_once_with(self.session.get_transport(), window_size=4194304,
+                                                              max_packet_size=65536)
+        self.sftp.open.assert_called_once_with('tmp123/script1', 'wb')
+        remote_file.set_pipelined.assert_called_once_with(True)
+        remote_file.write.assert_called_once_with(b'some script code')
+        self.sftp.close.assert_called_once()
+        self.scp.putfo.assert_not_called()
+
+    def test_sftp_upload_limits_outstanding_requests(self):
+        remote_file = self._enable_sftp()
+        self.host.upload = UploadConfiguration(max_outstanding_requests=2)
+        remote_file.write.side_effect = lambda chunk: remote_file._reqs.extend(['req1', 'req2'])
+        remote_file._reqs = collections.deque()
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'x' * (LinuxScriptExecutor.UPLOAD_CHUNK_SIZE * 3)))
+        self.assertEqual(3, remote_file.write.call_count)
+        self.assertEqual(2, len(remote_file._reqs))
+        self.assertEqual(4, remote_file.sftp._read_response.call_count)
+
+    def test_streamed_script_uses_sftp_when_supported(self):
+        remote_file = self._enable_sftp()
+        self.executor.copy_script('tmp123', ScriptFile('script1', stream=iter([b'a', b'b'])))
+        self.assertEqual([((b'a',),), ((b'b',),)], remote_file.write.call_args_list)
+        self.session.exec_command.assert_not_called()
+
+    def test_sftp_support_is_probed_once(self):
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'code'))
+        self.executor.copy_script('tmp123', ScriptFile('script2', 'code'))
+        self.sftp_ctor.from_transport.assert_called_once()
+        self.assertEqual(2, self.scp.putfo.call_count)
+
+    def test_scp_method_never_tries_sftp(self):
+        self.host.upload = UploadConfiguration(UploadConfiguration.SCP)
+        self.executor.copy_script('tmp123', ScriptFile('script1', 'code'))
+        self.sftp_ctor.from_transport.assert_not_called()
+        self.scp.putfo.assert_called_once()
+
+    def test_sftp_method_fails_when_sftp_is_not_supported(self):
+        self.host.upload = UploadConfiguration(UploadConfiguration.SFTP)
+        with self.assertRaises(Exception) as e:
+            self.executor.copy_script('tmp123', ScriptFile('script1', 'code'))
+        self.assertIn(ErrorMsg.COPY_SCRIPT % 'subsystem request failed', str(e.exception))
+        self.scp.putfo.assert_not_called()
+
+    def test_sftp_upload_fail(self):
+        remote_file = self._enable_sftp()
+        remote_file.write.side_effect = IOError('disk full')
+        with self.assertRaises(Exception) as e:
+            self.executor.copy_script('tmp123', ScriptFile('script1', 'code'))
+        self.assertEqual(ErrorMsg.COPY_SCRIPT % 'disk full', str(e.exception))
+        self.sftp.close.assert_called_once()
+
+    # detached
+
+    def test_launch_detached(self):
+        self.host.password = '1234'
+        self._mock_session_answer(0, ['4321\n'], [])
+        pid = self.executor.launch_detached('tmp123', ScriptFile('script1', 'code'), {'a': 'b'})
+        self.assertEqual('4321', pid)
+        code = self.session.exec_command.call_args[0][0]
+        self.assertTrue(code.startswith("export a=$'\\x62';export cs_machine_pass="))
+        self.assertIn('nohup $(command -v setsid) sh -c', code)
+        self.assertIn('"tmp123/script1" "tmp123/.cs_exit_code" > "tmp123/.cs_stdout" 2> "tmp123/.cs_stderr" < /dev/null &', code)
+
+    def test_launch_detached_fail(self):
+        self._mock_session_answer(1, [], ['some error'])
+        with self.assertRaises(Exception) as e:
+            self.executor.launch_detached('tmp123', ScriptFile('script1', 'code'), {})
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'some error', str(e.exception))
+
+    def test_poll_detached_running(self):
+        self._mock_session_answer(0, ['|b3V0|\n'], [])
+        result = self.executor.poll_detached('tmp123', 10, 0, 100)
+        self.assertIsNone(result.exit_code)
+        self.assertEqual(b'out', result.std_out)
+        self.assertEqual(b'', result.std_err)
+        code = self.session.exec_command.call_args[0][0]
+        self.assertIn('tail -c +11 "tmp123/.cs_stdout" 2>/dev/null | head -c 100', code)
+        self.assertIn('tail -c +1 "tmp123/.cs_stderr" 2>/dev/null | head -c 100', code)
+
+    def test_poll_detached_exited(self):
+        self._mock_session_answer(0, ['3||ZXJy\n'], [])
+        result = self.executor.poll_detached('tmp123', 0, 0, 100)
+        self.assertEqual(3, result.exit_code)
+        self.assertEqual(b'err', result.std_err)
+
+    def test_run_script_detached_polls_until_exit(self):
+        self.host.execution.poll_interval_seconds = 0.01
+        self.cancel_sampler.throw_if_canceled = Mock()
+        self.executor.launch_detached = Mock()
+        self.executor.poll_detached = Mock(side_effect=[DetachedPollResult(None, b'a', b''),
+                                                        DetachedPollResult(0, b'b', b'')])
+        output_writer = Mock()
+        self.executor.run_script_detached('tmp123', ScriptFile('script1', 'code'), {}, output_writer)
+        self.executor.launch_detached.assert_called_once()
+        self.executor.poll_detached.assert_called_with('tmp123', 1, 0, Any())
+        output_writer.write.assert_any_call('a')
+        output_writer.write.assert_any_call('b')
+
+    def test_run_script_records_the_process_group(self):
+        self._mock_session_answer(0, 'some output', '')
+        self.executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+        self.session.exec_command.assert_called_with('echo $$ > "tmp123/.cs_pid"; exec sh tmp123/script1')
+
+    def test_kill_script(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.kill_script('tmp123')
+        code = self.session.exec_command.call_args[0][0]
+        self.assertTrue(code.startswith('pid=$(cat "tmp123/.cs_pid" 2>/dev/null)'))
+        self.assertIn('kill -TERM $t', code)
+        self.assertIn('kill -KILL $t', code)
+
+    def test_has_result_marker(self):
+        self._mock_session_answer(0, 'hit', '')
+        self.assertTrue(self.executor.has_result_marker('key123'))
+        self.assertEqual('[ -f "$HOME/.cloudshell/script_results/key123" ] && echo hit',
+                         self.session.exec_command.call_args[0][0])
+
+    def test_has_no_result_marker(self):
+        self._mock_session_answer(1, '', '')
+        self.assertFalse(self.executor.has_result_marker('key123'))
+
+    def test_write_result_marker(self):
+        self._mock_session_answer(0, '', '')
+        self.executor.write_result_marker('key123')
+        code = self.session.exec_command.call_args[0][0]
+        self.assertIn('touch "$HOME/.cloudshell/script_results/key123"', code)
+        self.assertIn('-mtime +30 -exec rm -f {} +', code)
+
+    def test_run_cancelable_deadline_kills_the_command(self):
+        finished = threading.Event()
+        self.executor._run = Mock(side_effect=lambda **kwargs: finished.wait(10))
+        on_abort = Mock(side_effect=finished.set)
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        with self.assertRaises(Exception) as e:
+            self.executor._run_cancelable('sleep 1000', deadline_minutes=0.0001, on_abort=on_abort)
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % (ErrorMsg.DEADLINE_EXCEEDED % 0.0001), str(e.exception))
+        on_abort.assert_called_once()
+        self.session.close.assert_not_called()
+
+    def test_run_cancelable_cancel_kills_the_command(self):
+        finished = threading.Event()
+        self.executor._run = Mock(side_effect=lambda **kwargs: finished.wait(10))
+        on_abort = Mock(side_effect=finished.set)
+        self.cancel_sampler.is_cancelled = Mock(return_value=True)
+        self.cancel_sampler.throw = Mock(side_effect=CancellationException('cancelled', None))
+        with self.assertRaises(CancellationException):
+            self.executor._run_cancelable('sleep 1000', on_abort=on_abort)
+        on_abort.assert_called_once()
+        self.session.close.assert_not_called()
+
+    def test_run_cancelable_cancel_without_kill_closes_the_session(self):
+        finished = threading.Event()
+        self.executor._run = Mock(side_effect=lambda **kwargs: finished.wait(10))
+        self.session.close = Mock(side_effect=finished.set)
+        self.cancel_sampler.is_cancelled = Mock(return_value=True)
+        self.cancel_sampler.throw = Mock(side_effect=CancellationException('cancelled', None))
+        with self.assertRaises(CancellationException):
+            self.executor._run_cancelable('sleep 1000')
+        self.session.close.assert_called_once()
+
+    # ssh multiplexing
+
+    def _multiplexed_executor(self):
+        self.host.username = 'root'
+        self.host.password = '1234'
+        self.host.ssh_multiplexing = SshMultiplexingConfiguration(max_sessions=10)
+        return LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler)
+
+    def test_multiplexed_executors_share_one_connection(self):
+        with patch.object(SshConnectionPool, '_default', SshConnectionPool()):
+            executor1 = self._multiplexed_executor()
+            executor2 = self._multiplexed_executor()
+            executor1.connect()
+            executor2.connect()
+            self.session.connect.assert_called_once_with('1.2.3.4', username='root', password='1234')
+            self.assertIs(executor1.session, executor2.session)
+            executor1.close()
+            self.session.close.assert_not_called()
+            executor2.close()
+            self.session.close.assert_called_once()
+
+    def test_is_multiplexed_only_with_ssh_multiplexing(self):
+        self.assertFalse(LinuxScriptExecutor(self.logger, self.host, self.cancel_sampler).is_multiplexed())
+        self.assertTrue(self._multiplexed_executor().is_multiplexed())
+
+    def test_multiplexed_reconnect_releases_the_previous_connection(self):
+        with patch.object(SshConnectionPool, '_default', SshConnectionPool()) as pool:
+            executor = self._multiplexed_executor()
+            executor.connect()
+            self.session.get_transport.return_value.is_active.return_value = False
+            executor.connect()
+            self.assertEqual(2, self.session.connect.call_count)
+            self.assertEqual(1, pool.connections_count(executor._get_connection_key()))
+
+    def test_multiplexed_connection_failure(self):
+        with patch.object(SshConnectionPool, '_default', SshConnectionPool()) as pool:
+            executor = self._multiplexed_executor()
+            self.session.connect.side_effect = Exception('refused')
+            with self.assertRaises(Exception):
+                executor.connect()
+            self.assertEqual(0, pool.connections_count(executor._get_connection_key()))
+
+    def test_multiplexed_cancel_closes_only_the_channels_of_the_command(self):
+        with patch.object(SshConnectionPool, '_default', SshConnectionPool()):
+            executor = self._multiplexed_executor()
+            executor.connect()
+            finished = threading.Event()
+            stdout = Mock()
+            started = threading.Event()
+            stdout.channel.recv_exit_status = Mock(side_effect=lambda: started.set() or finished.wait(10) and -1)
+            stdout.channel.close = Mock(side_effect=finished.set)
+            self.session.exec_command = Mock(return_value=(None, stdout, Mock()))
+            self.cancel_sampler.is_cancelled = Mock(side_effect=lambda: started.wait(10))
+            self.cancel_sampler.throw = Mock(side_effect=CancellationException('cancelled', None))
+            with self.assertRaises(CancellationException):
+                executor._run_cancelable('sleep 1000')
+            stdout.channel.close.assert_called_once()
+            self.session.close.assert_not_called()
+
+
+    # workspace
+
+    def _open_workspace(self):
+        self.executor.create_temp_folder = Mock(return_value='ws')
+        self.executor.open_workspace()
+
+    def test_execute_in_workspace_uses_subfolders_without_creating_or_deleting_them(self):
+        self._open_workspace()
+        self.executor.copy_script = Mock()
+        self.executor.run_script = Mock()
+        self.executor.delete_temp_folder = Mock()
+        script_file = ScriptFile('script1', 'code')
+        output_writer = Mock()
+        self.executor.execute(script_file, env_vars={}, output_writer=output_writer)
+        self.executor.execute(script_file, env_vars={}, output_writer=output_writer)
+        self.executor.create_temp_folder.assert_called_once()
+        self.assertEqual([call('ws/1', script_file), call('ws/2', script_file)],
+                         self.executor.copy_script.call_args_list)
+        self.executor.run_script.assert_called_with('ws/2', script_file, {}, output_writer, True)
+        self.executor.delete_temp_folder.assert_not_called()
+
+    def test_sftp_upload_creates_the_workspace_folder_once(self):
+        self._enable_sftp()
+        self._open_workspace()
+        tmp_folder = self.executor._new_workspace_folder()
+        self.executor.copy_script(tmp_folder, ScriptFile('script1', 'code'))
+        self.executor.copy_script(tmp_folder, ScriptFile('script2', 'code'))
+        self.sftp.mkdir.assert_called_once_with('ws/1')
+        self.session.exec_command.assert_not_called()
+
+    def test_scp_upload_creates_the_workspace_folder_first(self):
+        self._mock_session_answer(0, '', '')
+        self._open_workspace()
+        tmp_folder = self.executor._new_workspace_folder()
+        self.executor.copy_script(tmp_folder, ScriptFile('script1', 'code'))
+        self.session.exec_command.assert_called_once_with('mkdir -p "ws/1" && true')
+        self.scp.putfo.assert_called_once()
+
+    def test_tar_bundle_creates_the_workspace_folder_in_the_same_command(self):
+        self._mock_session_answer(0, '', '')
+        self.session.exec_command.return_value = (Mock(),) + self.session.exec_command.return_value[1:]
+        self._open_workspace()
+        tmp_folder = self.executor._new_workspace_folder()
+        self.executor.copy_bundle(tmp_folder, ScriptBundle('b.tgz', b'archive-bytes'))
+        self.session.exec_command.assert_called_once_with('mkdir -p "ws/1" && tar -xzf - -C "ws/1"')
+
+    def test_cache_lookup_creates_the_workspace_folder_in_the_same_command(self):
+        self._mock_session_answer(0, ['hit\n'], '')
+        self._open_workspace()
+        tmp_folder = self.executor._new_workspace_folder()
+        self.assertTrue(self.executor.copy_script_from_cache(ScriptCacheConfiguration(), tmp_folder,
+                                                             ScriptFile('script1', 'code')))
+        self.assertTrue(self.session.exec_command.call_args[0][0].startswith('mkdir -p "ws/1" && if [ -f '))
+        self.assertEqual('', self.executor._take_mkdir_code(tmp_folder))
+
+    def test_close_workspace_deletes_it_once_even_when_cancelled(self):
+        self._mock_session_answer(0, '', '')
+        self._open_workspace()
+        self.cancel_sampler.is_cancelled = Mock(return_value=True)
+        self.session.get_transport.return_value.is_active.return_value = True
+        self.executor.close_workspace()
+        self.executor.close_workspace()
+        self.session.exec_command.assert_called_once_with('rm -rf "ws"')
+        self.assertIsNone(self.executor.workspace)
+
+    def test_close_workspace_reconnects_a_closed_session(self):
+        self._mock_session_answer(0, '', '')
+        self._open_workspace()
+        self.session.get_transport.return_value = None
+        self.executor.connect = Mock()
+        self.executor.close_workspace()
+        self.executor.connect.assert_called_once()
+        self.session.exec_command.assert_called_once_with('rm -rf "ws"')
+
+    def test_close_workspace_failure_is_logged(self):
+        self._mock_session_answer(1, '', 'denied')
+        self._open_workspace()
+        self.executor.close_workspace()
+        self.logger.error.assert_called_once()
+        self.assertIsNone(self.executor.workspace)
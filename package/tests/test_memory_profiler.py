@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.memory_profiler import MemoryProfiler, profile_phase
+
+
+class TestMemoryProfiler(TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+
+    def test_records_peak_and_retained_per_phase(self):
+        profiler = MemoryProfiler(self.logger, 'a.sh', top_sites=3)
+        profiler.start()
+        try:
+            with profiler.phase('download'):
+                temp = b'x' * (4 * 1024 * 1024)
+                kept = [b'y' * (1024 * 1024)]
+                del temp
+            with profiler.phase('run'):
+                pass
+        finally:
+            profiler.stop()
+
+        self.assertEqual(['download', 'run'], [phase.name for phase in profiler.phases])
+        download = profiler.phases[0]
+        self.assertGreaterEqual(download.peak_bytes, 5 * 1024 * 1024)
+        self.assertGreaterEqual(download.retained_bytes, 1024 * 1024)
+        self.assertLess(download.retained_bytes, 2 * 1024 * 1024)
+        self.assertIn('test_memory_profiler.py', download.top_sites[0][0])
+        self.assertLessEqual(len(download.top_sites), 3)
+        self.assertIsNotNone(kept)
+
+    def test_tracing_is_stopped_by_the_last_profiler(self):
+        first = MemoryProfiler(self.logger, 'a.sh')
+        second = MemoryProfiler(self.logger, 'b.sh')
+
+        first.start()
+        second.start()
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        second.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_report_to_the_log(self):
+        profiler = MemoryProfiler(self.logger, 'a.sh')
+        profiler.start()
+        with profiler.phase('upload'):
+            pass
+        profiler.stop()
+
+        profiler.report()
+
+        text = self.logger.info.call_args[0][0]
+        self.assertIn('Memory profile of a.sh', text)
+        self.assertIn('upload', text)
+
+    def test_report_to_a_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            report_file = os.path.join(folder, 'memory.txt')
+            profiler = MemoryProfiler(self.logger, 'a.sh', report_file=report_file)
+            profiler.report()
+            profiler.report()
+
+            with open(report_file) as f:
+                self.assertEqual(2, f.read().count('Memory profile of a.sh'))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_profile_phase_without_a_profiler(self):
+        with profile_phase(None, 'run'):
+            pass
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profile_phase_with_a_profiler(self):
+        profiler = MemoryProfiler(self.logger, 'a.sh', top_sites=0)
+        profiler.start()
+        with profile_phase(profiler, 'run'):
+            pass
+        profiler.stop()
+
+        self.assertEqual('run', profiler.phases[0].name)
+        self.assertEqual([], profiler.phases[0].top_sites)
+
+    def test_overlapping_phases_have_no_peak(self):
+        first = MemoryProfiler(self.logger, 'a.sh', top_sites=0)
+        second = MemoryProfiler(self.logger, 'b.sh', top_sites=0)
+        first.start()
+        second.start()
+        try:
+            with first.phase('run'):
+                with second.phase('upload'):
+                    pass
+            with first.phase('close'):
+                pass
+        finally:
+            first.stop()
+            second.stop()
+
+        self.assertIsNone(first.phases[0].peak_bytes)
+        self.assertIsNone(second.phases[0].peak_bytes)
+        self.assertIsNotNone(first.phases[1].peak_bytes)
+        self.assertIn('n/a', first.format_report())
+
+    def test_no_peak_without_reset_peak(self):
+        profiler = MemoryProfiler(self.logger, 'a.sh', top_sites=0)
+        profiler.start()
+        try:
+            # Python < 3.9
+            without_reset_peak = Mock(spec=['get_traced_memory'], get_traced_memory=tracemalloc.get_traced_memory)
+            with patch('cloudshell.cm.customscript.domain.memory_profiler.tracemalloc', without_reset_peak):
+                with profiler.phase('run'):
+                    pass
+        finally:
+            profiler.stop()
+
+        self.assertIsNone(profiler.phases[0].peak_bytes)
+        self.assertIn('Python < 3.9', profiler.format_report())
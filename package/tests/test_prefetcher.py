@@ -0,0 +1,75 @@
+import threading
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.prefetcher import Prefetcher
+
+
+class TestPrefetcher(TestCase):
+
+    def setUp(self):
+        self.cancel_sampler = Mock()
+        self.cancel_sampler.throw_if_canceled = Mock()
+
+    def test_takes_the_items_in_order(self):
+        prefetcher = Prefetcher(lambda index: index * 10, 5, 2, self.cancel_sampler)
+        self.assertEqual([0, 10, 20, 30, 40], [prefetcher.take(i) for i in range(5)])
+        prefetcher.close()
+
+    def test_fetches_at_most_depth_items_ahead(self):
+        started = []
+        lock = threading.Lock()
+
+        def fetch(index):
+            with lock:
+                started.append(index)
+            return index
+
+        prefetcher = Prefetcher(fetch, 10, 2, self.cancel_sampler)
+        prefetcher.take(0)
+        prefetcher.take(1)
+        prefetcher.close()
+        self.assertEqual([0, 1, 2, 3], sorted(started))
+
+    def test_next_items_are_fetched_while_the_current_one_is_used(self):
+        fetched = threading.Event()
+
+        def fetch(index):
+            if index == 1:
+                fetched.set()
+            return index
+
+        prefetcher = Prefetcher(fetch, 2, 1, self.cancel_sampler)
+        prefetcher.take(0)
+        self.assertTrue(fetched.wait(5))
+        prefetcher.close()
+
+    def test_raises_the_error_of_the_fetch(self):
+        def fetch(index):
+            if index == 1:
+                raise ValueError('download failed')
+            return index
+
+        prefetcher = Prefetcher(fetch, 3, 2, self.cancel_sampler)
+        self.assertEqual(0, prefetcher.take(0))
+        with self.assertRaises(ValueError):
+            prefetcher.take(1)
+        prefetcher.close()
+
+    def test_close_discards_the_items_not_taken(self):
+        discard = Mock()
+        prefetcher = Prefetcher(lambda index: 'item%s' % index, 4, 3, self.cancel_sampler, discard)
+        prefetcher.take(0)
+        prefetcher.close()
+        self.assertEqual(['item1', 'item2', 'item3'], sorted(c[0][0] for c in discard.call_args_list))
+
+    def test_take_stops_waiting_on_cancellation(self):
+        release = threading.Event()
+        self.cancel_sampler.throw_if_canceled = Mock(side_effect=CancellationException('cancelled'))
+        prefetcher = Prefetcher(lambda index: release.wait(10), 1, 1, self.cancel_sampler)
+        with self.assertRaises(CancellationException):
+            prefetcher.take(0)
+        release.set()
+        prefetcher.close()
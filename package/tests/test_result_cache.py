@@ -0,0 +1,142 @@
+import time
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from cloudshell.cm.customscript.domain.result_cache import ResultCache
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_file import ScriptFile
+
+
+class TestResultCache(TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache()
+        self.logger = Mock()
+        self.host_conf = HostConfiguration()
+        self.host_conf.ip = '1.2.3.4'
+        self.host_conf.parameters = {'a': '1', 'b': '2'}
+
+    def _status_api(self, status):
+        api = Mock()
+        api.GetReservationStatus.return_value.ReservationSlimStatus.Status = status
+        return api
+
+    def test_key_depends_on_host_content_and_parameters(self):
+        key = ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 1'))
+
+        self.assertEqual(key, ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 1')))
+        self.assertNotEqual(key, ResultCache.get_key('res2', self.host_conf, ScriptFile('a.sh', 'echo 1')))
+        self.assertNotEqual(key, ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 2')))
+        self.host_conf.parameters = {'a': '1', 'b': '3'}
+        self.assertNotEqual(key, ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 1')))
+        self.host_conf.parameters = {'a': '1', 'b': '2'}
+        self.host_conf.ip = '1.2.3.5'
+        self.assertNotEqual(key, ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 1')))
+
+    def test_key_ignores_parameters_order(self):
+        key = ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 1'))
+        self.host_conf.parameters = {'b': '2', 'a': '1'}
+
+        self.assertEqual(key, ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', 'echo 1')))
+
+    def test_no_key_for_a_streamed_script(self):
+        self.assertIsNone(ResultCache.get_key('res1', self.host_conf, ScriptFile('a.sh', stream=iter([b'echo']))))
+
+    def test_results_are_per_reservation(self):
+        self.cache.add('res1', 'key')
+
+        self.assertTrue(self.cache.contains('res1', 'key'))
+        self.assertFalse(self.cache.contains('res2', 'key'))
+
+    def test_evict(self):
+        self.cache.add('res1', 'key')
+
+        self.cache.evict('res1')
+
+        self.assertFalse(self.cache.contains('res1', 'key'))
+
+    def test_evicts_ended_reservations(self):
+        self.cache.add('res1', 'key')
+        api = self._status_api('Completed')
+
+        with patch('cloudshell.cm.customscript.domain.result_cache.time.time',
+                   return_value=time.time() + ResultCache.RESERVATION_CHECK_INTERVAL_SECONDS):
+            self.cache.evict_ended_reservations(api, self.logger)
+
+        api.GetReservationStatus.assert_called_once_with('res1')
+        self.assertFalse(self.cache.contains('res1', 'key'))
+
+    def test_evicts_reservations_that_cannot_be_found(self):
+        self.cache.add('res1', 'key')
+        api = Mock()
+        api.GetReservationStatus.side_effect = Exception('not found')
+
+        with patch('cloudshell.cm.customscript.domain.result_cache.time.time',
+                   return_value=time.time() + ResultCache.RESERVATION_CHECK_INTERVAL_SECONDS):
+            self.cache.evict_ended_reservations(api, self.logger)
+
+        self.assertFalse(self.cache.contains('res1', 'key'))
+
+    def test_keeps_active_reservations(self):
+        self.cache.add('res1', 'key')
+        api = self._status_api('Started')
+
+        with patch('cloudshell.cm.customscript.domain.result_cache.time.time',
+                   return_value=time.time() + ResultCache.RESERVATION_CHECK_INTERVAL_SECONDS):
+            self.cache.evict_ended_reservations(api, self.logger)
+
+        self.assertTrue(self.cache.contains('res1', 'key'))
+
+    def test_reservations_are_not_checked_before_the_interval(self):
+        self.cache.add('res1', 'key')
+        api = self._status_api('Completed')
+
+        self.cache.evict_ended_reservations(api, self.logger)
+
+        api.GetReservationStatus.assert_not_called()
+        self.assertTrue(self.cache.contains('res1', 'key'))
+
+    def test_evicts_reservations_of_every_final_status(self):
+        for status in ('Completed', 'Ended', 'Cancelled', None):
+            self.cache.add('res1', 'key')
+            api = self._status_api(status)
+
+            with patch('cloudshell.cm.customscript.domain.result_cache.time.time',
+                       return_value=time.time() + ResultCache.RESERVATION_CHECK_INTERVAL_SECONDS):
+                self.cache.evict_ended_reservations(api, self.logger)
+
+            self.assertFalse(self.cache.contains('res1', 'key'), status)
+
+    def test_keeps_pending_reservations(self):
+        self.cache.add('res1', 'key')
+        api = self._status_api('Pending')
+
+        with patch('cloudshell.cm.customscript.domain.result_cache.time.time',
+                   return_value=time.time() + ResultCache.RESERVATION_CHECK_INTERVAL_SECONDS):
+            self.cache.evict_ended_reservations(api, self.logger)
+
+        self.assertTrue(self.cache.contains('res1', 'key'))
+
+    def test_evicts_reservations_without_a_recent_result(self):
+        cache = ResultCache(max_age_seconds=60)
+        cache.add('res1', 'key')
+        cache.add('res2', 'key')
+
+        with patch('cloudshell.cm.customscript.domain.result_cache.time.time', return_value=time.time() + 30):
+            cache.add('res2', 'key2')
+        with patch('cloudshell.cm.customscript.domain.result_cache.time.time', return_value=time.time() + 61):
+            self.assertFalse(cache.contains('res1', 'key'))
+            self.assertTrue(cache.contains('res2', 'key'))
+
+    def test_evicts_the_least_recently_added_reservation_over_the_limit(self):
+        cache = ResultCache(max_reservations=2)
+        cache.add('res1', 'key')
+        cache.add('res2', 'key')
+        cache.add('res1', 'key2')
+
+        cache.add('res3', 'key')
+
+        self.assertTrue(cache.contains('res1', 'key'))
+        self.assertFalse(cache.contains('res2', 'key'))
+        self.assertTrue(cache.contains('res3', 'key'))
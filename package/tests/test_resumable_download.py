@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import requests
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.download_cache import DownloadCache
+from cloudshell.cm.customscript.domain.resumable_download import ResumableDownload
+from tests.helpers import LocalHttpServer
+
+
+class TestResumableDownload(TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+        self.cancel_sampler = Mock()
+        self.content = os.urandom(1024 * 1024 + 123)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _download(self, server, parallel_parts=1, partial=None):
+        download = ResumableDownload(self.logger, self.cancel_sampler, True, parallel_parts)
+        download.RESUME_DELAY_SECONDS = 0
+        download.CHUNK_SIZE = 64 * 1024
+        return download.read(requests.get(server.url, stream=True), partial)
+
+    def test_download_without_failures(self):
+        with LocalHttpServer(self.content) as server:
+            data = self._download(server)
+
+        self.assertEqual(self.content, data)
+        self.assertEqual(1, len(server.requests))
+
+    def test_resumes_an_interrupted_download(self):
+        with LocalHttpServer(self.content, fail_after=[300 * 1024, 200 * 1024]) as server:
+            data = self._download(server)
+
+        self.assertEqual(self.content, data)
+        self.assertEqual(3, len(server.requests))
+        self.assertEqual('bytes=%s-' % (300 * 1024), server.requests[1]['Range'])
+        self.assertEqual('"v1"', server.requests[1]['If-Range'])
+        self.assertEqual('bytes=%s-' % (500 * 1024), server.requests[2]['Range'])
+
+    def test_restarts_when_the_file_changed(self):
+        with LocalHttpServer(self.content, fail_after=[300 * 1024]) as server:
+            response = requests.get(server.url, stream=True)
+            server.etag = '"v2"'
+            server.content = self.content[::-1]
+            download = ResumableDownload(self.logger, self.cancel_sampler, True)
+            download.RESUME_DELAY_SECONDS = 0
+            data = download.read(response)
+
+        self.assertEqual(self.content[::-1], data)
+
+    def test_does_not_resume_without_range_support(self):
+        with LocalHttpServer(self.content, accept_ranges=False, fail_after=[300 * 1024]) as server:
+            with self.assertRaises(IOError):
+                self._download(server)
+
+        self.assertEqual(1, len(server.requests))
+
+    def test_gives_up_after_max_attempts(self):
+        fail_after = [1024] * (ResumableDownload.MAX_RESUME_ATTEMPTS + 1)
+        with LocalHttpServer(self.content, fail_after=fail_after) as server:
+            with self.assertRaises(IOError):
+                self._download(server)
+
+        self.assertEqual(ResumableDownload.MAX_RESUME_ATTEMPTS + 1, len(server.requests))
+
+    def test_partial_download_is_resumed_by_a_later_download(self):
+        cache = DownloadCache(self.folder)
+        with LocalHttpServer(self.content, fail_after=[100 * 1024] * (ResumableDownload.MAX_RESUME_ATTEMPTS + 1)) as server:
+            partial = cache.open_partial(server.url)
+            with self.assertRaises(IOError):
+                self._download(server, partial=partial)
+            partial.close()
+
+            server.fail_after = []
+            server.requests = []
+            partial = cache.open_partial(server.url)
+            data = self._download(server, partial=partial)
+            partial.close()
+
+        self.assertEqual(self.content, data)
+        self.assertEqual('bytes=%s-' % (600 * 1024), server.requests[1]['Range'])
+        self.assertEqual([], os.listdir(os.path.join(self.folder, 'partial')))
+
+    def test_partial_download_is_held_by_a_single_download(self):
+        cache = DownloadCache(self.folder)
+        partial = cache.open_partial('http://repo/a.sh')
+
+        self.assertIsNone(cache.open_partial('http://repo/a.sh'))
+        partial.close()
+        self.assertIsNotNone(cache.open_partial('http://repo/a.sh'))
+
+    def test_parallel_range_requests(self):
+        with LocalHttpServer(self.content, bytes_per_second=2 * 1024 * 1024) as server:
+            download = ResumableDownload(self.logger, self.cancel_sampler, True, 4)
+            download.PARALLEL_MIN_BYTES = 1024
+            download.CHUNK_SIZE = 64 * 1024
+            start_time = time.time()
+            data = download.read(requests.get(server.url, stream=True))
+            elapsed = time.time() - start_time
+
+        self.assertEqual(self.content, data)
+        self.assertEqual(4, len([r for r in server.requests if 'Range' in r]))
+        self.assertGreaterEqual(server.max_active, 4)
+        self.logger.info.assert_any_call('Downloading %s bytes with 4 parallel range requests ...' % len(self.content))
+        # throttled per connection: ~0.13s with 4 ranges, a single connection takes ~0.5s
+        self.assertLess(elapsed, 0.4)
+
+    def test_parallel_range_request_is_resumed(self):
+        with LocalHttpServer(self.content, fail_after=[None, 1024]) as server:
+            download = ResumableDownload(self.logger, self.cancel_sampler, True, 4)
+            download.PARALLEL_MIN_BYTES = 1024
+            download.RESUME_DELAY_SECONDS = 0
+            data = download.read(requests.get(server.url, stream=True))
+
+        self.assertEqual(self.content, data)
+        self.assertEqual(6, len(server.requests))
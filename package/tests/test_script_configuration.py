@@ -124,6 +124,197 @@ class TestScriptConfiguration(TestCase):
             self.parser.json_to_object(json)
         self.assertIn('Missing/Empty "hostsDetails[0].connectionMethod" node.', str(context.exception))
 
+    def test_cannot_parse_json_that_is_not_an_object(self):
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object('[]')
+        self.assertIn('Configuration must be a json object.', str(context.exception))
+
+    def test_parse_already_decoded_dict(self):
+        conf = self.parser.json_to_object({
+            'verifyCertificate': True,
+            'repositoryDetails': {'url': 'B'},
+            'hostsDetails': [{'ip': 'E', 'connectionMethod': 'SSH'}]
+        })
+        self.assertEqual('B', conf.script_repo.url)
+        self.assertEqual('E', conf.host_conf.ip)
+        self.assertEqual('ssh', conf.host_conf.connection_method)
+        self.assertEqual(True, conf.verify_certificate)
+
+    def test_stream_transfer(self):
+        json = '{"streamTransfer":"True","repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        self.assertTrue(self.parser.json_to_object(json).stream_transfer)
+
+    def test_id_and_depends_on(self):
+        conf = self.parser.json_to_object('{"id":"app","dependsOn":["db","cache"],"repositoryDetails":{"url":"u"},'
+                                          '"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}')
+        self.assertEqual('app', conf.id)
+        self.assertEqual(['db', 'cache'], conf.depends_on)
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}')
+        self.assertIsNone(conf.id)
+        self.assertEqual([], conf.depends_on)
+
+    def test_cannot_parse_json_with_invalid_depends_on(self):
+        json = '{"dependsOn":"db","repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "dependsOn" must be an array of configuration ids.', str(context.exception))
+
+    def test_upload_defaults(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}')
+        self.assertEqual('auto', conf.host_conf.upload.method)
+        self.assertEqual(64, conf.host_conf.upload.max_outstanding_requests)
+        self.assertEqual(1, conf.host_conf.upload.parallel_shells)
+
+    def test_upload(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"upload":{"method":"SFTP","maxOutstandingRequests":8,"windowSize":1048576}}]}')
+        self.assertEqual('sftp', conf.host_conf.upload.method)
+        self.assertEqual(8, conf.host_conf.upload.max_outstanding_requests)
+        self.assertEqual(1048576, conf.host_conf.upload.window_size)
+        self.assertIsNone(conf.host_conf.upload.max_packet_size)
+
+    def test_upload_null_values_are_defaults(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"upload":{"maxOutstandingRequests":null,"parallelShells":null}}]}')
+        self.assertEqual(64, conf.host_conf.upload.max_outstanding_requests)
+        self.assertEqual(1, conf.host_conf.upload.parallel_shells)
+
+    def test_cannot_parse_json_with_invalid_max_outstanding_requests(self):
+        for value in ('true', 'false', '0', '-1', '1.5', '"8"'):
+            json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",' \
+                   '"upload":{"maxOutstandingRequests":%s}}]}' % value
+            with self.assertRaises(SyntaxError) as context:
+                self.parser.json_to_object(json)
+            self.assertIn('Node "hostsDetails[0].upload.maxOutstandingRequests" must be a positive integer.',
+                          str(context.exception))
+
+    def test_cannot_parse_json_with_unknown_upload_method(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","upload":{"method":"ftp"}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].upload.method" must be one of: auto, sftp, scp.', str(context.exception))
+
+    def test_upload_parallel_shells(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"winrm",'
+                                          '"upload":{"parallelShells":4}}]}')
+        self.assertEqual(4, conf.host_conf.upload.parallel_shells)
+
+    def test_cannot_parse_json_with_invalid_parallel_shells(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"winrm","upload":{"parallelShells":0}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].upload.parallelShells" must be a positive integer.', str(context.exception))
+
+    def test_script_cache_is_off_by_default(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}')
+        self.assertIsNone(conf.host_conf.script_cache)
+
+    def test_script_cache(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"scriptCache":{"path":"/c","maxSizeMb":10}}]}')
+        self.assertEqual('/c', conf.host_conf.script_cache.path)
+        self.assertEqual(10, conf.host_conf.script_cache.max_size_mb)
+        self.assertEqual(30, conf.host_conf.script_cache.max_age_days)
+
+    def test_cannot_parse_json_with_negative_script_cache_size(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","scriptCache":{"maxSizeMb":-1}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].scriptCache.maxSizeMb" must be a non negative number.', str(context.exception))
+
+    def test_cannot_parse_json_with_boolean_script_cache_age(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","scriptCache":{"maxAgeDays":false}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].scriptCache.maxAgeDays" must be a non negative number.', str(context.exception))
+
+    def test_ssh_multiplexing(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}')
+        self.assertIsNone(conf.host_conf.ssh_multiplexing)
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"sshMultiplexing":{}}]}')
+        self.assertEqual(10, conf.host_conf.ssh_multiplexing.max_sessions)
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"sshMultiplexing":{"maxSessions":4}}]}')
+        self.assertEqual(4, conf.host_conf.ssh_multiplexing.max_sessions)
+
+    def test_cannot_parse_json_with_invalid_ssh_max_sessions(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","sshMultiplexing":{"maxSessions":"x"}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].sshMultiplexing.maxSessions" must be a positive integer.', str(context.exception))
+
+    def test_cannot_parse_json_with_boolean_ssh_max_sessions(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","sshMultiplexing":{"maxSessions":true}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].sshMultiplexing.maxSessions" must be a positive integer.', str(context.exception))
+
+    def test_result_cache_is_off_by_default(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        self.assertIsNone(self.parser.json_to_object(json).result_cache)
+
+    def test_result_cache(self):
+        json = '{"resultCache":{"markerOnHost":"True"},"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        self.assertTrue(self.parser.json_to_object(json).result_cache.marker_on_host)
+
+    def test_cannot_parse_json_with_invalid_result_cache(self):
+        json = '{"resultCache":true,"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "resultCache" must be an object.', str(context.exception))
+
+    def test_memory_profiling(self):
+        json = '{"memoryProfiling":{"topSites":5,"reportFile":"c:/mem.txt"},"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        conf = self.parser.json_to_object(json)
+        self.assertEqual(5, conf.memory_profiling.top_sites)
+        self.assertEqual('c:/mem.txt', conf.memory_profiling.report_file)
+
+    def test_memory_profiling_is_off_by_default(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        self.assertIsNone(self.parser.json_to_object(json).memory_profiling)
+
+    def test_cannot_parse_json_with_invalid_memory_profiling_top_sites(self):
+        json = '{"memoryProfiling":{"topSites":-1},"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "memoryProfiling.topSites" must be an integer greater/equal to zero.', str(context.exception))
+
+    def test_execution_is_attached_by_default(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh"}]}')
+        self.assertFalse(conf.host_conf.execution.detached)
+        self.assertEqual(10, conf.host_conf.execution.poll_interval_seconds)
+
+    def test_detached_execution(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"execution":{"detached":"True","pollIntervalSeconds":30}}]}')
+        self.assertTrue(conf.host_conf.execution.detached)
+        self.assertEqual(30, conf.host_conf.execution.poll_interval_seconds)
+
+    def test_execution_deadline(self):
+        conf = self.parser.json_to_object('{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh",'
+                                          '"execution":{"deadlineMinutes":1.5}}]}')
+        self.assertEqual(1.5, conf.host_conf.execution.deadline_minutes)
+        self.assertFalse(conf.host_conf.execution.detached)
+
+    def test_cannot_parse_json_with_negative_execution_deadline(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","execution":{"deadlineMinutes":-1}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].execution.deadlineMinutes" must be a positive number.', str(context.exception))
+
+    def test_cannot_parse_json_with_zero_poll_interval(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","execution":{"pollIntervalSeconds":0}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].execution.pollIntervalSeconds" must be a positive number.', str(context.exception))
+
+    def test_cannot_parse_json_with_boolean_execution_deadline(self):
+        json = '{"repositoryDetails":{"url":"u"},"hostsDetails":[{"ip":"i","connectionMethod":"ssh","execution":{"deadlineMinutes":true}}]}'
+        with self.assertRaises(SyntaxError) as context:
+            self.parser.json_to_object(json)
+        self.assertIn('Node "hostsDetails[0].execution.deadlineMinutes" must be a positive number.', str(context.exception))
+
     def test_sanity(self):
         def wrapIt(x):
             m = Mock()
@@ -0,0 +1,128 @@
+import threading
+import time
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
+from cloudshell.cm.customscript.domain.script_dag import ScriptDag, DagNode
+
+
+class TestScriptDag(TestCase):
+
+    def setUp(self):
+        self.cancel_sampler = Mock()
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+
+    def _confs(self, *specs):
+        """
+        :param specs: (id, depends_on) per configuration
+        """
+        confs = []
+        for conf_id, depends_on in specs:
+            conf = ScriptConfiguration()
+            conf.id = conf_id
+            conf.depends_on = depends_on
+            confs.append(conf)
+        return confs
+
+    def test_is_dag(self):
+        self.assertFalse(ScriptDag.is_dag(self._confs(('a', []), (None, []))))
+        self.assertTrue(ScriptDag.is_dag(self._confs(('a', []), ('b', ['a']))))
+
+    def test_duplicate_id(self):
+        with self.assertRaises(SyntaxError) as e:
+            ScriptDag(self._confs(('a', []), ('a', [])))
+        self.assertIn('Configuration id "a" is not unique.', str(e.exception))
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(SyntaxError) as e:
+            ScriptDag(self._confs(('a', []), (None, ['x'])))
+        self.assertIn('Configuration "#2" depends on an unknown id "x".', str(e.exception))
+
+    def test_cycle(self):
+        with self.assertRaises(SyntaxError) as e:
+            ScriptDag(self._confs(('a', ['c']), ('b', ['a']), ('c', ['b']), ('d', [])))
+        self.assertIn('Node "dependsOn" forms a cycle: a -> b -> c -> a.', str(e.exception))
+
+    def test_self_dependency(self):
+        with self.assertRaises(SyntaxError) as e:
+            ScriptDag(self._confs(('a', ['a']),))
+        self.assertIn('forms a cycle: a -> a.', str(e.exception))
+
+    def test_long_chain_has_no_cycle(self):
+        specs = [('n0', [])] + [('n%s' % i, ['n%s' % (i - 1)]) for i in range(1, 5000)]
+        self.assertEqual(5000, len(ScriptDag(self._confs(*specs)).nodes))
+
+    def test_runs_dependents_after_their_dependencies(self):
+        dag = ScriptDag(self._confs(('db', []), ('b', ['db']), ('c', ['db']), ('d', ['b', 'c'])))
+        order = []
+        lock = threading.Lock()
+
+        def run_node(conf):
+            with lock:
+                order.append(conf.id)
+
+        dag.run(run_node, 4, self.cancel_sampler)
+        self.assertEqual('db', order[0])
+        self.assertEqual({'b', 'c'}, set(order[1:3]))
+        self.assertEqual('d', order[3])
+        self.assertEqual(4, len(dag.get_nodes(DagNode.SUCCEEDED)))
+
+    def test_runs_ready_nodes_concurrently_up_to_the_limit(self):
+        dag = ScriptDag(self._confs(('a', []), ('b', []), ('c', []), ('d', ['a'])))
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def run_node(conf):
+            with lock:
+                running.append(conf.id)
+                max_running.append(len(running))
+            time.sleep(0.2)
+            with lock:
+                running.remove(conf.id)
+
+        dag.run(run_node, 2, self.cancel_sampler)
+        self.assertEqual(2, max(max_running))
+        self.assertEqual(4, len(dag.get_nodes(DagNode.SUCCEEDED)))
+
+    def test_failure_skips_the_dependents(self):
+        dag = ScriptDag(self._confs(('a', []), ('b', ['a']), ('c', ['b']), ('d', [])))
+
+        def run_node(conf):
+            if conf.id == 'a':
+                raise Exception('failed')
+
+        dag.run(run_node, 2, self.cancel_sampler)
+        self.assertEqual(['a'], [n.name for n in dag.get_nodes(DagNode.FAILED)])
+        self.assertEqual(['b', 'c'], [n.name for n in dag.get_nodes(DagNode.SKIPPED)])
+        self.assertEqual(['d'], [n.name for n in dag.get_nodes(DagNode.SUCCEEDED)])
+        summary = dag.format_summary()
+        self.assertIn('Failed: a (failed)', summary)
+        self.assertIn('Skipped (a dependency did not succeed): b, c', summary)
+
+    def test_cancellation_starts_no_new_node(self):
+        dag = ScriptDag(self._confs(('a', []), ('b', ['a'])))
+        self.cancel_sampler.throw = Mock(side_effect=CancellationException('cancelled'))
+        ran = []
+
+        def run_node(conf):
+            ran.append(conf.id)
+            self.cancel_sampler.is_cancelled.return_value = True
+
+        with self.assertRaises(CancellationException):
+            dag.run(run_node, 2, self.cancel_sampler)
+        self.assertEqual(['a'], ran)
+
+    def test_critical_path(self):
+        dag = ScriptDag(self._confs(('db', []), ('b', ['db']), ('c', ['db']), ('d', ['b', 'c']), ('e', [])))
+        seconds = {'db': 5, 'b': 1, 'c': 3, 'd': 2, 'e': 9}
+        for node in dag.nodes:
+            node.start_time = 100
+            node.end_time = 100 + seconds[node.name]
+        path, total = dag.critical_path()
+        self.assertEqual(['db', 'c', 'd'], [n.name for n in path])
+        self.assertEqual(10, total)
+        self.assertIn('Critical path (10.0 seconds): db (5.0s) -> c (3.0s) -> d (2.0s)', dag.format_summary())
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
 from cloudshell.cm.customscript.domain.script_executor import ExcutorConnectionError
@@ -8,6 +11,8 @@ from cloudshell.cm.customscript.domain.reservation_output_writer import Reservat
 from cloudshell.cm.customscript.domain.script_configuration import ScriptConfiguration
 from cloudshell.cm.customscript.domain.script_file import ScriptFile
 from cloudshell.cm.customscript.domain.script_downloader import ScriptDownloader, HttpAuth
+from cloudshell.cm.customscript.domain.download_cache import DownloadCache
+from cloudshell.cm.customscript.domain.resumable_download import ResumableDownload
 from cloudshell.cm.customscript.domain.script_configuration import ScriptRepository
 from tests.helpers import mocked_requests_get
 
@@ -119,4 +124,182 @@ class TestScriptDownloader(TestCase):
 
         # assert name and content
         #self.assertEqual(script_file.name, "bashScript.sh")
-        #self.assertEqual(script_file.text, "SomeBashScriptContent")
\ No newline at end of file
+        #self.assertEqual(script_file.text, "SomeBashScriptContent")
+
+    def test_validate_bundle(self):
+        script_downloader = ScriptDownloader(self.logger, self.cancel_sampler)
+        script_downloader._validate_bundle('b.zip', b'PK\x03\x04rest')
+        script_downloader._validate_bundle('b.tar.gz', b'\x1f\x8brest')
+        with self.assertRaises(Exception) as context:
+            script_downloader._validate_bundle('b.tgz', b'<!doctype html>')
+        self.assertIn('"b.tgz" is not a valid archive', str(context.exception))
+
+
+    def test_open_stream(self):
+        response = Mock()
+        response.headers = {'content-length': '8'}
+        response.iter_content = Mock(return_value=iter([b'echo', b'', b' hi']))
+        script_downloader = ScriptDownloader(self.logger, self.cancel_sampler)
+        script_downloader._get_response = Mock(return_value=(response, 'a.sh'))
+        script_file = script_downloader.open_stream('url', None, True)
+        self.assertEqual('a.sh', script_file.name)
+        self.assertEqual(8, script_file.size())
+        self.assertEqual(b'echo hi', b''.join(script_file.iter_content()))
+        response.close.assert_called_once()
+
+    def test_open_stream_validates_first_chunk(self):
+        response = Mock()
+        response.headers = {}
+        response.iter_content = Mock(return_value=iter([b'<!doctype html><html>']))
+        script_downloader = ScriptDownloader(self.logger, self.cancel_sampler)
+        script_downloader._get_response = Mock(return_value=(response, 'a.sh'))
+        with self.assertRaises(Exception) as context:
+            script_downloader.open_stream('url', None, True)
+        self.assertIn('url points to an html file', str(context.exception))
+
+    def test_open_stream_bundle(self):
+        response = Mock()
+        response.headers = {}
+        response.iter_content = Mock(return_value=iter([b'PK\x03\x04', b'rest']))
+        script_downloader = ScriptDownloader(self.logger, self.cancel_sampler)
+        script_downloader._get_response = Mock(return_value=(response, 'b.zip'))
+        bundle = script_downloader.open_stream('url', None, True)
+        self.assertEqual('b.zip', bundle.archive_name)
+        self.assertIsNone(bundle.size())
+        self.assertEqual(b'PK\x03\x04rest', b''.join(bundle.iter_content()))
+
+    def test_filename_from_the_headers(self):
+        script_downloader = ScriptDownloader(self.logger, self.cancel_sampler)
+        response = Mock()
+        response.url = 'https://repo.com/download?id=1'
+        response.headers = {'content-disposition': 'attachment; filename="a.sh"', 'x-artifactory-filename': 'b.sh'}
+        self.assertEqual('a.sh', script_downloader._get_filename(response))
+
+        response.headers = {'content-disposition': 'attachment', 'x-artifactory-filename': 'b.sh'}
+        self.assertEqual('b.sh', script_downloader._get_filename(response))
+
+        response.headers = {}
+        with self.assertRaises(Exception) as context:
+            script_downloader._get_filename(response)
+        self.assertIn('was not found', str(context.exception))
+
+
+class TestScriptDownloaderCache(TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+        self.cancel_sampler = Mock()
+        self.folder = tempfile.mkdtemp()
+        self.cache = DownloadCache(self.folder)
+        self.downloader = ScriptDownloader(self.logger, self.cancel_sampler, self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _response(self, status_code, content=b'', headers=None):
+        response = Mock()
+        response.status_code = status_code
+        response.headers = headers or {}
+        response.url = 'http://repo/a.sh'
+        response.iter_content = Mock(return_value=iter([content]))
+        return response
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_stores_a_response_with_validators(self, requests_get):
+        requests_get.return_value = self._response(200, b'echo 1', {'etag': '"e1"'})
+
+        self.downloader.download('http://repo/a.sh', None, True)
+
+        self.assertEqual('"e1"', self.cache.lookup('http://repo/a.sh').etag)
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_does_not_store_a_response_without_validators(self, requests_get):
+        requests_get.return_value = self._response(200, b'echo 1')
+
+        self.downloader.download('http://repo/a.sh', None, True)
+
+        self.assertIsNone(self.cache.lookup('http://repo/a.sh'))
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_not_modified_is_served_from_the_cache(self, requests_get):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        requests_get.return_value = self._response(304)
+
+        script_file = self.downloader.download('http://repo/a.sh', None, True)
+
+        self.assertEqual('a.sh', script_file.name)
+        self.assertEqual('echo 1', script_file.text)
+        self.assertEqual({'If-None-Match': '"e1"'}, requests_get.call_args[1]['headers'])
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_not_modified_bundle_is_served_from_the_cache(self, requests_get):
+        self.cache.store('http://repo/b.zip', 'b.zip', b'PK\x03\x04rest', etag='"e1"')
+        requests_get.return_value = self._response(304)
+
+        bundle = self.downloader.download('http://repo/b.zip', None, True)
+
+        self.assertEqual(b'PK\x03\x04rest', b''.join(bundle.iter_content()))
+        bundle.close()
+        self.assertTrue(bundle.data.closed)
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_invalid_cached_bundle_is_unmapped(self, requests_get):
+        self.cache.store('http://repo/b.zip', 'b.zip', b'not a zip', etag='"e1"')
+        requests_get.return_value = self._response(304)
+        mapped = []
+        read = self.cache.read
+        self.cache.read = lambda cached: mapped.append(read(cached)) or mapped[-1]
+
+        with self.assertRaises(Exception):
+            self.downloader.download('http://repo/b.zip', None, True)
+
+        self.assertTrue(mapped[0].closed)
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_modified_content_replaces_the_cached_one(self, requests_get):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        requests_get.return_value = self._response(200, b'echo 2', {'etag': '"e2"'})
+
+        script_file = self.downloader.download('http://repo/a.sh', None, True)
+
+        self.assertEqual('echo 2', script_file.text)
+        self.assertEqual('"e2"', self.cache.lookup('http://repo/a.sh').etag)
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_corrupted_cache_downloads_again(self, requests_get):
+        self.cache.store('http://repo/a.sh', 'a.sh', b'echo 1', etag='"e1"')
+        with open(self.cache._get_blob_path(self.cache.lookup('http://repo/a.sh').sha256), 'wb') as f:
+            f.write(b'echo X')
+        requests_get.side_effect = [self._response(304), self._response(200, b'echo 1', {'etag': '"e1"'})]
+
+        script_file = self.downloader.download('http://repo/a.sh', None, True)
+
+        self.assertEqual('echo 1', script_file.text)
+        self.assertNotIn('headers', requests_get.call_args[1])
+
+    @patch('cloudshell.cm.customscript.domain.script_downloader.requests.get')
+    def test_interrupted_download_is_kept_in_the_cache(self, requests_get):
+        response = self._response(200, headers={'etag': '"e1"', 'accept-ranges': 'bytes', 'content-length': '12'})
+        response.request.headers = {}
+        def iter_content(chunk_size):
+            yield b'echo'
+            raise IOError('reset')
+        response.iter_content = iter_content
+        requests_get.side_effect = IOError('unreachable')
+        self.downloader._get_response = Mock(return_value=(response, 'a.sh'))
+
+        with patch.object(ResumableDownload, 'RESUME_DELAY_SECONDS', 0):
+            with self.assertRaises(IOError):
+                self.downloader.download('http://repo/a.sh', None, True)
+
+        partial = self.cache.open_partial('http://repo/a.sh')
+        self.assertEqual(4, partial.load('"e1"'))
+        self.assertEqual(b'echo', b''.join(partial.iter_content(1024)))
+        partial.close()
+
+    def test_parallel_ranges_from_the_environment(self):
+        with patch.dict(os.environ, {ScriptDownloader.ENV_PARALLEL_RANGES: '4'}):
+            self.assertEqual(4, ScriptDownloader(self.logger, self.cancel_sampler).parallel_ranges)
+        with patch.dict(os.environ, {ScriptDownloader.ENV_PARALLEL_RANGES: 'x'}):
+            with self.assertRaises(ValueError):
+                ScriptDownloader(self.logger, self.cancel_sampler)
@@ -10,7 +10,7 @@ class TestScriptExecutorSelector(TestCase):
     def test_create_windows_script_executor(self):
         host_conf = HostConfiguration()
         host_conf.connection_method = 'winrm'
-        with patch('cloudshell.cm.customscript.domain.script_executor_selector.WindowsScriptExecutor') as win_ctor:
+        with patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor') as win_ctor:
             win_executor = Mock()
             win_ctor.return_value = win_executor
             result = ScriptExecutorSelector().get(host_conf, Mock(), Mock())
@@ -19,8 +19,22 @@ class TestScriptExecutorSelector(TestCase):
     def test_create_linux_script_executor(self):
         host_conf = HostConfiguration()
         host_conf.connection_method = 'ssh'
-        with patch('cloudshell.cm.customscript.domain.script_executor_selector.LinuxScriptExecutor') as linux_ctor:
+        with patch('cloudshell.cm.customscript.domain.linux_script_executor.LinuxScriptExecutor') as linux_ctor:
             linux_executor = Mock()
             linux_ctor.return_value = linux_executor
             result = ScriptExecutorSelector().get(host_conf, Mock(), Mock())
-            self.assertEqual(result, linux_executor)
\ No newline at end of file
+            self.assertEqual(result, linux_executor)
+
+    def test_unknown_connection_method_falls_back_to_windows(self):
+        host_conf = HostConfiguration()
+        host_conf.connection_method = 'something'
+        with patch('cloudshell.cm.customscript.domain.windows_script_executor.WindowsScriptExecutor') as win_ctor:
+            result = ScriptExecutorSelector().get(host_conf, Mock(), Mock())
+            self.assertEqual(result, win_ctor.return_value)
+
+    def test_register_executor(self):
+        ScriptExecutorSelector.register('mock', 'mock.Mock')
+        try:
+            self.assertEqual(Mock, ScriptExecutorSelector.get_class('mock'))
+        finally:
+            del ScriptExecutorSelector._executors['mock']
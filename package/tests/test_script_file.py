@@ -0,0 +1,97 @@
+import hashlib
+import mmap
+import tempfile
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
+
+
+class TestScriptFile(TestCase):
+
+    def test_script_file_sha256_and_size(self):
+        script_file = ScriptFile('a.sh', 'echo א')
+        self.assertEqual(hashlib.sha256('echo א'.encode('utf-8')).hexdigest(), script_file.sha256())
+        # in bytes: 'א' is 2 bytes in utf-8
+        self.assertEqual(7, script_file.size())
+        self.assertEqual(7, script_file.transferred_size())
+        self.assertEqual(6, ScriptFile('a.sh', 'echo 1').size())
+
+    def test_bundle_archive_type(self):
+        self.assertEqual(ScriptBundle.TAR_GZ, ScriptBundle('b.tar.gz', b'').archive_type)
+        self.assertEqual(ScriptBundle.TAR_GZ, ScriptBundle('B.TGZ', b'').archive_type)
+        self.assertEqual(ScriptBundle.ZIP, ScriptBundle('b.zip', b'').archive_type)
+        self.assertIsNone(ScriptBundle.get_archive_type('b.sh'))
+
+    def test_bundle_sha256_and_size(self):
+        bundle = ScriptBundle('b.zip', b'\x00\x01')
+        self.assertEqual(hashlib.sha256(b'\x00\x01').hexdigest(), bundle.sha256())
+        self.assertEqual(2, bundle.size())
+
+    def test_bundle_entry_point(self):
+        bundle = ScriptBundle('b.zip', b'')
+        bundle.set_entry_point('scripts\\install.ps1')
+        self.assertEqual('scripts/install.ps1', bundle.name)
+
+    def test_bundle_entry_point_is_required(self):
+        with self.assertRaises(Exception) as e:
+            ScriptBundle('b.zip', b'').set_entry_point(None)
+        self.assertIn('repositoryDetails.entryPoint', str(e.exception))
+
+    def test_bundle_entry_point_must_be_inside_the_archive(self):
+        for entry_point in ['/etc/run.sh', '../run.sh', 'a/../../run.sh']:
+            with self.assertRaises(Exception):
+                ScriptBundle('b.zip', b'').set_entry_point(entry_point)
+
+    def test_streamed_content(self):
+        script_file = ScriptFile('a.sh', stream=iter([b'echo ', b'hi']), stream_size=8)
+        self.assertTrue(script_file.is_streamed)
+        self.assertEqual(8, script_file.size())
+        self.assertIsNone(script_file.sha256())
+        self.assertEqual([b'echo ', b'hi'], list(script_file.iter_content()))
+        self.assertEqual(hashlib.sha256(b'echo hi').hexdigest(), script_file.sha256())
+
+    def test_transferred_size(self):
+        script_file = ScriptFile('a.sh', stream=iter([b'echo ', b'hi']))
+        self.assertEqual(0, script_file.transferred_size())
+        list(script_file.iter_content())
+        self.assertEqual(7, script_file.transferred_size())
+        self.assertEqual(5, ScriptFile('a.sh', 'abcde').transferred_size())
+
+    def test_streamed_content_can_be_read_once(self):
+        script_file = ScriptFile('a.sh', stream=iter([b'echo']))
+        list(script_file.iter_content())
+        with self.assertRaises(Exception):
+            list(script_file.iter_content())
+
+    def test_in_memory_content_chunks(self):
+        self.assertEqual([b'abc', b'de'], list(ScriptFile('a.sh', 'abcde').iter_content(3)))
+        self.assertEqual([b'ab', b'c'], list(ScriptBundle('b.zip', b'abc').iter_content(2)))
+
+    def test_close_stream(self):
+        stream = Mock()
+        ScriptFile('a.sh', stream=stream).close()
+        stream.close.assert_called_once()
+
+    def test_close_unmaps_a_mapped_bundle(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'PK\x03\x04rest')
+            f.flush()
+            bundle = ScriptBundle('b.zip', mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self.assertEqual(b'PK\x03\x04rest', b''.join(bundle.iter_content()))
+        bundle.close()
+        self.assertTrue(bundle.data.closed)
+
+    def test_close_of_a_bundle_still_being_read(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'x' * 10)
+            f.flush()
+            bundle = ScriptBundle('b.zip', mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        chunks = bundle.iter_content(chunk_size=4)
+        next(chunks)
+        bundle.close()
+        self.assertFalse(bundle.data.closed)
+        chunks.close()
+        bundle.close()
+        self.assertTrue(bundle.data.closed)
@@ -0,0 +1,112 @@
+import threading
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.ssh_connection_pool import SshConnectionPool
+
+
+class TestSshConnectionPool(TestCase):
+
+    def setUp(self):
+        self.pool = SshConnectionPool()
+        self.clients = []
+
+    def _connect(self):
+        client = Mock()
+        client.get_transport.return_value.is_active.return_value = True
+        self.clients.append(client)
+        return client
+
+    def test_same_key_shares_the_connection(self):
+        lease1 = self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        lease2 = self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        self.assertIs(lease1.client, lease2.client)
+        self.assertEqual(1, len(self.clients))
+
+    def test_other_key_gets_another_connection(self):
+        lease1 = self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        lease2 = self.pool.acquire(('h', 'u', 'other'), 10, self._connect)
+        self.assertIsNot(lease1.client, lease2.client)
+
+    def test_max_sessions_limits_the_executors_per_connection(self):
+        leases = [self.pool.acquire(('h', 'u', 'c'), 4, self._connect) for _ in range(5)]  # 2 per connection
+        self.assertEqual(3, len(self.clients))
+        self.assertEqual(3, self.pool.connections_count(('h', 'u', 'c')))
+        self.assertIs(leases[0].client, leases[1].client)
+        self.assertIsNot(leases[1].client, leases[2].client)
+
+    def test_last_release_closes_the_connection(self):
+        lease1 = self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        lease2 = self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        lease1.release()
+        lease1.release()  # released once
+        self.clients[0].close.assert_not_called()
+        lease2.release()
+        self.clients[0].close.assert_called_once()
+        self.assertEqual(0, self.pool.connections_count(('h', 'u', 'c')))
+
+    def test_inactive_connection_is_not_leased(self):
+        self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        self.clients[0].get_transport.return_value.is_active.return_value = False
+        lease = self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        self.assertIs(self.clients[1], lease.client)
+
+    def test_failed_connect_is_not_kept(self):
+        with self.assertRaises(ValueError):
+            self.pool.acquire(('h', 'u', 'c'), 10, Mock(side_effect=ValueError('refused')))
+        self.assertEqual(0, self.pool.connections_count(('h', 'u', 'c')))
+        self.pool.acquire(('h', 'u', 'c'), 10, self._connect)
+        self.assertEqual(1, len(self.clients))
+
+    def test_concurrent_executors_wait_for_the_connection_being_created(self):
+        connecting = threading.Event()
+        proceed = threading.Event()
+
+        def slow_connect():
+            connecting.set()
+            proceed.wait(10)
+            return self._connect()
+
+        leases = []
+        first = threading.Thread(target=lambda: leases.append(self.pool.acquire(('h', 'u', 'c'), 10, slow_connect)))
+        first.start()
+        connecting.wait(10)
+        second = threading.Thread(target=lambda: leases.append(self.pool.acquire(('h', 'u', 'c'), 10, self._connect)))
+        second.start()
+        proceed.set()
+        first.join(10)
+        second.join(10)
+        self.assertEqual(1, len(self.clients))
+        self.assertIs(leases[0].client, leases[1].client)
+
+    def test_concurrent_executors_fail_with_the_connection_being_created(self):
+        connecting = threading.Event()
+        proceed = threading.Event()
+
+        def failing_connect():
+            connecting.set()
+            proceed.wait(10)
+            raise ValueError('refused')
+
+        errors = []
+
+        def acquire(connect):
+            try:
+                self.pool.acquire(('h', 'u', 'c'), 10, connect)
+            except ValueError as e:
+                errors.append(e)
+
+        first = threading.Thread(target=acquire, args=(failing_connect,))
+        first.start()
+        connecting.wait(10)
+        second = threading.Thread(target=acquire, args=(self._connect,))
+        second.start()
+        proceed.set()
+        first.join(10)
+        second.join(10)
+        self.assertEqual(2, len(errors))
+        self.assertEqual(0, len(self.clients))
+
+    def test_default_is_shared(self):
+        self.assertIs(SshConnectionPool.get_default(), SshConnectionPool.get_default())
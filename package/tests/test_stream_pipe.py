@@ -0,0 +1,79 @@
+import threading
+import time
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.cancellation_sampler import CancellationException
+from cloudshell.cm.customscript.domain.stream_pipe import StreamPipe
+
+
+class TestStreamPipe(TestCase):
+
+    def setUp(self):
+        self.cancel_sampler = Mock()
+        self.cancel_sampler.throw_if_canceled = Mock()
+
+    def test_passes_all_chunks_in_order(self):
+        pipe = StreamPipe(iter([b'a', b'', b'b', b'c']), self.cancel_sampler)
+        self.assertEqual([b'a', b'b', b'c'], list(pipe))
+
+    def test_buffer_is_bounded(self):
+        produced = []
+
+        def source():
+            for i in range(100):
+                produced.append(i)
+                yield b'x'
+
+        pipe = StreamPipe(source(), self.cancel_sampler, max_chunks=2)
+        time.sleep(0.2)
+        self.assertLessEqual(len(produced), 3)  # 2 queued + 1 waiting to be queued
+        self.assertEqual(100, len(list(pipe)))
+
+    def test_producer_error_is_raised_to_consumer(self):
+        def source():
+            yield b'a'
+            raise ValueError('connection reset')
+
+        pipe = StreamPipe(source(), self.cancel_sampler)
+        with self.assertRaises(ValueError):
+            list(pipe)
+
+    def test_cancellation_is_raised_to_consumer(self):
+        self.cancel_sampler.throw_if_canceled.side_effect = Exception('Command was cancelled')
+        pipe = StreamPipe(iter([b'a']), self.cancel_sampler)
+        with self.assertRaises(Exception) as e:
+            list(pipe)
+        self.assertEqual('Command was cancelled', str(e.exception))
+
+    def test_on_close_is_called_once(self):
+        on_close = Mock()
+        pipe = StreamPipe(iter([b'a']), self.cancel_sampler, on_close=on_close)
+        list(pipe)
+        pipe.close()
+        on_close.assert_called_once()
+
+    def test_close_releases_a_blocked_producer(self):
+        pipe = StreamPipe(iter([b'x'] * 100), self.cancel_sampler, max_chunks=1)
+        pipe.close()
+        pipe._thread.join(2)
+        self.assertFalse(pipe._thread.is_alive())
+
+    def test_cancellation_stops_a_consumer_waiting_for_a_stalled_source(self):
+        stalled = threading.Event()
+
+        def source():
+            yield b'a'
+            stalled.wait(5)
+            yield b'b'
+
+        pipe = StreamPipe(source(), self.cancel_sampler)
+        chunks = iter(pipe)
+        self.assertEqual(b'a', next(chunks))
+        self.cancel_sampler.throw_if_canceled.side_effect = CancellationException('cancelled', None)
+        try:
+            with self.assertRaises(CancellationException):
+                next(chunks)
+        finally:
+            stalled.set()
@@ -1,9 +1,12 @@
+import base64
+import threading
 from unittest import TestCase
 from mock import patch, Mock
 
-from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration
+from cloudshell.cm.customscript.domain.script_configuration import HostConfiguration, ScriptCacheConfiguration, \
+    UploadConfiguration
 from cloudshell.cm.customscript.domain.script_executor import ErrorMsg
-from cloudshell.cm.customscript.domain.script_file import ScriptFile
+from cloudshell.cm.customscript.domain.script_file import ScriptFile, ScriptBundle
 from cloudshell.cm.customscript.domain.windows_script_executor import WindowsScriptExecutor
 from tests.helpers import Any
 
@@ -42,6 +45,9 @@ class TestWindowsScriptExecutor(TestCase):
         WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
         self.session_ctor.assert_called_with('1.2.3.4', auth=('admin', '1234'), transport='ssl', server_cert_validation='ignore')
 
+    def test_is_multiplexed(self):
+        self.assertTrue(WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler).is_multiplexed())
+
     # Create temp folder
 
     def test_create_temp_folder_success(self):
@@ -103,6 +109,20 @@ class TestWindowsScriptExecutor(TestCase):
         output_writer.write.assert_any_call(b'some output')
         output_writer.write.assert_any_call('some error')
 
+    def test_run_script_records_the_exit_code(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.script_result = Mock()
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+        executor.script_result.set_exit_code.assert_called_once_with(0)
+
+    def test_run_script_records_the_output(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.script_result = Mock()
+        self.session.protocol.get_command_output = Mock(return_value=(b'some output', b'', 0))
+        executor.run_script('tmp123', ScriptFile('script1', 'some script code'), {}, Mock())
+        executor.script_result.add_output.assert_called_once_with(b'some output', '')
+
     def test_run_script_fail_with_xml_error(self):
         executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
         output_writer = Mock()
@@ -166,6 +186,21 @@ class TestWindowsScriptExecutor(TestCase):
         executor.run_script.assert_called_with(create_temp_folder_result, script_file, {}, output_writer, True)
         executor.delete_temp_folder.assert_called_with(create_temp_folder_result)
 
+    def test_execute_detached(self):
+        self.host.execution.detached = True
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        output_writer = Mock()
+        executor.create_temp_folder = Mock(return_value='folder')
+        executor.copy_script = Mock()
+        executor.run_script = Mock()
+        executor.run_script_detached = Mock()
+        executor.delete_temp_folder = Mock()
+        script_file = ScriptFile('script1', 'some script code')
+        executor.execute(script_file, env_vars={}, output_writer=output_writer)
+        executor.run_script_detached.assert_called_with('folder', script_file, {}, output_writer, True)
+        executor.run_script.assert_not_called()
+        executor.delete_temp_folder.assert_called_with('folder')
+
     def test_execute_error_on_create_temp_folder_exits_before_executing_script(self):
         executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
         output_writer = Mock()
@@ -238,3 +273,295 @@ class TestWindowsScriptExecutor(TestCase):
         executor.run_script.assert_called_with(create_temp_folder_result, script_file, {}, output_writer, True)
         executor.delete_temp_folder.assert_called_with(create_temp_folder_result)
         self.logger.error.assert_called_with(f'Failed to delete temp folder "{create_temp_folder_result}" from target machine: error message')
+
+
+    # remote script cache
+
+    def test_copy_script_from_cache_hit(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'hit\r\n', b'', 0))
+        self.assertTrue(executor.copy_script_from_cache(ScriptCacheConfiguration('c:\\cache'), 'tmp123', ScriptFile('script1', 'code')))
+
+    def test_copy_script_from_cache_miss(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        self.assertFalse(executor.copy_script_from_cache(ScriptCacheConfiguration(), 'tmp123', ScriptFile('script1', 'code')))
+
+    def test_store_script_in_cache_failure_is_only_logged(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'some error', 1))
+        executor.store_script_in_cache(ScriptCacheConfiguration(), 'tmp123', ScriptFile('script1', 'code'))
+        self.logger.warning.assert_called_once()
+
+    def test_store_script_in_cache_evicts_by_age_in_minutes(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run_cancelable = Mock(return_value=Mock(status_code=0))
+        executor.store_script_in_cache(ScriptCacheConfiguration('c:\\cache', 1, 0.5), 'tmp123', ScriptFile('script1', 'code'))
+        self.assertIn('if (720 -gt 0)', executor._run_cancelable.call_args[0][0])
+        executor.store_script_in_cache(ScriptCacheConfiguration('c:\\cache', 1, 0.0001), 'tmp123', ScriptFile('script1', 'code'))
+        self.assertIn('(Get-Date).AddMinutes(-1)', executor._run_cancelable.call_args[0][0])
+        executor.store_script_in_cache(ScriptCacheConfiguration('c:\\cache', 1, 0), 'tmp123', ScriptFile('script1', 'code'))
+        self.assertIn('if (0 -gt 0)', executor._run_cancelable.call_args[0][0])
+
+    def test_execute_with_cache_hit_skips_copy(self):
+        self.host.script_cache = ScriptCacheConfiguration()
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.create_temp_folder = Mock(return_value='folder')
+        executor.copy_script_from_cache = Mock(return_value=True)
+        executor.copy_script = Mock()
+        executor.store_script_in_cache = Mock()
+        executor.run_script = Mock()
+        executor.delete_temp_folder = Mock()
+        executor.execute(ScriptFile('script1', 'some script code'), env_vars={}, output_writer=Mock())
+        executor.copy_script.assert_not_called()
+        executor.store_script_in_cache.assert_not_called()
+        executor.run_script.assert_called_once()
+
+
+    # script bundles
+
+    def test_copy_zip_bundle_uses_expand_archive(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        executor._run_cancelable = Mock(wraps=executor._run_cancelable)
+        executor.copy_bundle('tmp123', ScriptBundle('b.zip', b'x' * 2500))
+        codes = [c[0][0] for c in executor._run_cancelable.call_args_list]
+        self.assertEqual(3, len(codes))  # 2 bulks + extraction
+        self.assertIn('Expand-Archive', codes[-1])
+
+    def test_copy_tar_gz_bundle_uses_tar(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        executor._run_cancelable = Mock(wraps=executor._run_cancelable)
+        executor.copy_bundle('tmp123', ScriptBundle('b.tar.gz', b'x'))
+        self.assertIn('tar.exe -xzf', executor._run_cancelable.call_args[0][0])
+
+    def test_copy_bundle_fail(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'some error', 1))
+        with self.assertRaises(Exception) as e:
+            executor.copy_bundle('tmp123', ScriptBundle('b.zip', b''))
+        self.assertEqual(ErrorMsg.COPY_SCRIPT % 'some error', str(e.exception))
+
+
+    # pipe mode
+
+    def test_copy_streamed_script_in_bulks(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'',b'',0))
+        stream = iter([b'a' * 1500, b'a' * 1500, b'a' * 1500])
+        executor.copy_script('tmp123', ScriptFile('script1', stream=stream)) # 3 bulks: 2000,2000,500
+        self.assertEqual(3, self.session.protocol.get_command_output.call_count)
+
+    # parallel upload
+
+    def _decode_commands(self):
+        return [base64.b64decode(c[0][1].split(' ')[-1]).decode('utf_16_le')
+                for c in self.session.protocol.run_command.call_args_list]
+
+    def test_copy_large_script_in_parallel_parts(self):
+        self.host.upload = UploadConfiguration(parallel_shells=3)
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.PARALLEL_PART_MIN_SIZE = 4000
+        executor._get_host_shell_limit = Mock(return_value=None)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        script_file = ScriptFile('script1', 'a' * 12000)
+        executor.copy_script('tmp123', script_file)  # 3 parts of 2 bulks: 2000,2000 + the join
+        commands = self._decode_commands()
+        self.assertEqual(7, len(commands))
+        for i in range(3):
+            self.assertEqual(2, len([c for c in commands if '"script1.part%s"' % i in c]))
+        self.assertIn('foreach ($i in 0..2)', commands[-1])
+        self.assertIn('if ($hash -ne "%s")' % script_file.sha256(), commands[-1])
+        self.session_ctor.assert_called_with('1.2.3.4', auth=('admin', '1234'), transport='ssl',
+                                             server_cert_validation='ignore')
+
+    def test_copy_parallel_part_fail(self):
+        self.host.upload = UploadConfiguration(parallel_shells=2)
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.PARALLEL_PART_MIN_SIZE = 2000
+        executor._get_host_shell_limit = Mock(return_value=None)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'some error', 1))
+        with self.assertRaises(Exception) as e:
+            executor.copy_script('tmp123', ScriptFile('script1', 'a' * 8000))
+        self.assertEqual(ErrorMsg.COPY_SCRIPT % 'some error', str(e.exception))
+        self.assertFalse(any('foreach ($i in' in c for c in self._decode_commands()))
+
+    def test_parallel_parts(self):
+        self.host.upload = UploadConfiguration(parallel_shells=8)
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.PARALLEL_PART_MIN_SIZE = 1000
+        executor._get_host_shell_limit = Mock(return_value=None)
+        self.assertEqual(1, executor._get_parallel_parts(ScriptFile('s', 'a' * 1999)))
+        self.assertEqual(5, executor._get_parallel_parts(ScriptFile('s', 'a' * 5500)))
+        # sized in bytes: 2750 characters of 2 bytes each
+        self.assertEqual(5, executor._get_parallel_parts(ScriptFile('s', 'א' * 2750)))
+        self.assertEqual(8, executor._get_parallel_parts(ScriptFile('s', 'a' * 50000)))
+        self.assertEqual(1, executor._get_parallel_parts(ScriptFile('s', stream=iter([b'a' * 50000]))))
+        executor._get_host_shell_limit = Mock(return_value=4)
+        self.assertEqual(3, executor._get_parallel_parts(ScriptFile('s', 'a' * 50000)))
+
+    def test_parallel_parts_off_by_default(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._get_host_shell_limit = Mock()
+        self.assertEqual(1, executor._get_parallel_parts(ScriptFile('s', 'a' * 10 * 1024 * 1024)))
+        executor._get_host_shell_limit.assert_not_called()
+
+    def test_host_shell_limit_is_read_once(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run_cancelable = Mock(return_value=Mock(status_code=0, std_out=b'30\r\n25\r\n'))
+        self.assertEqual(25, executor._get_host_shell_limit())
+        self.assertEqual(25, executor._get_host_shell_limit())
+        executor._run_cancelable.assert_called_once()
+
+    def test_host_shell_limit_unreadable(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run_cancelable = Mock(return_value=Mock(status_code=0, std_out=b'\r\n', std_err=''))
+        self.assertIsNone(executor._get_host_shell_limit())
+
+    def test_to_bulks(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.assertEqual([b'abc', b'def', b'g'], list(executor._to_bulks(iter([b'ab', b'cdefg']), 3)))
+
+    # detached
+
+    def test_launch_detached(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._copy_data = Mock()
+        self.session.protocol.get_command_output = Mock(return_value=(b'4321\r\n', b'', 0))
+        pid = executor.launch_detached('tmp123', ScriptFile('script1.ps1', 'code'), {'a': 'b'})
+        self.assertEqual('4321', pid)
+        launcher = b''.join(executor._copy_data.call_args[0][2]).decode('utf-8-sig')
+        self.assertEqual('$env:a = "b"\n& (Join-Path $PSScriptRoot \'script1.ps1\')\nexit $LASTEXITCODE\n', launcher)
+        executor._copy_data.assert_called_with('tmp123', '.cs_run.ps1', Any())
+
+    def test_launch_detached_fail(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._copy_data = Mock()
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'some error', 1))
+        with self.assertRaises(Exception) as e:
+            executor.launch_detached('tmp123', ScriptFile('script1.ps1', 'code'), {})
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % 'some error', str(e.exception))
+
+    def test_poll_detached(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'1|b3V0|ZXJy\r\n', b'', 0))
+        result = executor.poll_detached('tmp123', 0, 0, 100)
+        self.assertEqual(1, result.exit_code)
+        self.assertEqual(b'out', result.std_out)
+        self.assertEqual(b'err', result.std_err)
+
+    def test_poll_detached_running(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.session.protocol.get_command_output = Mock(return_value=(b'||\r\n', b'', 0))
+        result = executor.poll_detached('tmp123', 0, 0, 100)
+        self.assertIsNone(result.exit_code)
+        self.assertEqual(b'', result.std_out)
+
+    def test_kill_script(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run = Mock(return_value=Mock(status_code=0))
+        executor.kill_script('tmp123')
+        code = executor._run.call_args[0][1]
+        self.assertIn('$pidFile = Join-Path "tmp123" ".cs_pid"', code)
+        self.assertIn('taskkill.exe /PID (Get-Content $pidFile -Raw).Trim() /T /F', code)
+
+    def test_kill_script_when_cancelled(self):
+        self.cancel_sampler.is_cancelled = Mock(return_value=True)
+        self.cancel_sampler.throw = Mock(side_effect=Exception('cancelled'))
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.kill_script('tmp123')
+        code = base64.b64decode(self.session.protocol.run_command.call_args[0][1].split(' ')[-1]).decode('utf_16_le')
+        self.assertIn('taskkill.exe /PID (Get-Content $pidFile -Raw).Trim() /T /F', code)
+
+    def test_has_result_marker(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run_cancelable = Mock(return_value=Mock(status_code=0, std_out=b'hit\r\n'))
+        self.assertTrue(executor.has_result_marker('key123'))
+        self.assertIn('Test-Path (Join-Path "$env:LOCALAPPDATA\\CloudShell\\ScriptResults" "key123")',
+                      executor._run_cancelable.call_args[0][0])
+
+    def test_has_no_result_marker(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run_cancelable = Mock(return_value=Mock(status_code=0, std_out=b''))
+        self.assertFalse(executor.has_result_marker('key123'))
+
+    def test_write_result_marker(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor._run_cancelable = Mock(return_value=Mock(status_code=0))
+        executor.write_result_marker('key123')
+        code = executor._run_cancelable.call_args[0][0]
+        self.assertIn('Set-Content -Path (Join-Path $folder "key123") -Value ""', code)
+        self.assertIn('(Get-Date).AddDays(-30)', code)
+
+    def test_run_cancelable_deadline_closes_the_shell(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        finished = threading.Event()
+        self.session.protocol.get_command_output = Mock(side_effect=lambda **kwargs: finished.wait(10))
+        self.session.protocol.close_shell = Mock(side_effect=lambda shell_id: finished.set())
+        with self.assertRaises(Exception) as e:
+            executor._run_cancelable('Start-Sleep 1000', deadline_minutes=0.0001)
+        self.assertEqual(ErrorMsg.RUN_SCRIPT % (ErrorMsg.DEADLINE_EXCEEDED % 0.0001), str(e.exception))
+        self.session.protocol.close_shell.assert_called_once()
+
+    # workspace
+
+    def _workspace_executor(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        executor.create_temp_folder = Mock(return_value='C:\\ws')
+        executor.open_workspace()
+        return executor
+
+    def test_execute_in_workspace_uses_subfolders_without_creating_or_deleting_them(self):
+        executor = self._workspace_executor()
+        executor.copy_script = Mock()
+        executor.run_script = Mock()
+        executor.delete_temp_folder = Mock()
+        script_file = ScriptFile('script1', 'code')
+        output_writer = Mock()
+        executor.execute(script_file, env_vars={}, output_writer=output_writer)
+        executor.execute(script_file, env_vars={}, output_writer=output_writer)
+        executor.create_temp_folder.assert_called_once()
+        executor.copy_script.assert_called_with('C:\\ws\\2', script_file)
+        executor.run_script.assert_called_with('C:\\ws\\2', script_file, {}, output_writer, True)
+        executor.delete_temp_folder.assert_not_called()
+
+    def test_every_upload_command_creates_the_workspace_folder(self):
+        self.host.upload = UploadConfiguration(parallel_shells=2)
+        self.cancel_sampler.is_cancelled = Mock(return_value=False)
+        executor = self._workspace_executor()
+        executor.PARALLEL_PART_MIN_SIZE = 2000
+        executor._get_host_shell_limit = Mock(return_value=None)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        tmp_folder = executor._new_workspace_folder()
+        executor.copy_script(tmp_folder, ScriptFile('script1', 'a' * 4000))  # 2 parts of 1 bulk + the join
+        commands = self._decode_commands()
+        self.assertEqual(3, len(commands))
+        for command in commands[:2]:
+            self.assertIn('[System.IO.Directory]::CreateDirectory("C:\\ws\\1") | Out-Null', command)
+
+    def test_upload_outside_a_workspace_does_not_create_the_folder(self):
+        executor = WindowsScriptExecutor(self.logger, self.host, self.cancel_sampler)
+        self.assertEqual('', executor._get_create_folder_code('tmp123'))
+
+    def test_close_workspace_deletes_it_once_even_when_cancelled(self):
+        executor = self._workspace_executor()
+        self.cancel_sampler.is_cancelled = Mock(return_value=True)
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'', 0))
+        executor.close_workspace()
+        executor.close_workspace()
+        commands = self._decode_commands()
+        self.assertEqual(1, len(commands))
+        self.assertIn('Remove-Item "C:\\ws" -Recurse -Force', commands[0])
+        self.assertIsNone(executor.workspace)
+
+    def test_close_workspace_failure_is_logged(self):
+        executor = self._workspace_executor()
+        self.session.protocol.get_command_output = Mock(return_value=(b'', b'denied', 1))
+        executor.close_workspace()
+        self.logger.error.assert_called_with(
+            'Failed to delete workspace "C:\\ws" from target machine: %s' % (ErrorMsg.DELETE_TEMP_FOLDER % 'denied'))
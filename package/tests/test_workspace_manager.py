@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from mock import Mock
+
+from cloudshell.cm.customscript.domain.workspace_manager import WorkspaceManager
+
+
+class TestWorkspaceManager(TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+        self.manager = WorkspaceManager(self.logger)
+
+    def test_close_deletes_every_opened_workspace_once(self):
+        services = [Mock(), Mock()]
+        for service in services:
+            self.manager.open(service)
+        self.manager.close()
+        self.manager.close()
+        for service in services:
+            service.open_workspace.assert_called_once()
+            service.close_workspace.assert_called_once()
+
+    def test_workspace_that_failed_to_open_is_not_deleted(self):
+        service = Mock()
+        service.open_workspace.side_effect = Exception('disk full')
+        with self.assertRaises(Exception):
+            self.manager.open(service)
+        self.manager.close()
+        service.close_workspace.assert_not_called()
+
+    def test_close_failure_does_not_stop_the_other_hosts(self):
+        services = [Mock(), Mock()]
+        services[0].close_workspace.side_effect = Exception('host is gone')
+        for service in services:
+            self.manager.open(service)
+        self.manager.close()
+        services[1].close_workspace.assert_called_once()
+        self.logger.error.assert_called_once()
+
+    def test_release_deletes_one_workspace(self):
+        services = [Mock(), Mock()]
+        for service in services:
+            self.manager.open(service)
+        self.manager.release(services[0])
+        services[0].close_workspace.assert_called_once()
+        services[1].close_workspace.assert_not_called()
+        self.manager.close()
+        services[0].close_workspace.assert_called_once()
+        services[1].close_workspace.assert_called_once()